@@ -0,0 +1,207 @@
+"""
+Exports and imports the stored chat history.
+
+Exports are newline-delimited JSON, one message per line with its chat id:
+
+    {"chat_id": -100123, "message_id": 42, "content": "...", "owner_id": 7, "owner_name": "Alice", "created_at": "..."}
+
+Chats are found with SCAN and read in LRANGE chunks, and every record is written
+as soon as it is read, so exporting every chat takes as little memory as one chunk.
+Each chat is exported newest first, the order it's stored in.
+The archive can be exported in the same format, see export_archived_chats.
+
+Imports take either an export, or the result.json of a Telegram Desktop chat export,
+and store it in pipelined batches, so a new group can be seeded with its history.
+"""
+import json
+import logging
+from dataclasses import asdict
+from datetime import datetime, timezone
+from typing import IO, Iterable, Iterator, Optional
+
+from redis import Redis
+
+from message_archive import SegmentReader
+from message_storage import Message, get_all_chat_ids, iter_chat_messages, store_history, revise_messages
+from summary_cache import invalidate_cached_summaries
+
+logger = logging.getLogger(__name__)
+
+IMPORT_BATCH_SIZE = 500
+
+# Telegram Desktop exports the bare id, the Bot API prefixes it by chat type
+_SUPERGROUP_CHAT_TYPES = {"private_supergroup", "public_supergroup", "private_channel", "public_channel"}
+_GROUP_CHAT_TYPES = {"private_group"}
+
+
+def export_chats(redis_client: Redis,
+                 output: IO[str],
+                 chat_ids: Optional[Iterable[int]] = None,
+                 chunk_size: int = 100) -> int:
+    """
+    Writes the stored messages of the chats as newline-delimited JSON.
+    @param redis_client: The Redis client singleton
+    @param output: where the records are written
+    @param chat_ids: the chats to export, every chat by default
+    @param chunk_size: how many messages each LRANGE reads
+    @return: how many messages were exported
+    """
+    if chat_ids is None:
+        chat_ids = sorted(get_all_chat_ids(redis_client))
+
+    exported = 0
+    for chat_id in chat_ids:
+        for message in iter_chat_messages(redis_client, chat_id, chunk_size):
+            output.write(json.dumps({'chat_id': chat_id, **asdict(message)}, ensure_ascii=False) + '\n')
+            exported += 1
+        logger.debug(f"Exported chat id: {chat_id}")
+
+    return exported
+
+
+def export_archived_chats(redis_client: Redis,
+                          reader: SegmentReader,
+                          output: IO[str],
+                          chat_ids: Optional[Iterable[int]] = None,
+                          start_day: Optional[str] = None,
+                          end_day: Optional[str] = None) -> int:
+    """
+    Writes the archived messages of the chats as newline-delimited JSON, with their edits applied.
+    The segments are read a day at a time, so the export takes as little memory as one day of a chat.
+    @param redis_client: The Redis client singleton, for the edits
+    @param reader: reads the archive
+    @param output: where the records are written
+    @param chat_ids: the chats to export, every archived chat by default
+    @param start_day: the first day exported, e.g. 2024-05-14, the oldest by default
+    @param end_day: the last day exported, the newest by default
+    @return: how many messages were exported
+    """
+    if chat_ids is None:
+        chat_ids = reader.chat_ids()
+
+    exported = 0
+    for chat_id in chat_ids:
+        archived_messages = reader.read_messages(chat_id, start_day, end_day)
+        for message in revise_messages(redis_client, chat_id, archived_messages):
+            output.write(json.dumps({'chat_id': chat_id, **asdict(message)}, ensure_ascii=False) + '\n')
+            exported += 1
+        logger.debug(f"Exported the archive of chat id: {chat_id}")
+
+    return exported
+
+
+def read_export(lines: Iterable[str]) -> Iterator[tuple[int, Message]]:
+    """
+    Reads the records of an export.
+    @param lines: the lines of the export
+    @return: the chat id and message of each record
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        chat_id = record.pop('chat_id')
+        yield chat_id, Message(**record)
+
+
+def read_telegram_desktop_export(export: dict, chat_id: Optional[int] = None) -> tuple[int, list[Message]]:
+    """
+    Reads the result.json of a Telegram Desktop chat export (Export chat history, JSON format).
+    Service messages, e.g. joins and pins, and messages without text are skipped.
+    @param export: the parsed result.json
+    @param chat_id: the chat the history belongs to, derived from the export by default
+    @return: the chat id and the messages, oldest first
+    """
+    if chat_id is None:
+        chat_id = _bot_api_chat_id(export)
+
+    messages = []
+    for record in export.get('messages', []):
+        if record.get('type') != 'message':
+            continue
+
+        content = _plain_text(record.get('text', ''))
+        if not content:
+            continue
+
+        messages.append(Message(
+            message_id=int(record['id']),
+            content=content,
+            owner_id=_user_id(record.get('from_id')),
+            owner_name=record.get('from') or "Deleted Account",
+            created_at=_created_at(record),
+            reply_to_message_id=record.get('reply_to_message_id')
+        ))
+
+    return chat_id, messages
+
+
+def import_messages(redis_client: Redis,
+                    records: Iterable[tuple[int, Message]],
+                    batch_size: int = IMPORT_BATCH_SIZE) -> int:
+    """
+    Stores imported messages in pipelined batches, as the records are read,
+    so an import takes as little memory as one batch per chat.
+    The chats can be interleaved, but each chat's records must be newest first, the order they're exported in.
+    @param redis_client: The Redis client singleton
+    @param records: the chat id and message of each record
+    @param batch_size: how many messages each pipeline stores
+    @return: how many messages were stored in the chats' windows
+    """
+    batches: dict[int, list[Message]] = {}
+    imported: dict[int, int] = {}
+    stored = 0
+    for chat_id, message in records:
+        batch = batches.setdefault(chat_id, [])
+        batch.append(message)
+        if len(batch) >= batch_size:
+            stored += _import_batch(redis_client, chat_id, batches.pop(chat_id), imported)
+
+    for chat_id, batch in batches.items():
+        stored += _import_batch(redis_client, chat_id, batch, imported)
+
+    for chat_id, count in imported.items():
+        invalidate_cached_summaries(redis_client, chat_id)
+        logger.info(f"Imported {count} messages into chat id: {chat_id}")
+
+    return stored
+
+
+def _import_batch(redis_client: Redis, chat_id: int, batch: list[Message], imported: dict[int, int]) -> int:
+    # Records with the same timestamp can be out of order within a batch
+    batch.sort(key=lambda message: message.message_id, reverse=True)
+    imported[chat_id] = imported.get(chat_id, 0) + len(batch)
+    return store_history(redis_client, chat_id, batch)
+
+
+def _bot_api_chat_id(export: dict) -> int:
+    if 'id' not in export:
+        raise ValueError("The export doesn't say which chat it is, pass the chat id")
+
+    bare_id = int(export['id'])
+    chat_type = export.get('type')
+    if chat_type in _SUPERGROUP_CHAT_TYPES:
+        return int(f"-100{bare_id}")
+    if chat_type in _GROUP_CHAT_TYPES:
+        return -bare_id
+    return bare_id
+
+
+def _plain_text(text) -> str:
+    # Formatted messages are a list of plain strings and entities, e.g. {"type": "bold", "text": "..."}
+    if isinstance(text, list):
+        return ''.join(part if isinstance(part, str) else part.get('text', '') for part in text)
+    return text
+
+
+def _user_id(from_id: Optional[str]) -> int:
+    # e.g. "user123456", or "channel123456" for anonymous admins
+    digits = ''.join(char for char in (from_id or '') if char.isdigit())
+    return int(digits) if digits else 0
+
+
+def _created_at(record: dict) -> str:
+    # "date" is in the local time of whoever exported the chat, "date_unixtime" is unambiguous
+    if 'date_unixtime' in record:
+        return datetime.fromtimestamp(int(record['date_unixtime']), tz=timezone.utc).isoformat()
+    return record['date']
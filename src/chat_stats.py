@@ -0,0 +1,177 @@
+"""
+Per-chat activity statistics, in constant memory.
+
+Every stored message updates a few counters under the chat's {chat:<id>} hash tag:
+
+    stats:hour:<hour>     how many messages were posted in that hour, expires after the retention
+    stats:users:<day>     a HyperLogLog of the users who posted that day (UTC), expires after the retention
+    stats:posters         sorted set of user id -> messages posted, capped at STATS_MAX_POSTERS
+    stats:names           user id -> name, for the posters in the sorted set
+
+So however busy a chat is, its stats take a bounded amount of memory, and reading
+them never scans its messages. The distinct users are estimated, with a standard
+error under 2%. The top posters are approximate once the cap is reached: the
+quietest posters are evicted in batches, and start from zero if they post again.
+
+Configuration (env variables):
+    STATS_ENABLED          count the activity of every chat (default True)
+    STATS_RETENTION_DAYS   how long the hourly and daily counters are kept (default 7)
+    STATS_MAX_POSTERS      how many posters of each chat are counted (default 100)
+"""
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Optional
+
+from redis import Redis
+from redis.client import Pipeline
+
+from redis_keys import stats_hour_key, stats_users_key, stats_posters_key, stats_names_key
+from utils import str_to_bool
+
+STATS_RETENTION_DAYS = int(os.getenv('STATS_RETENTION_DAYS', 7))
+STATS_MAX_POSTERS = int(os.getenv('STATS_MAX_POSTERS', 100))
+# Evicting in batches keeps the per-message write cost flat
+STATS_EVICTION_BATCH = 20
+
+SECONDS_PER_HOUR = 60 * 60
+SECONDS_PER_DAY = 24 * SECONDS_PER_HOUR
+
+_stats_enabled = str_to_bool(os.getenv('STATS_ENABLED', True))
+
+
+@dataclass
+class ChatStats:
+    """The activity of a chat"""
+    chat_id: int
+    # Oldest first, the last one is the current hour
+    messages_per_hour: list[int] = field(default_factory=list)
+    active_users_today: int = 0
+    active_users_this_week: int = 0
+    # (name, messages), busiest first
+    top_posters: list[tuple[str, int]] = field(default_factory=list)
+
+    @property
+    def messages(self) -> int:
+        return sum(self.messages_per_hour)
+
+    @property
+    def busiest_hour(self) -> int:
+        return max(self.messages_per_hour, default=0)
+
+
+def is_stats_enabled() -> bool:
+    return _stats_enabled
+
+
+def record_activity(pipeline: Pipeline, chat_id: int, owner_id: int, owner_name: str, now: Optional[float] = None):
+    """
+    Queues the commands that count a message.
+    The last command returns how many posters are counted, evict_quiet_posters once it passes the cap.
+    @param pipeline: the pipeline the message is stored with
+    @param chat_id: The unique identifier for the chat session.
+    @param owner_id: who posted the message
+    @param owner_name: their name
+    @param now: when the message was posted, now by default
+    """
+    now = now or time.time()
+    retention_seconds = STATS_RETENTION_DAYS * SECONDS_PER_DAY
+
+    hour_key = stats_hour_key(chat_id, _hour(now))
+    pipeline.incr(hour_key)
+    pipeline.expire(hour_key, retention_seconds)
+
+    users_key = stats_users_key(chat_id, _day(now))
+    pipeline.pfadd(users_key, owner_id)
+    pipeline.expire(users_key, retention_seconds + SECONDS_PER_DAY)
+
+    posters_key = stats_posters_key(chat_id)
+    pipeline.zincrby(posters_key, 1, owner_id)
+    pipeline.hset(stats_names_key(chat_id), owner_id, owner_name)
+    pipeline.zcard(posters_key)
+
+
+def evict_quiet_posters(redis_client: Redis, chat_id: int, keep: int = STATS_MAX_POSTERS) -> int:
+    """
+    Stops counting the quietest posters of a chat
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @param keep: how many of the busiest posters are still counted
+    @return: how many posters were evicted
+    """
+    posters_key = stats_posters_key(chat_id)
+    excess = redis_client.zcard(posters_key) - keep
+    if excess <= 0:
+        return 0
+
+    quiet_posters = redis_client.zrange(posters_key, 0, excess - 1)
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.zrem(posters_key, *quiet_posters)
+    pipeline.hdel(stats_names_key(chat_id), *quiet_posters)
+    pipeline.execute()
+    return len(quiet_posters)
+
+
+def get_chat_stats(redis_client: Redis,
+                   chat_id: int,
+                   hours: int = 24,
+                   top_n: int = 5,
+                   now: Optional[float] = None) -> ChatStats:
+    """
+    Reads the activity of a chat, in one round trip for the counters and one for the names
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @param hours: how many of the latest hours are counted, up to the retention
+    @param top_n: how many of the busiest posters are listed
+    @param now: the time the stats are read at, now by default
+    @return: the stats, all zeros for a chat without activity
+    """
+    now = now or time.time()
+    hours = max(1, min(hours, STATS_RETENTION_DAYS * 24))
+    current_hour = _hour(now)
+    week = [_day(now - days_ago * SECONDS_PER_DAY) for days_ago in range(min(7, STATS_RETENTION_DAYS))]
+
+    pipeline = redis_client.pipeline(transaction=False)
+    for hour in range(current_hour - hours + 1, current_hour + 1):
+        pipeline.get(stats_hour_key(chat_id, hour))
+    pipeline.pfcount(stats_users_key(chat_id, week[0]))
+    pipeline.pfcount(*[stats_users_key(chat_id, day) for day in week])
+    pipeline.zrevrange(stats_posters_key(chat_id), 0, top_n - 1, withscores=True)
+    *hourly_counts, active_today, active_this_week, top_posters = pipeline.execute()
+
+    names = redis_client.hmget(stats_names_key(chat_id), [owner_id for owner_id, _ in top_posters]) if top_posters else []
+    return ChatStats(
+        chat_id=chat_id,
+        messages_per_hour=[int(count or 0) for count in hourly_counts],
+        active_users_today=active_today,
+        active_users_this_week=active_this_week,
+        top_posters=[((name or owner_id).decode('utf-8'), int(messages))
+                     for (owner_id, messages), name in zip(top_posters, names)]
+    )
+
+
+def format_chat_stats(stats: ChatStats) -> str:
+    """
+    @param stats: the stats of a chat
+    @return: the stats, for the admins
+    """
+    lines = [
+        f"Activity of chat id: {stats.chat_id}",
+        f"Messages in the last {len(stats.messages_per_hour)} hours: {stats.messages}",
+        f"Busiest hour: {stats.busiest_hour} messages",
+        f"Active users today (UTC): {stats.active_users_today}",
+        f"Active users this week: {stats.active_users_this_week}",
+    ]
+    if stats.top_posters:
+        posters = ', '.join(f"{name} ({messages})" for name, messages in stats.top_posters)
+        lines.append(f"Top posters: {posters}")
+    return '\n'.join(lines)
+
+
+def _hour(now: float) -> int:
+    return int(now // SECONDS_PER_HOUR)
+
+
+def _day(now: float) -> str:
+    return datetime.fromtimestamp(now, tz=timezone.utc).strftime('%Y%m%d')
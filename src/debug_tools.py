@@ -0,0 +1,245 @@
+"""
+Tools to find out what is slowing down the bot in production.
+
+The loop lag monitor ticks on the event loop, and a watchdog thread checks that
+the ticks keep coming. When the loop hasn't ticked for LOOP_LAG_THRESHOLD_MS,
+e.g. because a handler made a sync Redis or OpenAI call, the watchdog logs the
+stack of the loop's thread while it is still blocked, so the log names the
+culprit and not just the delay.
+
+The sampling profiler records the stack of every thread at a fixed interval,
+from its own thread, and folds them into the collapsed stack format
+("frame;frame;frame count" per line), which flamegraph.pl, speedscope and
+inferno turn into a flame graph. It doesn't slow down the code it profiles.
+
+The memory report uses tracemalloc. Tracing is started by the first report,
+or at startup with TRACEMALLOC_FRAMES, and every report also has the growth
+since the previous one, to find a leak.
+
+The reports are served by the admin endpoints under /debug, see server.py.
+
+Configuration (env variables):
+    LOOP_LAG_MONITOR_ENABLED   watch the event loop for blocking calls (default True)
+    LOOP_LAG_THRESHOLD_MS      how long the loop may be blocked before its stack is logged (default 250)
+    PROFILE_MAX_SECONDS        the longest profile that can be requested (default 60)
+    TRACEMALLOC_FRAMES         start tracing allocations at startup with this many frames, 0 to wait for a report (default 0)
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import Counter
+from dataclasses import dataclass
+from typing import Optional
+
+from structured_logging import log_event
+from utils import str_to_bool
+
+logger = logging.getLogger(__name__)
+
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', 60))
+DEFAULT_TRACEMALLOC_FRAMES = 10
+
+
+@dataclass
+class LoopLagReport:
+    """How often, and for how long, the event loop was blocked"""
+    threshold_ms: float
+    stalls: int = 0
+    max_lag_ms: float = 0.0
+    last_stall_stack: Optional[str] = None
+
+
+class LoopLagMonitor:
+    """Logs the stack of whatever blocks the event loop for longer than a threshold"""
+
+    def __init__(self, threshold_seconds: float):
+        """
+        @param threshold_seconds: how long the loop may be blocked before its stack is logged
+        """
+        self._threshold_seconds = threshold_seconds
+        # Several checks per threshold, so a stall is caught while it is still going on
+        self._interval_seconds = threshold_seconds / 4
+        self._last_tick = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._stopped = threading.Event()
+        self.report = LoopLagReport(threshold_ms=threshold_seconds * 1000)
+
+    async def run(self):
+        """
+        Ticks on the event loop, and watches the ticks from a thread, for as long as the bot runs.
+        """
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._stopped.clear()
+        watchdog = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+        watchdog.start()
+        logger.info(f"Watching the event loop for calls blocking it longer than {self.report.threshold_ms:.0f}ms")
+        try:
+            while True:
+                self._last_tick = time.monotonic()
+                await asyncio.sleep(self._interval_seconds)
+        finally:
+            self._stopped.set()
+
+    def _watch(self):
+        stalled_since: Optional[float] = None
+        while not self._stopped.wait(self._interval_seconds):
+            last_tick = self._last_tick
+            lag = time.monotonic() - last_tick - self._interval_seconds
+            if lag < self._threshold_seconds:
+                if stalled_since is not None:
+                    log_event(logger, logging.INFO, "event_loop_unblocked", max_lag_ms=round(self.report.max_lag_ms))
+                stalled_since = None
+                continue
+
+            self.report.max_lag_ms = max(self.report.max_lag_ms, lag * 1000)
+            if stalled_since == last_tick:
+                continue  # Already logged this stall
+
+            stalled_since = last_tick
+            self.report.stalls += 1
+            self.report.last_stall_stack = self._loop_stack()
+            log_event(logger, logging.WARNING, "event_loop_blocked", blocked_ms=round(lag * 1000),
+                      stack=self.report.last_stall_stack)
+
+    def _loop_stack(self) -> str:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        return ''.join(traceback.format_stack(frame)) if frame is not None else "<the loop's thread has exited>"
+
+
+_loop_lag_monitor: Optional[LoopLagMonitor] = None
+
+
+def configure_loop_lag_monitor() -> Optional[LoopLagMonitor]:
+    """
+    Creates the monitor, if LOOP_LAG_MONITOR_ENABLED.
+    @return: the monitor, or None if the loop isn't watched
+    """
+    global _loop_lag_monitor
+
+    if not str_to_bool(os.getenv('LOOP_LAG_MONITOR_ENABLED', True)):
+        _loop_lag_monitor = None
+        return None
+
+    _loop_lag_monitor = LoopLagMonitor(threshold_seconds=float(os.getenv('LOOP_LAG_THRESHOLD_MS', 250)) / 1000)
+    return _loop_lag_monitor
+
+
+def get_loop_lag_monitor() -> Optional[LoopLagMonitor]:
+    return _loop_lag_monitor
+
+
+async def run_loop_lag_monitor_async():
+    """
+    Watches the event loop for as long as the bot runs, if the monitor is enabled.
+    """
+    monitor = configure_loop_lag_monitor()
+    if monitor is not None:
+        await monitor.run()
+
+
+def sample_stacks(seconds: float, interval_seconds: float = 0.005) -> Counter:
+    """
+    Profiles every thread, except the profiler's own, by sampling their stacks.
+    Blocks for the whole profile, run it in a thread.
+    @param seconds: how long to profile for, up to PROFILE_MAX_SECONDS
+    @param interval_seconds: the time between samples
+    @return: how many times each collapsed stack was seen
+    """
+    seconds = min(seconds, PROFILE_MAX_SECONDS)
+    profiler_thread_id = threading.get_ident()
+    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+    samples = Counter()
+
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id != profiler_thread_id:
+                samples[_collapse(thread_names.get(thread_id, str(thread_id)), frame)] += 1
+        time.sleep(interval_seconds)
+
+    return samples
+
+
+def format_collapsed_stacks(samples: Counter) -> str:
+    """
+    @param samples: how many times each collapsed stack was seen
+    @return: one "frame;frame;frame count" line per stack, most seen first, ready for flamegraph.pl or speedscope
+    """
+    return ''.join(f"{stack} {count}\n" for stack, count in samples.most_common())
+
+
+def _collapse(thread_name: str, frame) -> str:
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    # Root first, semicolons separate the frames
+    return ';'.join([thread_name, *reversed(frames)])
+
+
+_previous_memory_snapshot: Optional[tracemalloc.Snapshot] = None
+
+
+def start_tracing_allocations(frames: int = DEFAULT_TRACEMALLOC_FRAMES) -> bool:
+    """
+    @param frames: how many frames are recorded per allocation, more is slower
+    @return: True if tracing was started, False if it already was
+    """
+    if tracemalloc.is_tracing():
+        return False
+    tracemalloc.start(frames)
+    logger.info(f"Tracing memory allocations, with {frames} frames")
+    return True
+
+
+def start_tracing_allocations_from_env():
+    """
+    Starts tracing the allocations at startup, if TRACEMALLOC_FRAMES is set.
+    """
+    frames = int(os.getenv('TRACEMALLOC_FRAMES', 0))
+    if frames > 0:
+        start_tracing_allocations(frames)
+
+
+def get_memory_report(top_n: int = 20, group_by: str = 'lineno') -> dict:
+    """
+    Reports the top allocators, and what grew since the previous report.
+    Starts tracing on the first call, so the first report is empty.
+    @param top_n: how many allocators are listed
+    @param group_by: 'lineno', 'filename' or 'traceback'
+    @return: the report
+    """
+    global _previous_memory_snapshot
+
+    if start_tracing_allocations():
+        _previous_memory_snapshot = None
+        return {'tracing': 'started', 'top': [], 'growth': []}
+
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ])
+    current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+
+    top = [{'location': _format_location(stat.traceback), 'size_bytes': stat.size, 'count': stat.count}
+           for stat in snapshot.statistics(group_by)[:top_n]]
+    growth = []
+    if _previous_memory_snapshot is not None:
+        growth = [{'location': _format_location(stat.traceback), 'size_diff_bytes': stat.size_diff,
+                   'count_diff': stat.count_diff}
+                  for stat in snapshot.compare_to(_previous_memory_snapshot, group_by)[:top_n] if stat.size_diff]
+    _previous_memory_snapshot = snapshot
+
+    return {'tracing': 'running', 'traced_bytes': current_bytes, 'peak_bytes': peak_bytes, 'top': top,
+            'growth': growth}
+
+
+def _format_location(trace: tracemalloc.Traceback) -> str:
+    return ' <- '.join(f"{frame.filename}:{frame.lineno}" for frame in reversed(trace))
@@ -0,0 +1,241 @@
+"""
+Proactive digests.
+
+Posts a digest to every active chat once a day at a configured local time,
+or as soon as a chat has accumulated enough new messages. Each chat gets a
+stable slot inside the schedule window, so the model calls are spread out
+instead of all firing at the same time.
+"""
+import asyncio
+import json
+import logging
+import os
+import zlib
+from dataclasses import dataclass
+from datetime import datetime, time, timedelta
+from typing import Optional, Union
+from zoneinfo import ZoneInfo
+
+from redis import Redis
+from redis.client import Pipeline
+from telegram import Bot
+from telegram.error import Forbidden, BadRequest
+
+from leader_election import holds_leadership
+from message_storage import get_redis_client, get_all_chat_ids, get_nth_latest_message, DEFAULT_MESSAGE_STORAGE
+from redis_keys import digest_state_key, chat_messages_key
+from summary_pipeline import SummaryStyle, summarize_chat
+from utils import str_to_bool
+from white_list import is_whitelisted
+
+logger = logging.getLogger(__name__)
+
+# How many chats are read per pipeline when looking for the ones due a digest
+DIGEST_READ_BATCH_SIZE = 500
+
+
+@dataclass
+class DigestConfig:
+    """When digests are posted"""
+    enabled: bool = False
+    local_time: time = time(hour=9)
+    timezone: ZoneInfo = ZoneInfo("UTC")
+    window: timedelta = timedelta(hours=1)
+    message_threshold: int = 0  # 0 disables the message count trigger
+    poll_interval_seconds: float = 60
+    max_concurrent_digests: int = 2
+
+    @staticmethod
+    def from_env() -> 'DigestConfig':
+        return DigestConfig(
+            enabled=str_to_bool(os.getenv('DIGEST_ENABLED', False)),
+            local_time=time.fromisoformat(os.getenv('DIGEST_TIME', '09:00')),
+            timezone=ZoneInfo(os.getenv('DIGEST_TIMEZONE', 'UTC')),
+            window=timedelta(minutes=int(os.getenv('DIGEST_WINDOW_MINUTES', 60))),
+            message_threshold=int(os.getenv('DIGEST_MESSAGE_THRESHOLD', 0)),
+            poll_interval_seconds=float(os.getenv('DIGEST_POLL_SECONDS', 60)),
+            max_concurrent_digests=int(os.getenv('DIGEST_MAX_CONCURRENT', 2)),
+        )
+
+
+@dataclass
+class DigestState:
+    """What the last digest of a chat covered"""
+    last_message_id: int = -1
+    last_scheduled_date: str = ""
+
+
+class DigestScheduler:
+    """Decides which chats are due a digest and posts them"""
+
+    def __init__(self, redis_client: Redis, bot: Bot, config: DigestConfig):
+        self._redis_client = redis_client
+        self._bot = bot
+        self._config = config
+        self._semaphore = asyncio.Semaphore(config.max_concurrent_digests)
+        self._in_progress: set[int] = set()
+        # Holds the digests in flight, so they aren't garbage collected before they finish
+        self._tasks: set[asyncio.Task] = set()
+
+    def slot_for(self, chat_id: int, day: datetime) -> datetime:
+        """
+        Returns when the chat's scheduled digest is due on that day.
+        The offset inside the window is derived from the chat id, so it is stable across restarts.
+        @param chat_id: The unique identifier for the chat session.
+        @param day: the local day
+        @return: the local time of the chat's slot
+        """
+        window_seconds = max(int(self._config.window.total_seconds()), 1)
+        offset = timedelta(seconds=zlib.crc32(str(chat_id).encode()) % window_seconds)
+        start = datetime.combine(day.date(), self._config.local_time, tzinfo=self._config.timezone)
+        return start + offset
+
+    async def run(self):
+        logger.info(f"Digests scheduled at {self._config.local_time} {self._config.timezone}, "
+                    f"spread over {self._config.window}")
+        try:
+            while True:
+                await asyncio.sleep(self._config.poll_interval_seconds)
+                try:
+                    await self.run_once(datetime.now(self._config.timezone))
+                except Exception:
+                    logger.exception("Failed to schedule the digests")
+        finally:
+            # e.g. the leadership was lost, the digests in flight stop with the scheduler
+            for task in self._tasks:
+                task.cancel()
+
+    async def run_once(self, now: datetime) -> list[asyncio.Task]:
+        """
+        Starts a digest for every chat that is due one.
+        @param now: the current local time
+        @return: the started digests
+        """
+        # The scan and the reads are blocking, only the digests are started on the event loop
+        due_chats = await asyncio.to_thread(self._find_due_chats, now, set(self._in_progress))
+
+        tasks = []
+        for chat_id, is_scheduled in due_chats:
+            if chat_id in self._in_progress:
+                continue
+            self._in_progress.add(chat_id)
+            task = asyncio.create_task(self._post_digest(chat_id, now, is_scheduled))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            tasks.append(task)
+
+        return tasks
+
+    def _find_due_chats(self, now: datetime, in_progress: set[int]) -> list[tuple[int, bool]]:
+        """
+        Reads the chats' digest states and latest messages, a pipeline per batch of chats.
+        @param now: the current local time
+        @param in_progress: the chats that already have a digest in flight
+        @return: the chats that are due a digest, and whether it is their scheduled one
+        """
+        chat_ids = [chat_id for chat_id in get_all_chat_ids(self._redis_client)
+                    if chat_id not in in_progress and is_whitelisted(chat_id)]
+        today = now.date().isoformat()
+
+        due_chats = []
+        for start in range(0, len(chat_ids), DIGEST_READ_BATCH_SIZE):
+            batch = chat_ids[start:start + DIGEST_READ_BATCH_SIZE]
+            pipeline = self._redis_client.pipeline(transaction=False)
+            for chat_id in batch:
+                pipeline.hgetall(digest_state_key(chat_id))
+                pipeline.lindex(chat_messages_key(chat_id), 0)
+                # If the Mth latest message is newer than the last digest, there are at least M new messages
+                pipeline.lindex(chat_messages_key(chat_id), max(self._config.message_threshold - 1, 0))
+            results = pipeline.execute()
+
+            skipped_slots = self._redis_client.pipeline(transaction=False)
+            for index, chat_id in enumerate(batch):
+                raw_state, latest_message, threshold_message = results[3 * index:3 * index + 3]
+                state = _parse_state(raw_state)
+                is_scheduled = now >= self.slot_for(chat_id, now) and state.last_scheduled_date != today
+
+                if latest_message is None or _message_id(latest_message) <= state.last_message_id:
+                    # Nothing new since the last digest, the chat skips today's slot
+                    if is_scheduled:
+                        state.last_scheduled_date = today
+                        _write_state(skipped_slots, chat_id, state)
+                    continue
+
+                has_enough_new_messages = (self._config.message_threshold > 0 and threshold_message is not None
+                                           and _message_id(threshold_message) > state.last_message_id)
+                if is_scheduled or has_enough_new_messages:
+                    due_chats.append((chat_id, is_scheduled))
+            skipped_slots.execute()
+
+        return due_chats
+
+    async def _post_digest(self, chat_id: int, now: datetime, is_scheduled: bool):
+        try:
+            async with self._semaphore:
+                latest_message = get_nth_latest_message(self._redis_client, chat_id)
+                # Same window and style as a plain /gist, so the digest pre-warms its cache
+                summary = await summarize_chat(chat_id, DEFAULT_MESSAGE_STORAGE, SummaryStyle.BULLET_POINTS,
+                                               background=True)
+                if summary is None:
+                    return
+
+                if not holds_leadership():
+                    logger.warning(f"Lost the leadership, not posting the digest to chat id: {chat_id}")
+                    return
+
+                await self._bot.send_message(chat_id=chat_id, text=f"Digest of the latest messages:\n\n{summary}")
+                logger.info(f"Posted a digest to chat id: {chat_id}")
+
+                state = self._get_state(chat_id)
+                state.last_message_id = latest_message.message_id
+                if is_scheduled:
+                    state.last_scheduled_date = now.date().isoformat()
+                self._set_state(chat_id, state)
+        except (BadRequest, Forbidden):
+            logger.error(f"Failed to post a digest to chat id: {chat_id}")
+        except Exception:
+            logger.exception(f"Failed to post a digest to chat id: {chat_id}")
+        finally:
+            self._in_progress.discard(chat_id)
+
+    def _get_state(self, chat_id: int) -> DigestState:
+        return _parse_state(self._redis_client.hgetall(digest_state_key(chat_id)))
+
+    def _set_state(self, chat_id: int, state: DigestState):
+        _write_state(self._redis_client, chat_id, state)
+
+
+def _parse_state(state: dict) -> DigestState:
+    if not state:
+        return DigestState()
+
+    return DigestState(
+        last_message_id=int(state[b'last_message_id']),
+        last_scheduled_date=state[b'last_scheduled_date'].decode('utf-8')
+    )
+
+
+def _write_state(redis_client: Union[Redis, Pipeline], chat_id: int, state: DigestState):
+    redis_client.hset(digest_state_key(chat_id), mapping={
+        'last_message_id': state.last_message_id,
+        'last_scheduled_date': state.last_scheduled_date,
+    })
+
+
+def _message_id(serialized_message: bytes) -> int:
+    return json.loads(serialized_message)['message_id']
+
+
+async def run_digest_scheduler_async(bot: Bot, config: Optional[DigestConfig] = None):
+    """
+    Runs the digest scheduler in the current event loop, if digests are enabled.
+    @param bot: the bot used to post the digests
+    @param config: the schedule, read from the env variables by default
+    """
+    config = config or DigestConfig.from_env()
+    if not config.enabled:
+        logger.info("Digests are disabled")
+        return
+
+    scheduler = DigestScheduler(get_redis_client(), bot, config)
+    await scheduler.run()
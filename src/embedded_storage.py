@@ -0,0 +1,938 @@
+"""
+Embedded storage, for running the bot without a Redis server.
+
+EmbeddedRedis keeps the data in memory, in the same process as the bot, and
+implements the subset of the redis-py client that the bot uses, so every module
+works with either one:
+
+    strings     get set incr incrby decr decrby
+    lists       lpush rpush lpop ltrim lrange lindex llen lrem
+    hashes      hset hget hgetall hmget hdel hincrby hlen
+    sorted sets zadd zscore zcard zrem zrange zrevrange zremrangebyscore zincrby zinterstore
+    hyperloglog pfadd pfcount
+    keys        delete exists expire pexpire ttl type scan_iter
+    pub/sub     publish pubsub
+    other       pipeline transaction ping dbsize info
+
+A chat's messages are a deque capped by LTRIM, so storing a message is O(1).
+A HyperLogLog is a string of HYPERLOGLOG_REGISTERS one-byte registers, about 1.6%
+standard error, and like Redis' it can't be read back as a regular value.
+Pipelines run under one lock, so like a MULTI they are applied all at once.
+
+Writes are appended to a log (appendonly.<generation>.aof) as JSON lines, and the
+log is fsynced every EMBEDDED_FSYNC_SECONDS, like Redis' appendfsync everysec.
+Every EMBEDDED_SNAPSHOT_SECONDS the whole data set is written to snapshot.json and
+a new log generation is started, so the log stays short. On start, the snapshot is
+loaded and the logs written after it are replayed. A line torn by a crash ends the replay.
+"""
+import fnmatch
+import hashlib
+import json
+import math
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from itertools import islice
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+from redis.exceptions import ResponseError
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = "snapshot.json"
+LOG_FILE = "appendonly.{generation}.aof"
+
+_WRONG_TYPE = "WRONGTYPE Operation against a key holding the wrong kind of value"
+
+HYPERLOGLOG_REGISTERS = 4096
+_HYPERLOGLOG_HEADER = b"HYLL"
+_HYPERLOGLOG_INDEX_BITS = HYPERLOGLOG_REGISTERS.bit_length() - 1
+_INVALID_HYPERLOGLOG = "WRONGTYPE Key is not a valid HyperLogLog string value."
+
+Value = Union[bytes, str, int, float]
+
+
+def _encode(value: Value) -> bytes:
+    # Same conversions as redis-py
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    if isinstance(value, float):
+        return repr(value).encode('utf-8')
+    return str(value).encode('utf-8')
+
+
+def _to_json(value):
+    # Bytes round trip through latin-1, every other value in a log line is a number or a container
+    if isinstance(value, bytes):
+        return value.decode('latin-1')
+    if isinstance(value, (list, tuple, deque)):
+        return [_to_json(item) for item in value]
+    if isinstance(value, dict):
+        return [[_to_json(key), _to_json(item)] for key, item in value.items()]
+    return value
+
+
+def _bytes_from_json(value) -> bytes:
+    return value.encode('latin-1')
+
+
+def _range_bounds(length: int, start: int, end: int) -> tuple[int, int]:
+    """Converts Redis' inclusive, possibly negative, range to a Python slice"""
+    if start < 0:
+        start = max(start + length, 0)
+    if end < 0:
+        end += length
+    end = min(end, length - 1)
+    if start > end:
+        return 0, 0
+    return start, end + 1
+
+
+class EmbeddedPubSub:
+    """In-process pub/sub subscription, with redis-py's PubSub interface"""
+
+    def __init__(self, store: 'EmbeddedRedis', ignore_subscribe_messages: bool = False):
+        self._store = store
+        self._ignore_subscribe_messages = ignore_subscribe_messages
+        self._messages: queue.Queue = queue.Queue()
+        self._channels: set[bytes] = set()
+        self._closed = False
+
+    def subscribe(self, *channels: Value):
+        for channel in map(_encode, channels):
+            self._channels.add(channel)
+            self._store._subscribe(channel, self._messages)
+            if not self._ignore_subscribe_messages:
+                self._messages.put({'type': 'subscribe', 'pattern': None, 'channel': channel,
+                                    'data': len(self._channels)})
+
+    def get_message(self, timeout: float = 0.0) -> Optional[dict]:
+        try:
+            message = self._messages.get(timeout=timeout) if timeout else self._messages.get_nowait()
+        except queue.Empty:
+            return None
+        return message
+
+    def listen(self) -> Iterator[dict]:
+        while not self._closed:
+            message = self._messages.get()
+            if message is not None:
+                yield message
+
+    def close(self):
+        self._closed = True
+        for channel in self._channels:
+            self._store._unsubscribe(channel, self._messages)
+        self._channels.clear()
+        self._messages.put(None)  # Wakes up listen()
+
+
+class EmbeddedPipeline:
+    """Queues commands, and runs them all under the store's lock"""
+
+    def __init__(self, store: 'EmbeddedRedis'):
+        self._store = store
+        self._commands: list[tuple[str, tuple, dict]] = []
+
+    def __getattr__(self, name: str):
+        if name.startswith('_') or name in ('pipeline', 'pubsub') or not callable(getattr(self._store, name, None)):
+            raise AttributeError(name)
+
+        def queue_command(*args, **kwargs) -> 'EmbeddedPipeline':
+            self._commands.append((name, args, kwargs))
+            return self
+
+        return queue_command
+
+    def execute(self) -> list:
+        commands, self._commands = self._commands, []
+        results, error = [], None
+        with self._store._lock:
+            for name, args, kwargs in commands:
+                try:
+                    results.append(getattr(self._store, name)(*args, **kwargs))
+                except ResponseError as ex:
+                    results.append(ex)
+                    error = error or ex
+        if error is not None:
+            raise error
+        return results
+
+    def reset(self):
+        self._commands = []
+
+    def __len__(self) -> int:
+        return len(self._commands)
+
+    def __enter__(self) -> 'EmbeddedPipeline':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.reset()
+
+
+class EmbeddedTransaction(EmbeddedPipeline):
+    """
+    The pipeline passed to EmbeddedRedis.transaction. Like a redis-py pipeline that is watching keys,
+    it runs commands immediately until multi() is called, then queues them.
+    """
+
+    def __init__(self, store: 'EmbeddedRedis'):
+        super().__init__(store)
+        self._immediate = True
+
+    def __getattr__(self, name: str):
+        if self._immediate and not name.startswith('_'):
+            return getattr(self._store, name)
+        return super().__getattr__(name)
+
+    def watch(self, *keys):
+        pass  # The store's lock is held for the whole transaction
+
+    def multi(self):
+        self._immediate = False
+
+
+class EmbeddedRedis:
+    """In-memory store with a snapshot and an append-only log on local disk"""
+
+    def __init__(self,
+                 directory: Union[str, Path],
+                 fsync_seconds: float = 1.0,
+                 snapshot_seconds: float = 300.0):
+        self._directory = Path(directory)
+        self._fsync_seconds = fsync_seconds
+        self._snapshot_seconds = snapshot_seconds
+        self._lock = threading.RLock()
+        self._data: dict[bytes, Union[bytes, deque, dict]] = {}
+        self._expires_at: dict[bytes, float] = {}
+        self._subscribers: dict[bytes, list[queue.Queue]] = {}
+        self._generation = 0
+        self._log = None
+        self._replaying = False
+        self._stopped = threading.Event()
+        self._persistence_thread: Optional[threading.Thread] = None
+
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._load()
+        # Compact what was replayed, this also drops a line torn by a crash
+        self.snapshot()
+
+    @property
+    def connection(self) -> str:
+        return f"embedded:{self._directory}"
+
+    #####################################################################
+    # Persistence
+    #####################################################################
+    def start(self):
+        """Starts fsyncing the log and writing snapshots in the background"""
+        if self._persistence_thread is None:
+            self._persistence_thread = threading.Thread(target=self._persist, name="embedded-storage", daemon=True)
+            self._persistence_thread.start()
+
+    def close(self):
+        """Writes a final snapshot, and stops persisting"""
+        self._stopped.set()
+        if self._persistence_thread is not None:
+            self._persistence_thread.join()
+            self._persistence_thread = None
+        self.snapshot()
+        with self._lock:
+            self._log.close()
+
+    def snapshot(self):
+        """
+        Writes the whole data set to disk, and starts a new log generation.
+        The previous generation's log is only deleted once the snapshot is on disk.
+        """
+        with self._lock:
+            self._purge_expired()
+            previous_generation = self._generation
+            self._generation += 1
+            state = {
+                'generation': self._generation,
+                'keys': [[_to_json(key), self._type_of(value), _to_json(value), self._expires_at.get(key)]
+                         for key, value in self._data.items()],
+            }
+            if self._log is not None:
+                self._log.flush()
+                os.fsync(self._log.fileno())
+                self._log.close()
+            # Line buffered, so every write reaches the OS right away and only the fsync is batched
+            self._log = open(self._log_path(self._generation), "a", encoding="utf-8", buffering=1)
+
+        temporary_path = self._directory / f"{SNAPSHOT_FILE}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as snapshot_file:
+            json.dump(state, snapshot_file)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary_path, self._directory / SNAPSHOT_FILE)
+
+        for path in self._directory.glob("appendonly.*.aof"):
+            if self._generation_of(path) <= previous_generation:
+                path.unlink()
+
+    def _persist(self):
+        last_snapshot = time.monotonic()
+        while not self._stopped.wait(self._fsync_seconds):
+            try:
+                if time.monotonic() - last_snapshot >= self._snapshot_seconds:
+                    self.snapshot()
+                    last_snapshot = time.monotonic()
+                else:
+                    with self._lock:
+                        self._log.flush()
+                        os.fsync(self._log.fileno())
+            except Exception:
+                logger.exception("Failed to persist the embedded storage")
+
+    def _load(self):
+        snapshot_path = self._directory / SNAPSHOT_FILE
+        if snapshot_path.exists():
+            with open(snapshot_path, encoding="utf-8") as snapshot_file:
+                state = json.load(snapshot_file)
+            self._generation = state['generation']
+            for key, kind, value, expires_at in state['keys']:
+                key = _bytes_from_json(key)
+                self._data[key] = self._value_from_json(kind, value)
+                if expires_at is not None:
+                    self._expires_at[key] = expires_at
+
+        logs = sorted((path for path in self._directory.glob("appendonly.*.aof")
+                       if self._generation_of(path) >= self._generation), key=self._generation_of)
+        self._replaying = True
+        try:
+            for path in logs:
+                self._replay(path)
+        finally:
+            self._replaying = False
+        # A crash during a snapshot leaves a newer log than the snapshot, the next generation is after both
+        self._generation = max([self._generation, *map(self._generation_of, logs)])
+        self._purge_expired()
+        logger.info(f"Loaded {len(self._data)} keys from {self._directory}")
+
+    def _replay(self, path: Path):
+        with open(path, encoding="utf-8") as log:
+            for line_number, line in enumerate(log, start=1):
+                try:
+                    command, *args = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Stopped replaying {path} at its torn line {line_number}")
+                    return
+                getattr(self, f"_apply_{command}")(*args)
+
+    def _log_write(self, command: str, *args):
+        if not self._replaying and self._log is not None:
+            self._log.write(json.dumps([command, *map(_to_json, args)]) + "\n")
+
+    def _log_path(self, generation: int) -> Path:
+        return self._directory / LOG_FILE.format(generation=generation)
+
+    @staticmethod
+    def _generation_of(path: Path) -> int:
+        return int(path.name.split('.')[1])
+
+    @staticmethod
+    def _type_of(value) -> str:
+        if isinstance(value, bytes):
+            return 'string'
+        if isinstance(value, deque):
+            return 'list'
+        if isinstance(value, _SortedSet):
+            return 'zset'
+        return 'hash'
+
+    @staticmethod
+    def _value_from_json(kind: str, value):
+        if kind == 'string':
+            return _bytes_from_json(value)
+        if kind == 'list':
+            return deque(map(_bytes_from_json, value))
+        if kind == 'zset':
+            return _SortedSet({_bytes_from_json(member): score for member, score in value})
+        return {_bytes_from_json(field): _bytes_from_json(item) for field, item in value}
+
+    #####################################################################
+    # Key space
+    #####################################################################
+    def _get(self, key: bytes, kind: type, create: bool = False):
+        if key in self._expires_at and self._expires_at[key] <= time.time():
+            self._remove(key)
+
+        value = self._data.get(key)
+        if value is None:
+            if not create:
+                return None
+            value = self._data[key] = kind()
+        elif type(value) is not kind:
+            raise ResponseError(_WRONG_TYPE)
+        return value
+
+    def _remove(self, key: bytes) -> bool:
+        self._expires_at.pop(key, None)
+        return self._data.pop(key, None) is not None
+
+    def _remove_if_empty(self, key: bytes, value):
+        if not value:
+            self._remove(key)
+
+    def _purge_expired(self):
+        now = time.time()
+        for key in [key for key, expires_at in self._expires_at.items() if expires_at <= now]:
+            self._remove(key)
+
+    def delete(self, *keys: Value) -> int:
+        with self._lock:
+            keys = [_encode(key) for key in keys]
+            self._log_write('delete', keys)
+            return self._apply_delete(keys)
+
+    def _apply_delete(self, keys: list) -> int:
+        return sum(self._remove(_encode_arg(key)) for key in keys)
+
+    def exists(self, *keys: Value) -> int:
+        with self._lock:
+            return sum(1 for key in keys if self._get_any(_encode(key)) is not None)
+
+    def _get_any(self, key: bytes):
+        if key in self._expires_at and self._expires_at[key] <= time.time():
+            self._remove(key)
+        return self._data.get(key)
+
+    def expire(self, key: Value, seconds: Union[int, float]) -> bool:
+        return self.pexpire(key, int(seconds * 1000))
+
+    def pexpire(self, key: Value, milliseconds: int) -> bool:
+        with self._lock:
+            key = _encode(key)
+            if self._get_any(key) is None:
+                return False
+            expires_at = time.time() + milliseconds / 1000
+            self._log_write('expireat', key, expires_at)
+            return self._apply_expireat(key, expires_at)
+
+    def _apply_expireat(self, key, expires_at: float) -> bool:
+        key = _encode_arg(key)
+        if key not in self._data:
+            return False
+        self._expires_at[key] = expires_at
+        return True
+
+    def ttl(self, key: Value) -> int:
+        with self._lock:
+            key = _encode(key)
+            if self._get_any(key) is None:
+                return -2
+            if key not in self._expires_at:
+                return -1
+            return max(int(round(self._expires_at[key] - time.time())), 0)
+
+    def type(self, key: Value) -> bytes:
+        with self._lock:
+            value = self._get_any(_encode(key))
+            return b'none' if value is None else self._type_of(value).encode('utf-8')
+
+    def scan_iter(self, match: Optional[str] = None, count: Optional[int] = None, _type: Optional[str] = None):
+        with self._lock:
+            self._purge_expired()
+            keys = [(key, self._type_of(value)) for key, value in self._data.items()]
+
+        pattern = match.encode('utf-8') if isinstance(match, str) else match
+        for key, kind in keys:
+            if pattern is not None and not fnmatch.fnmatchcase(key.decode('latin-1'), pattern.decode('latin-1')):
+                continue
+            if _type is not None and kind != _type.lower():
+                continue
+            yield key
+
+    #####################################################################
+    # Strings
+    #####################################################################
+    def get(self, key: Value) -> Optional[bytes]:
+        with self._lock:
+            return self._get(_encode(key), bytes)
+
+    def set(self,
+            key: Value,
+            value: Value,
+            ex: Optional[Union[int, float]] = None,
+            px: Optional[int] = None,
+            nx: bool = False,
+            xx: bool = False) -> Optional[bool]:
+        with self._lock:
+            key = _encode(key)
+            exists = self._get_any(key) is not None
+            if (nx and exists) or (xx and not exists):
+                return None
+
+            expires_at = None
+            if ex is not None:
+                expires_at = time.time() + ex
+            elif px is not None:
+                expires_at = time.time() + px / 1000
+
+            self._log_write('set', key, _encode(value), expires_at)
+            return self._apply_set(key, _encode(value), expires_at)
+
+    def _apply_set(self, key, value, expires_at: Optional[float]) -> bool:
+        key = _encode_arg(key)
+        self._remove(key)
+        self._data[key] = _encode_arg(value)
+        if expires_at is not None:
+            self._expires_at[key] = expires_at
+        return True
+
+    def incr(self, key: Value, amount: int = 1) -> int:
+        return self.incrby(key, amount)
+
+    def decr(self, key: Value, amount: int = 1) -> int:
+        return self.incrby(key, -amount)
+
+    def decrby(self, key: Value, decrement: int = 1) -> int:
+        return self.incrby(key, -decrement)
+
+    def incrby(self, key: Value, amount: int = 1) -> int:
+        with self._lock:
+            key = _encode(key)
+            self._log_write('incrby', key, int(amount))
+            return self._apply_incrby(key, int(amount))
+
+    def _apply_incrby(self, key, amount: int) -> int:
+        key = _encode_arg(key)
+        current = self._get(key, bytes)
+        try:
+            value = int(current or 0) + amount
+        except ValueError:
+            raise ResponseError("value is not an integer or out of range")
+        expires_at = self._expires_at.get(key)
+        self._data[key] = str(value).encode('utf-8')
+        if expires_at is not None:
+            self._expires_at[key] = expires_at
+        return value
+
+    #####################################################################
+    # Lists
+    #####################################################################
+    def lpush(self, key: Value, *values: Value) -> int:
+        with self._lock:
+            key, values = _encode(key), [_encode(value) for value in values]
+            self._log_write('lpush', key, values)
+            return self._apply_lpush(key, values)
+
+    def _apply_lpush(self, key, values: list) -> int:
+        items = self._get(_encode_arg(key), deque, create=True)
+        items.extendleft(map(_encode_arg, values))
+        return len(items)
+
+    def rpush(self, key: Value, *values: Value) -> int:
+        with self._lock:
+            key, values = _encode(key), [_encode(value) for value in values]
+            self._log_write('rpush', key, values)
+            return self._apply_rpush(key, values)
+
+    def _apply_rpush(self, key, values: list) -> int:
+        items = self._get(_encode_arg(key), deque, create=True)
+        items.extend(map(_encode_arg, values))
+        return len(items)
+
+    def ltrim(self, key: Value, start: int, end: int) -> bool:
+        with self._lock:
+            key = _encode(key)
+            items = self._get(key, deque)
+            if items is None:
+                return True
+            start, stop = _range_bounds(len(items), start, end)
+            if start == 0 and stop == len(items):
+                return True  # Nothing to trim, e.g. a chat with fewer messages than the cap
+            self._log_write('ltrim', key, start, stop)
+            return self._apply_ltrim(key, start, stop)
+
+    def _apply_ltrim(self, key, start: int, stop: int) -> bool:
+        key = _encode_arg(key)
+        items = self._get(key, deque)
+        if items is None:
+            return True
+        # Popping the ends keeps the common case, trimming a capped list after a push, O(1)
+        for _ in range(len(items) - stop):
+            items.pop()
+        for _ in range(start):
+            items.popleft()
+        self._remove_if_empty(key, items)
+        return True
+
+    def lpop(self, key: Value, count: Optional[int] = None) -> Union[bytes, list[bytes], None]:
+        with self._lock:
+            key = _encode(key)
+            items = self._get(key, deque)
+            if items is None:
+                return None
+            popped = list(islice(items, 0, 1 if count is None else count))
+            # Logged as the trim it is, so the replay doesn't need its own command
+            self._log_write('ltrim', key, len(popped), len(items))
+            self._apply_ltrim(key, len(popped), len(items))
+            return popped[0] if count is None else popped
+
+    def lrange(self, key: Value, start: int, end: int) -> list[bytes]:
+        with self._lock:
+            items = self._get(_encode(key), deque)
+            if items is None:
+                return []
+            start, stop = _range_bounds(len(items), start, end)
+            return list(islice(items, start, stop))
+
+    def lindex(self, key: Value, index: int) -> Optional[bytes]:
+        with self._lock:
+            items = self._get(_encode(key), deque)
+            if items is None or not -len(items) <= index < len(items):
+                return None
+            return items[index]
+
+    def llen(self, key: Value) -> int:
+        with self._lock:
+            items = self._get(_encode(key), deque)
+            return len(items) if items is not None else 0
+
+    def lrem(self, key: Value, count: int, value: Value) -> int:
+        with self._lock:
+            key, value = _encode(key), _encode(value)
+            self._log_write('lrem', key, count, value)
+            return self._apply_lrem(key, count, value)
+
+    def _apply_lrem(self, key, count: int, value) -> int:
+        key, value = _encode_arg(key), _encode_arg(value)
+        items = self._get(key, deque)
+        if items is None:
+            return 0
+
+        ordered = list(items) if count >= 0 else list(reversed(items))
+        kept, removed = [], 0
+        for item in ordered:
+            if item == value and (count == 0 or removed < abs(count)):
+                removed += 1
+            else:
+                kept.append(item)
+        if removed:
+            items.clear()
+            items.extend(kept if count >= 0 else reversed(kept))
+            self._remove_if_empty(key, items)
+        return removed
+
+    #####################################################################
+    # Hashes
+    #####################################################################
+    def hset(self,
+             name: Value,
+             key: Optional[Value] = None,
+             value: Optional[Value] = None,
+             mapping: Optional[dict] = None) -> int:
+        with self._lock:
+            fields = {}
+            if key is not None:
+                fields[_encode(key)] = _encode(value)
+            for field, item in (mapping or {}).items():
+                fields[_encode(field)] = _encode(item)
+            name = _encode(name)
+            self._log_write('hset', name, fields)
+            return self._apply_hset(name, fields)
+
+    def _apply_hset(self, name, fields) -> int:
+        if isinstance(fields, list):
+            fields = {_encode_arg(field): _encode_arg(item) for field, item in fields}
+        items = self._get(_encode_arg(name), dict, create=True)
+        added = sum(1 for field in fields if field not in items)
+        items.update(fields)
+        return added
+
+    def hget(self, name: Value, key: Value) -> Optional[bytes]:
+        with self._lock:
+            items = self._get(_encode(name), dict)
+            return items.get(_encode(key)) if items is not None else None
+
+    def hgetall(self, name: Value) -> dict[bytes, bytes]:
+        with self._lock:
+            items = self._get(_encode(name), dict)
+            return dict(items) if items is not None else {}
+
+    def hmget(self, name: Value, keys, *args: Value) -> list[Optional[bytes]]:
+        with self._lock:
+            fields = ([keys] if isinstance(keys, (bytes, str, int)) else list(keys)) + list(args)
+            items = self._get(_encode(name), dict) or {}
+            return [items.get(_encode(field)) for field in fields]
+
+    def hdel(self, name: Value, *keys: Value) -> int:
+        with self._lock:
+            name, keys = _encode(name), [_encode(key) for key in keys]
+            self._log_write('hdel', name, keys)
+            return self._apply_hdel(name, keys)
+
+    def _apply_hdel(self, name, keys: list) -> int:
+        name = _encode_arg(name)
+        items = self._get(name, dict)
+        if items is None:
+            return 0
+        removed = sum(1 for key in map(_encode_arg, keys) if items.pop(key, None) is not None)
+        self._remove_if_empty(name, items)
+        return removed
+
+    def hincrby(self, name: Value, key: Value, amount: int = 1) -> int:
+        with self._lock:
+            name, key = _encode(name), _encode(key)
+            self._log_write('hincrby', name, key, int(amount))
+            return self._apply_hincrby(name, key, int(amount))
+
+    def _apply_hincrby(self, name, key, amount: int) -> int:
+        items = self._get(_encode_arg(name), dict, create=True)
+        key = _encode_arg(key)
+        value = int(items.get(key, 0)) + amount
+        items[key] = str(value).encode('utf-8')
+        return value
+
+    def hlen(self, name: Value) -> int:
+        with self._lock:
+            items = self._get(_encode(name), dict)
+            return len(items) if items is not None else 0
+
+    #####################################################################
+    # Sorted sets
+    #####################################################################
+    def zadd(self, name: Value, mapping: dict, nx: bool = False, xx: bool = False) -> int:
+        with self._lock:
+            name = _encode(name)
+            scores = {_encode(member): float(score) for member, score in mapping.items()}
+            members = self._get(name, _SortedSet) or {}
+            if nx:
+                scores = {member: score for member, score in scores.items() if member not in members}
+            if xx:
+                scores = {member: score for member, score in scores.items() if member in members}
+            if not scores:
+                return 0
+            self._log_write('zadd', name, scores)
+            return self._apply_zadd(name, scores)
+
+    def _apply_zadd(self, name, scores) -> int:
+        if isinstance(scores, list):
+            scores = {_encode_arg(member): score for member, score in scores}
+        members = self._get(_encode_arg(name), _SortedSet, create=True)
+        added = sum(1 for member in scores if member not in members)
+        members.update(scores)
+        return added
+
+    def zscore(self, name: Value, value: Value) -> Optional[float]:
+        with self._lock:
+            members = self._get(_encode(name), _SortedSet) or {}
+            return members.get(_encode(value))
+
+    def zcard(self, name: Value) -> int:
+        with self._lock:
+            members = self._get(_encode(name), _SortedSet)
+            return len(members) if members is not None else 0
+
+    def zrem(self, name: Value, *values: Value) -> int:
+        with self._lock:
+            name, values = _encode(name), [_encode(value) for value in values]
+            self._log_write('zrem', name, values)
+            return self._apply_zrem(name, values)
+
+    def _apply_zrem(self, name, values: list) -> int:
+        name = _encode_arg(name)
+        members = self._get(name, _SortedSet)
+        if members is None:
+            return 0
+        removed = sum(1 for value in map(_encode_arg, values) if members.pop(value, None) is not None)
+        self._remove_if_empty(name, members)
+        return removed
+
+    def zrange(self, name: Value, start: int, end: int, desc: bool = False, withscores: bool = False):
+        with self._lock:
+            members = self._get(_encode(name), _SortedSet)
+            if members is None:
+                return []
+            ordered = sorted(members.items(), key=lambda item: (item[1], item[0]), reverse=desc)
+            start, stop = _range_bounds(len(ordered), start, end)
+            selected = ordered[start:stop]
+            return selected if withscores else [member for member, _ in selected]
+
+    def zrevrange(self, name: Value, start: int, end: int, withscores: bool = False):
+        return self.zrange(name, start, end, desc=True, withscores=withscores)
+
+    def zremrangebyscore(self, name: Value, min: Union[float, str], max: Union[float, str]) -> int:
+        with self._lock:
+            name = _encode(name)
+            members = self._get(name, _SortedSet)
+            if members is None:
+                return 0
+            low, high = float(min), float(max)
+            values = [member for member, score in members.items() if low <= score <= high]
+            if not values:
+                return 0
+            self._log_write('zrem', name, values)
+            return self._apply_zrem(name, values)
+
+    def zincrby(self, name: Value, amount: float, value: Value) -> float:
+        with self._lock:
+            name, value = _encode(name), _encode(value)
+            score = (self._get(name, _SortedSet) or {}).get(value, 0.0) + amount
+            self._log_write('zadd', name, {value: score})
+            self._apply_zadd(name, {value: score})
+            return score
+
+    def zinterstore(self, dest: Value, keys, aggregate: Optional[str] = None) -> int:
+        with self._lock:
+            weights = keys if isinstance(keys, dict) else {key: 1 for key in keys}
+            sets = [(self._get(_encode(key), _SortedSet) or {}, weight) for key, weight in weights.items()]
+
+            smallest = min((members for members, _ in sets), key=len, default={})
+            result = {}
+            for member in smallest:
+                if all(member in members for members, _ in sets):
+                    scores = [members[member] * weight for members, weight in sets]
+                    if aggregate and aggregate.upper() == 'MIN':
+                        result[member] = min(scores)
+                    elif aggregate and aggregate.upper() == 'MAX':
+                        result[member] = max(scores)
+                    else:
+                        result[member] = sum(scores)
+
+            dest = _encode(dest)
+            self._log_write('delete', [dest])
+            self._remove(dest)
+            if result:
+                self._log_write('zadd', dest, result)
+                self._apply_zadd(dest, result)
+            return len(result)
+
+    #####################################################################
+    # Pub/sub
+    #####################################################################
+    def publish(self, channel: Value, message: Value) -> int:
+        with self._lock:
+            channel = _encode(channel)
+            subscribers = list(self._subscribers.get(channel, []))
+        for subscriber in subscribers:
+            subscriber.put({'type': 'message', 'pattern': None, 'channel': channel, 'data': _encode(message)})
+        return len(subscribers)
+
+    def pubsub(self, ignore_subscribe_messages: bool = False) -> EmbeddedPubSub:
+        return EmbeddedPubSub(self, ignore_subscribe_messages)
+
+    def _subscribe(self, channel: bytes, messages: queue.Queue):
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(messages)
+
+    def _unsubscribe(self, channel: bytes, messages: queue.Queue):
+        with self._lock:
+            if messages in self._subscribers.get(channel, []):
+                self._subscribers[channel].remove(messages)
+
+    #####################################################################
+    # HyperLogLogs
+    #####################################################################
+    def pfadd(self, name: Value, *values: Value) -> int:
+        with self._lock:
+            name, values = _encode(name), [_encode(value) for value in values]
+            self._log_write('pfadd', name, values)
+            return self._apply_pfadd(name, values)
+
+    def _apply_pfadd(self, name, values: list) -> int:
+        name = _encode_arg(name)
+        current = self._get_hyperloglog(name)
+        registers = bytearray(current or bytes(HYPERLOGLOG_REGISTERS))
+        changed = current is None
+        for value in map(_encode_arg, values):
+            index, rank = _hyperloglog_register(value)
+            if registers[index] < rank:
+                registers[index] = rank
+                changed = True
+        if changed:
+            self._data[name] = _HYPERLOGLOG_HEADER + bytes(registers)
+        return int(changed)
+
+    def pfcount(self, *sources: Value) -> int:
+        """Like Redis, counting several HyperLogLogs counts their union"""
+        with self._lock:
+            union = [0] * HYPERLOGLOG_REGISTERS
+            for source in sources:
+                registers = self._get_hyperloglog(_encode(source))
+                if registers is not None:
+                    union = list(map(max, union, registers))
+            return _hyperloglog_estimate(union)
+
+    def _get_hyperloglog(self, key: bytes) -> Optional[bytes]:
+        value = self._get(key, bytes)
+        if value is None:
+            return None
+        if not value.startswith(_HYPERLOGLOG_HEADER) or len(value) != len(_HYPERLOGLOG_HEADER) + HYPERLOGLOG_REGISTERS:
+            raise ResponseError(_INVALID_HYPERLOGLOG)
+        return value[len(_HYPERLOGLOG_HEADER):]
+
+    #####################################################################
+    # Other
+    #####################################################################
+    def pipeline(self, transaction: bool = True) -> EmbeddedPipeline:
+        return EmbeddedPipeline(self)
+
+    def transaction(self, func, *watches, value_from_callable: bool = False, **kwargs):
+        """
+        Like redis-py's WATCH/MULTI helper. The store is locked while func reads and queues the writes,
+        so the watched keys can't change in between, and the transaction never has to be retried.
+        @param func: called with the transaction pipeline
+        @param watches: the keys func reads
+        @param value_from_callable: return what func returned instead of the results of the writes
+        """
+        with self._lock:
+            pipeline = EmbeddedTransaction(self)
+            value = func(pipeline)
+            results = pipeline.execute()
+        return value if value_from_callable else results
+
+    def ping(self) -> bool:
+        return True
+
+    def dbsize(self) -> int:
+        with self._lock:
+            self._purge_expired()
+            return len(self._data)
+
+    def info(self) -> dict:
+        with self._lock:
+            return {'redis_version': 'embedded', 'keys': len(self._data), 'aof_generation': self._generation}
+
+    def client(self) -> 'EmbeddedRedis':
+        return self
+
+
+def _hyperloglog_register(value: bytes) -> tuple[int, int]:
+    """
+    @return: the register the value falls in, and the position of the first 1 bit in the rest of its hash
+    """
+    hashed = int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'little')
+    index = hashed & (HYPERLOGLOG_REGISTERS - 1)
+    remaining_bits = 64 - _HYPERLOGLOG_INDEX_BITS
+    rest = hashed >> _HYPERLOGLOG_INDEX_BITS
+    return index, remaining_bits - rest.bit_length() + 1
+
+
+def _hyperloglog_estimate(registers: list[int]) -> int:
+    # Flajolet et al., with linear counting while many registers are still empty
+    alpha = 0.7213 / (1 + 1.079 / HYPERLOGLOG_REGISTERS)
+    estimate = alpha * HYPERLOGLOG_REGISTERS ** 2 / sum(2.0 ** -register for register in registers)
+    empty_registers = registers.count(0)
+    if estimate <= 2.5 * HYPERLOGLOG_REGISTERS and empty_registers:
+        estimate = HYPERLOGLOG_REGISTERS * math.log(HYPERLOGLOG_REGISTERS / empty_registers)
+    return round(estimate)
+
+
+class _SortedSet(dict):
+    """member -> score"""
+
+
+def _encode_arg(value) -> bytes:
+    # Arguments are bytes when called live, and latin-1 strings when replayed from the log
+    return value if isinstance(value, bytes) else _bytes_from_json(value)
@@ -0,0 +1,92 @@
+"""
+Admin command line for backing up and seeding the chat history.
+Connects to the Redis configured by the REDIS_* env variables.
+
+Usage:
+    python src/history_cli.py export --output history.ndjson
+    python src/history_cli.py export --chat-id -100123 --output chat.ndjson
+    python src/history_cli.py export --archive --since 2024-05-01 --until 2024-05-31 --output may.ndjson
+    python src/history_cli.py import history.ndjson
+    python src/history_cli.py import-telegram result.json [--chat-id -100123]
+"""
+import argparse
+import json
+import logging
+import sys
+
+from dotenv import load_dotenv
+
+from chat_history import (export_chats, export_archived_chats, read_export, import_messages,
+                          read_telegram_desktop_export)
+from message_archive import get_segment_reader
+from message_storage import configure_message_storage, get_redis_client
+from structured_logging import configure_logging
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Export and import the stored chat history")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="export chats as newline-delimited JSON")
+    export_parser.add_argument("--chat-id", type=int, action="append",
+                               help="the chat to export, can be repeated, every chat by default")
+    export_parser.add_argument("--output", default="-", help="the file written, stdout by default")
+    export_parser.add_argument("--chunk-size", type=int, default=100, help="messages read per LRANGE")
+    export_parser.add_argument("--archive", action="store_true",
+                               help="export the archived history instead, oldest first, see ARCHIVE_DIR")
+    export_parser.add_argument("--since", help="with --archive, the first day exported, e.g. 2024-05-01")
+    export_parser.add_argument("--until", help="with --archive, the last day exported, e.g. 2024-05-31")
+
+    import_parser = commands.add_parser("import", help="import an export")
+    import_parser.add_argument("path", help="the export, - for stdin")
+
+    telegram_parser = commands.add_parser("import-telegram", help="import a Telegram Desktop result.json")
+    telegram_parser.add_argument("path", help="the result.json")
+    telegram_parser.add_argument("--chat-id", type=int, help="the chat the history belongs to, derived by default")
+
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_args()
+
+    load_dotenv()
+    if not configure_message_storage():
+        raise SystemExit("Unable to connect to Redis")
+    redis_client = get_redis_client()
+
+    if args.command == "export":
+        output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+        try:
+            if args.archive:
+                exported = export_archived_chats(redis_client, get_segment_reader(), output, args.chat_id,
+                                                 args.since, args.until)
+            else:
+                exported = export_chats(redis_client, output, args.chat_id, args.chunk_size)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        logger.info(f"Exported {exported} messages")
+
+    elif args.command == "import":
+        lines = sys.stdin if args.path == "-" else open(args.path, encoding="utf-8")
+        try:
+            imported = import_messages(redis_client, read_export(lines))
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+        logger.info(f"Imported {imported} messages")
+
+    else:
+        with open(args.path, encoding="utf-8") as export_file:
+            chat_id, messages = read_telegram_desktop_export(json.load(export_file), args.chat_id)
+        # Telegram Desktop exports oldest first
+        imported = import_messages(redis_client, ((chat_id, message) for message in reversed(messages)))
+        logger.info(f"Imported {imported} of {len(messages)} messages into chat id: {chat_id}")
+
+
+if __name__ == '__main__':
+    configure_logging()
+    main()
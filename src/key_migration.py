@@ -0,0 +1,140 @@
+"""
+Online migration from the bare keys to the {chat:<id>} key schema.
+
+Before the schema in redis_keys, a chat's messages were stored under its bare
+chat id, and its other keys under their own prefixes. The migration runs in the
+background while the bot keeps serving, one chat at a time:
+
+    <chat_id>                              -> {chat:<id>}:messages, merged with messages stored since the upgrade,
+                                              and added to the search index when search is enabled
+    summary:pending:<chat_id>              -> {chat:<id>}:pending, added to the new count
+    digest:state:<chat_id>                 -> {chat:<id>}:digest, unless the new schema already has one
+    summary:<chat_id>:<style>:<n>          -> deleted, caches are rebuilt on the next summary
+
+Keys on different cluster slots can't be renamed, so they are copied and then
+deleted. Re-running the migration after an interruption is safe: messages that
+were already copied are recognised by their message id.
+"""
+import asyncio
+import json
+import logging
+import os
+from dataclasses import dataclass
+
+from redis import Redis
+
+from message_storage import MAX_MESSAGE_STORAGE, get_redis_client, invalidate_cached_window, is_search_enabled
+from redis_keys import chat_messages_key, pending_messages_key, digest_state_key
+from search_index import index_document
+from utils import str_to_bool
+
+logger = logging.getLogger(__name__)
+
+LEGACY_PENDING_KEY = "summary:pending:{chat_id}"
+LEGACY_DIGEST_STATE_KEY = "digest:state:{chat_id}"
+LEGACY_SUMMARY_CACHE_PATTERN = "summary:{chat_id}:*"
+
+
+@dataclass
+class MigrationReport:
+    """What the migration moved"""
+    chats: int = 0
+    messages: int = 0
+    deleted_caches: int = 0
+
+
+def migrate_legacy_keys(redis_client: Redis, scan_count: int = 1000) -> MigrationReport:
+    """
+    Moves every chat stored under the bare keys to the new key schema.
+    @param redis_client: The Redis client singleton
+    @param scan_count: how many keys each SCAN call looks at
+    @return: what was moved
+    """
+    report = MigrationReport()
+
+    # Collect first, the keys change while we migrate
+    legacy_chat_ids = [
+        int(key)
+        for key in redis_client.scan_iter(count=scan_count)
+        if key.lstrip(b'-').isdigit() and redis_client.type(key) == b'list'
+    ]
+
+    for chat_id in legacy_chat_ids:
+        report.messages += _migrate_messages(redis_client, chat_id)
+        _migrate_pending_count(redis_client, chat_id)
+        _migrate_digest_state(redis_client, chat_id)
+        report.deleted_caches += _delete_summary_caches(redis_client, chat_id, scan_count)
+        report.chats += 1
+        logger.debug(f"Migrated chat id: {chat_id} to the new key schema")
+
+    return report
+
+
+def _migrate_messages(redis_client: Redis, chat_id: int) -> int:
+    legacy_key = str(chat_id)
+    new_key = chat_messages_key(chat_id)
+
+    legacy_messages = redis_client.lrange(legacy_key, 0, -1)
+    migrated_ids = {json.loads(message)['message_id'] for message in redis_client.lrange(new_key, 0, -1)}
+
+    # Both lists are newest first, the legacy messages are older than any stored since the upgrade
+    missing = [message for message in legacy_messages if json.loads(message)['message_id'] not in migrated_ids]
+    if missing:
+        pipeline = redis_client.pipeline(transaction=False)
+        pipeline.rpush(new_key, *missing)
+        pipeline.ltrim(new_key, 0, MAX_MESSAGE_STORAGE - 1)
+        if is_search_enabled():
+            for message in missing:
+                fields = json.loads(message)
+                index_document(pipeline, chat_id, fields['message_id'], fields['content'], message)
+        pipeline.execute()
+        invalidate_cached_window(redis_client, chat_id)
+
+    redis_client.delete(legacy_key)
+    return len(missing)
+
+
+def _migrate_pending_count(redis_client: Redis, chat_id: int):
+    legacy_key = LEGACY_PENDING_KEY.format(chat_id=chat_id)
+    count = redis_client.get(legacy_key)
+    if count is None:
+        return
+
+    # Delete first, an interrupted migration may miss a few pending messages but never counts them twice
+    redis_client.delete(legacy_key)
+    if int(count) > 0:
+        redis_client.incrby(pending_messages_key(chat_id), int(count))
+
+
+def _migrate_digest_state(redis_client: Redis, chat_id: int):
+    legacy_key = LEGACY_DIGEST_STATE_KEY.format(chat_id=chat_id)
+    state = redis_client.hgetall(legacy_key)
+    if state and not redis_client.exists(digest_state_key(chat_id)):
+        redis_client.hset(digest_state_key(chat_id), mapping=state)
+    redis_client.delete(legacy_key)
+
+
+def _delete_summary_caches(redis_client: Redis, chat_id: int, scan_count: int) -> int:
+    keys = list(redis_client.scan_iter(match=LEGACY_SUMMARY_CACHE_PATTERN.format(chat_id=chat_id), count=scan_count))
+    for key in keys:
+        redis_client.delete(key)
+    return len(keys)
+
+
+async def run_key_migration_async():
+    """
+    Migrates the legacy keys on a worker thread, so the bot keeps serving meanwhile.
+    Enabled with REDIS_MIGRATE_LEGACY_KEYS=True, only needed once per deployment since it SCANs the whole keyspace.
+    """
+    if not str_to_bool(os.getenv('REDIS_MIGRATE_LEGACY_KEYS', False)):
+        return
+
+    try:
+        report = await asyncio.to_thread(migrate_legacy_keys, get_redis_client())
+    except Exception:
+        logger.exception("Failed to migrate the legacy Redis keys, the migration will resume on the next start")
+        return
+
+    if report.chats:
+        logger.info(f"Migrated {report.chats} chats and {report.messages} messages to the new key schema, "
+                    f"deleted {report.deleted_caches} cached summaries")
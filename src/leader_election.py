@@ -0,0 +1,274 @@
+"""
+Leader election with a Redis lease.
+
+Every instance of the bot starts its application, but only the leader polls
+Telegram and runs the singleton jobs: the digests, the archiver and the key
+migration. The others are warm standbys, with their connections open, so two
+instances never poll at once during a deploy, and a standby can take over at any time.
+
+The lease is a key with a TTL, only set if it doesn't exist. The leader renews
+it every LEADER_RENEW_SECONDS, and the standbys try to take it as often, so a
+standby takes over within LEADER_RENEW_SECONDS of the lease expiring. A leader
+that is shut down stops polling first, then releases the lease, so a rolling
+deploy hands over right away. A leader that can't renew steps down before its
+lease could have expired.
+
+Every time the lease is taken, its fencing counter is incremented and the new
+leader gets the count as its fencing token. A leader that was paused for longer
+than its lease, e.g. by a network partition, finds that its token is no longer
+the current one before it posts a digest.
+
+The lease is read and written in WATCH/MULTI transactions, so taking, renewing
+and releasing it is atomic without scripting. A Redis Cluster client has no
+WATCH, so there the lease is taken with SET NX PX, and renewed and released by
+Lua scripts that compare its value first, on the lease key alone.
+
+Configuration (env variables):
+    LEADER_ELECTION_ENABLED   elect a leader among the instances (default True)
+    LEADER_LEASE_SECONDS      how long the lease lasts without being renewed (default 10)
+    LEADER_RENEW_SECONDS      how often the lease is renewed, or tried by the standbys (default 3)
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Awaitable, Callable, Optional
+
+from redis import Redis
+from redis.cluster import RedisCluster
+
+from redis_keys import leader_lease_key, leader_fencing_key
+from utils import str_to_bool
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEADER_NAME = "bot"
+
+# Only extends or deletes the lease if it still has this instance's value
+_RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class LeaderLease:
+    """A lease on the leadership, held by at most one instance at a time"""
+
+    def __init__(self, redis_client: Redis, ttl_seconds: float, name: str = DEFAULT_LEADER_NAME,
+                 instance_id: Optional[str] = None):
+        self._redis_client = redis_client
+        self._ttl_ms = int(ttl_seconds * 1000)
+        self._lease_key = leader_lease_key(name)
+        self._fencing_key = leader_fencing_key(name)
+        self.instance_id = instance_id or f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+        self.fencing_token: Optional[int] = None
+        self._is_cluster = isinstance(redis_client, RedisCluster)
+        if self._is_cluster:
+            self._renew_script = redis_client.register_script(_RENEW_SCRIPT)
+            self._release_script = redis_client.register_script(_RELEASE_SCRIPT)
+
+    @property
+    def ttl_seconds(self) -> float:
+        return self._ttl_ms / 1000
+
+    def try_acquire(self) -> Optional[int]:
+        """
+        Takes the lease, if nobody holds it.
+        @return: the fencing token of the new lease, or None if another instance holds it
+        """
+        if self._is_cluster:
+            return self._try_acquire_with_set_nx()
+
+        def acquire(pipeline) -> Optional[int]:
+            if pipeline.exists(self._lease_key):
+                return None
+            token = int(pipeline.get(self._fencing_key) or 0) + 1
+            pipeline.multi()
+            pipeline.set(self._lease_key, self._lease_value(token), px=self._ttl_ms)
+            pipeline.set(self._fencing_key, token)
+            return token
+
+        token = self._redis_client.transaction(acquire, self._lease_key, self._fencing_key,
+                                               value_from_callable=True)
+        if token is not None:
+            self.fencing_token = token
+        return token
+
+    def renew(self) -> bool:
+        """
+        Extends the lease, if this instance still holds it.
+        @return: False if the lease was lost
+        """
+        if self.fencing_token is None:
+            return False
+
+        if self._is_cluster:
+            renewed = bool(self._renew_script(keys=[self._lease_key],
+                                              args=[self._lease_value(self.fencing_token), self._ttl_ms]))
+            if not renewed:
+                self.fencing_token = None
+            return renewed
+
+        def extend(pipeline) -> bool:
+            if pipeline.get(self._lease_key) != self._lease_value(self.fencing_token):
+                return False
+            pipeline.multi()
+            pipeline.pexpire(self._lease_key, self._ttl_ms)
+            return True
+
+        renewed = self._redis_client.transaction(extend, self._lease_key, value_from_callable=True)
+        if not renewed:
+            self.fencing_token = None
+        return renewed
+
+    def release(self):
+        """
+        Gives up the lease, if this instance still holds it, so a standby can take it right away.
+        """
+        if self.fencing_token is None:
+            return
+
+        if self._is_cluster:
+            self._release_script(keys=[self._lease_key], args=[self._lease_value(self.fencing_token)])
+            self.fencing_token = None
+            return
+
+        def delete(pipeline):
+            if pipeline.get(self._lease_key) == self._lease_value(self.fencing_token):
+                pipeline.multi()
+                pipeline.delete(self._lease_key)
+
+        self._redis_client.transaction(delete, self._lease_key)
+        self.fencing_token = None
+
+    def is_current(self, fencing_token: int) -> bool:
+        """
+        @param fencing_token: the token the leader was elected with
+        @return: True if the lease with that token hasn't been lost
+        """
+        return self._redis_client.get(self._lease_key) == self._lease_value(fencing_token)
+
+    def _try_acquire_with_set_nx(self) -> Optional[int]:
+        # Checked first so the standbys don't increment the fencing counter every time they try
+        if self._redis_client.exists(self._lease_key):
+            return None
+        # A token lost to a race with another instance is skipped, the tokens still only increase
+        token = self._redis_client.incr(self._fencing_key)
+        if not self._redis_client.set(self._lease_key, self._lease_value(token), nx=True, px=self._ttl_ms):
+            return None
+        self.fencing_token = token
+        return token
+
+    def _lease_value(self, fencing_token: int) -> bytes:
+        return f"{fencing_token}:{self.instance_id}".encode('utf-8')
+
+
+class LeaderElection:
+    """Runs a job while this instance is the leader, and cancels it when it isn't anymore"""
+
+    def __init__(self, lease: LeaderLease, renew_interval_seconds: float):
+        self.lease = lease
+        self._renew_interval_seconds = renew_interval_seconds
+        self._leader_task: Optional[asyncio.Task] = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._leader_task is not None and not self._leader_task.done()
+
+    async def run(self, lead: Callable[[int], Awaitable]):
+        """
+        Takes part in the election for as long as the bot runs.
+        @param lead: run while this instance leads, with its fencing token, cancelled when it stops leading
+        """
+        logger.info(f"Instance {self.lease.instance_id} is taking part in the leader election")
+        valid_until = 0.0
+        try:
+            while True:
+                attempted_at = time.monotonic()
+                if self._leader_task is None:
+                    token = await self._call_lease(self.lease.try_acquire)
+                    if token is not None:
+                        valid_until = attempted_at + self.lease.ttl_seconds
+                        logger.info(f"Elected the leader with fencing token {token}")
+                        self._leader_task = asyncio.create_task(lead(token))
+
+                elif self._leader_task.done():
+                    if not self._leader_task.cancelled() and self._leader_task.exception():
+                        logger.error("The leader's jobs failed, stepping down", exc_info=self._leader_task.exception())
+                    await self._step_down()
+
+                else:
+                    renewed = await self._call_lease(self.lease.renew)
+                    if renewed:
+                        valid_until = attempted_at + self.lease.ttl_seconds
+                    elif renewed is False or time.monotonic() + self._renew_interval_seconds >= valid_until:
+                        # Lost, or it may expire before the next renewal
+                        logger.warning("Lost the leader lease, stepping down")
+                        await self._step_down()
+
+                await asyncio.sleep(self._renew_interval_seconds)
+        finally:
+            await self._step_down()
+
+    async def _step_down(self):
+        leader_task, self._leader_task = self._leader_task, None
+        if leader_task is not None:
+            # The jobs stop before the lease is released, so the next leader never overlaps them
+            leader_task.cancel()
+            await asyncio.gather(leader_task, return_exceptions=True)
+        await self._call_lease(self.lease.release)
+
+    @staticmethod
+    async def _call_lease(operation: Callable):
+        try:
+            return await asyncio.to_thread(operation)
+        except Exception:
+            logger.exception("Unable to reach the leader lease")
+            return None
+
+
+_leader_election: Optional[LeaderElection] = None
+
+
+def configure_leader_election(redis_client: Redis) -> Optional[LeaderElection]:
+    """
+    Turns on the leader election, if LEADER_ELECTION_ENABLED.
+    @param redis_client: The Redis client singleton
+    @return: the election, or None if this instance always leads
+    """
+    global _leader_election
+
+    if not str_to_bool(os.getenv('LEADER_ELECTION_ENABLED', True)):
+        _leader_election = None
+        return None
+
+    lease = LeaderLease(redis_client, ttl_seconds=float(os.getenv('LEADER_LEASE_SECONDS', 10)))
+    _leader_election = LeaderElection(lease, renew_interval_seconds=float(os.getenv('LEADER_RENEW_SECONDS', 3)))
+    return _leader_election
+
+
+def get_leader_election() -> Optional[LeaderElection]:
+    return _leader_election
+
+
+def holds_leadership() -> bool:
+    """
+    Checks the fencing token before a side effect that only the leader may have, e.g. posting a digest.
+    @return: True if this instance still leads, or if there is no election
+    """
+    election = get_leader_election()
+    if election is None:
+        return True
+
+    token = election.lease.fencing_token
+    return token is not None and election.lease.is_current(token)
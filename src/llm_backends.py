@@ -0,0 +1,334 @@
+"""
+Summarizer backends.
+
+A backend turns a window of messages into a summary. The OpenAI backend is the
+default. A local model served behind an OpenAI-compatible API (e.g. llama.cpp's
+server) and an extractive summarizer that runs on the CPU can serve chosen
+chats, small windows, or every chat while the primary backend is failing.
+
+Configuration (env variables):
+    LLM_BACKEND               the primary backend: openai, local or extractive (default openai)
+    LLM_FALLBACK_BACKEND      used when the primary backend fails, empty to disable (default extractive)
+    LLM_CHAT_BACKENDS         per chat overrides, e.g. "-4257039919:local,-4170925867:extractive"
+    LLM_LOCAL_MAX_MESSAGES    windows up to this size use the fallback backend directly (default 0, disabled)
+    OPENAI_MODEL              the OpenAI model (default gpt-4o-mini)
+    OPENAI_MODEL_TIERS        the OpenAI model tiers, see openai_utils.parse_model_tiers (default OPENAI_MODEL only)
+    OPENAI_DEADLINE_SECONDS   how long an OpenAI summary may take, including retries (default 60)
+    OPENAI_MAX_ATTEMPTS       attempts per OpenAI summary (default 3)
+    OPENAI_HEDGING_ENABLED    send a duplicate request when an attempt is slower than the p95 (default True)
+    OPENAI_BREAKER_FAILURES   consecutive failures that open the OpenAI circuit (default 5)
+    OPENAI_BREAKER_RESET_SECONDS  how long the OpenAI circuit stays open before a trial call (default 30)
+    LOCAL_LLM_URL             base URL of the local OpenAI-compatible server (default http://localhost:8080/v1)
+    LOCAL_LLM_MODEL           the model name the local server expects (default local)
+"""
+import logging
+import math
+import os
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Optional, Protocol
+
+from openai import OpenAI
+
+from message_storage import Message
+from openai_utils import (get_ai_client, format_message_for_openai, summarize_messages_as_paragraph,
+                          summarize_messages_as_bullet_points, CompletionResult, OPEN_AI_MODEL, ModelRouter,
+                          get_model_router, get_openai_caller)
+from resilience import ResilientCaller, CircuitOpenError, CircuitState
+from utils import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+OPENAI_BACKEND = "openai"
+LOCAL_BACKEND = "local"
+EXTRACTIVE_BACKEND = "extractive"
+
+DEFAULT_LOCAL_LLM_URL = "http://localhost:8080/v1"
+
+
+class SummaryStyle(Enum):
+    """How the summary is written"""
+    PARAGRAPH = "paragraph"
+    BULLET_POINTS = "bullet_points"
+
+
+@dataclass
+class Summary:
+    """A summary and what it cost to write"""
+    text: str
+    backend: str
+    model: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+class SummarizerBackend(Protocol):
+    """Writes summaries of chat messages"""
+    name: str
+
+    def summarize(self, messages: list[Message], style: SummaryStyle) -> Summary:
+        """
+        Summarizes the messages. Blocking, callers run it on a worker thread.
+        @param messages: the messages, oldest first
+        @param style: how the summary is written
+        @return: the summary
+        """
+        ...
+
+
+class OpenAIBackend:
+    """
+    Summarizes with an OpenAI chat completion model.
+    With a router, the model, its limits and the window are picked per summary.
+    With a caller, completions get a deadline, retries, hedging and a circuit breaker.
+    """
+
+    def __init__(self,
+                 model: str,
+                 name: str = OPENAI_BACKEND,
+                 router: Optional[ModelRouter] = None,
+                 caller: Optional[ResilientCaller] = None):
+        self.name = name
+        self.model = model
+        self._router = router
+        self._caller = caller
+
+    @property
+    def available(self) -> bool:
+        """False while the circuit is open and calls fail fast"""
+        return self._caller is None or self._caller.breaker.state is not CircuitState.OPEN
+
+    def _get_client(self) -> OpenAI:
+        return get_ai_client()
+
+    def summarize(self, messages: list[Message], style: SummaryStyle) -> Summary:
+        prompt_message_schema = format_message_for_openai(messages)
+        model, max_tokens, timeout = self.model, None, None
+
+        if self._router is not None:
+            decision = self._router.route(estimate_tokens(len(prompt_message_schema)))
+            if decision.window_scale < 1:
+                # Too slow for the whole window, summarize the latest messages only
+                keep = max(1, int(len(messages) * decision.window_scale))
+                logger.info(f"Summarizing the latest {keep} of {len(messages)} messages while degraded")
+                prompt_message_schema = format_message_for_openai(messages[-keep:])
+            model, max_tokens, timeout = decision.tier.model, decision.tier.max_tokens, decision.tier.timeout_seconds
+
+        if self._caller is None:
+            return self._to_summary(self._attempt(prompt_message_schema, style, model, max_tokens, timeout))
+
+        result = self._caller.call(
+            lambda time_left: self._attempt(prompt_message_schema, style, model, max_tokens,
+                                            min(timeout or time_left, time_left))
+        )
+        return self._to_summary(result)
+
+    def _attempt(self,
+                 prompt_message_schema: str,
+                 style: SummaryStyle,
+                 model: str,
+                 max_tokens: Optional[int] = None,
+                 timeout: Optional[float] = None) -> CompletionResult:
+        if self._router is None:
+            return self._complete(prompt_message_schema, style, model, max_tokens, timeout)
+
+        with self._router.track():
+            return self._complete(prompt_message_schema, style, model, max_tokens, timeout)
+
+    def _complete(self,
+                  prompt_message_schema: str,
+                  style: SummaryStyle,
+                  model: str,
+                  max_tokens: Optional[int] = None,
+                  timeout: Optional[float] = None) -> CompletionResult:
+        if style is SummaryStyle.BULLET_POINTS:
+            summarize = summarize_messages_as_bullet_points
+        else:
+            summarize = summarize_messages_as_paragraph
+
+        return summarize(self._get_client(), prompt_message_schema, model, max_tokens, timeout)
+
+    def _to_summary(self, result: CompletionResult) -> Summary:
+        return Summary(
+            text=result.content,
+            backend=self.name,
+            model=result.model,
+            prompt_tokens=result.prompt_tokens,
+            completion_tokens=result.completion_tokens
+        )
+
+
+class LocalServerBackend(OpenAIBackend):
+    """
+    Summarizes with a model served locally behind an OpenAI-compatible API, e.g. llama.cpp's server.
+    The client is only created the first time it is used.
+    """
+
+    def __init__(self, base_url: str, model: str):
+        super().__init__(model, name=LOCAL_BACKEND)
+        self._base_url = base_url
+        self._client: Optional[OpenAI] = None
+
+    def _get_client(self) -> OpenAI:
+        if self._client is None:
+            self._client = OpenAI(base_url=self._base_url, api_key="local")
+        return self._client
+
+
+class ExtractiveBackend:
+    """
+    Summarizes by picking the most informative messages, on the CPU.
+    Messages are scored by how many of the chat's frequent words they contain.
+    Predictable latency and no per-token cost, at the price of quality.
+    """
+    name = EXTRACTIVE_BACKEND
+
+    _WORD_PATTERN = re.compile(r"[a-z0-9']{3,}")
+    _STOP_WORDS = frozenset(
+        "the and for are but not you all any can had her was one our out has him his how its may new now "
+        "see two who did get she too use that with have this will your from they know want been good much "
+        "some time very when come here just like long make many more only over such take than them well "
+        "were what lol lmao yeah okay".split()
+    )
+
+    def __init__(self, min_sentences: int = 3, max_sentences: int = 8):
+        self._min_sentences = min_sentences
+        self._max_sentences = max_sentences
+
+    def summarize(self, messages: list[Message], style: SummaryStyle) -> Summary:
+        selected = self._select_messages(messages)
+
+        if style is SummaryStyle.BULLET_POINTS:
+            text = '\n'.join(f"- {msg.owner_name}: {msg.content}" for msg in selected)
+        else:
+            text = ' '.join(f"{msg.owner_name} said: {msg.content.rstrip('.')}." for msg in selected)
+
+        return Summary(text=text, backend=self.name, model=self.name)
+
+    def _select_messages(self, messages: list[Message]) -> list[Message]:
+        tokenized = [self._content_words(msg.content) for msg in messages]
+        frequencies = Counter(word for words in tokenized for word in set(words))
+
+        scores = []
+        for index, words in enumerate(tokenized):
+            if not words:
+                continue
+            # Favour messages with many frequent words, without favouring long messages too much
+            score = sum(frequencies[word] for word in set(words)) / math.sqrt(len(words))
+            scores.append((score, index))
+
+        limit = min(self._max_sentences, max(self._min_sentences, len(messages) // 10))
+        best = sorted(scores, reverse=True)[:limit]
+
+        # Keep the chronological order
+        return [messages[index] for _, index in sorted(best, key=lambda score_and_index: score_and_index[1])]
+
+    def _content_words(self, content: str) -> list[str]:
+        return [word for word in self._WORD_PATTERN.findall(content.lower()) if word not in self._STOP_WORDS]
+
+
+@dataclass
+class BackendSelection:
+    """Which backend serves which chat"""
+    primary: str = OPENAI_BACKEND
+    fallback: Optional[str] = EXTRACTIVE_BACKEND
+    chat_overrides: dict[int, str] = field(default_factory=dict)
+    local_max_messages: int = 0
+
+    @staticmethod
+    def from_env() -> 'BackendSelection':
+        overrides = {}
+        for override in filter(None, os.getenv('LLM_CHAT_BACKENDS', '').split(',')):
+            chat_id, backend = override.rsplit(':', 1)
+            overrides[int(chat_id)] = backend.strip()
+
+        return BackendSelection(
+            primary=os.getenv('LLM_BACKEND', OPENAI_BACKEND),
+            fallback=os.getenv('LLM_FALLBACK_BACKEND', EXTRACTIVE_BACKEND) or None,
+            chat_overrides=overrides,
+            local_max_messages=int(os.getenv('LLM_LOCAL_MAX_MESSAGES', 0)),
+        )
+
+
+_backends: dict[str, SummarizerBackend] = {}
+_selection = BackendSelection()
+
+
+def configure_backends(selection: Optional[BackendSelection] = None):
+    """
+    Registers the backends and how they are selected.
+    @param selection: read from the env variables by default
+    """
+    global _selection
+
+    _backends.clear()
+    register_backend(OpenAIBackend(os.getenv('OPENAI_MODEL', OPEN_AI_MODEL),
+                                   router=get_model_router(),
+                                   caller=get_openai_caller()))
+    register_backend(LocalServerBackend(os.getenv('LOCAL_LLM_URL', DEFAULT_LOCAL_LLM_URL),
+                                        os.getenv('LOCAL_LLM_MODEL', 'local')))
+    register_backend(ExtractiveBackend())
+
+    _selection = selection or BackendSelection.from_env()
+    logger.info(f"Summaries use the {_selection.primary} backend, falling back to {_selection.fallback}")
+
+
+def register_backend(backend: SummarizerBackend):
+    _backends[backend.name] = backend
+
+
+def get_backend(name: str) -> SummarizerBackend:
+    if not _backends:
+        configure_backends(_selection)
+    return _backends[name]
+
+
+def select_backends(chat_id: Optional[int], number_of_msgs: int) -> list[SummarizerBackend]:
+    """
+    Returns the backends to try for a summary, in order.
+    @param chat_id: The unique identifier for the chat session.
+    @param number_of_msgs: the size of the window being summarized
+    @return: the backends
+    """
+    if _selection.fallback and number_of_msgs <= _selection.local_max_messages:
+        return [get_backend(_selection.fallback)]
+
+    primary = _selection.chat_overrides.get(chat_id, _selection.primary)
+    names = [primary]
+    if _selection.fallback and _selection.fallback != primary:
+        names.append(_selection.fallback)
+
+    return [get_backend(name) for name in names]
+
+
+def is_primary_backend_available(chat_id: Optional[int]) -> bool:
+    """
+    Checks if the chat's primary backend can take calls, i.e. its circuit is not open
+    @param chat_id: The unique identifier for the chat session.
+    @return: False if summaries would fail fast
+    """
+    backend = get_backend(_selection.chat_overrides.get(chat_id, _selection.primary))
+    return getattr(backend, "available", True)
+
+
+def summarize_with_backends(chat_id: Optional[int], messages: list[Message], style: SummaryStyle) -> Summary:
+    """
+    Summarizes with the chat's backend, falling back to the next one if it fails.
+    Blocking, callers run it on a worker thread.
+    @param chat_id: The unique identifier for the chat session.
+    @param messages: the messages, oldest first
+    @param style: how the summary is written
+    @return: the summary
+    """
+    backends = select_backends(chat_id, len(messages))
+    for backend in backends[:-1]:
+        try:
+            return backend.summarize(messages, style)
+        except CircuitOpenError:
+            logger.warning(f"The {backend.name} backend is unavailable, falling back for chat id: {chat_id}")
+        except Exception:
+            logger.exception(f"The {backend.name} backend failed to summarize chat id: {chat_id}, falling back")
+
+    return backends[-1].summarize(messages, style)
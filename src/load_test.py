@@ -0,0 +1,403 @@
+"""
+Load-test harness for the chat-nuff bot.
+
+Replays a synthetic stream of Telegram updates through the same handlers that
+`get_application` registers, without talking to Telegram or OpenAI.
+Both are replaced by local stubs with configurable latency.
+
+Usage:
+    python src/load_test.py --chats 200 --rate 2000 --duration 30
+"""
+import argparse
+import asyncio
+import logging
+import random
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from dotenv import load_dotenv
+from redis import Redis
+from telegram import Bot, Chat, Message, MessageEntity, Update, User
+from telegram.ext import Application, ApplicationBuilder
+
+import message_storage
+import openai_utils
+import telegram_bot
+from update_processing import build_update_processor
+from utils import percentile
+
+logger = logging.getLogger(__name__)
+
+STUB_BOT_TOKEN = "123456:load-test"
+STUB_BOT_USERNAME = "chat_nuff_load_test_bot"
+
+SAMPLE_WORDS = (
+    "meeting tomorrow dinner plans football match tickets birthday party "
+    "weekend trip flight delayed lol who is bringing drinks traffic was crazy "
+    "did you see the game last night send me the link pictures from saturday"
+).split()
+
+
+@dataclass
+class LoadTestConfig:
+    """Shape of the synthetic traffic and the latency of the stubs"""
+    chats: int = 100
+    users_per_chat: int = 10
+    messages_per_second: float = 500
+    duration_seconds: float = 10
+    command_ratio: float = 0.01
+    bot_latency_ms: float = 50
+    openai_latency_ms: float = 800
+    loop_lag_interval_ms: float = 50
+    whitelist_all_chats: bool = True
+    seed: int = 42
+
+
+@dataclass
+class LoadTestReport:
+    """Results of a load-test run"""
+    updates_sent: int
+    elapsed_seconds: float
+    handler_latencies_ms: dict[str, list[float]]
+    loop_lag_ms: list[float]
+    redis_ops: Counter
+    bot_api_calls: Counter
+    openai_calls: int
+
+    def format(self) -> str:
+        lines = [
+            f"Updates sent: {self.updates_sent} in {self.elapsed_seconds:.1f}s "
+            f"({self.updates_sent / self.elapsed_seconds:.0f} updates/s)",
+            "",
+            f"{'handler':<32}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}",
+        ]
+        for name, samples in sorted(self.handler_latencies_ms.items()):
+            if not samples:
+                continue
+            lines.append(
+                f"{name:<32}{len(samples):>8}{percentile(samples, 50):>10.1f}"
+                f"{percentile(samples, 99):>10.1f}{max(samples):>10.1f}"
+            )
+
+        total_redis_ops = sum(self.redis_ops.values())
+        lines += [
+            "",
+            f"Event-loop lag: p50 {percentile(self.loop_lag_ms, 50):.1f} ms, "
+            f"p99 {percentile(self.loop_lag_ms, 99):.1f} ms, "
+            f"max {max(self.loop_lag_ms, default=0.0):.1f} ms",
+            f"Redis ops: {total_redis_ops} ({total_redis_ops / self.elapsed_seconds:.0f} ops/s) "
+            f"{dict(self.redis_ops.most_common())}",
+            f"Bot API calls: {dict(self.bot_api_calls.most_common())}",
+            f"OpenAI calls: {self.openai_calls}",
+        ]
+        return "\n".join(lines)
+
+
+class StubBot(Bot):
+    """
+    Bot that never talks to Telegram.
+    Every Bot API request sleeps for the configured latency and succeeds.
+    """
+
+    def __init__(self, latency_ms: float):
+        super().__init__(token=STUB_BOT_TOKEN)
+        with self._unfrozen():
+            self.latency_seconds = latency_ms / 1000
+            self.api_calls = Counter()
+
+    async def initialize(self) -> None:
+        self._bot_user = User(id=123456, first_name="ChatNuff", is_bot=True, username=STUB_BOT_USERNAME)
+        self._initialized = True
+
+    async def shutdown(self) -> None:
+        self._initialized = False
+
+    async def _do_post(self, endpoint: str, data: dict, **kwargs) -> bool:
+        self.api_calls[endpoint] += 1
+        await asyncio.sleep(self.latency_seconds)
+        return True
+
+
+class StubOpenAI:
+    """
+    Stand-in for the OpenAI client.
+    Completions block for the configured latency, the same way the real synchronous client does.
+    """
+
+    def __init__(self, latency_ms: float):
+        self.latency_seconds = latency_ms / 1000
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_completion))
+
+    def _create_completion(self, model: str, messages: list[dict], **kwargs):
+        self.calls += 1
+        time.sleep(self.latency_seconds)
+        prompt_tokens = sum(len(message["content"]) for message in messages) // 4
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="- Stub summary\n- Of the chat"))],
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=8,
+                                  total_tokens=prompt_tokens + 8),
+        )
+
+
+class SyntheticUpdateFactory:
+    """Builds realistic Telegram updates for a fixed set of chats and users"""
+
+    def __init__(self, bot: Bot, config: LoadTestConfig):
+        self._bot = bot
+        self._config = config
+        self._random = random.Random(config.seed)
+        self._update_id = 0
+        self._message_ids: dict[int, int] = defaultdict(int)
+        self._chats = [
+            Chat(id=-4_000_000_000 - index, type=Chat.SUPERGROUP, title=f"Load test chat {index}")
+            for index in range(config.chats)
+        ]
+        self._users = [
+            User(id=10_000 + index, first_name=f"User{index}", last_name=None if index % 3 else "Tester",
+                 is_bot=False)
+            for index in range(config.users_per_chat * 4)
+        ]
+
+    def next_update(self) -> Update:
+        chat = self._random.choice(self._chats)
+        user = self._users[(abs(chat.id) + self._random.randrange(self._config.users_per_chat)) % len(self._users)]
+
+        if self._random.random() < self._config.command_ratio:
+            text, entities = self._command_text()
+        else:
+            text, entities = self._chatter_text(), None
+
+        self._update_id += 1
+        self._message_ids[chat.id] += 1
+        message = Message(
+            message_id=self._message_ids[chat.id],
+            date=datetime.now(timezone.utc),
+            chat=chat,
+            from_user=user,
+            text=text,
+            entities=entities,
+        )
+        message.set_bot(self._bot)
+        return Update(update_id=self._update_id, message=message)
+
+    def _chatter_text(self) -> str:
+        return " ".join(self._random.choices(SAMPLE_WORDS, k=self._random.randint(1, 25)))
+
+    def _command_text(self) -> tuple[str, list[MessageEntity]]:
+        command = self._random.choice([
+            telegram_bot.GIST_COMMAND,
+            telegram_bot.SUMMARY_COMMAND,
+            telegram_bot.WHISPER_GIST_COMMAND,
+            telegram_bot.WHISPER_COMMAND,
+        ])
+        number_of_messages = self._random.choice([25, 50, 100, message_storage.MAX_MESSAGE_STORAGE])
+        entity = MessageEntity(type=MessageEntity.BOT_COMMAND, offset=0, length=len(command) + 1)
+        return f"/{command} {number_of_messages}", [entity]
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up a sleeping coroutine"""
+
+    def __init__(self, interval_ms: float):
+        self.interval_seconds = interval_ms / 1000
+        self.samples_ms: list[float] = []
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            scheduled = loop.time()
+            await asyncio.sleep(self.interval_seconds)
+            lag = loop.time() - scheduled - self.interval_seconds
+            self.samples_ms.append(max(lag, 0.0) * 1000)
+
+
+def _count_redis_ops(redis_client: Redis) -> Counter:
+    """
+    Counts every command the client sends to Redis.
+    @param redis_client: the client used by the bot during the run
+    @return: a counter keyed by the command name, updated as commands are sent
+    """
+    redis_ops = Counter()
+    execute_command = redis_client.execute_command
+
+    def counting_execute_command(*args, **options):
+        redis_ops[str(args[0]).upper()] += 1
+        return execute_command(*args, **options)
+
+    def counting_pipeline(*args, **kwargs):
+        pipeline = create_pipeline(*args, **kwargs)
+        execute_pipeline = pipeline.execute
+
+        def counting_execute(*execute_args, **execute_kwargs):
+            for command_args, _ in pipeline.command_stack:
+                redis_ops[str(command_args[0]).upper()] += 1
+            return execute_pipeline(*execute_args, **execute_kwargs)
+
+        pipeline.execute = counting_execute
+        return pipeline
+
+    create_pipeline = redis_client.pipeline
+    redis_client.execute_command = counting_execute_command
+    redis_client.pipeline = counting_pipeline
+    return redis_ops
+
+
+def _time_handlers(application: Application, latencies_ms: dict[str, list[float]]):
+    """Wraps every registered handler callback to record how long it takes"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = _timed_callback(handler.callback, latencies_ms[handler.callback.__name__])
+
+
+def _timed_callback(callback, samples_ms: list[float]):
+    async def timed(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            samples_ms.append((time.perf_counter() - started) * 1000)
+
+    timed.__name__ = callback.__name__
+    return timed
+
+
+def build_load_test_application(bot: Bot) -> Application:
+    """
+    Assembles the same handlers and update processing as `get_application`, around a stubbed bot
+    and without an updater.
+    @param bot: the stubbed bot
+    @return: the application
+    """
+    application = ApplicationBuilder().bot(bot).updater(None).concurrent_updates(build_update_processor()).build()
+    for handler in [*telegram_bot.get_handlers(), *telegram_bot.get_admin_handlers()]:
+        application.add_handler(handler)
+
+    return application
+
+
+async def run_load_test(config: LoadTestConfig, redis_client: Redis) -> LoadTestReport:
+    """
+    Replays synthetic updates at the configured rate and measures the bot.
+    The Redis and OpenAI singletons are swapped for the duration of the run, then restored.
+    @param config: the shape of the traffic
+    @param redis_client: the Redis client the bot should use
+    @return: the report of the run
+    """
+    original_redis_client = getattr(message_storage, "redis_client_singleton", None)
+    original_ai_client = openai_utils.open_client_singleton
+    original_is_whitelisted = telegram_bot.is_whitelisted
+
+    ai_client = StubOpenAI(config.openai_latency_ms)
+    message_storage.redis_client_singleton = redis_client
+    openai_utils.open_client_singleton = ai_client
+    if config.whitelist_all_chats:
+        telegram_bot.is_whitelisted = lambda chat_id: True
+
+    try:
+        return await _replay_updates(config, redis_client, ai_client)
+    finally:
+        message_storage.redis_client_singleton = original_redis_client
+        openai_utils.open_client_singleton = original_ai_client
+        telegram_bot.is_whitelisted = original_is_whitelisted
+
+
+async def _replay_updates(config: LoadTestConfig, redis_client: Redis, ai_client: StubOpenAI) -> LoadTestReport:
+    bot = StubBot(config.bot_latency_ms)
+    redis_ops = _count_redis_ops(redis_client)
+
+    application = build_load_test_application(bot)
+    handler_latencies_ms: dict[str, list[float]] = defaultdict(list)
+    _time_handlers(application, handler_latencies_ms)
+
+    factory = SyntheticUpdateFactory(bot, config)
+    lag_monitor = LoopLagMonitor(config.loop_lag_interval_ms)
+
+    await application.initialize()
+    await application.start()
+    lag_task = asyncio.create_task(lag_monitor.run())
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    updates_sent = 0
+    total_updates = int(config.messages_per_second * config.duration_seconds)
+    logger.info(f"Replaying {total_updates} updates across {config.chats} chats")
+
+    while updates_sent < total_updates:
+        # Pace the producer so the offered load matches the configured rate
+        due = started + updates_sent / config.messages_per_second
+        delay = due - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        await application.update_queue.put(factory.next_update())
+        updates_sent += 1
+
+    await application.update_queue.join()
+    elapsed = loop.time() - started
+
+    lag_task.cancel()
+    await application.stop()
+    await application.shutdown()
+
+    return LoadTestReport(
+        updates_sent=updates_sent,
+        elapsed_seconds=elapsed,
+        handler_latencies_ms=dict(handler_latencies_ms),
+        loop_lag_ms=lag_monitor.samples_ms,
+        redis_ops=redis_ops,
+        bot_api_calls=bot.api_calls,
+        openai_calls=ai_client.calls,
+    )
+
+
+def _parse_args() -> argparse.Namespace:
+    defaults = LoadTestConfig()
+    parser = argparse.ArgumentParser(description="Replay synthetic Telegram traffic against the bot")
+    parser.add_argument("--chats", type=int, default=defaults.chats)
+    parser.add_argument("--users-per-chat", type=int, default=defaults.users_per_chat)
+    parser.add_argument("--rate", type=float, default=defaults.messages_per_second, help="updates per second")
+    parser.add_argument("--duration", type=float, default=defaults.duration_seconds, help="seconds")
+    parser.add_argument("--command-ratio", type=float, default=defaults.command_ratio,
+                        help="fraction of updates that are summary commands")
+    parser.add_argument("--bot-latency-ms", type=float, default=defaults.bot_latency_ms)
+    parser.add_argument("--openai-latency-ms", type=float, default=defaults.openai_latency_ms)
+    parser.add_argument("--real-redis", action="store_true",
+                        help="use the Redis configured by the REDIS_* env variables instead of an in-memory fake")
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_args()
+    load_dotenv()
+    config = LoadTestConfig(
+        chats=args.chats,
+        users_per_chat=args.users_per_chat,
+        messages_per_second=args.rate,
+        duration_seconds=args.duration,
+        command_ratio=args.command_ratio,
+        bot_latency_ms=args.bot_latency_ms,
+        openai_latency_ms=args.openai_latency_ms,
+    )
+
+    if args.real_redis:
+        if not message_storage.configure_message_storage():
+            raise SystemExit("Unable to connect to Redis")
+        redis_client = message_storage.get_redis_client()
+    else:
+        from fakeredis import FakeRedis  # Dev dependency, only needed for the in-memory mode
+        redis_client = FakeRedis()
+
+    report = asyncio.run(run_load_test(config, redis_client))
+    print(report.format())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    main()
@@ -1,34 +1,72 @@
 import asyncio
 import logging
 import os
+import sys
 
+from dotenv import load_dotenv
 from telegram.error import Conflict
 
+from debug_tools import run_loop_lag_monitor_async, start_tracing_allocations_from_env
+from digest_scheduler import run_digest_scheduler_async
+from key_migration import run_key_migration_async
+from leader_election import configure_leader_election
+from message_archive import run_archiver_async
+from message_storage import get_redis_client, close_message_storage
 from server import run_server_async
+from startup import get_startup_timer, connect_message_storage_async, warm_up_async, StartupError
+from structured_logging import configure_logging
 from telegram_bot import get_application, run_bot_async
+from tracing import configure_tracing, shutdown_tracing
+from update_processing import install_uvloop
 from utils import str_to_bool
+from window_cache import run_invalidation_listener_async
 
 logger = logging.getLogger(__name__)
 
 
 async def main():
-    application = get_application()
+    startup_timer = get_startup_timer()
+    configure_tracing()
+    start_tracing_allocations_from_env()
+    # Logs the stack of anything that blocks the event loop, from startup on
+    loop_lag_task = asyncio.create_task(run_loop_lag_monitor_async())
+
+    # Answers the liveness probe while the bot starts, /ready turns green once it is warmed up
+    server_task = asyncio.create_task(run_server_async())
+    logger.info("Started the webserver")
+
+    with startup_timer.phase("storage"):
+        await connect_message_storage_async()
+
+    with startup_timer.phase("application"):
+        application = get_application()
     logger.info("Built the chat-nuff application")
 
-    bot_task = run_bot_async(application)
+    with startup_timer.phase("warmup"):
+        await warm_up_async(get_redis_client())
+
+    configure_leader_election(get_redis_client())
+
+    async def run_singleton_jobs_async():
+        # Moves chats stored under the old bare keys while the bot serves, when REDIS_MIGRATE_LEGACY_KEYS is on
+        migration_task = run_key_migration_async()
+        digest_task = run_digest_scheduler_async(application.bot)
+        archive_task = run_archiver_async()
+        await asyncio.gather(digest_task, migration_task, archive_task)
+
+    # Only the leader polls and runs the singleton jobs
+    bot_task = run_bot_async(application, run_singleton_jobs_async)
     logger.info("Running the chat-nuff application")
 
-    server_task = run_server_async()
-    logger.info("Started the webserver")
+    # Drops the cached windows of chats other replicas write to
+    invalidation_task = run_invalidation_listener_async(get_redis_client())
 
-    await asyncio.gather(bot_task, server_task)
+    await asyncio.gather(bot_task, server_task, invalidation_task, loop_lag_task)
 
 
 if __name__ == '__main__':
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO
-    )
+    load_dotenv()  # The logging is configured before the application reads the rest of the .env
+    configure_logging()
 
     debug_mode = str_to_bool(os.getenv('LOCAL', False))
 
@@ -37,11 +75,19 @@ if __name__ == '__main__':
         logging.getLogger('message_storage').setLevel(logging.DEBUG)
         logger.info("Running in LOCAL development mode! Do not use for production!")
 
+    install_uvloop()
+
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Application shutdown by KeyboardInterrupt successfully")
+    except StartupError:
+        logger.critical("Failed to start. Exiting the application.", exc_info=True)
+        sys.exit(1)  # Exit the program with an error code
     except Conflict:
         logger.info("Multiple bots are running. Likely due to a deployment in progress")
     except Exception:
         logger.exception("Unexpected exception happened in main")
+    finally:
+        close_message_storage()
+        shutdown_tracing()
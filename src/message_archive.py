@@ -0,0 +1,279 @@
+"""
+Archives the chat history to compressed segment files on local disk.
+
+Redis only keeps the latest messages of a chat. With archiving enabled,
+store_message also queues every message on the chat's {chat:<id>}:archive list,
+in the same pipeline, and the archiver drains the queues into append-only
+segment files, one per chat and day:
+
+    <ARCHIVE_DIR>/<chat_id>/<YYYY-MM-DD>.seg
+
+A segment is a sequence of frames, each a batch of messages as JSON lines,
+compressed with zstd if the "archive" extra is installed, or zlib otherwise:
+
+    magic (4 bytes) | codec (1 byte) | payload length (4 bytes) | payload crc32 (4 bytes) | payload
+
+A batch is popped off the queue with LPOP <count>, atomically with the producers,
+so exactly the messages that are written are removed, even when history is pushed
+to the head of the queue or the queue is trimmed at its cap. A batch that fails to
+be written is pushed back. A frame torn by a crash fails its length or crc check
+and ends the segment. Imported history can land in a day's segment after newer
+messages, so the reader sorts each day by message id, and skips repeats.
+The reader memory-maps the segments, so long ranges of history can be read
+without loading them back into Redis: history_cli exports them, and
+summarize_days summarizes a chat's last days from them.
+
+Each queue holds at most ARCHIVE_MAX_QUEUED messages. If the archiver falls that
+far behind, or isn't running, the oldest queued messages are dropped rather than
+growing Redis without bound.
+
+Configuration (env variables):
+    ARCHIVE_ENABLED              queue and archive the messages (default False)
+    ARCHIVE_DIR                  where the segments are written (default archive)
+    ARCHIVE_INTERVAL_SECONDS     how often the queues are drained (default 300)
+    ARCHIVE_BATCH_SIZE           the most messages written per frame (default 1000)
+    ARCHIVE_MAX_QUEUED           the most messages queued per chat, the oldest are dropped (default 50000)
+"""
+import asyncio
+import json
+import logging
+import mmap
+import os
+import struct
+import zlib
+from dataclasses import dataclass
+from datetime import date, datetime, timezone
+from pathlib import Path
+from typing import Iterator, Optional
+
+from redis import Redis
+
+from message_storage import Message, get_redis_client, get_all_chat_ids
+from redis_keys import archive_queue_key
+from utils import str_to_bool
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover, depends on the install
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = ".seg"
+
+_FRAME_MAGIC = b"CNSG"
+_FRAME_HEADER = struct.Struct("<4sBII")
+_ZLIB_CODEC = 0
+_ZSTD_CODEC = 1
+
+
+@dataclass
+class ArchiveConfig:
+    """Where and how often the messages are archived"""
+    enabled: bool = False
+    directory: Path = Path("archive")
+    interval_seconds: float = 5 * 60
+    batch_size: int = 1000
+
+    @staticmethod
+    def from_env() -> 'ArchiveConfig':
+        return ArchiveConfig(
+            enabled=str_to_bool(os.getenv('ARCHIVE_ENABLED', False)),
+            directory=Path(os.getenv('ARCHIVE_DIR', 'archive')),
+            interval_seconds=float(os.getenv('ARCHIVE_INTERVAL_SECONDS', 5 * 60)),
+            batch_size=int(os.getenv('ARCHIVE_BATCH_SIZE', 1000)),
+        )
+
+
+class SegmentWriter:
+    """Appends batches of messages to the segment files"""
+
+    def __init__(self, directory: Path, use_zstd: Optional[bool] = None):
+        self._directory = Path(directory)
+        self._codec = _ZSTD_CODEC if (zstandard is not None if use_zstd is None else use_zstd) else _ZLIB_CODEC
+        if self._codec == _ZSTD_CODEC and zstandard is None:
+            raise RuntimeError("zstd compression needs the 'archive' extra")
+
+    def append(self, chat_id: int, serialized_messages: list[bytes]) -> int:
+        """
+        Writes the messages to their day's segment, and waits until they are on disk.
+        @param chat_id: The unique identifier for the chat session.
+        @param serialized_messages: the stored messages, oldest first
+        @return: how many frames were written
+        """
+        batches: dict[str, list[bytes]] = {}
+        for serialized_message in serialized_messages:
+            day = _day_of(json.loads(serialized_message))
+            batches.setdefault(day, []).append(serialized_message)
+
+        chat_directory = self._directory / str(chat_id)
+        chat_directory.mkdir(parents=True, exist_ok=True)
+        for day, batch in batches.items():
+            frame = self._encode_frame(b"\n".join(batch))
+            with open(chat_directory / f"{day}{SEGMENT_SUFFIX}", "ab") as segment:
+                segment.write(frame)
+                segment.flush()
+                os.fsync(segment.fileno())
+
+        return len(batches)
+
+    def _encode_frame(self, payload: bytes) -> bytes:
+        if self._codec == _ZSTD_CODEC:
+            compressed = zstandard.ZstdCompressor(level=3).compress(payload)
+        else:
+            compressed = zlib.compress(payload, 6)
+        return _FRAME_HEADER.pack(_FRAME_MAGIC, self._codec, len(compressed), zlib.crc32(compressed)) + compressed
+
+
+class SegmentReader:
+    """Reads the archived history of the chats"""
+
+    def __init__(self, directory: Path):
+        self._directory = Path(directory)
+
+    def chat_ids(self) -> list[int]:
+        """
+        @return: the chats with archived messages
+        """
+        if not self._directory.is_dir():
+            return []
+        return sorted(int(path.name) for path in self._directory.iterdir() if path.name.lstrip('-').isdigit())
+
+    def days(self, chat_id: int) -> list[str]:
+        """
+        @param chat_id: The unique identifier for the chat session.
+        @return: the days with archived messages, oldest first, e.g. 2024-05-14
+        """
+        chat_directory = self._directory / str(chat_id)
+        if not chat_directory.is_dir():
+            return []
+        return sorted(path.stem for path in chat_directory.glob(f"*{SEGMENT_SUFFIX}"))
+
+    def read_messages(self,
+                      chat_id: int,
+                      start_day: Optional[str] = None,
+                      end_day: Optional[str] = None) -> Iterator[Message]:
+        """
+        Reads the archived messages of a chat, one day at a time, so at most a day is held in memory.
+        @param chat_id: The unique identifier for the chat session.
+        @param start_day: the first day read, e.g. 2024-05-14, the oldest by default
+        @param end_day: the last day read, the newest by default
+        @return: the messages, oldest first
+        """
+        for day in self.days(chat_id):
+            if (start_day and day < start_day) or (end_day and day > end_day):
+                continue
+
+            # Imported history is appended after the newer messages of its day, and can repeat
+            messages: dict[int, Message] = {}
+            for payload in self._read_frames(self._directory / str(chat_id) / f"{day}{SEGMENT_SUFFIX}"):
+                for line in payload.splitlines():
+                    message = Message(**json.loads(line))
+                    messages.setdefault(message.message_id, message)
+            yield from (messages[message_id] for message_id in sorted(messages))
+
+    @staticmethod
+    def _read_frames(path: Path) -> Iterator[bytes]:
+        with open(path, "rb") as segment:
+            if os.fstat(segment.fileno()).st_size == 0:
+                return
+            with mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                offset = 0
+                while offset + _FRAME_HEADER.size <= len(mapped):
+                    magic, codec, length, crc = _FRAME_HEADER.unpack_from(mapped, offset)
+                    start = offset + _FRAME_HEADER.size
+                    compressed = mapped[start:start + length]
+                    if magic != _FRAME_MAGIC or len(compressed) != length or zlib.crc32(compressed) != crc:
+                        logger.warning(f"Skipping the torn end of segment {path} at byte {offset}")
+                        return
+                    yield _decompress(codec, compressed)
+                    offset = start + length
+
+
+def _decompress(codec: int, compressed: bytes) -> bytes:
+    if codec == _ZLIB_CODEC:
+        return zlib.decompress(compressed)
+    if zstandard is None:
+        raise RuntimeError("The segment is zstd compressed, reading it needs the 'archive' extra")
+    return zstandard.ZstdDecompressor().decompress(compressed)
+
+
+def _day_of(fields: dict) -> str:
+    try:
+        created_at = datetime.fromisoformat(fields['created_at'])
+    except (KeyError, TypeError, ValueError):
+        return date.today().isoformat()
+
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone(timezone.utc)
+    return created_at.date().isoformat()
+
+
+class MessageArchiver:
+    """Drains the archive queues into the segments"""
+
+    def __init__(self, redis_client: Redis, writer: SegmentWriter, config: ArchiveConfig):
+        self._redis_client = redis_client
+        self._writer = writer
+        self._config = config
+
+    async def run(self):
+        logger.info(f"Archiving messages to {self._config.directory} every {self._config.interval_seconds}s")
+        while True:
+            await asyncio.sleep(self._config.interval_seconds)
+            try:
+                archived = await asyncio.to_thread(self.run_once)
+                logger.debug(f"Archived {archived} messages")
+            except Exception:
+                logger.exception("Failed to archive the messages")
+
+    def run_once(self) -> int:
+        """
+        Drains every chat's archive queue.
+        @return: how many messages were archived
+        """
+        return sum(self.archive_chat(chat_id) for chat_id in get_all_chat_ids(self._redis_client))
+
+    def archive_chat(self, chat_id: int) -> int:
+        """
+        Drains a chat's archive queue, a batch at a time.
+        @param chat_id: The unique identifier for the chat session.
+        @return: how many messages were archived
+        """
+        queue_key = archive_queue_key(chat_id)
+        archived = 0
+        while True:
+            batch = self._redis_client.lpop(queue_key, self._config.batch_size)
+            if not batch:
+                return archived
+
+            try:
+                self._writer.append(chat_id, batch)
+            except Exception:
+                # Back at the head, in the same order, for the next run
+                self._redis_client.lpush(queue_key, *reversed(batch))
+                raise
+            archived += len(batch)
+
+
+def get_segment_reader(config: Optional[ArchiveConfig] = None) -> SegmentReader:
+    """
+    @param config: read from the env variables by default
+    @return: a reader of the archived history
+    """
+    return SegmentReader((config or ArchiveConfig.from_env()).directory)
+
+
+async def run_archiver_async(config: Optional[ArchiveConfig] = None):
+    """
+    Runs the archiver in the current event loop, if archiving is enabled.
+    Only one instance of the bot should archive to a directory.
+    @param config: read from the env variables by default
+    """
+    config = config or ArchiveConfig.from_env()
+    if not config.enabled:
+        logger.info("Archiving is disabled")
+        return
+
+    archiver = MessageArchiver(get_redis_client(), SegmentWriter(config.directory), config)
+    await archiver.run()
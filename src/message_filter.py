@@ -0,0 +1,144 @@
+"""
+Deterministic pre-filter that prunes low-value messages before the prompt is assembled.
+
+Group chats are full of "lol", single emojis and the same link posted three times.
+None of it helps the model, but all of it costs prompt tokens. In one pass, the filter:
+    1. drops messages below an information threshold
+    2. drops near-identical repeats of a sender's earlier messages
+    3. collapses runs of consecutive messages from the same sender into one
+"""
+import re
+import unicodedata
+from dataclasses import dataclass, replace
+from urllib.parse import urlsplit, urlunsplit
+
+from message_storage import Message
+from utils import estimate_tokens
+
+MIN_INFORMATIVE_CHARS = 3
+COLLAPSED_MESSAGE_SEPARATOR = ". "
+
+FILLER_MESSAGES = frozenset(
+    "lol lool lmao lmfao rofl haha hahaha hehe ok okay kk k "
+    "true facts same wow omg nice cool thanks thx ty np word bet fr".split()
+)
+# Short, but they say who agreed to what, and the same answer can answer different questions
+ANSWER_MESSAGES = frozenset("yes yeah yea ya yep yup sure no nah nope".split())
+
+_URL_PATTERN = re.compile(r"https?://\S+")
+# Query parameters that only say where a link was shared from, every other parameter makes the link distinct
+_TRACKING_PARAMETER_PATTERN = re.compile(
+    r"^(?:utm_\w*|fbclid|gclid|dclid|gbraid|wbraid|msclkid|yclid|igshid|igsh|si|mc_cid|mc_eid|ref_src|_ga|_gl)$"
+)
+_REPEATED_CHARACTERS_PATTERN = re.compile(r"(.)\1{2,}")
+_NON_WORD_PATTERN = re.compile(r"[\W_]+")
+_LAUGHTER_PATTERN = re.compile(r"^(?:a?h+a+|h+e+|l+o+l+|l+m+a+o+)+h?$")
+
+
+@dataclass
+class FilterStats:
+    """What the filter removed"""
+    messages_in: int = 0
+    messages_out: int = 0
+    dropped_low_information: int = 0
+    dropped_duplicates: int = 0
+    collapsed: int = 0
+    prompt_chars_before: int = 0
+    prompt_chars_after: int = 0
+
+    @property
+    def tokens_saved(self) -> int:
+        return estimate_tokens(self.prompt_chars_before) - estimate_tokens(self.prompt_chars_after)
+
+
+def prune_messages(messages: list[Message]) -> tuple[list[Message], FilterStats]:
+    """
+    Removes messages that add nothing to a summary.
+    @param messages: the messages, oldest first
+    @return: the remaining messages, oldest first, and what was removed
+    """
+    stats = FilterStats(messages_in=len(messages), prompt_chars_before=_prompt_chars(messages))
+    seen: set[tuple[int, str]] = set()
+    pruned: list[Message] = []
+
+    for message in messages:
+        normalized = _normalize(message.content)
+
+        if _is_low_information(normalized):
+            stats.dropped_low_information += 1
+            continue
+
+        if normalized not in ANSWER_MESSAGES:
+            # Only the sender repeating themselves, different senders saying the same thing is a signal
+            key = (message.owner_id, normalized)
+            if key in seen:
+                stats.dropped_duplicates += 1
+                continue
+            seen.add(key)
+
+        previous = pruned[-1] if pruned else None
+        if previous is not None and previous.owner_id == message.owner_id:
+            pruned[-1] = replace(previous, content=_join(previous.content, message.content))
+            stats.collapsed += 1
+            continue
+
+        pruned.append(message)
+
+    if not pruned:
+        # Nothing worth keeping, let the summary say so rather than summarize nothing
+        pruned = list(messages)
+
+    stats.messages_out = len(pruned)
+    stats.prompt_chars_after = _prompt_chars(pruned)
+    return pruned, stats
+
+
+def _normalize(content: str) -> str:
+    """Reduces a message to what makes it distinct from near-identical ones"""
+    text = unicodedata.normalize("NFKC", content).casefold()
+    parts = []
+    end = 0
+    for match in _URL_PATTERN.finditer(text):
+        parts.append(_collapse_repeated_characters(text[end:match.start()]))
+        parts.append(_strip_tracking_parameters(match.group(0)))
+        end = match.end()
+    parts.append(_collapse_repeated_characters(text[end:]))
+    return _NON_WORD_PATTERN.sub(" ", "".join(parts)).strip()
+
+
+def _collapse_repeated_characters(text: str) -> str:
+    # "hahahaaaa" and "hahaa" are the same message, links are left alone
+    return _REPEATED_CHARACTERS_PATTERN.sub(r"\1\1", text)
+
+
+def _strip_tracking_parameters(url: str) -> str:
+    """The same link with different tracking parameters is the same link"""
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return url
+    query = '&'.join(parameter for parameter in parts.query.split('&')
+                     if parameter and not _TRACKING_PARAMETER_PATTERN.match(parameter.split('=', 1)[0]))
+    return urlunsplit(parts._replace(query=query))
+
+
+def _is_low_information(normalized: str) -> bool:
+    if normalized in ANSWER_MESSAGES:
+        return False
+
+    if len(normalized.replace(" ", "")) < MIN_INFORMATIVE_CHARS:
+        return True  # Emojis, stickers as text, "k", "??"
+
+    return normalized in FILLER_MESSAGES or _LAUGHTER_PATTERN.match(normalized.replace(" ", "")) is not None
+
+
+def _join(first: str, second: str) -> str:
+    first = first.rstrip()
+    if first.endswith(('.', '!', '?')):
+        return f"{first} {second}"
+    return f"{first}{COLLAPSED_MESSAGE_SEPARATOR}{second}"
+
+
+def _prompt_chars(messages: list[Message]) -> int:
+    # Same shape as format_message_for_openai, "{Sender}: {Message};", without building the string
+    return sum(len(msg.owner_name) + len(msg.content) + 3 for msg in messages)
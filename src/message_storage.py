@@ -2,32 +2,69 @@ import json
 import logging
 import os
 from dataclasses import dataclass, asdict
+from typing import Iterable, Iterator, Optional, Union
 
 from redis import Redis
+from redis.cluster import RedisCluster
 from telegram import Update
 
+from chat_stats import record_activity, evict_quiet_posters, is_stats_enabled, STATS_MAX_POSTERS, STATS_EVICTION_BATCH
+from embedded_storage import EmbeddedRedis
+from redis_keys import (chat_messages_key, pending_messages_key, chat_messages_pattern, chat_id_from_messages_key,
+                        search_ids_key, archive_queue_key, message_revisions_key, search_docs_key,
+                        thread_replies_key)
+from reply_threads import (index_reply, get_thread_ids, evict_oldest as evict_oldest_replies, THREAD_MAX_REPLIES,
+                           THREAD_EVICTION_BATCH)
+from search_index import index_document, evict_oldest, remove_document, search, SEARCH_MAX_MESSAGES, SEARCH_EVICTION_BATCH
+from structured_logging import log_event
+from tracing import start_span
 from utils import str_to_bool
+from window_cache import get_window_cache, invalidation_channel, invalidation_message
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_MESSAGE_STORAGE = 100
 MAX_MESSAGE_STORAGE = 200
 
+# The revision of a forgotten message
+TOMBSTONE = b""
+
+_search_enabled = str_to_bool(os.getenv('SEARCH_ENABLED', True))
+_archive_enabled = str_to_bool(os.getenv('ARCHIVE_ENABLED', False))
+# Bounds a chat's archive queue while nothing drains it, e.g. while no instance leads
+_archive_max_queued = int(os.getenv('ARCHIVE_MAX_QUEUED', 50_000))
+
+
+def is_search_enabled() -> bool:
+    """
+    @return: whether the stored messages are added to the search index
+    """
+    return _search_enabled
+
 
 def configure_message_storage() -> bool:
 
     try:
+        if os.getenv('STORAGE_BACKEND', 'redis') == 'embedded':
+            return _configure_embedded_storage()
+
         host = os.getenv('REDIS_HOST', "localhost")
         port = os.getenv('REDIS_PORT', 6379)
         db = os.getenv('REDIS_DB', 0)
         use_tls = str_to_bool((os.getenv('REDIS_USE_TLS', False)))  # We have to use TLS with Elasticache
         timeout = int(os.getenv('REDIS_TIMEOUT', 60))
+        use_cluster = str_to_bool(os.getenv('REDIS_CLUSTER', False))
 
         global redis_client_singleton
 
         logger.info(f"Connecting to Redis at: {host}:{port}")
-        logger.info(f"Redis DB: {db}, TLS: {use_tls}, Timeout:{timeout}")
-        redis_client_singleton = Redis(host=host, port=port, db=db, ssl=use_tls, socket_timeout=timeout)
+        if use_cluster:
+            # A cluster has no DBs, the chats are spread across the nodes by their {chat:<id>} hash tag
+            logger.info(f"Redis Cluster, TLS: {use_tls}, Timeout:{timeout}")
+            redis_client_singleton = RedisCluster(host=host, port=int(port), ssl=use_tls, socket_timeout=timeout)
+        else:
+            logger.info(f"Redis DB: {db}, TLS: {use_tls}, Timeout:{timeout}")
+            redis_client_singleton = Redis(host=host, port=port, db=db, ssl=use_tls, socket_timeout=timeout)
 
         return redis_client_singleton.ping()
 
@@ -39,6 +76,30 @@ def configure_message_storage() -> bool:
         return False
 
 
+def _configure_embedded_storage() -> bool:
+    global redis_client_singleton
+
+    directory = os.getenv('EMBEDDED_STORAGE_DIR', 'data')
+    logger.info(f"Using the embedded storage at: {directory}")
+    redis_client_singleton = EmbeddedRedis(
+        directory,
+        fsync_seconds=float(os.getenv('EMBEDDED_FSYNC_SECONDS', 1)),
+        snapshot_seconds=float(os.getenv('EMBEDDED_SNAPSHOT_SECONDS', 300))
+    )
+    redis_client_singleton.start()
+    return redis_client_singleton.ping()
+
+
+def close_message_storage():
+    """
+    Persists the embedded storage before the bot exits. Redis needs nothing.
+    """
+    client = globals().get('redis_client_singleton')
+    if isinstance(client, EmbeddedRedis):
+        client.close()
+        logger.info("Closed the embedded storage")
+
+
 @dataclass
 class Message:
     """Stores the content of the messages"""
@@ -47,13 +108,16 @@ class Message:
     owner_id: int
     owner_name: str
     created_at: str
+    reply_to_message_id: Optional[int] = None
 
     @staticmethod
     def convert_update_to_owner(update: Update):
-        if not update.message.from_user.last_name:
-            return f"{update.message.from_user.first_name}"
+        # Edits only have the edited message
+        from_user = (update.message or update.edited_message).from_user
+        if not from_user.last_name:
+            return f"{from_user.first_name}"
 
-        return f"{update.message.from_user.first_name} {update.message.from_user.last_name}"
+        return f"{from_user.first_name} {from_user.last_name}"
 
 
 def get_redis_client() -> Redis:
@@ -75,15 +139,240 @@ def store_message(redis_client: Redis,
     """
 
     serialized_message = _serialize_message(message)
-    chat_key = str(chat_id)
+    chat_key = chat_messages_key(chat_id)
+
+    with start_span("redis.store_message", {"chat.id": chat_id}):
+        # One round trip for the whole write, the keys share the chat's hash slot
+        pipeline = redis_client.pipeline(transaction=False)
+        pipeline.lpush(chat_key, serialized_message)
+        # Trim the list to only keep the latest 200 messages
+        pipeline.ltrim(chat_key, 0, MAX_MESSAGE_STORAGE - 1)
+        pipeline.incr(pending_messages_key(chat_id))
+        if _archive_enabled:
+            # Queued in the same pipeline, so no message is trimmed before the archiver has seen it
+            pipeline.rpush(archive_queue_key(chat_id), serialized_message)
+            pipeline.ltrim(archive_queue_key(chat_id), -_archive_max_queued, -1)
+        is_change_published = _publish_window_change(redis_client, chat_id, pipeline)
+        # Where each count is in the results, to know whether to evict
+        search_count_index = reply_count_index = poster_count_index = None
+        if _search_enabled:
+            # The search index keeps the message long after it is trimmed from the list
+            index_document(pipeline, chat_id, message.message_id, message.content, serialized_message)
+            pipeline.zcard(search_ids_key(chat_id))
+            search_count_index = len(pipeline) - 1
+        if message.reply_to_message_id is not None:
+            index_reply(pipeline, chat_id, message.message_id, message.reply_to_message_id)
+            pipeline.zcard(thread_replies_key(chat_id))
+            reply_count_index = len(pipeline) - 1
+        if is_stats_enabled():
+            # Its last command counts the posters
+            record_activity(pipeline, chat_id, message.owner_id, message.owner_name)
+            poster_count_index = len(pipeline) - 1
+        # Return the current number of messages in the list
+        pipeline.llen(chat_key)
+        results = pipeline.execute()
+        message_count = results[-1]
+        log_event(logger, logging.DEBUG, "message_stored", chat_id=chat_id, message_id=message.message_id,
+                  content=serialized_message, stored=message_count)
+
+    window_cache = get_window_cache()
+    if window_cache is not None:
+        window_cache.add_message(chat_id, message, message_count)
+        if not is_change_published:
+            _publish_window_change(redis_client, chat_id)
+
+    if search_count_index is not None and results[search_count_index] > SEARCH_MAX_MESSAGES + SEARCH_EVICTION_BATCH:
+        evict_oldest(redis_client, chat_id)
+    if reply_count_index is not None and results[reply_count_index] > THREAD_MAX_REPLIES + THREAD_EVICTION_BATCH:
+        evict_oldest_replies(redis_client, chat_id)
+    if poster_count_index is not None and results[poster_count_index] > STATS_MAX_POSTERS + STATS_EVICTION_BATCH:
+        evict_quiet_posters(redis_client, chat_id)
+
+    return message_count
+
+
+def store_history(redis_client: Redis,
+                  chat_id: int,
+                  messages: list[Message]) -> int:
+    """
+    Stores messages from before the bot joined the chat, e.g. an imported export, in one pipeline.
+    They are older than what is stored, so they go after it, and don't count as new messages.
+    Messages that aren't older than the oldest stored one are skipped, so an import can be re-run.
+    Only the newest ones that fit in the window are stored in it, the older ones only go to the
+    search index and the archive, when those are enabled.
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @param messages: the messages, newest first
+    @return: how many messages were stored in the window
+    """
+    chat_key = chat_messages_key(chat_id)
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.llen(chat_key)
+    pipeline.lindex(chat_key, -1)
+    stored_count, oldest = pipeline.execute()
+    if oldest is not None:
+        oldest_id = json.loads(oldest)['message_id']
+        messages = [message for message in messages if message.message_id < oldest_id]
+
+    space_left = max(MAX_MESSAGE_STORAGE - stored_count, 0)
+    kept = messages[:space_left]
+    if not kept and not (messages and (_search_enabled or _archive_enabled)):
+        return 0
+
+    serialized_messages = [_serialize_message(message) for message in messages]
+
+    with start_span("redis.store_history", {"chat.id": chat_id, "messages.stored": len(kept)}):
+        pipeline = redis_client.pipeline(transaction=False)
+        if kept:
+            pipeline.rpush(chat_key, *serialized_messages[:len(kept)])
+            # Messages stored since the LLEN could have filled the window
+            pipeline.ltrim(chat_key, 0, MAX_MESSAGE_STORAGE - 1)
+        if _archive_enabled:
+            # The queue is oldest first, and the history is older than anything queued
+            pipeline.lpush(archive_queue_key(chat_id), *serialized_messages)
+            pipeline.ltrim(archive_queue_key(chat_id), -_archive_max_queued, -1)
+        if _search_enabled:
+            for message, serialized_message in zip(messages, serialized_messages):
+                index_document(pipeline, chat_id, message.message_id, message.content, serialized_message)
+        # Threads find the replies that left the window through the search index
+        for message in (messages if _search_enabled else kept):
+            if message.reply_to_message_id is not None:
+                index_reply(pipeline, chat_id, message.message_id, message.reply_to_message_id)
+        pipeline.execute()
+
+    if kept:
+        invalidate_cached_window(redis_client, chat_id)
+
+    if _search_enabled:
+        evict_oldest(redis_client, chat_id)
+    evict_oldest_replies(redis_client, chat_id)
+
+    return len(kept)
+
+
+def edit_message(redis_client: Redis, chat_id: int, message: Message) -> bool:
+    """
+    Replaces a stored message with its edited version, without touching the rest of the chat.
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @param message: the edited message
+    @return: False if the message isn't stored, e.g. it was trimmed
+    """
+    serialized_message = _serialize_message(message)
+    return _revise_message(redis_client, chat_id, message.message_id, serialized_message, message.content)
+
+
+def forget_message(redis_client: Redis, chat_id: int, message_id: int) -> bool:
+    """
+    Tombstones a stored message, so it is left out of the summaries, searches and exports.
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @param message_id: the message to forget
+    @return: False if the message isn't stored, e.g. it was trimmed
+    """
+    return _revise_message(redis_client, chat_id, message_id, TOMBSTONE)
+
+
+def _revise_message(redis_client: Redis,
+                    chat_id: int,
+                    message_id: int,
+                    revision: Union[str, bytes],
+                    content: Optional[str] = None) -> bool:
+    chat_key = chat_messages_key(chat_id)
+    revisions_key = message_revisions_key(chat_id)
+
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.lindex(chat_key, 0)
+    pipeline.lindex(chat_key, -1)
+    pipeline.zscore(search_ids_key(chat_id), message_id)
+    newest, oldest, search_score = pipeline.execute()
+    # Message ids only grow within a chat, so the ends of the list tell if the message is still stored
+    oldest_id = json.loads(oldest)['message_id'] if oldest is not None else None
+    is_stored = oldest_id is not None and oldest_id <= message_id <= json.loads(newest)['message_id']
+    # The search index keeps messages long after they are trimmed from the list
+    is_indexed = _search_enabled and search_score is not None
+    if not is_stored and not is_indexed:
+        return False
+
+    with start_span("redis.revise_message", {"chat.id": chat_id}):
+        if is_indexed:
+            remove_document(redis_client, chat_id, message_id)
+
+        pipeline = redis_client.pipeline(transaction=False)
+        if is_indexed and revision != TOMBSTONE:
+            index_document(pipeline, chat_id, message_id, content, revision)
+        if is_stored:
+            pipeline.hset(revisions_key, message_id, revision)
+            pipeline.hlen(revisions_key)
+        results = pipeline.execute()
+
+    if not is_stored:
+        return True
+
+    invalidate_cached_window(redis_client, chat_id)
+
+    if results[-1] > MAX_MESSAGE_STORAGE:
+        # Drop the revisions of the messages that were trimmed since
+        trimmed_ids = [revised_id for revised_id in redis_client.hgetall(revisions_key) if int(revised_id) < oldest_id]
+        if trimmed_ids:
+            redis_client.hdel(revisions_key, *trimmed_ids)
+
+    return True
+
+
+def invalidate_cached_window(redis_client: Redis, chat_id: int):
+    """
+    Drops the chat's cached window on every replica, after its stored messages changed other than by store_message
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    """
+    window_cache = get_window_cache()
+    if window_cache is not None:
+        window_cache.invalidate(chat_id)
+        _publish_window_change(redis_client, chat_id)
+
+
+def _publish_window_change(redis_client: Redis, chat_id: int, pipeline=None) -> bool:
+    """
+    Tells the other replicas to drop the chat's cached window.
+    @param pipeline: queues the message on the pipeline instead of sending it right away
+    @return: True if the message was sent or queued
+    """
+    window_cache = get_window_cache()
+    if window_cache is None:
+        return False
 
-    redis_client.lpush(chat_key, serialized_message)
-    # Trim the list to only keep the latest 200 messages
-    redis_client.ltrim(chat_key, 0, MAX_MESSAGE_STORAGE - 1)
-    logger.debug(f"Stored {serialized_message} into the cache at key {chat_key}")
+    if pipeline is not None and isinstance(redis_client, RedisCluster):
+        return False  # A cluster pipeline can't PUBLISH, it's sent after the pipeline instead
 
-    # Return the current number of messages in the list
-    return redis_client.llen(chat_key)
+    (pipeline or redis_client).publish(invalidation_channel(), invalidation_message(window_cache, chat_id))
+    return True
+
+
+def get_new_message_count(redis_client: Redis,
+                          chat_id: int) -> int:
+    """
+    Returns how many messages were stored since the chat was last summarized
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @return: the number of new messages
+    """
+    count = redis_client.get(pending_messages_key(chat_id))
+    return int(count) if count else 0
+
+
+def mark_messages_summarized(redis_client: Redis,
+                             chat_id: int,
+                             count: int):
+    """
+    Takes summarized messages off the new message count.
+    Messages stored while the summary was being written keep counting as new.
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @param count: the new message count read before summarizing
+    """
+    if count > 0:
+        redis_client.decrby(pending_messages_key(chat_id), count)
 
 
 def _serialize_message(message: Message):
@@ -99,7 +388,8 @@ def chat_exists(redis_client: Redis,
     @param chat_id: The unique identifier for the chat session.
     @return: True if chat exists
     """
-    exists = True if redis_client.exists(str(chat_id)) != 0 else False
+    with start_span("redis.chat_exists", {"chat.id": chat_id}):
+        exists = True if redis_client.exists(chat_messages_key(chat_id)) != 0 else False
     return exists
 
 
@@ -121,21 +411,167 @@ def get_latest_n_messages(
     if number_of_msgs <= 0:
         return []
 
-    serialized_messages = redis_client.lrange(str(chat_id), 0, number_of_msgs - 1)
-    logger.debug(f"Redis Messages: {serialized_messages}")
+    window_cache = get_window_cache()
+    if window_cache is not None:
+        cached_messages = window_cache.get(chat_id, number_of_msgs)
+        if cached_messages is not None:
+            return cached_messages
+        window_version = window_cache.version(chat_id)
+
+    with start_span("redis.get_latest_n_messages", {"chat.id": chat_id, "messages.requested": number_of_msgs}) as span:
+        # The edits and tombstones are read with the window, in the same round trip
+        pipeline = redis_client.pipeline(transaction=False)
+        pipeline.lrange(chat_messages_key(chat_id), 0, number_of_msgs - 1)
+        pipeline.hgetall(message_revisions_key(chat_id))
+        serialized_messages, revisions = pipeline.execute()
+        log_event(logger, logging.DEBUG, "messages_read", chat_id=chat_id, messages=serialized_messages)
+
+        messages = _apply_revisions(serialized_messages, revisions)
+        span.set_attribute("messages.returned", len(messages))
+
+    if window_cache is not None and serialized_messages:
+        window_cache.put(chat_id, messages, len(serialized_messages) < number_of_msgs, window_version)
+    return messages
+
 
-    messages_json = [json.loads(msg) for msg in serialized_messages]
-    messages = [Message(**msg) for msg in messages_json]
+def _apply_revisions(serialized_messages: list[bytes], revisions: dict[bytes, bytes]) -> list[Message]:
+    """
+    @param serialized_messages: the stored messages
+    @param revisions: message id -> the edited message, or a tombstone
+    @return: the messages as they are now, without the forgotten ones
+    """
+    messages = []
+    for serialized_message in serialized_messages:
+        message = Message(**json.loads(serialized_message))
+        revision = revisions.get(str(message.message_id).encode('utf-8'))
+        if revision == TOMBSTONE:
+            continue
+        messages.append(Message(**json.loads(revision)) if revision is not None else message)
     return messages
 
 
+def revise_messages(redis_client: Redis, chat_id: int, messages: Iterable[Message]) -> Iterator[Message]:
+    """
+    Applies the edits and /forget to messages read from elsewhere, e.g. the archive.
+    Only the revisions of the messages that are still stored are kept.
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @param messages: the messages as they were stored
+    @return: the messages as they are now, without the forgotten ones
+    """
+    revisions = redis_client.hgetall(message_revisions_key(chat_id))
+    for message in messages:
+        revision = revisions.get(str(message.message_id).encode('utf-8'))
+        if revision == TOMBSTONE:
+            continue
+        yield Message(**json.loads(revision)) if revision is not None else message
+
+
+def iter_chat_messages(redis_client: Redis,
+                       chat_id: int,
+                       chunk_size: int = 100) -> Iterator[Message]:
+    """
+    Reads every stored message of a chat, one LRANGE chunk at a time, as they are now.
+    Messages stored meanwhile shift the list, so a chunk can start with messages
+    that were already read; those are skipped.
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @param chunk_size: how many messages each LRANGE reads
+    @return: the messages, newest first
+    """
+    chat_key = chat_messages_key(chat_id)
+    revisions = redis_client.hgetall(message_revisions_key(chat_id))
+    last_message_id = None
+    start = 0
+    while True:
+        chunk = redis_client.lrange(chat_key, start, start + chunk_size - 1)
+        for serialized_message in chunk:
+            message_id = json.loads(serialized_message)['message_id']
+            if last_message_id is None or message_id < last_message_id:
+                last_message_id = message_id
+                yield from _apply_revisions([serialized_message], revisions)
+
+        if len(chunk) < chunk_size:
+            return
+        start += chunk_size
+
+
+def get_thread_messages(redis_client: Redis,
+                        chat_id: int,
+                        message_id: int,
+                        limit: int = MAX_MESSAGE_STORAGE) -> list[Message]:
+    """
+    Gets the messages of the reply thread a message belongs to, as they are now.
+    They are read from the latest messages, and the older ones from the search index.
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @param message_id: any message of the thread
+    @param limit: the most messages returned, the latest ones are kept
+    @return: the messages that are still stored, oldest first
+    """
+    with start_span("redis.get_thread_messages", {"chat.id": chat_id}) as span:
+        thread_ids = get_thread_ids(redis_client, chat_id, message_id, limit)
+        span.set_attribute("thread.messages", len(thread_ids))
+
+        window = {message.message_id: message for message in get_latest_n_messages(redis_client, chat_id,
+                                                                                    MAX_MESSAGE_STORAGE)}
+        messages = {thread_id: window[thread_id] for thread_id in thread_ids if thread_id in window}
+
+        older_ids = [thread_id for thread_id in thread_ids if thread_id not in messages]
+        if older_ids and _search_enabled:
+            for serialized_message in redis_client.hmget(search_docs_key(chat_id), older_ids):
+                if serialized_message is not None:
+                    message = Message(**json.loads(serialized_message))
+                    messages[message.message_id] = message
+
+        span.set_attribute("messages.returned", len(messages))
+    return [messages[thread_id] for thread_id in thread_ids if thread_id in messages]
+
+
+def get_nth_latest_message(redis_client: Redis,
+                           chat_id: int,
+                           index: int = 0) -> Optional[Message]:
+    """
+    Gets a single message counting back from the latest one, without reading the rest of the chat
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @param index: 0 is the latest message, 1 the one before it, etc.
+    @return: the message, or None if the chat has fewer messages
+    """
+    serialized_message = redis_client.lindex(chat_messages_key(chat_id), index)
+    if serialized_message is None:
+        return None
+
+    return Message(**json.loads(serialized_message))
+
+
 def get_all_chat_ids(redis_client: Redis) -> set[int]:
     """
     Returns the chat id for all chats the bot is in
     @return: set of the chat ids
     """
+    # In a cluster, SCAN visits every primary node
     chat_ids = {
-        int(key.decode('utf-8'))
-        for key in redis_client.keys()
+        chat_id_from_messages_key(key)
+        for key in redis_client.scan_iter(match=chat_messages_pattern(), count=1000)
     }
+    chat_ids.discard(None)
     return chat_ids
+
+
+def search_messages(redis_client: Redis,
+                    chat_id: int,
+                    query: str,
+                    limit: int = 5) -> list[Message]:
+    """
+    Finds the messages that contain every term of the query, including ones trimmed from the latest messages
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @param query: the terms to look for
+    @param limit: the most messages returned
+    @return: the messages, best match first
+    """
+    with start_span("redis.search_messages", {"chat.id": chat_id}) as span:
+        documents = search(redis_client, chat_id, query, limit)
+        span.set_attribute("messages.returned", len(documents))
+    return [Message(**json.loads(document)) for document in documents]
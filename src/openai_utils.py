@@ -1,30 +1,262 @@
 import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Optional
 
-from dotenv import load_dotenv
-from openai import OpenAI
+from openai import OpenAI, APIConnectionError, RateLimitError, InternalServerError
+
+from message_storage import Message
+from resilience import CircuitBreaker, RetryPolicy, ResilientCaller
+from tracing import start_span
+from utils import percentile, str_to_bool
 
 OPEN_AI_MODEL = "gpt-4o-mini"
+PING_TIMEOUT_SECONDS = 10
+MIN_HEDGE_LATENCY_SAMPLES = 20
+
+# Timeouts, dropped connections, rate limits and 5xx are worth retrying, other errors are not
+RETRYABLE_OPENAI_ERRORS = (APIConnectionError, RateLimitError, InternalServerError)
+
+# Built on first use, or by the startup warmup, so importing the module doesn't construct the client
+open_client_singleton: Optional[OpenAI] = None
+_open_client_lock = threading.Lock()
+
+
+@dataclass
+class CompletionResult:
+    """The content of a completion and what it cost"""
+    content: str
+    model: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+@dataclass(frozen=True)
+class ModelTier:
+    """A model and the limits it is called with"""
+    name: str
+    model: str
+    max_tokens: int
+    timeout_seconds: float
+    max_prompt_tokens: int  # Bigger prompts go to the next tier
+
+
+@dataclass
+class RouteDecision:
+    """The tier a summary is sent to, and how much of the window it can afford"""
+    tier: ModelTier
+    window_scale: float = 1.0  # Below 1 the oldest messages are dropped
+    degraded: bool = False
+
 
-load_dotenv()
-api_key = os.getenv("OPENAI_API_KEY", "fake-key")  # Need to add a default for the tests to work
-open_client_singleton = OpenAI(api_key=api_key)
+class ModelRouter:
+    """
+    Picks the tier for each completion from the prompt size and the current load.
+    Tiers are ordered from the cheapest and fastest to the most capable.
+    When the latency SLO is breached, or too many completions are in flight,
+    prompts go one tier down, and windows are shortened to fit the lowest tier.
+    """
+
+    def __init__(self,
+                 tiers: list[ModelTier],
+                 latency_slo_seconds: float,
+                 max_in_flight: int,
+                 latency_sample_size: int = 200):
+        self.tiers = tiers
+        self.latency_slo_seconds = latency_slo_seconds
+        self.max_in_flight = max_in_flight
+        self._latencies: deque[float] = deque(maxlen=latency_sample_size)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def latency_samples(self) -> int:
+        return len(self._latencies)
+
+    def latency_percentile(self, pct: float) -> float:
+        with self._lock:
+            samples = list(self._latencies)
+        return percentile(samples, pct)
+
+    def is_degraded(self) -> bool:
+        return self._in_flight >= self.max_in_flight or self.latency_percentile(95) > self.latency_slo_seconds
+
+    def route(self, prompt_tokens: int) -> RouteDecision:
+        """
+        Picks the tier for a prompt.
+        @param prompt_tokens: the estimated size of the prompt
+        @return: the decision
+        """
+        index = next(
+            (index for index, tier in enumerate(self.tiers) if prompt_tokens <= tier.max_prompt_tokens),
+            len(self.tiers) - 1
+        )
+
+        if not self.is_degraded():
+            return RouteDecision(tier=self.tiers[index])
+
+        tier = self.tiers[max(index - 1, 0)]
+        window_scale = min(1.0, tier.max_prompt_tokens / prompt_tokens) if prompt_tokens else 1.0
+        return RouteDecision(tier=tier, window_scale=window_scale, degraded=True)
+
+    @contextmanager
+    def track(self):
+        """Counts a completion as in flight and records its latency"""
+        with self._lock:
+            self._in_flight += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._latencies.append(time.monotonic() - started)
+
+
+def parse_model_tiers(tiers: str) -> list[ModelTier]:
+    """
+    Parses tiers written as name=model:max_tokens:timeout_seconds:max_prompt_tokens, separated by commas
+    @param tiers: e.g. "fast=gpt-4o-mini:300:20:2000,standard=gpt-4o:700:45:100000"
+    @return: the tiers
+    """
+    parsed = []
+    for tier in filter(None, tiers.split(',')):
+        name, settings = tier.strip().split('=', 1)
+        model, max_tokens, timeout_seconds, max_prompt_tokens = settings.rsplit(':', 3)
+        parsed.append(ModelTier(name, model, int(max_tokens), float(timeout_seconds), int(max_prompt_tokens)))
+    return parsed
+
+
+def _default_model_tiers() -> list[ModelTier]:
+    model = os.getenv('OPENAI_MODEL', OPEN_AI_MODEL)
+    return [
+        ModelTier("fast", model, max_tokens=300, timeout_seconds=20, max_prompt_tokens=2_000),
+        ModelTier("standard", model, max_tokens=700, timeout_seconds=45, max_prompt_tokens=16_000),
+    ]
+
+
+# Built from the env variables by their configure_ function, or on first use
+_model_router: Optional[ModelRouter] = None
+_openai_caller: Optional[ResilientCaller] = None
+
+
+def configure_model_router(router: Optional[ModelRouter] = None) -> ModelRouter:
+    """
+    Sets the router that picks the model tier of each completion.
+    @param router: read from the env variables by default
+    @return: the router
+    """
+    global _model_router
+
+    _model_router = router or ModelRouter(
+        tiers=parse_model_tiers(os.getenv('OPENAI_MODEL_TIERS', '')) or _default_model_tiers(),
+        latency_slo_seconds=float(os.getenv('OPENAI_LATENCY_SLO_SECONDS', 15)),
+        max_in_flight=int(os.getenv('OPENAI_MAX_IN_FLIGHT', 8)),
+    )
+    return _model_router
+
+
+def get_model_router() -> ModelRouter:
+    """
+    Returns the router that picks the model tier of each completion
+    @return:
+    """
+    return _model_router or configure_model_router()
+
+
+def _hedge_delay() -> Optional[float]:
+    # Hedge the attempts that are slower than 95% of the recent ones, once there are enough to tell
+    if not str_to_bool(os.getenv('OPENAI_HEDGING_ENABLED', True)):
+        return None
+    router = get_model_router()
+    if router.latency_samples < MIN_HEDGE_LATENCY_SAMPLES:
+        return None
+    return router.latency_percentile(95)
+
+
+def configure_openai_caller(caller: Optional[ResilientCaller] = None) -> ResilientCaller:
+    """
+    Sets the caller that wraps completions in deadlines, retries, hedging and the circuit breaker.
+    Configure it before the backends, they keep the caller they are registered with.
+    @param caller: read from the env variables by default
+    @return: the caller
+    """
+    global _openai_caller
+
+    _openai_caller = caller or ResilientCaller(
+        breaker=CircuitBreaker(
+            "openai",
+            failure_threshold=int(os.getenv('OPENAI_BREAKER_FAILURES', 5)),
+            reset_timeout_seconds=float(os.getenv('OPENAI_BREAKER_RESET_SECONDS', 30)),
+        ),
+        retry_policy=RetryPolicy(
+            max_attempts=int(os.getenv('OPENAI_MAX_ATTEMPTS', 3)),
+            retryable=RETRYABLE_OPENAI_ERRORS,
+        ),
+        deadline_seconds=float(os.getenv('OPENAI_DEADLINE_SECONDS', 60)),
+        hedge_after=_hedge_delay,
+    )
+    return _openai_caller
+
+
+def get_openai_caller() -> ResilientCaller:
+    """
+    Returns the caller that wraps completions in deadlines, retries, hedging and the circuit breaker
+    @return:
+    """
+    return _openai_caller or configure_openai_caller()
 
 
 def get_ai_client() -> OpenAI:
     """
-    Returns the GPT client
+    Returns the GPT client, building it on first use
     @return:
     """
+    global open_client_singleton
+
+    if open_client_singleton is None:
+        with _open_client_lock:
+            if open_client_singleton is None:
+                api_key = os.getenv("OPENAI_API_KEY", "fake-key")  # Need to add a default for the tests to work
+                # Retries are done by the resilient caller, so they share the call's deadline and circuit breaker
+                open_client_singleton = OpenAI(api_key=api_key, max_retries=0)
     return open_client_singleton
 
 
-def summarize_messages_as_paragraph(client: OpenAI, messages: str) -> str:
+def format_message_for_openai(messages: list[Message]) -> str:
+    """
+    Formats the messages the way the summary prompts expect them
+    @param messages: the messages, oldest first
+    @return: the messages in the {Sender}: {Message}; format
+    """
+    with start_span("format_message_for_openai", {"messages.count": len(messages)}) as span:
+        messages_content = [f"{msg.owner_name}: {msg.content}" for msg in messages]
+        prompt_message_schema = ';'.join(messages_content)
+        span.set_attribute("prompt.chars", len(prompt_message_schema))
+    return prompt_message_schema
+
+
+def summarize_messages_as_paragraph(client: OpenAI,
+                                    messages: str,
+                                    model: str = OPEN_AI_MODEL,
+                                    max_tokens: Optional[int] = None,
+                                    timeout: Optional[float] = None) -> CompletionResult:
     """
     Uses ChatGPT to summarize messages and returns the summary in a TL;DR format.
     It needs the messages to be in the following format.
     {Sender}:{Message};{Sender}:{Message};...{Sender}:{Message}
     @param client: The OpenAI client
     @param messages: the messages in the {Sender}:{Message} format
+    @param model: the model that writes the summary
+    @param max_tokens: the longest summary the model may write
+    @param timeout: how long to wait for the summary, in seconds
     @return: the summarized messages
     """
     prompt = "You are a secretary. I will give you messages from a group chat in the following format: " \
@@ -33,23 +265,23 @@ def summarize_messages_as_paragraph(client: OpenAI, messages: str) -> str:
              "Assume that the messages are in chronological order. "  \
              "Also, make your best effort to associate messages that have a common theme."
 
-    completion = client.chat.completions.create(
-        model=OPEN_AI_MODEL,
-        messages=[
-            {"role": "system", "content": f"{prompt}"},
-            {"role": "user", "content": f"{messages}"}
-        ]
-    )
-    return completion.choices[0].message.content
+    return _create_completion(client, prompt, messages, model, max_tokens, timeout)
 
 
-def summarize_messages_as_bullet_points(client: OpenAI, messages: str) -> str:
+def summarize_messages_as_bullet_points(client: OpenAI,
+                                        messages: str,
+                                        model: str = OPEN_AI_MODEL,
+                                        max_tokens: Optional[int] = None,
+                                        timeout: Optional[float] = None) -> CompletionResult:
     """
     Uses ChatGPT to summarize messages and returns the summary in a TL;DR format.
     It needs the messages to be in the following format.
     {Sender}:{Message};{Sender}:{Message};...{Sender}:{Message}
     @param client: The OpenAI client
     @param messages: the messages in the {Sender}:{Message} format
+    @param model: the model that writes the summary
+    @param max_tokens: the longest summary the model may write
+    @param timeout: how long to wait for the summary, in seconds
     @return: the summarized messages
     """
     prompt = "You are a secretary. I will give you messages from a group chat in the following format: " \
@@ -59,14 +291,49 @@ def summarize_messages_as_bullet_points(client: OpenAI, messages: str) -> str:
              "Assume that the messages are in chronological order. "  \
              "Also, make your best effort to associate messages that have a common theme."
 
-    completion = client.chat.completions.create(
-        model=OPEN_AI_MODEL,
-        messages=[
-            {"role": "system", "content": f"{prompt}"},
-            {"role": "user", "content": f"{messages}"}
-        ]
-    )
-    return completion.choices[0].message.content
+    return _create_completion(client, prompt, messages, model, max_tokens, timeout)
+
+
+def _create_completion(client: OpenAI,
+                       prompt: str,
+                       messages: str,
+                       model: str,
+                       max_tokens: Optional[int] = None,
+                       timeout: Optional[float] = None) -> CompletionResult:
+    """
+    Requests a chat completion, traced with the model and the token usage
+    @param client: The OpenAI client
+    @param prompt: the system prompt
+    @param messages: the user content
+    @param model: the model that writes the completion
+    @param max_tokens: the longest completion the model may write
+    @param timeout: how long to wait for the completion, in seconds
+    @return: the completion
+    """
+    options = {}
+    if max_tokens is not None:
+        options["max_tokens"] = max_tokens
+    if timeout is not None:
+        options["timeout"] = timeout
+
+    with start_span("openai.chat.completions", {"model": model, "prompt.chars": len(messages)}) as span:
+        completion = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": f"{prompt}"},
+                {"role": "user", "content": f"{messages}"}
+            ],
+            **options
+        )
+
+        result = CompletionResult(content=completion.choices[0].message.content, model=model)
+        if completion.usage:
+            result.prompt_tokens = completion.usage.prompt_tokens
+            result.completion_tokens = completion.usage.completion_tokens
+            span.set_attribute("tokens.prompt", result.prompt_tokens)
+            span.set_attribute("tokens.completion", result.completion_tokens)
+
+    return result
 
 
 def ping_openai(client: OpenAI) -> str:
@@ -86,7 +353,8 @@ def ping_openai(client: OpenAI) -> str:
             messages=[
                 {"role": "system", "content": f"{prompt}"},
                 {"role": "user", "content": f"{message}"}
-            ]
+            ],
+            timeout=PING_TIMEOUT_SECONDS
         )
         return completion.choices[0].message.content
     except Exception as e:
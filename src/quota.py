@@ -0,0 +1,278 @@
+"""
+Per-user and per-chat quotas, and a ledger of the tokens summaries cost.
+
+Summary commands are rate limited with a sliding window per user and per chat,
+kept in Redis sorted sets so every instance of the bot shares them. The tokens
+of every completion are added to a daily ledger per user, per chat and in total,
+and daily token budgets are enforced from it.
+
+Configuration (env variables):
+    QUOTA_ENABLED                  enforce the limits below (default False, usage is recorded either way)
+    QUOTA_WINDOW_SECONDS           the sliding window of the request limits (default 3600)
+    QUOTA_USER_REQUESTS            summaries a user may request per window (default 20)
+    QUOTA_CHAT_REQUESTS            summaries a chat may request per window (default 60)
+    QUOTA_USER_DAILY_TOKENS        tokens a user may spend per day, 0 for no limit (default 0)
+    QUOTA_CHAT_DAILY_TOKENS        tokens a chat may spend per day, 0 for no limit (default 0)
+    QUOTA_PROMPT_COST_PER_1K       price of 1K prompt tokens, for the cost estimate (default 0.00015)
+    QUOTA_COMPLETION_COST_PER_1K   price of 1K completion tokens, for the cost estimate (default 0.0006)
+"""
+import logging
+import os
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional
+
+from redis import Redis
+
+from redis_keys import namespaced_key
+from utils import str_to_bool
+
+logger = logging.getLogger(__name__)
+
+USER_SCOPE = "user"
+CHAT_SCOPE = "chat"
+
+REQUESTS_KEY = "quota:requests:{scope}:{owner_id}"
+TOKENS_KEY = "quota:tokens:{scope}:{owner_id}:{day}"
+TOTAL_TOKENS_KEY = "quota:tokens:total:{day}"
+TOP_CONSUMERS_KEY = "quota:top:{scope}:{day}"
+
+LEDGER_TTL_SECONDS = 8 * 24 * 60 * 60  # A week of history for /status, plus a day of slack
+
+
+@dataclass
+class QuotaConfig:
+    """How much each user and chat may summarize"""
+    enabled: bool = False
+    window_seconds: int = 60 * 60
+    user_requests_per_window: int = 20
+    chat_requests_per_window: int = 60
+    user_daily_tokens: int = 0
+    chat_daily_tokens: int = 0
+    prompt_cost_per_1k: float = 0.00015
+    completion_cost_per_1k: float = 0.0006
+
+    @staticmethod
+    def from_env() -> 'QuotaConfig':
+        return QuotaConfig(
+            enabled=str_to_bool(os.getenv('QUOTA_ENABLED', False)),
+            window_seconds=int(os.getenv('QUOTA_WINDOW_SECONDS', 60 * 60)),
+            user_requests_per_window=int(os.getenv('QUOTA_USER_REQUESTS', 20)),
+            chat_requests_per_window=int(os.getenv('QUOTA_CHAT_REQUESTS', 60)),
+            user_daily_tokens=int(os.getenv('QUOTA_USER_DAILY_TOKENS', 0)),
+            chat_daily_tokens=int(os.getenv('QUOTA_CHAT_DAILY_TOKENS', 0)),
+            prompt_cost_per_1k=float(os.getenv('QUOTA_PROMPT_COST_PER_1K', 0.00015)),
+            completion_cost_per_1k=float(os.getenv('QUOTA_COMPLETION_COST_PER_1K', 0.0006)),
+        )
+
+
+@dataclass
+class QuotaDecision:
+    """Whether a summary may be requested, and if not, why"""
+    allowed: bool
+    reason: str = ""
+    retry_after_seconds: int = 0
+
+
+class QuotaExceededError(Exception):
+    """Raised instead of writing a summary the user or the chat has no quota left for"""
+
+    def __init__(self, decision: QuotaDecision):
+        super().__init__(decision.reason)
+        self.decision = decision
+
+
+@dataclass
+class TokenUsage:
+    """Tokens spent on summaries"""
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def cost(self, config: QuotaConfig) -> float:
+        return (self.prompt_tokens * config.prompt_cost_per_1k
+                + self.completion_tokens * config.completion_cost_per_1k) / 1000
+
+
+_config = QuotaConfig()
+
+
+def configure_quota(config: Optional[QuotaConfig] = None):
+    """
+    Sets the quotas.
+    @param config: read from the env variables by default
+    """
+    global _config
+
+    _config = config or QuotaConfig.from_env()
+    if _config.enabled:
+        logger.info(f"Quotas: {_config.user_requests_per_window} summaries per user and "
+                    f"{_config.chat_requests_per_window} per chat every {_config.window_seconds}s")
+
+
+def get_quota_config() -> QuotaConfig:
+    return _config
+
+
+def acquire_summary_quota(redis_client: Redis,
+                          chat_id: int,
+                          user_id: int,
+                          now: Optional[float] = None) -> QuotaDecision:
+    """
+    Checks the user's and the chat's budgets, and counts the request against their rate limits if it is allowed.
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @param user_id: the user requesting the summary
+    @param now: the current unix time, for the tests
+    @return: the decision
+    """
+    if not _config.enabled:
+        return QuotaDecision(allowed=True)
+
+    now = time.time() if now is None else now
+    day = _day(now)
+
+    budgets = [
+        (USER_SCOPE, user_id, _config.user_daily_tokens, "You've used up today's summaries."),
+        (CHAT_SCOPE, chat_id, _config.chat_daily_tokens, "This chat has used up today's summaries."),
+    ]
+    for scope, owner_id, budget, reason in budgets:
+        if budget and get_token_usage(redis_client, scope, owner_id, day).total_tokens >= budget:
+            return QuotaDecision(allowed=False, reason=reason, retry_after_seconds=_seconds_until_tomorrow(now))
+
+    limits = [
+        (USER_SCOPE, user_id, _config.user_requests_per_window, "You're requesting summaries too often."),
+        (CHAT_SCOPE, chat_id, _config.chat_requests_per_window, "This chat is requesting summaries too often."),
+    ]
+    acquired = []
+    for scope, owner_id, limit, reason in limits:
+        key = namespaced_key(REQUESTS_KEY.format(scope=scope, owner_id=owner_id))
+        member, retry_after = _acquire_sliding_window(redis_client, key, limit, now)
+        if member is None:
+            # Give back what the other limits already counted
+            for acquired_key, acquired_member in acquired:
+                redis_client.zrem(acquired_key, acquired_member)
+            return QuotaDecision(allowed=False, reason=reason, retry_after_seconds=retry_after)
+        acquired.append((key, member))
+
+    return QuotaDecision(allowed=True)
+
+
+def _acquire_sliding_window(redis_client: Redis, key: str, limit: int, now: float) -> tuple[Optional[str], int]:
+    """
+    Adds the request to the window, and takes it back out if the window was already full.
+    @return: the request's member if it was allowed, and how long until the oldest request leaves the window
+    """
+    member = f"{now}:{uuid.uuid4().hex}"
+
+    pipeline = redis_client.pipeline()
+    pipeline.zremrangebyscore(key, 0, now - _config.window_seconds)
+    pipeline.zadd(key, {member: now})
+    pipeline.zcard(key)
+    pipeline.zrange(key, 0, 0, withscores=True)
+    pipeline.expire(key, _config.window_seconds)
+    _, _, count, oldest, _ = pipeline.execute()
+
+    if count <= limit:
+        return member, 0
+
+    redis_client.zrem(key, member)
+    retry_after = int(oldest[0][1] + _config.window_seconds - now) + 1 if oldest else _config.window_seconds
+    return None, retry_after
+
+
+def record_token_usage(redis_client: Redis,
+                       chat_id: int,
+                       user_id: Optional[int],
+                       prompt_tokens: int,
+                       completion_tokens: int,
+                       now: Optional[float] = None):
+    """
+    Adds the tokens of a completion to the ledger.
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @param user_id: the user who requested the summary, None for background summaries
+    @param prompt_tokens: the prompt tokens of the completion
+    @param completion_tokens: the completion tokens of the completion
+    @param now: the current unix time, for the tests
+    """
+    if not prompt_tokens and not completion_tokens:
+        return  # The extractive backend and cache hits cost nothing
+
+    day = _day(time.time() if now is None else now)
+    owners = [(CHAT_SCOPE, chat_id)] + ([(USER_SCOPE, user_id)] if user_id is not None else [])
+
+    ledger_keys = [TOKENS_KEY.format(scope=scope, owner_id=owner_id, day=day) for scope, owner_id in owners]
+    ledger_keys.append(TOTAL_TOKENS_KEY.format(day=day))
+
+    pipeline = redis_client.pipeline(transaction=False)
+    for key in map(namespaced_key, ledger_keys):
+        pipeline.hincrby(key, "prompt", prompt_tokens)
+        pipeline.hincrby(key, "completion", completion_tokens)
+        pipeline.expire(key, LEDGER_TTL_SECONDS)
+    for scope, owner_id in owners:
+        top_key = namespaced_key(TOP_CONSUMERS_KEY.format(scope=scope, day=day))
+        pipeline.zincrby(top_key, prompt_tokens + completion_tokens, owner_id)
+        pipeline.expire(top_key, LEDGER_TTL_SECONDS)
+    pipeline.execute()
+
+
+def get_token_usage(redis_client: Redis, scope: str, owner_id: int, day: Optional[str] = None) -> TokenUsage:
+    """
+    Gets the tokens a user or a chat spent on a day.
+    @param redis_client: The Redis client singleton
+    @param scope: USER_SCOPE or CHAT_SCOPE
+    @param owner_id: the user or chat id
+    @param day: the UTC day, e.g. 20240514, today by default
+    @return: the usage
+    """
+    day = day or _day(time.time())
+    return _read_usage(redis_client, namespaced_key(TOKENS_KEY.format(scope=scope, owner_id=owner_id, day=day)))
+
+
+def get_usage_report(redis_client: Redis, top_n: int = 3) -> str:
+    """
+    Summarizes today's token usage for the admins
+    @param redis_client: The Redis client singleton
+    @param top_n: how many of the biggest chats and users are listed
+    @return: the report
+    """
+    day = _day(time.time())
+    total = _read_usage(redis_client, namespaced_key(TOTAL_TOKENS_KEY.format(day=day)))
+
+    lines = [
+        "Usage (today, UTC)",
+        f"Tokens: {total.total_tokens} ({total.prompt_tokens} prompt, {total.completion_tokens} completion)",
+        f"Estimated cost: ${total.cost(_config):.4f}",
+        f"Quotas enforced: {_config.enabled}",
+    ]
+    for scope in (CHAT_SCOPE, USER_SCOPE):
+        top_key = namespaced_key(TOP_CONSUMERS_KEY.format(scope=scope, day=day))
+        top = redis_client.zrevrange(top_key, 0, top_n - 1, withscores=True)
+        if top:
+            consumers = ', '.join(f"{owner_id.decode('utf-8')} ({int(tokens)})" for owner_id, tokens in top)
+            lines.append(f"Top {scope}s: {consumers}")
+
+    return '\n'.join(lines)
+
+
+def _read_usage(redis_client: Redis, key: str) -> TokenUsage:
+    usage = redis_client.hgetall(key)
+    return TokenUsage(
+        prompt_tokens=int(usage.get(b'prompt', 0)),
+        completion_tokens=int(usage.get(b'completion', 0))
+    )
+
+
+def _day(now: float) -> str:
+    return datetime.fromtimestamp(now, tz=timezone.utc).strftime('%Y%m%d')
+
+
+def _seconds_until_tomorrow(now: float) -> int:
+    seconds_per_day = 24 * 60 * 60
+    return int(seconds_per_day - now % seconds_per_day) + 1
@@ -0,0 +1,147 @@
+"""
+The Redis key schema.
+
+Every key that belongs to a chat starts with the chat's {chat:<id>} hash tag.
+Redis Cluster only hashes the part inside the braces, so a chat's messages,
+counters, caches and checkpoints all live on the same slot, and can be read
+and written together in one pipeline.
+
+    <prefix>{chat:<id>}:messages                 the latest messages, newest first
+    <prefix>{chat:<id>}:revisions                message id -> the edited message, or a tombstone
+    <prefix>{chat:<id>}:pending                  messages stored since the last summary
+    <prefix>{chat:<id>}:summary:<style>:<n>      the cached summary of a window
+    <prefix>{chat:<id>}:summary_generation       bumped when the cached summaries go stale, e.g. on an edit
+    <prefix>{chat:<id>}:digest                   what the last digest covered
+    <prefix>{chat:<id>}:search:*                 the full-text index, see search_index
+    <prefix>{chat:<id>}:thread:*                 the reply threads, see reply_threads
+    <prefix>{chat:<id>}:stats:*                  the activity counters, see chat_stats
+    <prefix>{chat:<id>}:archive                  messages waiting to be archived, oldest first, see message_archive
+
+Keys that don't belong to a chat, e.g. the per-user quotas, only get the prefix.
+The leader lease and its fencing counter share their own {leader:<name>} hash tag.
+The optional prefix (REDIS_KEY_PREFIX) lets several deployments share one Redis.
+"""
+import os
+import re
+from typing import Optional
+
+_key_prefix = os.getenv('REDIS_KEY_PREFIX', '')
+
+_CHAT_MESSAGES_KEY_PATTERN = re.compile(rb"\{chat:(-?\d+)\}:messages$")
+
+
+def namespaced_key(key: str) -> str:
+    """
+    @param key: a key that doesn't belong to a chat
+    @return: the key in this deployment's namespace
+    """
+    return f"{_key_prefix}{key}"
+
+
+def chat_tag(chat_id: int) -> str:
+    """
+    @param chat_id: The unique identifier for the chat session.
+    @return: the prefix shared by all the chat's keys
+    """
+    return f"{_key_prefix}{{chat:{chat_id}}}"
+
+
+def chat_messages_key(chat_id: int) -> str:
+    return f"{chat_tag(chat_id)}:messages"
+
+
+def message_revisions_key(chat_id: int) -> str:
+    return f"{chat_tag(chat_id)}:revisions"
+
+
+def pending_messages_key(chat_id: int) -> str:
+    return f"{chat_tag(chat_id)}:pending"
+
+
+def summary_cache_key(chat_id: int, style: str, number_of_msgs: int) -> str:
+    return f"{chat_tag(chat_id)}:summary:{style}:{number_of_msgs}"
+
+
+def summary_generation_key(chat_id: int) -> str:
+    return f"{chat_tag(chat_id)}:summary_generation"
+
+
+def digest_state_key(chat_id: int) -> str:
+    return f"{chat_tag(chat_id)}:digest"
+
+
+def archive_queue_key(chat_id: int) -> str:
+    return f"{chat_tag(chat_id)}:archive"
+
+
+def chat_messages_pattern() -> str:
+    """
+    @return: the SCAN pattern that matches every chat's message list
+    """
+    # Braces are not special in SCAN patterns, only *, ?, [ and \ are
+    return f"{_key_prefix}{{chat:*}}:messages"
+
+
+def chat_id_from_messages_key(key: bytes) -> Optional[int]:
+    """
+    @param key: a key returned by SCAN
+    @return: the chat id, or None if it isn't a chat's message list
+    """
+    match = _CHAT_MESSAGES_KEY_PATTERN.search(key)
+    return int(match.group(1)) if match else None
+
+
+def search_docs_key(chat_id: int) -> str:
+    return f"{chat_tag(chat_id)}:search:docs"
+
+
+def search_ids_key(chat_id: int) -> str:
+    return f"{chat_tag(chat_id)}:search:ids"
+
+
+def search_doc_terms_key(chat_id: int) -> str:
+    return f"{chat_tag(chat_id)}:search:doc_terms"
+
+
+def search_term_key(chat_id: int, term: str) -> str:
+    return f"{chat_tag(chat_id)}:search:term:{term}"
+
+
+def search_scratch_key(chat_id: int, token: str) -> str:
+    return f"{chat_tag(chat_id)}:search:scratch:{token}"
+
+
+def thread_parents_key(chat_id: int) -> str:
+    return f"{chat_tag(chat_id)}:thread:parents"
+
+
+def thread_children_key(chat_id: int, message_id: int) -> str:
+    return f"{chat_tag(chat_id)}:thread:children:{message_id}"
+
+
+def thread_replies_key(chat_id: int) -> str:
+    return f"{chat_tag(chat_id)}:thread:replies"
+
+
+def stats_hour_key(chat_id: int, hour: int) -> str:
+    return f"{chat_tag(chat_id)}:stats:hour:{hour}"
+
+
+def stats_users_key(chat_id: int, day: str) -> str:
+    return f"{chat_tag(chat_id)}:stats:users:{day}"
+
+
+def stats_posters_key(chat_id: int) -> str:
+    return f"{chat_tag(chat_id)}:stats:posters"
+
+
+def stats_names_key(chat_id: int) -> str:
+    return f"{chat_tag(chat_id)}:stats:names"
+
+
+def leader_lease_key(name: str) -> str:
+    return namespaced_key(f"{{leader:{name}}}:lease")
+
+
+def leader_fencing_key(name: str) -> str:
+    return namespaced_key(f"{{leader:{name}}}:fencing")
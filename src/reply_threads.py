@@ -0,0 +1,98 @@
+"""
+Reply threads, indexed in Redis next to the messages.
+
+Every reply is recorded as an edge between the message and the one it replies to,
+under the chat's {chat:<id>} hash tag:
+
+    thread:parents           message id -> the id of the message it replies to
+    thread:children:<id>     sorted set of the ids of the replies to a message
+    thread:replies           sorted set of every indexed reply, to evict the oldest ones
+
+A thread is found by walking up the parents to the message that started it,
+then down the children, one pipelined round trip per level, so its cost depends
+on the size of the thread and not on the history of the chat.
+
+Configuration (env variables):
+    THREAD_MAX_REPLIES   how many of the latest replies of a chat stay indexed (default 10000)
+"""
+import os
+
+from redis import Redis
+from redis.client import Pipeline
+
+from redis_keys import thread_parents_key, thread_children_key, thread_replies_key
+
+THREAD_MAX_REPLIES = int(os.getenv('THREAD_MAX_REPLIES', 10_000))
+# Evicting in batches keeps the per-message write cost flat
+THREAD_EVICTION_BATCH = 100
+# How far up a reply chain the walk goes to find the start of the thread
+MAX_THREAD_DEPTH = 50
+
+
+def index_reply(pipeline: Pipeline, chat_id: int, message_id: int, parent_id: int):
+    """
+    Queues the commands that record a reply
+    @param pipeline: the pipeline the message is stored with
+    @param chat_id: The unique identifier for the chat session.
+    @param message_id: the reply
+    @param parent_id: the message it replies to
+    """
+    pipeline.hset(thread_parents_key(chat_id), message_id, parent_id)
+    pipeline.zadd(thread_children_key(chat_id, parent_id), {message_id: message_id})
+    pipeline.zadd(thread_replies_key(chat_id), {message_id: message_id})
+
+
+def get_thread_ids(redis_client: Redis, chat_id: int, message_id: int, limit: int) -> list[int]:
+    """
+    Finds the messages of the thread a message belongs to
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @param message_id: any message of the thread
+    @param limit: the most messages returned, the latest ones are kept
+    @return: the message ids, oldest first, or just the message if it isn't part of a thread
+    """
+    parents_key = thread_parents_key(chat_id)
+    root_id = message_id
+    for _ in range(MAX_THREAD_DEPTH):
+        parent_id = redis_client.hget(parents_key, root_id)
+        if parent_id is None:
+            break
+        root_id = int(parent_id)
+
+    thread_ids = {root_id}
+    level = [root_id]
+    while level:
+        pipeline = redis_client.pipeline(transaction=False)
+        for parent_id in level:
+            pipeline.zrange(thread_children_key(chat_id, parent_id), 0, -1)
+        level = [int(child_id) for children in pipeline.execute() for child_id in children
+                 if int(child_id) not in thread_ids]
+        thread_ids.update(level)
+
+    return sorted(thread_ids)[-limit:]
+
+
+def evict_oldest(redis_client: Redis, chat_id: int, keep: int = THREAD_MAX_REPLIES) -> int:
+    """
+    Removes the oldest replies from the chat's index
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @param keep: how many of the newest replies stay indexed
+    @return: how many replies were removed
+    """
+    replies_key = thread_replies_key(chat_id)
+    excess = redis_client.zcard(replies_key) - keep
+    if excess <= 0:
+        return 0
+
+    reply_ids = [int(reply_id) for reply_id in redis_client.zrange(replies_key, 0, excess - 1)]
+    parent_ids = redis_client.hmget(thread_parents_key(chat_id), reply_ids)
+
+    pipeline = redis_client.pipeline(transaction=False)
+    for reply_id, parent_id in zip(reply_ids, parent_ids):
+        if parent_id is not None:
+            pipeline.zrem(thread_children_key(chat_id, int(parent_id)), reply_id)
+    pipeline.hdel(thread_parents_key(chat_id), *reply_ids)
+    pipeline.zrem(replies_key, *reply_ids)
+    pipeline.execute()
+    return len(reply_ids)
@@ -0,0 +1,214 @@
+"""
+Deadlines, retries, hedging and circuit breaking for calls to a remote provider.
+
+Calls are blocking and run on worker threads, so the building blocks are
+thread-safe and use a small thread pool for the hedged duplicates.
+
+    - every call has a deadline, and each attempt is told how much of it is left
+    - failed attempts are retried a bounded number of times, with full jitter
+    - when an attempt is slower than the observed p95, a duplicate is sent and the first answer wins
+    - after repeated failures the circuit opens and calls fail fast until the provider recovers
+"""
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait, Future
+from dataclasses import dataclass
+from enum import Enum
+from typing import Callable, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class CircuitState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider that is unhealthy"""
+
+
+class DeadlineExceededError(TimeoutError):
+    """Raised when a call ran out of time, including its retries"""
+
+
+class CircuitBreaker:
+    """
+    Fails fast while a provider is unhealthy.
+    Opens after consecutive failures, then lets a single trial call through once the reset timeout has passed.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout_seconds: float = 30):
+        self.name = name
+        self._failure_threshold = failure_threshold
+        self._reset_timeout_seconds = reset_timeout_seconds
+        self._state = CircuitState.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> CircuitState:
+        with self._lock:
+            if self._state is CircuitState.OPEN and self._reset_timeout_elapsed():
+                return CircuitState.HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        """
+        Checks if a call may go through. A half open circuit lets one trial call through at a time.
+        @return: True if the call may go through
+        """
+        with self._lock:
+            if self._state is CircuitState.CLOSED:
+                return True
+
+            if self._state is CircuitState.OPEN and not self._reset_timeout_elapsed():
+                return False
+
+            if self._trial_in_flight:
+                return False
+
+            self._state = CircuitState.HALF_OPEN
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._state is not CircuitState.CLOSED:
+                logger.info(f"The {self.name} circuit closed")
+            self._state = CircuitState.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state is CircuitState.HALF_OPEN or self._failures >= self._failure_threshold:
+                if self._state is not CircuitState.OPEN:
+                    logger.warning(f"The {self.name} circuit opened after {self._failures} failures")
+                self._state = CircuitState.OPEN
+                self._opened_at = time.monotonic()
+
+    def _reset_timeout_elapsed(self) -> bool:
+        return time.monotonic() - self._opened_at >= self._reset_timeout_seconds
+
+
+@dataclass
+class RetryPolicy:
+    """How failed attempts are retried"""
+    max_attempts: int = 3
+    base_delay_seconds: float = 0.5
+    max_delay_seconds: float = 4
+    retryable: tuple[type[BaseException], ...] = (Exception,)
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Full jitter: a random delay up to the exponential backoff, so retries of many callers don't line up.
+        @param attempt: the attempt that failed, starting at 1
+        @return: the delay before the next attempt, in seconds
+        """
+        return random.uniform(0, min(self.max_delay_seconds, self.base_delay_seconds * 2 ** (attempt - 1)))
+
+
+class ResilientCaller:
+    """Calls a provider with a deadline, retries, hedging and a circuit breaker"""
+
+    def __init__(self,
+                 breaker: CircuitBreaker,
+                 retry_policy: RetryPolicy,
+                 deadline_seconds: float,
+                 hedge_after: Callable[[], Optional[float]] = lambda: None,
+                 max_hedge_workers: int = 8):
+        """
+        @param breaker: the provider's circuit breaker
+        @param retry_policy: how failed attempts are retried
+        @param deadline_seconds: how long a call may take, including its retries
+        @param hedge_after: returns how long to wait before sending a duplicate attempt, None to never hedge
+        @param max_hedge_workers: how many attempts may run on the pool at once
+        """
+        self.breaker = breaker
+        self._retry_policy = retry_policy
+        self._deadline_seconds = deadline_seconds
+        self._hedge_after = hedge_after
+        self._executor = ThreadPoolExecutor(max_workers=max_hedge_workers, thread_name_prefix=f"{breaker.name}-call")
+
+    def call(self, attempt_fn: Callable[[float], T]) -> T:
+        """
+        Calls the provider.
+        @param attempt_fn: makes one attempt, given the seconds left before the deadline as its timeout
+        @return: the result of the first successful attempt
+        @raise CircuitOpenError: if the provider is unhealthy
+        @raise DeadlineExceededError: if the deadline passed
+        """
+        deadline = time.monotonic() + self._deadline_seconds
+
+        for attempt in range(1, self._retry_policy.max_attempts + 1):
+            if not self.breaker.allow():
+                raise CircuitOpenError(f"The {self.breaker.name} circuit is open")
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceededError(f"The {self.breaker.name} call ran out of time")
+
+            try:
+                result = self._hedged_attempt(attempt_fn, remaining)
+            except Exception as e:
+                is_retryable = isinstance(e, self._retry_policy.retryable)
+                if not is_retryable and not isinstance(e, TimeoutError):
+                    # The provider answered, the request itself was wrong
+                    self.breaker.record_success()
+                    raise
+
+                # The provider failed, or didn't answer in time, e.g. it hangs
+                self.breaker.record_failure()
+                if not is_retryable or attempt == self._retry_policy.max_attempts:
+                    raise
+
+                delay = self._retry_policy.backoff(attempt)
+                logger.warning(f"Attempt {attempt} of the {self.breaker.name} call failed with {e!r}, "
+                               f"retrying in {delay:.2f}s")
+                if time.monotonic() + delay >= deadline:
+                    raise DeadlineExceededError(f"The {self.breaker.name} call ran out of time") from e
+                time.sleep(delay)
+                continue
+
+            self.breaker.record_success()
+            return result
+
+        raise AssertionError("unreachable")  # The last attempt either returns or raises
+
+    def _hedged_attempt(self, attempt_fn: Callable[[float], T], remaining: float) -> T:
+        started = time.monotonic()
+        futures: set[Future] = {self._executor.submit(attempt_fn, remaining)}
+
+        hedge_after = self._hedge_after()
+        if hedge_after is not None and hedge_after < remaining:
+            done, _ = wait(futures, timeout=hedge_after)
+            if not done:
+                logger.info(f"The {self.breaker.name} call is slower than {hedge_after:.2f}s, hedging")
+                futures.add(self._executor.submit(attempt_fn, remaining - (time.monotonic() - started)))
+
+        error: Optional[BaseException] = None
+        while futures:
+            time_left = remaining - (time.monotonic() - started)
+            done, futures = wait(futures, timeout=max(time_left, 0), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+
+            for future in done:
+                if future.exception() is None:
+                    # The slower duplicate keeps running until its own timeout, its result is dropped
+                    return future.result()
+                error = future.exception()
+
+        if error is not None:
+            raise error
+        raise DeadlineExceededError(f"The {self.breaker.name} call ran out of time")
@@ -0,0 +1,171 @@
+"""
+Full-text index over the chat history, kept in Redis next to the messages.
+
+Every chat has its own inverted index under its {chat:<id>} hash tag:
+
+    search:docs              message id -> the stored message
+    search:ids               sorted set of the indexed message ids, to evict the oldest ones
+    search:doc_terms         message id -> its terms, to remove them from the postings on eviction
+    search:term:<term>       sorted set of the message ids containing the term, scored by term weight
+
+The index keeps far more history than the message list (SEARCH_MAX_MESSAGES per chat).
+A query intersects the postings of its terms server-side, weighted by each term's
+inverse document frequency, so its cost depends on the postings and not the history size.
+"""
+import math
+import os
+import re
+import unicodedata
+import uuid
+from collections import Counter
+
+from redis import Redis
+from redis.client import Pipeline
+
+from redis_keys import search_docs_key, search_ids_key, search_doc_terms_key, search_term_key, search_scratch_key
+
+SEARCH_MAX_MESSAGES = int(os.getenv('SEARCH_MAX_MESSAGES', 10_000))
+# Evicting in batches keeps the per-message write cost flat
+SEARCH_EVICTION_BATCH = 100
+
+# BM25 term saturation and length normalization
+_K1 = 1.2
+_B = 0.75
+_AVERAGE_MESSAGE_TERMS = 12
+
+# Breaks ties in favour of the newest messages, without outweighing any term
+_RECENCY_WEIGHT = 1e-12
+
+_TERM_PATTERN = re.compile(r"\w[\w']+")
+_STOP_WORDS = frozenset(
+    "a an and are as at be but by for from has have i if in is it its me my no not of on or our so that the "
+    "their them then there they this to was we were what when which who will with you your".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Splits text into the terms that are indexed and searched
+    @param text: a message or a query
+    @return: the terms, in order, with repeats
+    """
+    text = unicodedata.normalize("NFKC", text).casefold()
+    terms = (term.removesuffix("'s").strip("'") for term in _TERM_PATTERN.findall(text))
+    return [term for term in terms if len(term) > 1 and term not in _STOP_WORDS]
+
+
+def index_document(pipeline: Pipeline, chat_id: int, doc_id: int, text: str, document: str):
+    """
+    Queues the commands that add a message to the chat's index
+    @param pipeline: the pipeline the message is stored with
+    @param chat_id: The unique identifier for the chat session.
+    @param doc_id: the message id
+    @param text: the text that is searched
+    @param document: what a search returns, e.g. the serialized message
+    """
+    terms = tokenize(text)
+    if not terms:
+        return
+
+    frequencies = Counter(terms)
+    pipeline.hset(search_docs_key(chat_id), doc_id, document)
+    pipeline.hset(search_doc_terms_key(chat_id), doc_id, ' '.join(frequencies))
+    pipeline.zadd(search_ids_key(chat_id), {doc_id: doc_id})
+    for term, frequency in frequencies.items():
+        pipeline.zadd(search_term_key(chat_id, term), {doc_id: _term_weight(frequency, len(terms))})
+
+
+def _term_weight(frequency: int, document_terms: int) -> float:
+    length_norm = 1 - _B + _B * document_terms / _AVERAGE_MESSAGE_TERMS
+    return frequency * (_K1 + 1) / (frequency + _K1 * length_norm)
+
+
+def remove_document(redis_client: Redis, chat_id: int, doc_id: int):
+    """
+    Removes a message from the chat's index
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @param doc_id: the message id
+    """
+    _remove_documents(redis_client, chat_id, [doc_id])
+
+
+def index_size(redis_client: Redis, chat_id: int) -> int:
+    return redis_client.zcard(search_ids_key(chat_id))
+
+
+def evict_oldest(redis_client: Redis, chat_id: int, keep: int = SEARCH_MAX_MESSAGES) -> int:
+    """
+    Removes the oldest messages from the chat's index
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @param keep: how many of the newest messages stay indexed
+    @return: how many messages were removed
+    """
+    excess = index_size(redis_client, chat_id) - keep
+    if excess <= 0:
+        return 0
+
+    doc_ids = [int(doc_id) for doc_id in redis_client.zrange(search_ids_key(chat_id), 0, excess - 1)]
+    _remove_documents(redis_client, chat_id, doc_ids)
+    return len(doc_ids)
+
+
+def _remove_documents(redis_client: Redis, chat_id: int, doc_ids: list[int]):
+    if not doc_ids:
+        return
+
+    doc_terms = redis_client.hmget(search_doc_terms_key(chat_id), doc_ids)
+
+    pipeline = redis_client.pipeline(transaction=False)
+    for doc_id, terms in zip(doc_ids, doc_terms):
+        for term in (terms or b'').decode('utf-8').split():
+            pipeline.zrem(search_term_key(chat_id, term), doc_id)
+    pipeline.hdel(search_docs_key(chat_id), *doc_ids)
+    pipeline.hdel(search_doc_terms_key(chat_id), *doc_ids)
+    pipeline.zrem(search_ids_key(chat_id), *doc_ids)
+    pipeline.execute()
+
+
+def search(redis_client: Redis, chat_id: int, query: str, limit: int) -> list[bytes]:
+    """
+    Finds the messages that contain every term of the query, best match first.
+    Rare terms weigh more than common ones, and ties go to the newest message.
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @param query: the terms to look for
+    @param limit: the most messages returned
+    @return: the matching documents
+    """
+    terms = list(dict.fromkeys(tokenize(query)))
+    if not terms or limit <= 0:
+        return []
+
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.zcard(search_ids_key(chat_id))
+    for term in terms:
+        pipeline.zcard(search_term_key(chat_id, term))
+    total, *document_frequencies = pipeline.execute()
+
+    if not all(document_frequencies):
+        return []  # A term that is in no message matches nothing
+
+    weights = {search_ids_key(chat_id): _RECENCY_WEIGHT}
+    for term, document_frequency in zip(terms, document_frequencies):
+        weights[search_term_key(chat_id, term)] = _inverse_document_frequency(total, document_frequency)
+
+    scratch_key = search_scratch_key(chat_id, uuid.uuid4().hex)
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.zinterstore(scratch_key, weights)
+    pipeline.zrevrange(scratch_key, 0, limit - 1)
+    pipeline.delete(scratch_key)
+    _, doc_ids, _ = pipeline.execute()
+
+    if not doc_ids:
+        return []
+
+    return [document for document in redis_client.hmget(search_docs_key(chat_id), doc_ids) if document is not None]
+
+
+def _inverse_document_frequency(total: int, document_frequency: int) -> float:
+    return math.log(1 + (total - document_frequency + 0.5) / (document_frequency + 0.5))
@@ -1,25 +1,171 @@
+import asyncio
+import hmac
 import logging
+import os
+from dataclasses import asdict
 
 from starlette.applications import Starlette
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, PlainTextResponse
 from starlette.routing import Route, Request
 from uvicorn import Config, Server
 
+from chat_stats import ChatStats, get_chat_stats
+from debug_tools import (get_loop_lag_monitor, sample_stacks, format_collapsed_stacks, get_memory_report,
+                         PROFILE_MAX_SECONDS)
+from message_storage import get_redis_client, get_all_chat_ids
+from startup import get_startup_timer
+from structured_logging import log_event
+
 logger = logging.getLogger(__name__)
 
+# Only one profile runs at a time, two would sample each other
+_profile_lock = asyncio.Lock()
+
 
 async def health(request: Request):
     """
     Health check endpoint to ensure the service is up and running.
     Returns a JSON response with the health status.
     """
-    logger.info("Heath check was hit")
+    log_event(logger, logging.DEBUG, "health_check")
     return JSONResponse({'status': 'healthy'})
 
 
+async def ready(request: Request):
+    """
+    Readiness endpoint. Returns 503 until the bot is warmed up and polling.
+    The body has the startup timings.
+    """
+    startup_timer = get_startup_timer()
+    status_code = 200 if startup_timer.is_ready else 503
+    return JSONResponse({'ready': startup_timer.is_ready, 'startup': startup_timer.report()}, status_code=status_code)
+
+
+def _is_authorized(request: Request) -> bool:
+    """
+    The admin endpoints take the ADMIN_API_TOKEN as a bearer token, and are disabled without one.
+    """
+    admin_token = os.getenv('ADMIN_API_TOKEN', '')
+    authorization = request.headers.get('Authorization', '')
+    return bool(admin_token) and hmac.compare_digest(authorization.encode(), f"Bearer {admin_token}".encode())
+
+
+def _unauthorized() -> JSONResponse:
+    return JSONResponse({'error': 'unauthorized'}, status_code=401)
+
+
+def _stats_to_dict(stats: ChatStats) -> dict:
+    return {**asdict(stats), 'messages': stats.messages, 'busiest_hour': stats.busiest_hour}
+
+
+async def chat_stats(request: Request):
+    """
+    Admin endpoint with the activity of one chat, e.g. GET /admin/stats/-100123?hours=48
+    """
+    if not _is_authorized(request):
+        return _unauthorized()
+
+    try:
+        chat_id = int(request.path_params['chat_id'])
+        hours = int(request.query_params.get('hours', 24))
+    except ValueError:
+        return JSONResponse({'error': 'the chat id and hours must be numbers'}, status_code=400)
+
+    stats = await asyncio.to_thread(get_chat_stats, get_redis_client(), chat_id, hours)
+    return JSONResponse(_stats_to_dict(stats))
+
+
+async def all_chat_stats(request: Request):
+    """
+    Admin endpoint with the activity of every chat, busiest first, e.g. GET /admin/stats?hours=24&limit=20
+    """
+    if not _is_authorized(request):
+        return _unauthorized()
+
+    try:
+        hours = int(request.query_params.get('hours', 24))
+        limit = int(request.query_params.get('limit', 50))
+    except ValueError:
+        return JSONResponse({'error': 'hours and limit must be numbers'}, status_code=400)
+
+    def read_all_stats() -> list:
+        redis_client = get_redis_client()
+        return [get_chat_stats(redis_client, chat_id, hours) for chat_id in get_all_chat_ids(redis_client)]
+
+    all_stats = await asyncio.to_thread(read_all_stats)
+    all_stats.sort(key=lambda stats: stats.messages, reverse=True)
+    return JSONResponse({'chats': [_stats_to_dict(stats) for stats in all_stats[:limit]]})
+
+
+async def loop_lag(request: Request):
+    """
+    Admin endpoint with how often the event loop was blocked, and the stack of the last stall.
+    """
+    if not _is_authorized(request):
+        return _unauthorized()
+
+    monitor = get_loop_lag_monitor()
+    if monitor is None:
+        return JSONResponse({'error': 'the loop lag monitor is disabled'}, status_code=404)
+    return JSONResponse(asdict(monitor.report))
+
+
+async def profile(request: Request):
+    """
+    Admin endpoint that profiles the bot for a while, e.g. GET /debug/profile?seconds=10&interval_ms=5
+    Returns the collapsed stacks, for flamegraph.pl or speedscope.
+    """
+    if not _is_authorized(request):
+        return _unauthorized()
+
+    try:
+        seconds = float(request.query_params.get('seconds', 10))
+        interval_seconds = float(request.query_params.get('interval_ms', 5)) / 1000
+    except ValueError:
+        return JSONResponse({'error': 'seconds and interval_ms must be numbers'}, status_code=400)
+    if not 0 < seconds <= PROFILE_MAX_SECONDS or interval_seconds <= 0:
+        return JSONResponse({'error': f'seconds must be between 0 and {PROFILE_MAX_SECONDS}'}, status_code=400)
+
+    if _profile_lock.locked():
+        return JSONResponse({'error': 'a profile is already running'}, status_code=409)
+    async with _profile_lock:
+        log_event(logger, logging.INFO, "profile_started", seconds=seconds)
+        # Sampled from a thread, so the event loop keeps running and shows up in the profile
+        samples = await asyncio.to_thread(sample_stacks, seconds, interval_seconds)
+
+    return PlainTextResponse(format_collapsed_stacks(samples),
+                             headers={'Content-Disposition': 'attachment; filename="profile.folded"'})
+
+
+async def memory(request: Request):
+    """
+    Admin endpoint with the top allocators, and the growth since the previous call,
+    e.g. GET /debug/memory?top=20&group_by=filename. The first call starts tracing the allocations.
+    """
+    if not _is_authorized(request):
+        return _unauthorized()
+
+    group_by = request.query_params.get('group_by', 'lineno')
+    try:
+        top_n = int(request.query_params.get('top', 20))
+    except ValueError:
+        return JSONResponse({'error': 'top must be a number'}, status_code=400)
+    if group_by not in ('lineno', 'filename', 'traceback'):
+        return JSONResponse({'error': 'group_by must be lineno, filename or traceback'}, status_code=400)
+
+    report = await asyncio.to_thread(get_memory_report, top_n, group_by)
+    return JSONResponse(report)
+
+
 web_app = Starlette(
     routes=[
         Route("/status", health, methods=["GET"]),
+        Route("/ready", ready, methods=["GET"]),
+        Route("/admin/stats", all_chat_stats, methods=["GET"]),
+        Route("/admin/stats/{chat_id}", chat_stats, methods=["GET"]),
+        Route("/debug/loop", loop_lag, methods=["GET"]),
+        Route("/debug/profile", profile, methods=["GET"]),
+        Route("/debug/memory", memory, methods=["GET"]),
     ]
 )
 
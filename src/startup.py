@@ -0,0 +1,194 @@
+"""
+Startup sequence of the bot, and how long each step of it took.
+
+The webserver starts first, so the liveness probe answers while the bot connects.
+Redis is connected with a bounded, jittered backoff instead of exiting on the
+first failure, then the Redis connection pool, its TLS handshakes, the OpenAI
+client and the whitelist are warmed concurrently. /ready only turns green once
+the warmup is done and the bot is polling, so the first update doesn't pay for any of it.
+
+The timings, measured from the start of the process, are logged with the first
+handled update and served by /ready.
+
+Configuration (env variables):
+    STARTUP_REDIS_ATTEMPTS            how many times Redis is tried before giving up (default 10)
+    STARTUP_REDIS_MAX_DELAY_SECONDS   the longest wait between the attempts (default 30)
+    STARTUP_WARM_CONNECTIONS          how many Redis connections are opened before the bot is ready (default 4)
+    STARTUP_WARM_OPENAI               open the connection to OpenAI before the bot is ready (default True)
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from redis import Redis
+
+from message_storage import configure_message_storage
+from openai_utils import get_ai_client, PING_TIMEOUT_SECONDS
+from resilience import RetryPolicy
+from structured_logging import log_event
+from utils import str_to_bool
+from white_list import warm_white_list
+
+logger = logging.getLogger(__name__)
+
+
+class StartupError(Exception):
+    """Raised when a dependency the bot can't run without never became available"""
+
+
+def _process_started_at() -> float:
+    # Linux knows when the process started, so the timings include the interpreter start up and the imports
+    try:
+        with open('/proc/self/stat') as stat_file:
+            # The fields after the command name, which may contain spaces, start at the 3rd field
+            start_ticks = int(stat_file.read().rpartition(')')[2].split()[19])
+        with open('/proc/stat') as stat_file:
+            boot_time = next(int(line.split()[1]) for line in stat_file if line.startswith('btime'))
+        return boot_time + start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, StopIteration):
+        return time.time()
+
+
+class StartupTimer:
+    """Records how long each startup phase took, and when the bot became ready and handled its first update"""
+
+    def __init__(self, started_at: Optional[float] = None):
+        self.started_at = started_at if started_at is not None else _process_started_at()
+        self._phases: dict[str, float] = {}
+        self._ready_at: Optional[float] = None
+        self._first_update_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        """Times a startup phase"""
+        phase_started = time.time()
+        try:
+            yield
+        finally:
+            self._phases[name] = time.time() - phase_started
+
+    @property
+    def is_ready(self) -> bool:
+        return self._ready_at is not None
+
+    def mark_ready(self):
+        if self._ready_at is None:
+            self._ready_at = time.time()
+            log_event(logger, logging.INFO, "startup_ready", ready_after_seconds=self._ready_at - self.started_at)
+
+    def mark_first_update(self) -> bool:
+        """
+        @return: True if this was the first update handled
+        """
+        with self._lock:
+            if self._first_update_at is not None:
+                return False
+            self._first_update_at = time.time()
+
+        log_event(logger, logging.INFO, "startup_report", **self.report())
+        return True
+
+    def report(self) -> dict:
+        """
+        @return: the duration of each phase, and the time to ready and to the first update, in seconds
+        """
+        return {
+            'phases': {name: round(seconds, 3) for name, seconds in self._phases.items()},
+            'ready_after_seconds': self._since_start(self._ready_at),
+            'first_update_after_seconds': self._since_start(self._first_update_at),
+        }
+
+    def _since_start(self, timestamp: Optional[float]) -> Optional[float]:
+        return round(timestamp - self.started_at, 3) if timestamp is not None else None
+
+
+_startup_timer = StartupTimer()
+
+
+def get_startup_timer() -> StartupTimer:
+    return _startup_timer
+
+
+async def connect_message_storage_async(max_attempts: Optional[int] = None,
+                                        max_delay_seconds: Optional[float] = None):
+    """
+    Connects to the storage, backing off between the attempts.
+    @param max_attempts: how many times to try, read from the env variables by default
+    @param max_delay_seconds: the longest wait between the attempts, read from the env variables by default
+    @raise StartupError: if the storage never answered
+    """
+    policy = RetryPolicy(
+        max_attempts=max_attempts or int(os.getenv('STARTUP_REDIS_ATTEMPTS', 10)),
+        base_delay_seconds=0.5,
+        max_delay_seconds=max_delay_seconds or float(os.getenv('STARTUP_REDIS_MAX_DELAY_SECONDS', 30)),
+    )
+
+    for attempt in range(1, policy.max_attempts + 1):
+        if await asyncio.to_thread(configure_message_storage):
+            return
+
+        if attempt < policy.max_attempts:
+            delay = policy.backoff(attempt)
+            logger.warning(f"The storage is unavailable, attempt {attempt} of {policy.max_attempts}. "
+                           f"Retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    raise StartupError(f"The storage is unavailable after {policy.max_attempts} attempts")
+
+
+async def warm_up_async(redis_client: Redis):
+    """
+    Opens the connections and builds the clients the first updates need, concurrently.
+    A warmup that fails is logged, the bot still starts and connects on first use.
+    @param redis_client: The Redis client singleton
+    """
+    warmups = {
+        'redis_pool': asyncio.to_thread(warm_redis_pool, redis_client,
+                                        int(os.getenv('STARTUP_WARM_CONNECTIONS', 4))),
+        'openai': asyncio.to_thread(warm_openai, str_to_bool(os.getenv('STARTUP_WARM_OPENAI', True))),
+        'white_list': asyncio.to_thread(warm_white_list),
+    }
+    results = await asyncio.gather(*warmups.values(), return_exceptions=True)
+    for name, result in zip(warmups, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Unable to warm up the {name}: {result}")
+
+
+def warm_redis_pool(redis_client: Redis, connections: int) -> int:
+    """
+    Opens connections in the client's pool, doing their TCP and TLS handshakes ahead of the first commands.
+    Clients without a connection pool, e.g. the embedded storage, are only pinged.
+    @param redis_client: The Redis client singleton
+    @param connections: how many connections to open
+    @return: how many connections were opened
+    """
+    pool = getattr(redis_client, 'connection_pool', None)
+    if pool is None:
+        redis_client.ping()
+        return 0
+
+    checked_out = []
+    try:
+        for _ in range(connections):
+            connection = pool.get_connection('PING')
+            checked_out.append(connection)
+            connection.connect()
+    finally:
+        for connection in checked_out:
+            pool.release(connection)
+    return len(checked_out)
+
+
+def warm_openai(open_connection: bool):
+    """
+    Builds the OpenAI client, and opens its connection with a request that doesn't use any tokens.
+    @param open_connection: False to only build the client
+    """
+    client = get_ai_client()
+    if open_connection:
+        client.with_options(timeout=PING_TIMEOUT_SECONDS).models.list()
@@ -0,0 +1,173 @@
+"""
+Structured logging that costs next to nothing when it's disabled.
+
+log_event checks the level before doing anything else, so a disabled event
+doesn't format a string, serialize a message or even evaluate its fields:
+a field can be a callable, which is only called when the event is written.
+High frequency events can be sampled, or rate limited per event name, and the
+text of chat messages is redacted unless it is explicitly allowed.
+
+    log_event(logger, logging.DEBUG, "message_stored", chat_id=chat_id, content=message.content)
+
+Events are written as JSON lines, or as "event key=value" text for local development.
+
+Configuration (env variables):
+    LOG_LEVEL            the level of the root logger (default INFO)
+    LOG_FORMAT           "json" or "text" (default "text")
+    LOG_SAMPLE_RATES     fraction of each event written, e.g. "message_stored=0.01,health_check=0"
+    LOG_RATE_LIMITS      most of each event written per second, e.g. "message_stored=10"
+    LOG_REDACT_CONTENT   redact the text of chat messages (default True)
+"""
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Optional
+
+from utils import str_to_bool
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# The fields that hold what chat members wrote
+REDACTED_FIELDS = frozenset({'content', 'text', 'summary', 'messages'})
+
+_sample_rates: dict[str, float] = {}
+_rate_limiters: dict[str, '_RateLimiter'] = {}
+_redact_content = True
+
+
+class _RateLimiter:
+    """Token bucket that allows a burst of one second's worth of events"""
+
+    def __init__(self, per_second: float):
+        self._per_second = per_second
+        self._tokens = per_second
+        self._updated_at = time.monotonic()
+        self._suppressed = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> Optional[int]:
+        """
+        @return: how many events were suppressed since the last one written, or None if this one is suppressed
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._per_second, self._tokens + (now - self._updated_at) * self._per_second)
+            self._updated_at = now
+            if self._tokens < 1:
+                self._suppressed += 1
+                return None
+
+            self._tokens -= 1
+            suppressed, self._suppressed = self._suppressed, 0
+            return suppressed
+
+
+class _Event:
+    """The message of a log record, only rendered by the handlers that write it"""
+    __slots__ = ('name', 'fields')
+
+    def __init__(self, name: str, fields: dict[str, Any]):
+        self.name = name
+        self.fields = fields
+
+    def __str__(self) -> str:
+        if not self.fields:
+            return self.name
+        return self.name + ' ' + ' '.join(f"{key}={value!r}" for key, value in self.fields.items())
+
+
+def log_event(logger: logging.Logger, level: int, event: str, **fields):
+    """
+    Writes a structured event, if the logger is enabled for the level and the event isn't sampled out.
+    @param logger: the module's logger
+    @param level: e.g. logging.DEBUG
+    @param event: the name of the event, in snake case
+    @param fields: the data of the event, callables are only called when the event is written
+    """
+    if not logger.isEnabledFor(level):
+        return
+
+    sample_rate = _sample_rates.get(event)
+    if sample_rate is not None and random.random() >= sample_rate:
+        return
+
+    limiter = _rate_limiters.get(event)
+    if limiter is not None:
+        suppressed = limiter.acquire()
+        if suppressed is None:
+            return
+        if suppressed:
+            fields['suppressed'] = suppressed
+
+    for key, value in fields.items():
+        if callable(value):
+            value = value()
+        if _redact_content and key in REDACTED_FIELDS:
+            value = _redact(value)
+        fields[key] = value
+
+    logger.log(level, _Event(event, fields), stacklevel=2)
+
+
+def _redact(value: Any) -> str:
+    if isinstance(value, (list, tuple)):
+        return f"<{len(value)} redacted>"
+    return f"<{len(str(value))} chars redacted>"
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as one line of JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+        }
+        if isinstance(record.msg, _Event):
+            entry['event'] = record.msg.name
+            entry.update(record.msg.fields)
+        else:
+            entry['message'] = record.getMessage()
+
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging(level: Optional[str] = None, log_format: Optional[str] = None):
+    """
+    Configures the root logger, the sampling, the rate limits and the redaction.
+    @param level: the level of the root logger, read from the env variables by default
+    @param log_format: "json" or "text", read from the env variables by default
+    """
+    global _redact_content
+
+    level = level or os.getenv('LOG_LEVEL', 'INFO')
+    log_format = log_format or os.getenv('LOG_FORMAT', 'text')
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT))
+    logging.basicConfig(level=level.upper(), handlers=[handler], force=True)
+
+    _sample_rates.clear()
+    _sample_rates.update({event: float(rate) for event, rate in _parse_pairs(os.getenv('LOG_SAMPLE_RATES', ''))})
+    _rate_limiters.clear()
+    _rate_limiters.update({event: _RateLimiter(float(per_second))
+                           for event, per_second in _parse_pairs(os.getenv('LOG_RATE_LIMITS', ''))})
+    _redact_content = str_to_bool(os.getenv('LOG_REDACT_CONTENT', True))
+
+
+def _parse_pairs(value: str) -> list[tuple[str, str]]:
+    # e.g. "message_stored=0.01,health_check=0"
+    pairs = []
+    for pair in value.split(','):
+        if pair.strip():
+            event, _, setting = pair.partition('=')
+            pairs.append((event.strip(), setting.strip()))
+    return pairs
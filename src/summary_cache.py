@@ -0,0 +1,90 @@
+import json
+import logging
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+from redis import Redis
+
+from redis_keys import summary_cache_key, summary_generation_key
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+
+@dataclass
+class CachedSummary:
+    """A summary and the newest message it covers"""
+    latest_message_id: int
+    summary: str
+    # The chat's summary generation when the messages were read, see invalidate_cached_summaries
+    generation: int = 0
+
+
+def get_cached_summary(redis_client: Redis,
+                       chat_id: int,
+                       style: str,
+                       number_of_msgs: int) -> Optional[CachedSummary]:
+    """
+    Gets the last summary computed for this window of the chat
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @param style: the style the summary was written in
+    @param number_of_msgs: the size of the window that was summarized
+    @return: the cached summary, or None if there isn't one, or it was invalidated since
+    """
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.get(summary_cache_key(chat_id, style, number_of_msgs))
+    pipeline.get(summary_generation_key(chat_id))
+    cached, generation = pipeline.execute()
+    if cached is None:
+        return None
+
+    cached_summary = CachedSummary(**json.loads(cached))
+    if cached_summary.generation != int(generation or 0):
+        return None
+    return cached_summary
+
+
+def get_summary_generation(redis_client: Redis, chat_id: int) -> int:
+    """
+    Read before the messages are, so a summary cached with it is invalidated by an edit made while it was written
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @return: the chat's current summary generation
+    """
+    return int(redis_client.get(summary_generation_key(chat_id)) or 0)
+
+
+def cache_summary(redis_client: Redis,
+                  chat_id: int,
+                  style: str,
+                  number_of_msgs: int,
+                  cached_summary: CachedSummary):
+    """
+    Stores the summary of this window of the chat.
+    It is only served while the newest message of the chat is still the one it covers.
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    @param style: the style the summary was written in
+    @param number_of_msgs: the size of the window that was summarized
+    @param cached_summary: the summary
+    """
+    key = summary_cache_key(chat_id, style, number_of_msgs)
+    redis_client.set(key, json.dumps(asdict(cached_summary)), ex=SUMMARY_CACHE_TTL_SECONDS)
+    logger.debug(f"Cached the summary of chat id: {chat_id} at key {key}")
+
+
+def invalidate_cached_summaries(redis_client: Redis, chat_id: int):
+    """
+    Invalidates every cached summary of the chat at once, e.g. after a message was edited,
+    by bumping its generation instead of finding its summaries.
+    @param redis_client: The Redis client singleton
+    @param chat_id: The unique identifier for the chat session.
+    """
+    key = summary_generation_key(chat_id)
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.incr(key)
+    # Outlives the summaries cached before the bump, so it never goes back to their generation
+    pipeline.expire(key, SUMMARY_CACHE_TTL_SECONDS)
+    pipeline.execute()
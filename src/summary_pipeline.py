@@ -0,0 +1,371 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from dataclasses import replace
+from datetime import datetime, timedelta, timezone
+from enum import Enum
+from typing import Optional
+
+from llm_backends import SummaryStyle, Summary, summarize_with_backends, is_primary_backend_available
+from message_archive import ArchiveConfig, get_segment_reader
+from message_filter import prune_messages
+from message_storage import (Message, get_redis_client, get_latest_n_messages, MAX_MESSAGE_STORAGE,
+                             get_new_message_count, mark_messages_summarized, search_messages,
+                             get_thread_messages, revise_messages)
+from quota import QuotaExceededError, acquire_summary_quota, record_token_usage
+import topic_clustering
+from summary_cache import CachedSummary, get_cached_summary, cache_summary, get_summary_generation
+from tracing import start_span
+from utils import str_to_bool
+
+logger = logging.getLogger(__name__)
+
+# Summaries users are waiting on. Background work backs off while there are any.
+_on_demand_in_flight = 0
+
+_prefilter_enabled = str_to_bool(os.getenv('PREFILTER_ENABLED', True))
+
+# A long-range summary reads at most this many days, and summarizes at most this many windows of messages
+LONG_RANGE_MAX_DAYS = 31
+LONG_RANGE_MAX_CHUNKS = 8
+
+STALE_SUMMARY_NOTICE = "The summary service is having trouble, so this summary may miss the latest messages.\n\n"
+
+
+class SummaryDestination(Enum):
+    """Where the summary is sent"""
+    CHAT = "chat"
+    PRIVATE = "private"
+
+
+async def summarize_chat(chat_id: int,
+                         number_of_msgs: int,
+                         style: SummaryStyle,
+                         background: bool = False,
+                         user_id: Optional[int] = None) -> Optional[str]:
+    """
+    Summarizes the latest N messages of a chat.
+    This is the single path every summary command goes through.
+    Summaries are cached until a new message arrives in the chat.
+    @param chat_id: The unique identifier for the chat session.
+    @param number_of_msgs: how many of the latest messages to summarize
+    @param style: how the summary is written
+    @param background: True if no user is waiting on the summary, e.g. digests and precomputed summaries
+    @param user_id: the user who requested the summary, it counts against their quota and its tokens their usage
+    @return: the summary, or None if there are no messages to summarize
+    """
+    global _on_demand_in_flight
+
+    if background:
+        return await _summarize_chat(chat_id, number_of_msgs, style, user_id)
+
+    _on_demand_in_flight += 1
+    try:
+        return await _summarize_chat(chat_id, number_of_msgs, style, user_id)
+    finally:
+        _on_demand_in_flight -= 1
+
+
+def on_demand_summaries_in_flight() -> int:
+    """
+    Returns how many summaries users are currently waiting on
+    @return: the number of summaries
+    """
+    return _on_demand_in_flight
+
+
+async def _summarize_chat(chat_id: int,
+                          number_of_msgs: int,
+                          style: SummaryStyle,
+                          user_id: Optional[int]) -> Optional[str]:
+    number_of_msgs = min(number_of_msgs, MAX_MESSAGE_STORAGE)
+
+    with start_span("summary_pipeline", {"chat.id": chat_id, "messages.requested": number_of_msgs,
+                                         "style": style.value}) as span:
+        redis_client = get_redis_client()
+        # Read before the messages, so an edit made while the summary is written invalidates it
+        generation = get_summary_generation(redis_client, chat_id)
+
+        # An empty window tells us the chat has no messages, no need to check it exists first
+        messages = get_latest_n_messages(redis_client, chat_id, number_of_msgs)
+        if not messages:
+            return None
+
+        latest_message_id = messages[0].message_id
+        cached = get_cached_summary(redis_client, chat_id, style.value, number_of_msgs)
+        is_cache_hit = cached is not None and cached.latest_message_id == latest_message_id
+        span.set_attribute("cache.hit", is_cache_hit)
+        if is_cache_hit:
+            return cached.summary
+
+        if cached is not None and not is_primary_backend_available(chat_id):
+            # Serve the last summary rather than fail fast or fall back to a degraded one
+            span.set_attribute("cache.stale", True)
+            return STALE_SUMMARY_NOTICE + cached.summary
+
+        # We have to reverse the list b/c Redis stores the latest message in index 0
+        messages.reverse()
+
+        _charge_quota(redis_client, chat_id, user_id)
+        new_message_count = get_new_message_count(redis_client, chat_id)
+        summary = await summarize_messages(messages, style, chat_id)
+        record_token_usage(redis_client, chat_id, user_id, summary.prompt_tokens, summary.completion_tokens)
+        cache_summary(redis_client, chat_id, style.value, number_of_msgs,
+                      CachedSummary(latest_message_id, summary.text, generation))
+        mark_messages_summarized(redis_client, chat_id, new_message_count)
+        return summary.text
+
+
+async def summarize_matching_messages(chat_id: int,
+                                      query: str,
+                                      style: SummaryStyle,
+                                      user_id: Optional[int] = None) -> Optional[str]:
+    """
+    Summarizes only the messages that match a search, in chronological order.
+    @param chat_id: The unique identifier for the chat session.
+    @param query: the terms the messages must contain
+    @param style: how the summary is written
+    @param user_id: the user who requested the summary, it counts against their quota and its tokens their usage
+    @return: the summary, or None if no message matches
+    """
+    global _on_demand_in_flight
+
+    _on_demand_in_flight += 1
+    try:
+        with start_span("summary_pipeline.matching", {"chat.id": chat_id, "style": style.value}) as span:
+            redis_client = get_redis_client()
+            messages = search_messages(redis_client, chat_id, query, MAX_MESSAGE_STORAGE)
+            span.set_attribute("messages.matched", len(messages))
+            if not messages:
+                return None
+
+            messages.sort(key=lambda message: message.message_id)
+            _charge_quota(redis_client, chat_id, user_id)
+            summary = await summarize_messages(messages, style, chat_id)
+            record_token_usage(redis_client, chat_id, user_id, summary.prompt_tokens, summary.completion_tokens)
+            return summary.text
+    finally:
+        _on_demand_in_flight -= 1
+
+
+async def summarize_thread(chat_id: int,
+                           message_id: int,
+                           number_of_msgs: int,
+                           style: SummaryStyle,
+                           user_id: Optional[int] = None) -> Optional[str]:
+    """
+    Summarizes only the reply thread a message belongs to, in chronological order.
+    Falls back to a regular summary if the message isn't part of a thread.
+    @param chat_id: The unique identifier for the chat session.
+    @param message_id: any message of the thread, e.g. the one the command replied to
+    @param number_of_msgs: the most messages of the thread to summarize, the latest ones are kept
+    @param style: how the summary is written
+    @param user_id: the user who requested the summary, it counts against their quota and its tokens their usage
+    @return: the summary, or None if there are no messages to summarize
+    """
+    global _on_demand_in_flight
+
+    redis_client = get_redis_client()
+    messages = get_thread_messages(redis_client, chat_id, message_id, min(number_of_msgs, MAX_MESSAGE_STORAGE))
+    if len(messages) < 2:
+        return await summarize_chat(chat_id, number_of_msgs, style, user_id=user_id)
+
+    _on_demand_in_flight += 1
+    try:
+        with start_span("summary_pipeline.thread", {"chat.id": chat_id, "style": style.value}) as span:
+            span.set_attribute("messages.thread", len(messages))
+            _charge_quota(redis_client, chat_id, user_id)
+            summary = await summarize_messages(messages, style, chat_id)
+            record_token_usage(redis_client, chat_id, user_id, summary.prompt_tokens, summary.completion_tokens)
+            return summary.text
+    finally:
+        _on_demand_in_flight -= 1
+
+
+async def summarize_days(chat_id: int,
+                         days: int,
+                         style: SummaryStyle,
+                         user_id: Optional[int] = None) -> Optional[str]:
+    """
+    Summarizes the last days of a chat from the archive, however many messages that is.
+    The messages are summarized a window at a time, in parallel, and the summaries are summarized in turn.
+    Falls back to a regular summary of the latest messages if archiving is disabled.
+    @param chat_id: The unique identifier for the chat session.
+    @param days: how many days to summarize, today (UTC) included, up to LONG_RANGE_MAX_DAYS
+    @param style: how the summary is written
+    @param user_id: the user who requested the summary, it counts against their quota and its tokens their usage
+    @return: the summary, or None if there are no messages in those days
+    """
+    if not ArchiveConfig.from_env().enabled:
+        logger.info("Summarizing days needs the archive, writing a regular summary instead")
+        return await summarize_chat(chat_id, MAX_MESSAGE_STORAGE, style, user_id=user_id)
+
+    global _on_demand_in_flight
+
+    _on_demand_in_flight += 1
+    try:
+        with start_span("summary_pipeline.days", {"chat.id": chat_id, "style": style.value}) as span:
+            redis_client = get_redis_client()
+            days = max(1, min(days, LONG_RANGE_MAX_DAYS))
+            # Reading the segments is blocking file IO
+            messages = await asyncio.to_thread(_read_days, redis_client, chat_id, days)
+            span.set_attribute("messages.days", len(messages))
+            if not messages:
+                return None
+
+            _charge_quota(redis_client, chat_id, user_id)
+            chunks = [messages[start:start + MAX_MESSAGE_STORAGE]
+                      for start in range(0, len(messages), MAX_MESSAGE_STORAGE)]
+            summaries = await asyncio.gather(*(summarize_messages(chunk, style, chat_id) for chunk in chunks))
+            for summary in summaries:
+                record_token_usage(redis_client, chat_id, user_id, summary.prompt_tokens, summary.completion_tokens)
+
+            if len(chunks) == 1:
+                return summaries[0].text
+
+            # Each partial summary reads as a message, so the backends summarize them like any other chat
+            partial_summaries = [Message(message_id=index, content=summary.text, owner_id=0,
+                                         owner_name=f"Summary of part {index + 1}", created_at=chunk[-1].created_at)
+                                 for index, (chunk, summary) in enumerate(zip(chunks, summaries))]
+            summary = await summarize_messages(partial_summaries, style, chat_id)
+            record_token_usage(redis_client, chat_id, user_id, summary.prompt_tokens, summary.completion_tokens)
+            return summary.text
+    finally:
+        _on_demand_in_flight -= 1
+
+
+def _read_days(redis_client, chat_id: int, days: int) -> list[Message]:
+    """
+    @return: the messages of the last days, oldest first, the latest ones if there are too many
+    """
+    start_day = (datetime.now(timezone.utc) - timedelta(days=days - 1)).date().isoformat()
+    messages = deque(maxlen=LONG_RANGE_MAX_CHUNKS * MAX_MESSAGE_STORAGE)
+    archived = get_segment_reader().read_messages(chat_id, start_day)
+    messages.extend(revise_messages(redis_client, chat_id, archived))
+
+    # The latest messages may still be queued for the archiver
+    latest_archived_id = messages[-1].message_id if messages else None
+    window = reversed(get_latest_n_messages(redis_client, chat_id, MAX_MESSAGE_STORAGE))
+    messages.extend(message for message in window
+                    if (message.message_id > latest_archived_id if latest_archived_id is not None
+                        else _day_of(message) >= start_day))
+    return list(messages)
+
+
+def _day_of(message: Message) -> str:
+    try:
+        created_at = datetime.fromisoformat(message.created_at)
+    except ValueError:
+        return ""
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone(timezone.utc)
+    return created_at.date().isoformat()
+
+
+async def summarize_topics(chat_id: int,
+                           number_of_msgs: int,
+                           style: SummaryStyle,
+                           user_id: Optional[int] = None,
+                           focus: Optional[str] = None) -> Optional[str]:
+    """
+    Groups the latest N messages by topic and summarizes each topic on its own, in parallel.
+    Falls back to a regular summary if topic clustering isn't installed.
+    @param chat_id: The unique identifier for the chat session.
+    @param number_of_msgs: how many of the latest messages to group
+    @param style: how the summaries are written
+    @param user_id: the user who requested the summary, it counts against their quota and its tokens their usage
+    @param focus: a few words about a topic, only that topic is summarized
+    @return: the summaries, or None if there are no messages, or none about the focus
+    """
+    if not topic_clustering.is_available():
+        logger.warning("Topic clustering needs NumPy, writing a regular summary instead")
+        return await summarize_chat(chat_id, number_of_msgs, style, user_id=user_id)
+
+    global _on_demand_in_flight
+
+    _on_demand_in_flight += 1
+    try:
+        with start_span("summary_pipeline.topics", {"chat.id": chat_id, "style": style.value}) as span:
+            redis_client = get_redis_client()
+            messages = get_latest_n_messages(redis_client, chat_id, min(number_of_msgs, MAX_MESSAGE_STORAGE))
+            if not messages:
+                return None
+
+            messages.reverse()
+            # Clustering is CPU bound, keep it off the event loop
+            topics = await asyncio.to_thread(topic_clustering.cluster_messages, messages)
+            span.set_attribute("topics", len(topics))
+
+            if focus:
+                topic = topic_clustering.find_topic(topics, focus)
+                if topic is None:
+                    return None
+                topics = [topic]
+
+            _charge_quota(redis_client, chat_id, user_id)
+            summaries = await asyncio.gather(*(summarize_messages(topic.messages, style, chat_id) for topic in topics))
+            for summary in summaries:
+                record_token_usage(redis_client, chat_id, user_id, summary.prompt_tokens, summary.completion_tokens)
+
+            if len(topics) == 1:
+                return f"Topic: {topics[0].label}\n\n{summaries[0].text}"
+
+            return '\n\n'.join(f"Topic: {topic.label} ({len(topic.messages)} messages)\n\n{summary.text}"
+                                 for topic, summary in zip(topics, summaries))
+    finally:
+        _on_demand_in_flight -= 1
+
+
+def _charge_quota(redis_client, chat_id: int, user_id: Optional[int]):
+    """
+    Counts a user's summary against the quotas, just before the model is called, so cache hits are free.
+    @raise QuotaExceededError: if the user or the chat is over quota
+    """
+    if user_id is None:
+        return
+
+    decision = acquire_summary_quota(redis_client, chat_id, user_id)
+    if not decision.allowed:
+        raise QuotaExceededError(decision)
+
+
+async def summarize_messages(messages: list[Message],
+                             style: SummaryStyle,
+                             chat_id: Optional[int] = None) -> Summary:
+    """
+    Summarizes messages that are in chronological order.
+    The backends are blocking, so they run on a worker thread to keep the event loop free.
+    @param messages: the messages, oldest first
+    @param style: how the summary is written
+    @param chat_id: the chat the messages are from, it decides which backend is used
+    @return: the summary, and what it cost
+    """
+    if _prefilter_enabled:
+        messages = _prefilter_messages(messages)
+
+    summary = await asyncio.to_thread(summarize_with_backends, chat_id, messages, style)
+    logger.debug(summary)
+
+    if style is SummaryStyle.BULLET_POINTS:
+        return replace(summary, text=_space_out_bullet_points(summary.text))
+
+    return summary
+
+
+def _prefilter_messages(messages: list[Message]) -> list[Message]:
+    with start_span("prefilter_messages") as span:
+        pruned, stats = prune_messages(messages)
+        span.set_attribute("messages.in", stats.messages_in)
+        span.set_attribute("messages.out", stats.messages_out)
+        span.set_attribute("tokens.saved", stats.tokens_saved)
+
+    logger.debug(f"Pre-filter kept {stats.messages_out} of {stats.messages_in} messages, "
+                 f"saving ~{stats.tokens_saved} prompt tokens")
+    return pruned
+
+
+def _space_out_bullet_points(summary: str) -> str:
+    # We want to add an extra line between the points for readability
+    bullet_points = summary.strip().split('\n')
+    return '\n\n'.join(bullet_points)
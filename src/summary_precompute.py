@@ -0,0 +1,148 @@
+"""
+Speculative summaries.
+
+Once a chat has accumulated enough new messages and then goes quiet for a few
+seconds, its summary is computed in the background and cached. A /gist right
+after a burst of conversation is then served from the cache.
+
+Speculation is bounded so it never starves the summaries users are waiting on:
+only a few run at a time, they stop while on-demand summaries are in flight,
+and they are capped by a model call budget per hour.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+from message_storage import get_redis_client, get_new_message_count, DEFAULT_MESSAGE_STORAGE
+from summary_pipeline import SummaryStyle, summarize_chat, on_demand_summaries_in_flight
+from utils import str_to_bool
+
+logger = logging.getLogger(__name__)
+
+BUDGET_PERIOD_SECONDS = 60 * 60
+
+
+@dataclass
+class PrecomputeConfig:
+    """When summaries are speculatively computed"""
+    enabled: bool = False
+    message_threshold: int = 30
+    idle_seconds: float = 5
+    max_concurrent: int = 1
+    max_model_calls_per_hour: int = 120
+    styles: tuple[SummaryStyle, ...] = (SummaryStyle.BULLET_POINTS,)
+
+    @staticmethod
+    def from_env() -> 'PrecomputeConfig':
+        styles = os.getenv('PRECOMPUTE_STYLES', SummaryStyle.BULLET_POINTS.value)
+        return PrecomputeConfig(
+            enabled=str_to_bool(os.getenv('PRECOMPUTE_ENABLED', False)),
+            message_threshold=int(os.getenv('PRECOMPUTE_MESSAGE_THRESHOLD', 30)),
+            idle_seconds=float(os.getenv('PRECOMPUTE_IDLE_SECONDS', 5)),
+            max_concurrent=int(os.getenv('PRECOMPUTE_MAX_CONCURRENT', 1)),
+            max_model_calls_per_hour=int(os.getenv('PRECOMPUTE_MAX_CALLS_PER_HOUR', 120)),
+            styles=tuple(SummaryStyle(style.strip()) for style in styles.split(',')),
+        )
+
+
+class SummaryPrecomputer:
+    """Watches for chats that went idle after a burst of messages and summarizes them ahead of time"""
+
+    def __init__(self, config: PrecomputeConfig):
+        self._config = config
+        self._semaphore = asyncio.Semaphore(config.max_concurrent)
+        self._idle_timers: dict[int, asyncio.TimerHandle] = {}
+        self._model_calls: deque[float] = deque()
+        self._tasks: set[asyncio.Task] = set()
+
+    def notify_message_stored(self, chat_id: int):
+        """
+        Restarts the chat's idle timer. Called on every stored message, so it does no I/O.
+        @param chat_id: The unique identifier for the chat session.
+        """
+        timer = self._idle_timers.pop(chat_id, None)
+        if timer is not None:
+            timer.cancel()
+
+        loop = asyncio.get_running_loop()
+        self._idle_timers[chat_id] = loop.call_later(self._config.idle_seconds, self._on_chat_idle, chat_id)
+
+    def _on_chat_idle(self, chat_id: int):
+        self._idle_timers.pop(chat_id, None)
+        task = asyncio.create_task(self.precompute(chat_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def precompute(self, chat_id: int) -> bool:
+        """
+        Computes and caches the chat's summaries if it has enough new messages and the budget allows it.
+        @param chat_id: The unique identifier for the chat session.
+        @return: True if summaries were computed
+        """
+        if get_new_message_count(get_redis_client(), chat_id) < self._config.message_threshold:
+            return False
+
+        if self._semaphore.locked() or on_demand_summaries_in_flight() > 0:
+            # Busy, try again once the chat has been idle for a while longer
+            self._reschedule(chat_id)
+            return False
+
+        async with self._semaphore:
+            for style in self._config.styles:
+                if not self._try_spend_model_call():
+                    logger.info(f"Precompute budget exhausted, skipping chat id: {chat_id}")
+                    return False
+
+                try:
+                    await summarize_chat(chat_id, DEFAULT_MESSAGE_STORAGE, style, background=True)
+                except Exception:
+                    logger.exception(f"Failed to precompute the summary of chat id: {chat_id}")
+                    return False
+
+        logger.debug(f"Precomputed the summary of chat id: {chat_id}")
+        return True
+
+    def _reschedule(self, chat_id: int):
+        if chat_id not in self._idle_timers:
+            loop = asyncio.get_running_loop()
+            self._idle_timers[chat_id] = loop.call_later(self._config.idle_seconds, self._on_chat_idle, chat_id)
+
+    def _try_spend_model_call(self) -> bool:
+        now = time.monotonic()
+        while self._model_calls and now - self._model_calls[0] >= BUDGET_PERIOD_SECONDS:
+            self._model_calls.popleft()
+
+        if len(self._model_calls) >= self._config.max_model_calls_per_hour:
+            return False
+
+        self._model_calls.append(now)
+        return True
+
+
+_precomputer_singleton: Optional[SummaryPrecomputer] = None
+
+
+def configure_summary_precompute(config: Optional[PrecomputeConfig] = None):
+    """
+    Enables speculative summaries if they are configured.
+    @param config: read from the env variables by default
+    """
+    global _precomputer_singleton
+
+    config = config or PrecomputeConfig.from_env()
+    _precomputer_singleton = SummaryPrecomputer(config) if config.enabled else None
+    if config.enabled:
+        logger.info(f"Precomputing summaries after {config.message_threshold} new messages "
+                    f"and {config.idle_seconds}s of silence")
+
+
+def get_summary_precomputer() -> Optional[SummaryPrecomputer]:
+    """
+    Gets the precomputer
+    @return: the precomputer, or None if speculative summaries are disabled
+    """
+    return _precomputer_singleton
@@ -1,25 +1,41 @@
 import asyncio
+import io
 import json
 import logging
 import os
-import sys
+from typing import Awaitable, Callable, Optional
 
-from dotenv import load_dotenv
 from openai import OpenAI
+from redis.cluster import RedisCluster
 from telegram import Update
+from telegram.constants import ChatAction
 from telegram.error import Forbidden, BadRequest
-from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, filters, MessageHandler
+from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, filters, MessageHandler, TypeHandler
 from telegram.ext._application import Application, BaseHandler
 
+from chat_history import export_chats
+from chat_stats import get_chat_stats, format_chat_stats
+from leader_election import get_leader_election
+from llm_backends import configure_backends
 from message_storage import (Message,
                              get_redis_client,
                              store_message,
                              chat_exists,
                              get_latest_n_messages,
-                             DEFAULT_MESSAGE_STORAGE, configure_message_storage, MAX_MESSAGE_STORAGE,
-                             get_all_chat_ids)
-from openai_utils import get_ai_client, summarize_messages_as_bullet_points, summarize_messages_as_paragraph, \
-    ping_openai, OPEN_AI_MODEL
+                             DEFAULT_MESSAGE_STORAGE, MAX_MESSAGE_STORAGE,
+                             get_all_chat_ids, search_messages, edit_message, forget_message)
+from openai_utils import (get_ai_client, ping_openai, configure_model_router, get_model_router,
+                          configure_openai_caller, get_openai_caller, OPEN_AI_MODEL)
+from quota import configure_quota, get_usage_report, QuotaDecision, QuotaExceededError
+from startup import get_startup_timer
+from structured_logging import log_event
+from summary_cache import invalidate_cached_summaries
+from summary_pipeline import (SummaryStyle, SummaryDestination, summarize_chat, summarize_matching_messages,
+                              summarize_topics, summarize_thread, summarize_days)
+from summary_precompute import configure_summary_precompute, get_summary_precomputer
+from tracing import trace_update, start_span
+from update_processing import build_update_processor
+from window_cache import configure_window_cache, get_window_cache
 from white_list import is_whitelisted, is_admin, get_admin_user_list
 
 logger = logging.getLogger(__name__)
@@ -31,11 +47,24 @@ GIST_COMMAND = 'gist'
 WHISPER_GIST_COMMAND = 'whspr'
 WHISPER_COMMAND = 'whisper'
 HELP_COMMAND = 'help'
+FIND_COMMAND = 'find'
+FIND_GIST_COMMAND = 'findgist'
+FORGET_COMMAND = 'forget'
+
+# e.g. /gist topic, /gist 200 topic, /gist topic concert
+TOPIC_ARGUMENT = 'topic'
+# e.g. /gist 7 days
+DAYS_ARGUMENT = 'days'
+
+FIND_RESULTS_LIMIT = 5
+FIND_SNIPPET_CHARS = 200
 
 # Admin commands
 REPLAY_COMMAND = 'replay'
 STATUS_COMMAND = 'status'
 BROADCAST_COMMAND = 'alert'
+EXPORT_COMMAND = 'export'
+STATS_COMMAND = 'stats'
 
 NOT_WHITE_LISTED_FRIENDLY_MESSAGE = (
     "Welcome to the ChatNuff bot 🗣️🤖!\n\n"
@@ -43,7 +72,13 @@ NOT_WHITE_LISTED_FRIENDLY_MESSAGE = (
     "However, I can respond to you privately here if you use me in chats where I have the necessary permissions."
 )
 
+SUMMARY_FAILED_MESSAGE = "Sorry, I couldn't write the summary right now. Please try again in a few minutes."
+
+# Typing indicators in flight, held so they aren't garbage collected before they're sent
+_typing_tasks: set[asyncio.Task] = set()
+
 
+@trace_update
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Introduction command
@@ -68,6 +103,7 @@ Use the /help command to learn about what I can do.
     await context.bot.send_message(chat_id=chat_id, text=start_msg)
 
 
+@trace_update
 async def summary_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Command that summarizes the last N messages as paragraphs
@@ -75,6 +111,56 @@ async def summary_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     @param context:
     @return:
     """
+    await _summary_command(update, context, SummaryStyle.PARAGRAPH, SummaryDestination.CHAT)
+
+
+@trace_update
+async def whisper_gist_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Command that summarizes the last N messages as bullet points
+    and messages the user privately.
+    @param update:
+    @param context:
+    @return:
+    """
+    await _summary_command(update, context, SummaryStyle.BULLET_POINTS, SummaryDestination.PRIVATE)
+
+
+@trace_update
+async def whisper_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Command that summarizes the last N messages as paragraphs
+    and messages the user privately.
+    @param update:
+    @param context:
+    @return:
+    """
+    await _summary_command(update, context, SummaryStyle.PARAGRAPH, SummaryDestination.PRIVATE)
+
+
+@trace_update
+async def gist_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Command that summarizes the last N messages as bullet points
+    @param update:
+    @param context:
+    @return:
+    """
+    await _summary_command(update, context, SummaryStyle.BULLET_POINTS, SummaryDestination.CHAT)
+
+
+async def _summary_command(update: Update,
+                           context: ContextTypes.DEFAULT_TYPE,
+                           style: SummaryStyle,
+                           destination: SummaryDestination):
+    """
+    Runs the summary pipeline for a command and sends the result.
+    @param update:
+    @param context:
+    @param style: how the summary is written
+    @param destination: whether the summary goes to the chat or privately to the user
+    @return:
+    """
     chat_id = update.effective_chat.id
 
     if not is_whitelisted(chat_id):
@@ -82,86 +168,152 @@ async def summary_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id=chat_id, text=NOT_WHITE_LISTED_FRIENDLY_MESSAGE)
         return
 
-    redis_client = get_redis_client()
+    # Making assumption that the 1st argument is the number
+    number_of_messages_to_summarize = await _determine_number_of_messages_from_message_context(context)
+
+    topic_focus = _determine_topic_focus_from_message_context(context)
+    thread_message_id = _determine_thread_from_message_context(update)
+    days = _determine_days_from_message_context(context)
+    if days is not None:
+        summary_task = summarize_days(chat_id, days, style, user_id=update.effective_user.id)
+    elif topic_focus is None and thread_message_id is not None:
+        summary_task = summarize_thread(chat_id, thread_message_id, number_of_messages_to_summarize, style,
+                                        user_id=update.effective_user.id)
+    elif topic_focus is None:
+        summary_task = summarize_chat(chat_id, number_of_messages_to_summarize, style,
+                                      user_id=update.effective_user.id)
+    else:
+        summary_task = summarize_topics(chat_id, number_of_messages_to_summarize, style,
+                                        user_id=update.effective_user.id, focus=topic_focus or None)
 
-    if not chat_exists(redis_client, chat_id):
+    if destination is SummaryDestination.CHAT:
+        # Let the chat know we're working on it while the summary is being written
+        _start_typing(context, chat_id)
+
+    try:
+        summarized_msg = await summary_task
+    except QuotaExceededError as error:
+        await _send_quota_notice(update, context, error.decision)
+        return
+    except Exception:
+        logger.exception(f"Failed to summarize chat id: {chat_id}")
+        await context.bot.send_message(chat_id=chat_id, text=SUMMARY_FAILED_MESSAGE)
+        return
+
+    if summarized_msg is None:
         empty_message_notice = "There are no messages to summarize"
         await context.bot.send_message(chat_id=chat_id, text=empty_message_notice)
-    else:
+        return
 
-        # Making assumption that the 1st argument is the number
-        number_of_messages_to_summarize = await _determine_number_of_messages_from_message_context(context)
+    if destination is SummaryDestination.CHAT:
+        with start_span("telegram.send_message", {"chat.id": chat_id}):
+            await context.bot.send_message(chat_id=chat_id, text=summarized_msg)
+        return
 
-        messages = get_latest_n_messages(redis_client, chat_id, number_of_messages_to_summarize)
-        # We have to reverse the list b/c Redis stores the latest message in index 0
-        messages.reverse()
+    prefix = "Gist" if style is SummaryStyle.BULLET_POINTS else "Summary"
+    private_summary = f"{prefix} from {update.effective_chat.effective_name} chat:\n\n" + summarized_msg
 
-        # Send N messages to OpenAI
-        prompt_message_schema = await format_message_for_openai(messages)
-        summarized_msg = _summarize_messages_as_paragraph(prompt_message_schema)
-        await context.bot.send_message(chat_id=chat_id, text=summarized_msg)
+    # Send private message to the user
+    try:
+        with start_span("telegram.send_message", {"chat.id": update.effective_user.id}):
+            await context.bot.send_message(chat_id=update.effective_user.id, text=private_summary)
+    except Forbidden:
+        warning_msg = "Sorry, but I can't message you privately unless you start a chat with me first."
+        await context.bot.send_message(chat_id=chat_id, text=warning_msg)
 
 
-def _summarize_messages_as_paragraph(formatted_messages: str) -> str:
-    client = get_ai_client()
-    summary = summarize_messages_as_paragraph(client, formatted_messages)
-    logger.debug(summary)
+def _start_typing(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    """
+    Shows the typing indicator while a summary is written. Best effort, the summary is sent either way.
+    """
+    task = asyncio.create_task(_send_typing(context, chat_id))
+    _typing_tasks.add(task)
+    task.add_done_callback(_typing_tasks.discard)
 
-    return summary
 
+async def _send_typing(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    try:
+        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+    except Exception as ex:
+        logger.warning(f"Failed to show the typing indicator in chat id: {chat_id}: {ex}")
 
-async def whisper_gist_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+
+async def _send_quota_notice(update: Update, context: ContextTypes.DEFAULT_TYPE, quota: QuotaDecision):
     """
-    Command that summarizes the last N messages as bullet points
-    and messages the user privately.
-    @param update:
-    @param context:
-    @return:
+    Tells the user the summary wasn't written because they, or the chat, are over quota.
+    @param quota: the decision that refused the summary
     """
-
     chat_id = update.effective_chat.id
+    logger.info(f"user id: {update.effective_user.id} in chat id: {chat_id} is over quota: {quota.reason}")
+    quota_msg = f"{quota.reason} Try again in {_format_wait(quota.retry_after_seconds)}."
+    await context.bot.send_message(chat_id=chat_id, text=quota_msg)
 
-    if not is_whitelisted(chat_id):
-        logger.info(f'chat id: {chat_id} attempted to use the bot but was not whitelisted')
-        await context.bot.send_message(chat_id=chat_id, text=NOT_WHITE_LISTED_FRIENDLY_MESSAGE)
-        return
 
-    redis_client = get_redis_client()
+def _format_wait(seconds: int) -> str:
+    if seconds < 60:
+        return f"{seconds} seconds"
+    if seconds < 60 * 60:
+        return f"{seconds // 60} minutes"
+    return f"{seconds // (60 * 60)} hours"
 
-    if not chat_exists(redis_client, chat_id):
-        empty_message_notice = "There are no messages to summarize"
-        await context.bot.send_message(chat_id=chat_id, text=empty_message_notice)
+
+async def _determine_number_of_messages_from_message_context(context):
+    if context.args and context.args[0].isdigit():
+        number_of_messages = int(context.args[0])
     else:
+        number_of_messages = DEFAULT_MESSAGE_STORAGE
 
-        # Making assumption that the 1st argument is the number
-        number_of_messages_to_summarize = await _determine_number_of_messages_from_message_context(context)
+    return number_of_messages
 
-        messages = get_latest_n_messages(redis_client, chat_id, number_of_messages_to_summarize)
-        # We have to reverse the list b/c Redis stores the latest message in index 0
-        messages.reverse()
 
-        # Send N messages to OpenAI
-        prompt_message_schema = await format_message_for_openai(messages)
-        summarized_msg = _summarize_messages_as_bullet_points(prompt_message_schema)
+def _determine_topic_focus_from_message_context(context) -> Optional[str]:
+    """
+    @return: None for a regular summary, "" to summarize every topic, or the words describing the one topic to summarize
+    """
+    args = list(context.args or [])
+    if args and args[0].isdigit():
+        args = args[1:]
 
-        gist_prefix = f"Gist from {update.effective_chat.effective_name} chat:\n\n"
-        private_gist = gist_prefix + summarized_msg
+    if not args or args[0].lower() != TOPIC_ARGUMENT:
+        return None
 
-        # Send private message to the user
-        try:
-            await context.bot.send_message(chat_id=update.effective_user.id, text=private_gist)
-        except Forbidden:
-            warning_msg = "Sorry, but I can't message you privately unless you start a chat with me first."
-            await context.bot.send_message(chat_id=chat_id, text=warning_msg)
+    return ' '.join(args[1:])
 
 
-async def whisper_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def _determine_days_from_message_context(context) -> Optional[int]:
     """
-    Command that summarizes the last N messages as bullet points
-    and messages the user privately.
-    @param update:
-    @param context:
-    @return:
+    @return: how many days to summarize, or None to summarize a number of messages
+    """
+    args = context.args or []
+    if len(args) < 2 or not args[0].isdigit() or args[1].lower() != DAYS_ARGUMENT:
+        return None
+    return int(args[0])
+
+
+def _determine_thread_from_message_context(update: Update) -> Optional[int]:
+    """
+    @return: the id of the message the update replies to, or None if it isn't a reply
+    """
+    return _reply_to_message_id(update.message)
+
+
+def _reply_to_message_id(telegram_message) -> Optional[int]:
+    """
+    @param telegram_message: a new or edited message
+    @return: the id of the message it replies to, or None if it isn't a reply
+    """
+    reply_to_message = telegram_message.reply_to_message
+    # In forum topics, every message replies to the message that created the topic
+    if reply_to_message is None or reply_to_message.forum_topic_created is not None:
+        return None
+    return reply_to_message.message_id
+
+
+@trace_update
+async def listen_for_messages_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    # Command that listens for messages and stores them.
+    @rtype: object
     """
 
     chat_id = update.effective_chat.id
@@ -171,43 +323,64 @@ async def whisper_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id=chat_id, text=NOT_WHITE_LISTED_FRIENDLY_MESSAGE)
         return
 
-    redis_client = get_redis_client()
+    message_owner = Message.convert_update_to_owner(update)
+    message = Message(
+        message_id=update.message.id,
+        owner_id=update.message.from_user.id,
+        content=update.message.text,
+        owner_name=message_owner,
+        created_at=update.message.date.isoformat(),
+        reply_to_message_id=_determine_thread_from_message_context(update)
+    )
 
-    if not chat_exists(redis_client, chat_id):
-        empty_message_notice = "There are no messages to summarize"
-        await context.bot.send_message(chat_id=chat_id, text=empty_message_notice)
-    else:
+    redis_client = get_redis_client()
+    count = store_message(redis_client, chat_id, message)
+    log_event(logger, logging.DEBUG, "message_received", chat_id=chat_id, message_id=message.message_id,
+              owner_id=message.owner_id, content=message.content, stored=count)
 
-        # Making assumption that the 1st argument is the number
-        number_of_messages_to_summarize = await _determine_number_of_messages_from_message_context(context)
+    precomputer = get_summary_precomputer()
+    if precomputer:
+        precomputer.notify_message_stored(chat_id)
 
-        messages = get_latest_n_messages(redis_client, chat_id, number_of_messages_to_summarize)
-        # We have to reverse the list b/c Redis stores the latest message in index 0
-        messages.reverse()
 
-        # Send N messages to OpenAI
-        prompt_message_schema = await format_message_for_openai(messages)
-        summarized_msg = _summarize_messages_as_paragraph(prompt_message_schema)
+@trace_update
+async def edited_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Replaces a stored message with its edited version, so summaries don't quote what was retracted.
+    @param update:
+    @param context:
+    @return:
+    """
+    chat_id = update.effective_chat.id
+    if not is_whitelisted(chat_id):
+        return
 
-        summary_prefix = f"Summary from {update.effective_chat.effective_name} chat:\n\n"
-        private_summary = summary_prefix + summarized_msg
+    edited_message = update.edited_message
+    message = Message(
+        message_id=edited_message.id,
+        owner_id=edited_message.from_user.id,
+        content=edited_message.text,
+        owner_name=Message.convert_update_to_owner(update),
+        created_at=edited_message.date.isoformat(),
+        reply_to_message_id=_reply_to_message_id(edited_message)
+    )
 
-        # Send private message to the user
-        try:
-            await context.bot.send_message(chat_id=update.effective_user.id, text=private_summary)
-        except Forbidden:
-            warning_msg = "Sorry, but I can't message you privately unless you start a chat with me first."
-            await context.bot.send_message(chat_id=chat_id, text=warning_msg)
+    redis_client = get_redis_client()
+    if edit_message(redis_client, chat_id, message):
+        invalidate_cached_summaries(redis_client, chat_id)
+    log_event(logger, logging.DEBUG, "message_edited", chat_id=chat_id, message_id=message.message_id,
+              content=message.content)
 
 
-async def gist_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@trace_update
+async def forget_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Command that summarizes the last N messages as bullet points
+    Command that removes the message it replies to from the bot's storage.
+    Members can forget their own messages, admins any message.
     @param update:
     @param context:
     @return:
     """
-
     chat_id = update.effective_chat.id
 
     if not is_whitelisted(chat_id):
@@ -215,60 +388,79 @@ async def gist_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id=chat_id, text=NOT_WHITE_LISTED_FRIENDLY_MESSAGE)
         return
 
-    redis_client = get_redis_client()
+    target = update.message.reply_to_message
+    if target is None:
+        await update.message.reply_text(f"Reply to the message you want me to forget with /{FORGET_COMMAND}")
+        return
 
-    if not chat_exists(redis_client, chat_id):
-        empty_message_notice = "There are no messages to summarize"
-        await context.bot.send_message(chat_id=chat_id, text=empty_message_notice)
-    else:
+    user_id = update.effective_user.id
+    if (target.from_user is None or target.from_user.id != user_id) and not is_admin(user_id):
+        await update.message.reply_text("You can only make me forget your own messages")
+        return
 
-        # Making assumption that the 1st argument is the number
-        number_of_messages_to_summarize = await _determine_number_of_messages_from_message_context(context)
+    redis_client = get_redis_client()
+    if not forget_message(redis_client, chat_id, target.message_id):
+        await update.message.reply_text("I don't have that message anymore")
+        return
 
-        messages = get_latest_n_messages(redis_client, chat_id, number_of_messages_to_summarize)
-        # We have to reverse the list b/c Redis stores the latest message in index 0
-        messages.reverse()
+    invalidate_cached_summaries(redis_client, chat_id)
+    logger.info(f"Forgot message id: {target.message_id} of chat id: {chat_id}")
+    await update.message.reply_text("Done, I won't use that message anymore")
 
-        # Send N messages to OpenAI
-        prompt_message_schema = await format_message_for_openai(messages)
-        summarized_msg = _summarize_messages_as_bullet_points(prompt_message_schema)
-        await context.bot.send_message(chat_id=chat_id, text=summarized_msg)
 
+@trace_update
+async def find_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Command that finds the messages that contain the given terms
+    @param update:
+    @param context:
+    @return:
+    """
+    chat_id = update.effective_chat.id
 
-async def _determine_number_of_messages_from_message_context(context):
-    if context.args and context.args[0].isdigit():
-        number_of_messages = int(context.args[0])
-    else:
-        number_of_messages = DEFAULT_MESSAGE_STORAGE
+    if not is_whitelisted(chat_id):
+        logger.info(f'chat id: {chat_id} attempted to use the bot but was not whitelisted')
+        await context.bot.send_message(chat_id=chat_id, text=NOT_WHITE_LISTED_FRIENDLY_MESSAGE)
+        return
 
-    return number_of_messages
+    query = ' '.join(context.args or [])
+    if not query:
+        await context.bot.send_message(chat_id=chat_id, text=f"Tell me what to look for, e.g. /{FIND_COMMAND} dinner")
+        return
 
+    messages = search_messages(get_redis_client(), chat_id, query, FIND_RESULTS_LIMIT)
+    if not messages:
+        await context.bot.send_message(chat_id=chat_id, text=f"I couldn't find any messages about: {query}")
+        return
 
-async def format_message_for_openai(messages: list[Message]) -> str:
-    messages_content = [f"{msg.owner_name}: {msg.content}" for msg in messages]
-    prompt_message_schema = ';'.join(messages_content)
-    return prompt_message_schema
+    results = '\n\n'.join(_format_search_result(chat_id, message) for message in messages)
+    await context.bot.send_message(chat_id=chat_id, text=f"Messages about: {query}\n\n{results}",
+                                   disable_web_page_preview=True)
 
 
-def _summarize_messages_as_bullet_points(formatted_messages: str) -> str:
-    client = get_ai_client()
-    summary = summarize_messages_as_bullet_points(client, formatted_messages)
+def _format_search_result(chat_id: int, message: Message) -> str:
+    content = message.content
+    if len(content) > FIND_SNIPPET_CHARS:
+        content = content[:FIND_SNIPPET_CHARS].rstrip() + "…"
 
-    # We want to add an extra line between the points for readability
-    bullet_points = summary.strip().split('\n')
-    formatted_bullet_points = '\n\n'.join(bullet_points)
+    result = f"{message.owner_name} ({message.created_at[:10]}): {content}"
 
-    logger.debug(formatted_bullet_points)
+    # Supergroup messages can be linked to, their chat ids start with -100
+    chat_id_str = str(chat_id)
+    if chat_id_str.startswith("-100"):
+        result += f"\nhttps://t.me/c/{chat_id_str[4:]}/{message.message_id}"
 
-    return formatted_bullet_points
+    return result
 
 
-async def listen_for_messages_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@trace_update
+async def find_gist_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    # Command that listens for messages and stores them.
-    @rtype: object
+    Command that summarizes only the messages that contain the given terms, as bullet points
+    @param update:
+    @param context:
+    @return:
     """
-
     chat_id = update.effective_chat.id
 
     if not is_whitelisted(chat_id):
@@ -276,21 +468,32 @@ async def listen_for_messages_handler(update: Update, context: ContextTypes.DEFA
         await context.bot.send_message(chat_id=chat_id, text=NOT_WHITE_LISTED_FRIENDLY_MESSAGE)
         return
 
-    message_owner = Message.convert_update_to_owner(update)
-    message = Message(
-        message_id=update.message.id,
-        owner_id=update.message.from_user.id,
-        content=update.message.text,
-        owner_name=message_owner,
-        created_at=update.message.date.isoformat()
-    )
-    logger.debug(f'Got message: {message} from chat id: {chat_id}')
+    query = ' '.join(context.args or [])
+    if not query:
+        await context.bot.send_message(chat_id=chat_id,
+                                       text=f"Tell me what to summarize, e.g. /{FIND_GIST_COMMAND} dinner")
+        return
 
-    redis_client = get_redis_client()
-    count = store_message(redis_client, chat_id, message)
-    logger.debug(f'Cache size: {count} from chat id: {chat_id}')
+    _start_typing(context, chat_id)
+    try:
+        summarized_msg = await summarize_matching_messages(chat_id, query, SummaryStyle.BULLET_POINTS,
+                                                           update.effective_user.id)
+    except QuotaExceededError as error:
+        await _send_quota_notice(update, context, error.decision)
+        return
+    except Exception:
+        logger.exception(f"Failed to summarize the messages matching a search in chat id: {chat_id}")
+        await context.bot.send_message(chat_id=chat_id, text=SUMMARY_FAILED_MESSAGE)
+        return
+
+    if summarized_msg is None:
+        await context.bot.send_message(chat_id=chat_id, text=f"I couldn't find any messages about: {query}")
+        return
 
+    await context.bot.send_message(chat_id=chat_id, text=f"Gist of the messages about: {query}\n\n{summarized_msg}")
 
+
+@trace_update
 async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Command that summarizes the last N messages as paragraphs
@@ -312,6 +515,9 @@ Available commands:
 /{GIST_COMMAND} Gives you a bullet form of the last {DEFAULT_MESSAGE_STORAGE} messages.
 /{WHISPER_COMMAND} Privately messages you the summary of the last {DEFAULT_MESSAGE_STORAGE} messages.
 /{WHISPER_GIST_COMMAND} Privately messages you the bullet points of the last {DEFAULT_MESSAGE_STORAGE} messages.
+/{FIND_COMMAND} Finds the messages that mention the words you give me, e.g. /{FIND_COMMAND} concert tickets
+/{FIND_GIST_COMMAND} Gives you the bullet points of only the messages that mention those words.
+/{FORGET_COMMAND} Reply to one of your messages with it, and I won't use that message anymore.
 /{HELP_COMMAND}: Gives information about the bot.
 
 I can also summarize a certain number of messages if you provide me with a number.
@@ -320,6 +526,16 @@ For example: /gist 50
 
 Will give you the bullet form of the last 50 messages.
 
+Add "{TOPIC_ARGUMENT}" to split the summary by topic, or "{TOPIC_ARGUMENT}" and a few words to only summarize that topic.
+
+For example: /gist 200 {TOPIC_ARGUMENT} concert tickets
+
+Reply to a message with /gist to only summarize the conversation that message is part of.
+
+Add "{DAYS_ARGUMENT}" to summarize whole days instead, when the chat history is archived.
+
+For example: /gist 7 {DAYS_ARGUMENT}
+
 However, the maximum number of messages I can handle is {MAX_MESSAGE_STORAGE}.
 
 Happy chatting! 🗣️❤️
@@ -333,6 +549,7 @@ Bot Artwork created by [@Spritewrench](https://spritewrench.com/) 🎨
 #####################################################################
 # The following handlers are only for development and admin purposes!
 #####################################################################
+@trace_update
 async def replay_messages_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Command that replays the messages in storage
@@ -340,7 +557,7 @@ async def replay_messages_handler(update: Update, context: ContextTypes.DEFAULT_
     @rtype: object
     """
 
-    if not _is_admin_user(update, context):
+    if not await _is_admin_user(update, context):
         return
 
     redis_client = get_redis_client()
@@ -357,6 +574,7 @@ async def replay_messages_handler(update: Update, context: ContextTypes.DEFAULT_
             await context.bot.send_message(chat_id=chat_id, text=message.content)
 
 
+@trace_update
 async def status_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Command that gets the status of the bot.
@@ -364,7 +582,7 @@ async def status_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     @rtype: object
     """
 
-    if not _is_admin_user(update, context):
+    if not await _is_admin_user(update, context):
         return
 
     chat_id = update.effective_chat.id
@@ -379,12 +597,18 @@ async def status_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     redis_msg = await _get_redis_status(redis)
     logger.info(redis_msg)
 
+    # Token usage
+    usage_msg = get_usage_report(redis)
+    logger.info(usage_msg)
+
     status_msg = f"""{open_ai_status} 
 {redis_msg}
+{usage_msg}
 """
     await context.bot.send_message(chat_id=chat_id, text=status_msg)
 
 
+@trace_update
 async def broadcast_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Alerts all groups that use the bot.
@@ -423,6 +647,68 @@ async def broadcast_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return
 
 
+@trace_update
+async def export_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Sends the stored messages of a chat as a newline-delimited JSON file.
+    Exports the current chat, or the chat whose id is given.
+    @param update:
+    @param context:
+    @return:
+    """
+
+    if not await _is_admin_user(update, context):
+        return
+
+    chat_id = update.effective_chat.id
+    export_chat_id = chat_id
+    if context.args:
+        try:
+            export_chat_id = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text(f"Usage: /{EXPORT_COMMAND} [chat id]")
+            return
+
+    output = io.StringIO()
+    exported = await asyncio.to_thread(export_chats, get_redis_client(), output, [export_chat_id])
+    if not exported:
+        await context.bot.send_message(chat_id=chat_id, text="There are no messages to export")
+        return
+
+    await context.bot.send_document(
+        chat_id=chat_id,
+        document=io.BytesIO(output.getvalue().encode('utf-8')),
+        filename=f"chat_{export_chat_id}.ndjson",
+        caption=f"{exported} messages from chat id: {export_chat_id}"
+    )
+
+
+@trace_update
+async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Sends the activity of a chat over the last day: messages per hour, active users and top posters.
+    Reports on the current chat, or the chat whose id is given.
+    @param update:
+    @param context:
+    @return:
+    """
+
+    if not await _is_admin_user(update, context):
+        return
+
+    chat_id = update.effective_chat.id
+    stats_chat_id = chat_id
+    if context.args:
+        try:
+            stats_chat_id = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text(f"Usage: /{STATS_COMMAND} [chat id]")
+            return
+
+    stats = await asyncio.to_thread(get_chat_stats, get_redis_client(), stats_chat_id)
+    await context.bot.send_message(chat_id=chat_id, text=format_chat_stats(stats))
+
+
 async def _is_admin_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
@@ -442,8 +728,14 @@ async def _is_admin_user(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def _get_redis_status(redis) -> str:
     is_connected = redis.ping()
-    connection_info = redis.client().connection
-    redis_info = redis.info()
+    if isinstance(redis, RedisCluster):
+        # A cluster client has no single connection, its INFO is read from one node
+        connection_info = "cluster, nodes: " + ', '.join(
+            f"{node.name} ({node.server_type})" for node in redis.get_nodes())
+        redis_info = redis.info(target_nodes=RedisCluster.DEFAULT_NODE)
+    else:
+        connection_info = redis.client().connection
+        redis_info = redis.info()
     keys_to_extract = ['redis_version', 'uptime_in_days', 'listener0', 'used_memory_human']
     condensed_redis_info = {
         key: redis_info[key]
@@ -454,30 +746,59 @@ async def _get_redis_status(redis) -> str:
 Bot connected to Redis: {is_connected}
 Redis connection: {connection_info}
 Redis info: {json.dumps(condensed_redis_info, indent=4)}
+Window cache: {_get_window_cache_status()}
+Leader: {_get_leader_status()}
     """
     return redis_msg
 
 
+def _get_leader_status() -> str:
+    leader_election = get_leader_election()
+    if leader_election is None:
+        return "no election"
+    return f"{leader_election.lease.instance_id}, fencing token: {leader_election.lease.fencing_token}"
+
+
+def _get_window_cache_status() -> str:
+    window_cache = get_window_cache()
+    if window_cache is None:
+        return "disabled"
+
+    stats = window_cache.stats()
+    return (f"{stats.windows} chats, {stats.size_bytes // 1024}/{stats.max_bytes // 1024}KB, "
+            f"hit ratio {stats.hit_ratio:.0%}, {stats.invalidations} invalidations, {stats.evictions} evictions")
+
+
 async def _get_open_ai_status(ai_client: OpenAI) -> str:
     open_ai_response = ping_openai(ai_client)
+    router = get_model_router()
     open_ai_msg = f"""OpenAI 
 Status: {open_ai_response}
 Model: {OPEN_AI_MODEL}
+Tiers: {', '.join(f"{tier.name} ({tier.model})" for tier in router.tiers)}
+In flight: {router.in_flight}, p95 latency: {router.latency_percentile(95):.1f}s{' (degraded)' if router.is_degraded() else ''}
+Circuit: {get_openai_caller().breaker.state.value}
     """
     return open_ai_msg
 
 
 def get_application():
-    load_dotenv()
-
-    if not configure_message_storage():
-        logger.critical("Failed to configure the message storage. Exiting the application.")
-        sys.exit(1)  # Exit the program with an error code
+    """
+    Builds the application. The message storage must be configured first.
+    @return: the application
+    """
+    configure_model_router()
+    configure_openai_caller()
+    configure_backends()
+    configure_summary_precompute()
+    configure_quota()
+    configure_window_cache(MAX_MESSAGE_STORAGE)
 
     telegram_token = os.getenv('TELEGRAM_API_KEY')
 
     application = ApplicationBuilder() \
         .token(telegram_token) \
+        .concurrent_updates(build_update_processor()) \
         .build()
 
     handlers = [
@@ -488,9 +809,16 @@ def get_application():
     for handler in handlers:
         application.add_handler(handler)
 
+    # Runs ahead of the other handlers, without stopping them
+    application.add_handler(TypeHandler(Update, _record_first_update), group=-1)
+
     return application
 
 
+async def _record_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    get_startup_timer().mark_first_update()
+
+
 def get_handlers() -> list[BaseHandler]:
     return [
         CommandHandler(START_COMMAND, start_handler),
@@ -499,7 +827,11 @@ def get_handlers() -> list[BaseHandler]:
         CommandHandler(HELP_COMMAND, help_handler),
         CommandHandler(WHISPER_GIST_COMMAND, whisper_gist_handler),
         CommandHandler(WHISPER_COMMAND, whisper_handler),
-        MessageHandler(filters.TEXT & (~filters.COMMAND), listen_for_messages_handler)
+        CommandHandler(FIND_COMMAND, find_handler),
+        CommandHandler(FIND_GIST_COMMAND, find_gist_handler),
+        CommandHandler(FORGET_COMMAND, forget_handler),
+        MessageHandler(filters.UpdateType.MESSAGE & filters.TEXT & (~filters.COMMAND), listen_for_messages_handler),
+        MessageHandler(filters.UpdateType.EDITED_MESSAGE & filters.TEXT & (~filters.COMMAND), edited_message_handler)
     ]
 
 
@@ -508,32 +840,46 @@ def get_admin_handlers() -> list[BaseHandler]:
         CommandHandler(REPLAY_COMMAND, replay_messages_handler),
         CommandHandler(STATUS_COMMAND, status_handler),
         CommandHandler(BROADCAST_COMMAND, broadcast_handler),
+        CommandHandler(EXPORT_COMMAND, export_handler),
+        CommandHandler(STATS_COMMAND, stats_handler),
     ]
 
 
-async def run_bot_async(application: Application):
+async def run_bot_async(application: Application, singleton_jobs: Optional[Callable[[], Awaitable]] = None):
     """
     Runs the bot asynchronously.
     Manually handles what :meth run_polling does.
     We need to do this to run a webserver concurrently with the bot.
+    Every instance starts the application, but only the leader polls for updates and runs the singleton jobs.
+    Without a leader election, this instance always leads.
     @param application:
+    @param singleton_jobs: the background jobs only one instance may run at a time
     @return:
     """
 
     await application.initialize()
-
-    updater = application.updater
-    await updater.start_polling()
-
     await application.start()
+    get_startup_timer().mark_ready()
+
+    async def lead(fencing_token: int):
+        updater = application.updater
+        await updater.start_polling()
+        logger.info(f"Polling for updates, fencing token: {fencing_token}")
+        try:
+            jobs = [singleton_jobs()] if singleton_jobs else []
+            # Keep the event loop running
+            await asyncio.gather(*jobs, asyncio.Event().wait())
+        finally:
+            await updater.stop()
 
-    # Keep the event loop running
+    leader_election = get_leader_election()
     try:
-        while True:
-            await asyncio.sleep(3600)  # Sleep for 1 hour and then re-check
+        if leader_election is None:
+            await lead(0)
+        else:
+            await leader_election.run(lead)
     except (KeyboardInterrupt, SystemExit):
         pass
     finally:
-        await updater.stop()
         await application.stop()
         await application.shutdown()
@@ -0,0 +1,209 @@
+"""
+Groups messages by topic on the CPU, before any of them reach the model.
+
+Messages are turned into hashed TF-IDF vectors in one NumPy batch and clustered
+with spherical k-means. Each topic can then be summarized on its own, in parallel,
+or a single topic can be picked out, instead of asking the model to untangle
+every thread of the conversation in one expensive prompt.
+
+NumPy is optional (the "topics" extra). Without it, is_available() is False
+and topic summaries fall back to regular ones.
+"""
+import logging
+import os
+import zlib
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from typing import Optional
+
+from message_storage import Message
+from search_index import tokenize
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover, depends on the install
+    np = None
+
+logger = logging.getLogger(__name__)
+
+HASHING_DIMENSIONS = 2 ** 12
+MAX_TOPICS = int(os.getenv('TOPIC_MAX_TOPICS', 4))
+MIN_TOPIC_MESSAGES = int(os.getenv('TOPIC_MIN_MESSAGES', 3))
+KMEANS_ITERATIONS = 15
+KMEANS_RESTARTS = 8
+LABEL_TERMS = 3
+
+
+@dataclass
+class Topic:
+    """Messages about the same thing"""
+    label: str
+    terms: list[str] = field(default_factory=list)
+    messages: list[Message] = field(default_factory=list)
+
+
+def is_available() -> bool:
+    return np is not None
+
+
+def cluster_messages(messages: list[Message], max_topics: int = MAX_TOPICS) -> list[Topic]:
+    """
+    Groups the messages by topic.
+    @param messages: the messages, oldest first
+    @param max_topics: the most topics returned
+    @return: the topics, largest first, each with its messages oldest first
+    """
+    if not is_available():
+        raise RuntimeError("Topic clustering needs NumPy, install the 'topics' extra")
+
+    if not messages:
+        return []
+
+    documents = [tokenize(message.content) for message in messages]
+    vectors, column_terms = _vectorize(documents)
+
+    topic_count = _choose_topic_count(len(messages), max_topics)
+    assignments, centroids = _spherical_kmeans(vectors, topic_count)
+    assignments = _assign_empty_messages(vectors, assignments)
+    assignments = _merge_small_topics(assignments, centroids)
+
+    topics = []
+    for cluster in sorted(set(assignments.tolist()), key=lambda c: -int(np.sum(assignments == c))):
+        indexes = np.flatnonzero(assignments == cluster)
+        terms = _top_terms(vectors[indexes].sum(axis=0), column_terms)
+        topics.append(Topic(
+            label=', '.join(terms) or "other",
+            terms=terms,
+            messages=[messages[index] for index in indexes]
+        ))
+    return topics
+
+
+def find_topic(topics: list[Topic], query: str) -> Optional[Topic]:
+    """
+    Picks the topic a query is about.
+    @param topics: the topics of the chat
+    @param query: a few words about the topic
+    @return: the topic whose messages mention the query's terms the most, or None if none does
+    """
+    query_terms = set(tokenize(query))
+    if not query_terms:
+        return None
+
+    def mentions(topic: Topic) -> int:
+        return sum(1 for message in topic.messages if query_terms & set(tokenize(message.content)))
+
+    best = max(topics, key=mentions, default=None)
+    return best if best is not None and mentions(best) > 0 else None
+
+
+def _vectorize(documents: list[list[str]]) -> tuple['np.ndarray', dict[int, str]]:
+    """Hashed, sublinear TF-IDF vectors, L2 normalized, built in one batch"""
+    rows, columns, counts = [], [], []
+    column_term_counts: dict[int, Counter] = defaultdict(Counter)
+
+    for row, terms in enumerate(documents):
+        for term, count in Counter(terms).items():
+            column = zlib.crc32(term.encode('utf-8')) % HASHING_DIMENSIONS
+            rows.append(row)
+            columns.append(column)
+            counts.append(count)
+            column_term_counts[column][term] += count
+
+    vectors = np.zeros((len(documents), HASHING_DIMENSIONS), dtype=np.float32)
+    if rows:
+        np.add.at(vectors, (np.array(rows), np.array(columns)), 1 + np.log(np.array(counts, dtype=np.float32)))
+
+    document_frequencies = np.count_nonzero(vectors, axis=0)
+    inverse_document_frequencies = np.log((1 + len(documents)) / (1 + document_frequencies)) + 1
+    vectors *= inverse_document_frequencies
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+    # Hash collisions are rare at this size, label each column with its most frequent term
+    column_terms = {column: terms.most_common(1)[0][0] for column, terms in column_term_counts.items()}
+    return vectors, column_terms
+
+
+def _choose_topic_count(message_count: int, max_topics: int) -> int:
+    # Enough messages per topic for a summary to be worth writing, topics that end up smaller are merged
+    return max(1, min(max_topics, message_count // max(MIN_TOPIC_MESSAGES, 1)))
+
+
+def _spherical_kmeans(vectors: 'np.ndarray', topic_count: int) -> tuple['np.ndarray', 'np.ndarray']:
+    """
+    k-means on cosine similarity, seeded with k-means++.
+    Short messages share few terms, so the best of a few restarts is kept.
+    The seed is fixed, so the same messages always give the same topics.
+    """
+    rng = np.random.default_rng(0)
+    non_empty = np.flatnonzero(vectors.any(axis=1))
+    if len(non_empty) == 0:
+        return np.zeros(len(vectors), dtype=int), np.zeros((1, vectors.shape[1]), dtype=vectors.dtype)
+
+    topic_count = min(topic_count, len(non_empty))
+    best = None
+    for _ in range(KMEANS_RESTARTS if topic_count > 1 else 1):
+        assignments, centroids = _kmeans_run(vectors, non_empty, topic_count, rng)
+        cohesion = float(np.sum(np.max(vectors[non_empty] @ centroids.T, axis=1)))
+        if best is None or cohesion > best[0]:
+            best = (cohesion, assignments, centroids)
+
+    return best[1], best[2]
+
+
+def _kmeans_run(vectors: 'np.ndarray',
+                non_empty: 'np.ndarray',
+                topic_count: int,
+                rng: 'np.random.Generator') -> tuple['np.ndarray', 'np.ndarray']:
+    centroids = [vectors[rng.choice(non_empty)]]
+    for _ in range(1, topic_count):
+        distances = np.clip(1 - np.max(vectors[non_empty] @ np.array(centroids).T, axis=1), 0, None)
+        if distances.sum() <= 0:
+            break
+        centroids.append(vectors[non_empty[rng.choice(len(non_empty), p=distances / distances.sum())]])
+    centroids = np.array(centroids)
+
+    assignments = None
+    for _ in range(KMEANS_ITERATIONS):
+        new_assignments = np.argmax(vectors @ centroids.T, axis=1)
+        if assignments is not None and np.array_equal(new_assignments, assignments):
+            break
+        assignments = new_assignments
+
+        for cluster in range(len(centroids)):
+            members = vectors[assignments == cluster]
+            if len(members):
+                centroid = members.sum(axis=0)
+                centroids[cluster] = centroid / (np.linalg.norm(centroid) or 1)
+
+    return assignments, centroids
+
+
+def _assign_empty_messages(vectors: 'np.ndarray', assignments: 'np.ndarray') -> 'np.ndarray':
+    # Messages without terms ("ok", emojis) follow the message before them, they're usually replies to it
+    assignments = assignments.copy()
+    empty = ~vectors.any(axis=1)
+    for index in np.flatnonzero(empty):
+        if index > 0:
+            assignments[index] = assignments[index - 1]
+    return assignments
+
+
+def _merge_small_topics(assignments: 'np.ndarray', centroids: 'np.ndarray') -> 'np.ndarray':
+    assignments = assignments.copy()
+    sizes = np.bincount(assignments, minlength=len(centroids))
+    large = np.flatnonzero(sizes >= MIN_TOPIC_MESSAGES)
+    if len(large) == 0:
+        return np.zeros_like(assignments)
+
+    for cluster in np.flatnonzero((sizes > 0) & (sizes < MIN_TOPIC_MESSAGES)):
+        nearest = large[np.argmax(centroids[large] @ centroids[cluster])]
+        assignments[assignments == cluster] = nearest
+    return assignments
+
+
+def _top_terms(weights: 'np.ndarray', column_terms: dict[int, str]) -> list[str]:
+    columns = np.argsort(weights)[::-1][:LABEL_TERMS]
+    return [column_terms[int(column)] for column in columns if weights[column] > 0 and int(column) in column_terms]
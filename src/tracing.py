@@ -0,0 +1,329 @@
+"""
+Lightweight, OpenTelemetry-compatible tracing.
+
+Every update handled by the bot can be wrapped in a root span, with child spans
+for the storage and model calls made while handling it. Finished spans are
+exported in batches, as OTLP/JSON, to a file or to a local collector.
+
+Configuration (env variables):
+    TRACE_SAMPLE_RATE    fraction of updates that are traced, 0 disables tracing (default 0)
+    TRACE_EXPORTER       "file" or "otlp" (default "file")
+    TRACE_FILE           path of the file exporter (default "traces.jsonl")
+    TRACE_OTLP_ENDPOINT  collector endpoint (default "http://localhost:4318/v1/traces")
+"""
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Callable, Optional, Protocol
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = "chat-nuff-bot"
+DEFAULT_TRACE_FILE = "traces.jsonl"
+DEFAULT_OTLP_ENDPOINT = "http://localhost:4318/v1/traces"
+EXPORT_BATCH_SIZE = 256
+EXPORT_INTERVAL_SECONDS = 5
+
+# OTLP status codes
+STATUS_UNSET = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+class Span:
+    """A timed operation. Compatible with the OTLP span data model."""
+    __slots__ = ('trace_id', 'span_id', 'parent_span_id', 'name', 'attributes',
+                 'start_time_ns', 'end_time_ns', 'status_code', 'status_message')
+
+    def __init__(self, name: str, trace_id: str, parent_span_id: Optional[str], attributes: Optional[dict]):
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_span_id = parent_span_id
+        self.name = name
+        self.attributes = dict(attributes) if attributes else {}
+        self.start_time_ns = time.time_ns()
+        self.end_time_ns = 0
+        self.status_code = STATUS_UNSET
+        self.status_message = ""
+
+    @property
+    def is_recording(self) -> bool:
+        return True
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(self.start_time_ns),
+            "endTimeUnixNano": str(self.end_time_ns),
+            "attributes": [_to_otlp_attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": self.status_code, "message": self.status_message},
+        }
+        if self.parent_span_id:
+            span["parentSpanId"] = self.parent_span_id
+        return span
+
+
+class _NonRecordingSpan:
+    """Stands in for spans of traces that were not sampled. Does nothing."""
+    __slots__ = ()
+
+    @property
+    def is_recording(self) -> bool:
+        return False
+
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+
+NON_RECORDING_SPAN = _NonRecordingSpan()
+
+_current_span: ContextVar[Optional[Span | _NonRecordingSpan]] = ContextVar('current_span', default=None)
+
+
+class start_span:
+    """
+    Context manager that starts a span as a child of the current span.
+    Without a current span, it starts a new trace if the sampler allows it.
+
+        with start_span("redis.lrange", {"chat.id": chat_id}) as span:
+            ...
+            span.set_attribute("messages.returned", len(messages))
+    """
+    __slots__ = ('_name', '_attributes', '_span', '_token')
+
+    def __init__(self, name: str, attributes: Optional[dict] = None):
+        self._name = name
+        self._attributes = attributes
+        self._span = NON_RECORDING_SPAN
+        self._token = None
+
+    def __enter__(self) -> Span | _NonRecordingSpan:
+        parent = _current_span.get()
+
+        if parent is None:
+            if _tracer.sample_rate <= 0 or random.random() >= _tracer.sample_rate:
+                self._token = _current_span.set(NON_RECORDING_SPAN)
+                return NON_RECORDING_SPAN
+            self._span = Span(self._name, f"{random.getrandbits(128):032x}", None, self._attributes)
+        elif parent.is_recording:
+            self._span = Span(self._name, parent.trace_id, parent.span_id, self._attributes)
+        else:
+            return NON_RECORDING_SPAN
+
+        self._token = _current_span.set(self._span)
+        return self._span
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._token is not None:
+            _current_span.reset(self._token)
+
+        span = self._span
+        if not span.is_recording:
+            return False
+
+        span.end_time_ns = time.time_ns()
+        if exc_type is not None:
+            span.status_code = STATUS_ERROR
+            span.status_message = str(exc_value)
+            span.attributes["exception.type"] = exc_type.__name__
+
+        _tracer.on_end(span)
+        return False
+
+
+def get_current_span() -> Span | _NonRecordingSpan:
+    """
+    Returns the active span, or a non-recording span when nothing is being traced
+    @return: the span
+    """
+    return _current_span.get() or NON_RECORDING_SPAN
+
+
+def trace_update(handler: Callable) -> Callable:
+    """
+    Decorator for update handlers. Starts the root span of the update's trace.
+    @param handler: the handler callback
+    @return: the traced handler
+    """
+
+    @functools.wraps(handler)
+    async def traced_handler(update, context):
+        attributes = {"handler": handler.__name__, "update.id": update.update_id}
+        if update.effective_chat:
+            attributes["chat.id"] = update.effective_chat.id
+
+        with start_span("telegram.update", attributes):
+            return await handler(update, context)
+
+    return traced_handler
+
+
+class SpanExporter(Protocol):
+    """Sends a batch of finished spans somewhere"""
+
+    def export(self, spans: list[Span]):
+        """
+        Exports the batch. Blocking, the tracer calls it on its exporter thread.
+        @param spans: the finished spans
+        """
+        ...
+
+    def shutdown(self):
+        """Releases what the exporter holds, e.g. its connections"""
+        ...
+
+
+class FileSpanExporter:
+    """Appends every batch to a file, one OTLP/JSON document per line"""
+
+    def __init__(self, path: str):
+        self._path = path
+
+    def export(self, spans: list[Span]):
+        with open(self._path, "a", encoding="utf-8") as trace_file:
+            trace_file.write(json.dumps(_to_otlp_payload(spans)) + "\n")
+
+    def shutdown(self):
+        pass
+
+
+class OTLPHttpSpanExporter:
+    """Posts every batch to an OTLP/HTTP collector using the JSON encoding"""
+
+    def __init__(self, endpoint: str):
+        self._endpoint = endpoint
+        self._client = httpx.Client(timeout=5)
+
+    def export(self, spans: list[Span]):
+        response = self._client.post(self._endpoint, json=_to_otlp_payload(spans))
+        response.raise_for_status()
+
+    def shutdown(self):
+        self._client.close()
+
+
+class Tracer:
+    """
+    Holds the sampling rate and batches finished spans.
+    Batches are exported on a background thread so exporting never blocks the event loop.
+    """
+
+    def __init__(self):
+        self.sample_rate = 0.0
+        self._exporter: Optional[SpanExporter] = None
+        self._pending: list[Span] = []
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._batches: queue.Queue = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+
+    def configure(self, sample_rate: float, exporter: Optional[SpanExporter]):
+        self.shutdown()
+        self.sample_rate = sample_rate if exporter else 0.0
+        self._exporter = exporter
+
+        if exporter:
+            self._worker = threading.Thread(target=self._export_batches, name="span-exporter", daemon=True)
+            self._worker.start()
+
+    def on_end(self, span: Span):
+        # Spans may end on worker threads, e.g. blocking calls offloaded from the event loop
+        with self._lock:
+            self._pending.append(span)
+            pending = len(self._pending)
+
+        if pending >= EXPORT_BATCH_SIZE or time.monotonic() - self._last_flush >= EXPORT_INTERVAL_SECONDS:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        with self._lock:
+            batch, self._pending = self._pending, []
+
+        if batch:
+            self._batches.put(batch)
+
+    def shutdown(self):
+        if self._worker is None:
+            return
+
+        self.flush()
+        self._batches.put(None)
+        self._worker.join(timeout=EXPORT_INTERVAL_SECONDS)
+        self._exporter.shutdown()
+        self._worker = None
+
+    def _export_batches(self):
+        while (batch := self._batches.get()) is not None:
+            try:
+                self._exporter.export(batch)
+            except Exception:
+                logger.exception(f"Failed to export {len(batch)} spans")
+
+
+_tracer = Tracer()
+
+
+def configure_tracing():
+    """Configures sampling and the exporter from the environment"""
+    sample_rate = float(os.getenv('TRACE_SAMPLE_RATE', 0))
+    if sample_rate <= 0:
+        _tracer.configure(0.0, None)
+        return
+
+    exporter_name = os.getenv('TRACE_EXPORTER', 'file')
+    if exporter_name == 'otlp':
+        exporter = OTLPHttpSpanExporter(os.getenv('TRACE_OTLP_ENDPOINT', DEFAULT_OTLP_ENDPOINT))
+    else:
+        exporter = FileSpanExporter(os.getenv('TRACE_FILE', DEFAULT_TRACE_FILE))
+
+    logger.info(f"Tracing {sample_rate:.0%} of updates with the {exporter_name} exporter")
+    _tracer.configure(min(sample_rate, 1.0), exporter)
+
+
+def get_tracer() -> Tracer:
+    return _tracer
+
+
+def shutdown_tracing():
+    """Exports the spans that are still pending"""
+    _tracer.shutdown()
+
+
+def _to_otlp_payload(spans: list[Span]) -> dict:
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [_to_otlp_attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{
+                "scope": {"name": __name__},
+                "spans": [span.to_otlp() for span in spans],
+            }],
+        }]
+    }
+
+
+def _to_otlp_attribute(key: str, value: Any) -> dict:
+    if isinstance(value, bool):
+        typed_value = {"boolValue": value}
+    elif isinstance(value, int):
+        typed_value = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed_value = {"doubleValue": value}
+    else:
+        typed_value = {"stringValue": str(value)}
+
+    return {"key": key, "value": typed_value}
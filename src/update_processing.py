@@ -0,0 +1,120 @@
+"""
+Concurrent update processing, in order within each chat.
+
+By default the application handles one update at a time, so a slow /summary in
+one chat holds up the messages of every other chat. The ChatOrderedUpdateProcessor
+gives each chat a lane: the updates of a chat are handled one at a time, in the
+order they arrived, while the lanes of different chats run concurrently, up to
+UPDATE_MAX_CONCURRENT handlers at once. An update waits for its chat's turn
+before taking a worker, so a busy chat never holds workers the other chats could use.
+Updates that don't belong to a chat are handled as soon as a worker is free.
+
+The bot can also run on uvloop, with the `fast` extra installed.
+
+Configuration (env variables):
+    UPDATE_MAX_CONCURRENT   how many updates are handled at once (default 16)
+    UPDATE_MAX_QUEUED       how many updates may wait for their turn, beyond that they wait to be queued (default 1024)
+    UVLOOP_ENABLED          run the event loop on uvloop, if it is installed (default True)
+"""
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from utils import str_to_bool
+
+logger = logging.getLogger(__name__)
+
+
+class _ChatLane:
+    __slots__ = ('lock', 'updates')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.updates = 0  # Handled or waiting
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Handles the updates of different chats concurrently, and the updates of a chat in order"""
+
+    def __init__(self, max_concurrent_updates: int, max_queued_updates: int):
+        """
+        @param max_concurrent_updates: how many updates are handled at once
+        @param max_queued_updates: how many updates may wait for their chat's turn
+        """
+        # The base class' semaphore bounds the updates waiting in the lanes, the workers bound the handlers
+        super().__init__(max(max_queued_updates, max_concurrent_updates))
+        self._workers = asyncio.Semaphore(max_concurrent_updates)
+        self._lanes: dict[int, _ChatLane] = {}
+        self.max_concurrent_handlers = max_concurrent_updates
+
+    @property
+    def active_chats(self) -> int:
+        """How many chats have updates being handled or waiting"""
+        return len(self._lanes)
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]):
+        chat_id = _chat_id(update)
+        if chat_id is None:
+            async with self._workers:
+                await coroutine
+            return
+
+        lane = self._lanes.get(chat_id)
+        if lane is None:
+            lane = self._lanes[chat_id] = _ChatLane()
+        lane.updates += 1
+        try:
+            # asyncio locks are fair, so the chat's updates take their turn in the order they arrived
+            async with lane.lock:
+                async with self._workers:
+                    await coroutine
+        finally:
+            lane.updates -= 1
+            if lane.updates == 0:
+                del self._lanes[chat_id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def _chat_id(update: object) -> Optional[int]:
+    if isinstance(update, Update) and update.effective_chat is not None:
+        return update.effective_chat.id
+    return None
+
+
+def build_update_processor() -> ChatOrderedUpdateProcessor:
+    """
+    @return: the update processor configured by the env variables
+    """
+    max_concurrent = int(os.getenv('UPDATE_MAX_CONCURRENT', 16))
+    max_queued = int(os.getenv('UPDATE_MAX_QUEUED', 1024))
+    logger.info(f"Handling up to {max_concurrent} updates at once, in order within each chat")
+    return ChatOrderedUpdateProcessor(max_concurrent, max_queued)
+
+
+def install_uvloop() -> bool:
+    """
+    Runs the event loops created from now on with uvloop, if UVLOOP_ENABLED and it is installed.
+    Call it before asyncio.run.
+    @return: True if uvloop is used
+    """
+    if not str_to_bool(os.getenv('UVLOOP_ENABLED', True)):
+        return False
+
+    try:
+        import uvloop
+    except ImportError:
+        logger.info("uvloop isn't installed, using the default event loop")
+        return False
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info("Using the uvloop event loop")
+    return True
@@ -8,3 +8,28 @@ def str_to_bool(value):
         return False
     else:
         raise ValueError(f"Boolean value expected, got '{value}' instead.")
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """
+    Returns the nearest-rank percentile of the values.
+    @param values: the samples, in any order
+    @param pct: the percentile between 0 and 100
+    @return: the percentile, or 0.0 if there are no samples
+    """
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    rank = max(1, round(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def estimate_tokens(chars: int) -> int:
+    """
+    Estimates how many model tokens a text of that length is.
+    English averages about 4 characters per token.
+    @param chars: the length of the text
+    @return: the estimated number of tokens
+    """
+    return (chars + 3) // 4
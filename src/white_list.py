@@ -1,3 +1,6 @@
+import functools
+
+
 def get_white_list() -> list[int]:
     return [
         -1001334294461,  # Gerousia
@@ -24,7 +27,7 @@ def is_whitelisted(chat_id: int) -> bool:
     @param chat_id:
     @return: True if it does
     """
-    return chat_id in get_white_list()
+    return chat_id in _white_list_set()
 
 
 def is_admin(user_id: int) -> bool:
@@ -34,4 +37,22 @@ def is_admin(user_id: int) -> bool:
     @param user_id:
     @return: True if it does
     """
-    return user_id in get_admin_user_list()
+    return user_id in _admin_set()
+
+
+@functools.cache
+def _white_list_set() -> frozenset[int]:
+    return frozenset(get_white_list())
+
+
+@functools.cache
+def _admin_set() -> frozenset[int]:
+    return frozenset(get_admin_user_list())
+
+
+def warm_white_list():
+    """
+    Builds the lookup sets before the first update needs them.
+    """
+    _white_list_set()
+    _admin_set()
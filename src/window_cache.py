@@ -0,0 +1,278 @@
+"""
+In-process cache of the latest messages of the hot chats.
+
+get_latest_n_messages reads a chat's window from here before going to Redis,
+and store_message adds each new message to the cached window, so a chat that
+was read or written recently is summarized without any network I/O or JSON decoding.
+The cache is an LRU capped by an estimate of its memory.
+
+Every replica caches its own windows. store_message publishes the chat id on a
+Redis channel in the same pipeline as the write, and the other replicas drop
+their copy when they receive it. Pub/sub is at-most-once, so cached windows
+also expire after a while, and the whole cache is dropped when the subscription
+reconnects.
+
+Configuration (env variables):
+    WINDOW_CACHE_ENABLED         cache the windows (default True)
+    WINDOW_CACHE_MAX_BYTES       the memory budget of the cache (default 16MB)
+    WINDOW_CACHE_TTL_SECONDS     how long a window is served without being refreshed (default 60)
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Optional, TYPE_CHECKING
+
+from redis import Redis
+
+from redis_keys import namespaced_key
+from utils import str_to_bool
+
+if TYPE_CHECKING:
+    from message_storage import Message
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "window-cache:invalidate"
+
+# Python object overhead of a cached message, on top of its text
+_MESSAGE_OVERHEAD_BYTES = 400
+
+
+@dataclass
+class _CachedWindow:
+    messages: list['Message']  # newest first
+    complete: bool  # True if these are all the messages the chat has stored
+    size_bytes: int
+    expires_at: float
+
+
+@dataclass
+class WindowCacheStats:
+    """How well the cache is doing"""
+    hits: int = 0
+    misses: int = 0
+    invalidations: int = 0
+    evictions: int = 0
+    windows: int = 0
+    size_bytes: int = 0
+    max_bytes: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class WindowCache:
+    """LRU of the latest messages of each chat, newest first"""
+
+    def __init__(self, max_bytes: int, ttl_seconds: float, max_messages: int):
+        self._max_bytes = max_bytes
+        self._ttl_seconds = ttl_seconds
+        self._max_messages = max_messages
+        self._windows: OrderedDict[int, _CachedWindow] = OrderedDict()
+        self._size_bytes = 0
+        self._stats = WindowCacheStats(max_bytes=max_bytes)
+        # Bumped on every change, so a window read from Redis before a change isn't cached after it
+        self._epoch = 0
+        self._chat_versions: dict[int, int] = {}
+        # Summaries read on worker threads, messages are stored on the event loop
+        self._lock = threading.Lock()
+        self.instance_id = uuid.uuid4().hex
+
+    def get(self, chat_id: int, number_of_msgs: int) -> Optional[list['Message']]:
+        """
+        @param chat_id: The unique identifier for the chat session.
+        @param number_of_msgs: how many of the latest messages are needed
+        @return: the latest messages, newest first, or None if the cached window doesn't have them
+        """
+        with self._lock:
+            window = self._windows.get(chat_id)
+            if window is not None and window.expires_at <= time.monotonic():
+                self._remove(chat_id)
+                window = None
+
+            if window is None or (len(window.messages) < number_of_msgs and not window.complete):
+                self._stats.misses += 1
+                return None
+
+            self._windows.move_to_end(chat_id)
+            self._stats.hits += 1
+            return window.messages[:number_of_msgs]
+
+    def version(self, chat_id: int) -> tuple[int, int]:
+        """
+        @return: the chat's version, read it before reading the window from Redis
+        """
+        with self._lock:
+            return self._epoch, self._chat_versions.get(chat_id, 0)
+
+    def put(self, chat_id: int, messages: list['Message'], complete: bool, version: tuple[int, int]):
+        """
+        Caches the window read from Redis, unless the chat changed since.
+        @param chat_id: The unique identifier for the chat session.
+        @param messages: the latest messages, newest first
+        @param complete: True if the chat has no other stored messages
+        @param version: the chat's version before the window was read
+        """
+        complete = complete or len(messages) >= self._max_messages
+        with self._lock:
+            if version != (self._epoch, self._chat_versions.get(chat_id, 0)):
+                return
+
+            current = self._windows.get(chat_id)
+            if current is not None and len(current.messages) > len(messages) and not complete:
+                return  # Keep the larger window
+
+            self._remove(chat_id)
+            self._add(chat_id, list(messages), complete)
+
+    def add_message(self, chat_id: int, message: 'Message', stored_count: int):
+        """
+        Adds a message that was just stored to the chat's cached window.
+        @param chat_id: The unique identifier for the chat session.
+        @param message: the message
+        @param stored_count: how many messages the chat has stored, including this one
+        """
+        with self._lock:
+            self._bump(chat_id)
+            window = self._windows.get(chat_id)
+            if window is None:
+                return
+
+            messages = [message, *window.messages][:self._max_messages]
+            self._remove(chat_id)
+            if window.complete and len(messages) != min(stored_count, self._max_messages):
+                return  # Another replica wrote meanwhile, its invalidation is on the way
+
+            self._add(chat_id, messages, window.complete or len(messages) >= self._max_messages)
+
+    def invalidate(self, chat_id: int):
+        with self._lock:
+            self._bump(chat_id)
+            if self._remove(chat_id):
+                self._stats.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._chat_versions.clear()
+            self._windows.clear()
+            self._size_bytes = 0
+
+    def _bump(self, chat_id: int):
+        self._chat_versions[chat_id] = self._chat_versions.get(chat_id, 0) + 1
+
+    def stats(self) -> WindowCacheStats:
+        with self._lock:
+            self._stats.windows = len(self._windows)
+            self._stats.size_bytes = self._size_bytes
+            return replace(self._stats)
+
+    def _add(self, chat_id: int, messages: list['Message'], complete: bool):
+        size_bytes = sum(_MESSAGE_OVERHEAD_BYTES + len(msg.content) + len(msg.owner_name) for msg in messages)
+        if size_bytes > self._max_bytes:
+            return
+
+        self._windows[chat_id] = _CachedWindow(messages, complete, size_bytes, time.monotonic() + self._ttl_seconds)
+        self._size_bytes += size_bytes
+        while self._size_bytes > self._max_bytes:
+            evicted_chat_id = next(iter(self._windows))
+            self._remove(evicted_chat_id)
+            self._stats.evictions += 1
+
+    def _remove(self, chat_id: int) -> bool:
+        window = self._windows.pop(chat_id, None)
+        if window is None:
+            return False
+        self._size_bytes -= window.size_bytes
+        return True
+
+
+_window_cache: Optional[WindowCache] = None
+
+
+def configure_window_cache(max_messages: int,
+                           max_bytes: Optional[int] = None,
+                           ttl_seconds: Optional[float] = None) -> Optional[WindowCache]:
+    """
+    Turns on the window cache, if WINDOW_CACHE_ENABLED.
+    @param max_messages: the most messages a chat has stored
+    @param max_bytes: the memory budget, read from the env variables by default
+    @param ttl_seconds: how long a window is served, read from the env variables by default
+    @return: the cache, or None if it is disabled
+    """
+    global _window_cache
+
+    if not str_to_bool(os.getenv('WINDOW_CACHE_ENABLED', True)):
+        _window_cache = None
+        return None
+
+    _window_cache = WindowCache(
+        max_bytes=max_bytes if max_bytes is not None else int(os.getenv('WINDOW_CACHE_MAX_BYTES', 16 * 1024 * 1024)),
+        ttl_seconds=ttl_seconds if ttl_seconds is not None else float(os.getenv('WINDOW_CACHE_TTL_SECONDS', 60)),
+        max_messages=max_messages
+    )
+    logger.info(f"Caching chat windows in memory, up to {_window_cache.stats().max_bytes // 1024}KB")
+    return _window_cache
+
+
+def get_window_cache() -> Optional[WindowCache]:
+    return _window_cache
+
+
+def invalidation_channel() -> str:
+    return namespaced_key(INVALIDATION_CHANNEL)
+
+
+def invalidation_message(cache: WindowCache, chat_id: int) -> str:
+    """
+    @return: what a replica publishes when it writes to a chat
+    """
+    return f"{cache.instance_id}:{chat_id}"
+
+
+def handle_invalidation(cache: WindowCache, data: bytes):
+    """
+    Drops the chat's window, unless this replica published the message.
+    @param cache: the window cache
+    @param data: the published message
+    """
+    instance_id, _, chat_id = data.decode('utf-8').partition(':')
+    if instance_id != cache.instance_id:
+        cache.invalidate(int(chat_id))
+
+
+async def run_invalidation_listener_async(redis_client: Redis, reconnect_delay_seconds: float = 1):
+    """
+    Drops the windows other replicas write to, for as long as the bot runs.
+    """
+    cache = get_window_cache()
+    if cache is None:
+        return
+
+    while True:
+        try:
+            await asyncio.to_thread(_listen, redis_client, cache)
+        except Exception:
+            logger.exception("Lost the window cache invalidations, resubscribing")
+        # Invalidations may have been missed while we weren't subscribed
+        cache.clear()
+        await asyncio.sleep(reconnect_delay_seconds)
+
+
+def _listen(redis_client: Redis, cache: WindowCache):
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(invalidation_channel())
+        cache.clear()  # Anything cached before the subscription may be stale
+        for message in pubsub.listen():
+            if message['type'] == 'message':
+                handle_invalidation(cache, message['data'])
+    finally:
+        pubsub.close()
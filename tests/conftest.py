@@ -0,0 +1,31 @@
+from typing import Optional
+
+import pytest
+from fakeredis import FakeRedis
+
+from embedded_storage import EmbeddedRedis
+from message_storage import Message
+
+
+@pytest.fixture(params=["redis", "embedded"])
+def redis_client(request, tmp_path):
+    # The storage tests run against both backends
+    if request.param == "embedded":
+        return EmbeddedRedis(tmp_path)
+    return FakeRedis()
+
+
+def make_message(message_id: int,
+                 content: str = "",
+                 owner_name: str = "Alice",
+                 owner_id: Optional[int] = None,
+                 created_at: str = "2024-05-14T12:00:00",
+                 reply_to_message_id: Optional[int] = None) -> Message:
+    """
+    @param content: "message <id>" by default
+    @param owner_id: one id per owner name by default
+    @return: a message for the tests
+    """
+    return Message(message_id=message_id, content=content or f"message {message_id}",
+                   owner_id=hash(owner_name) if owner_id is None else owner_id, owner_name=owner_name,
+                   created_at=created_at, reply_to_message_id=reply_to_message_id)
@@ -0,0 +1,150 @@
+import io
+import json
+from dataclasses import asdict
+
+from fakeredis import FakeRedis
+
+from chat_history import (export_chats, export_archived_chats, read_export, import_messages,
+                          read_telegram_desktop_export)
+from message_archive import SegmentReader, SegmentWriter
+from message_storage import (Message, store_message, get_latest_n_messages, iter_chat_messages, search_messages,
+                             get_new_message_count, MAX_MESSAGE_STORAGE, edit_message, forget_message)
+from summary_cache import CachedSummary, cache_summary, get_cached_summary
+from tests.conftest import make_message
+
+CHAT_ID = -100
+
+
+def test_iter_chat_messages_reads_in_chunks(redis_client):
+    # Given: A chat with more messages than a chunk
+    for message_id in range(25):
+        store_message(redis_client, CHAT_ID, make_message(message_id))
+
+    # When: We read it 10 messages at a time
+    message_ids = [message.message_id for message in iter_chat_messages(redis_client, CHAT_ID, chunk_size=10)]
+
+    # Then: Every message is read once, newest first
+    assert message_ids == list(range(24, -1, -1))
+
+
+def test_iter_chat_messages_skips_messages_shifted_by_new_ones(redis_client):
+    # Given: A message arrives between two chunks
+    for message_id in range(10):
+        store_message(redis_client, CHAT_ID, make_message(message_id))
+    messages = iter_chat_messages(redis_client, CHAT_ID, chunk_size=5)
+    first_chunk = [next(messages).message_id for _ in range(5)]
+    store_message(redis_client, CHAT_ID, make_message(10))
+
+    # When: We read the rest
+    rest = [message.message_id for message in messages]
+
+    # Then: No message is read twice
+    assert first_chunk + rest == list(range(9, -1, -1))
+
+
+def test_export_and_import_round_trip():
+    # Given: Two chats exported
+    source = FakeRedis()
+    for message_id in range(5):
+        store_message(source, CHAT_ID, make_message(message_id))
+        store_message(source, -200, make_message(message_id, "other chat"))
+    output = io.StringIO()
+    assert export_chats(source, output) == 10
+
+    # When: We import the export into an empty Redis
+    target = FakeRedis()
+    imported = import_messages(target, read_export(io.StringIO(output.getvalue())))
+
+    # Then: Both chats have the same messages, in the same order, and none count as new
+    assert imported == 10
+    for chat_id in (CHAT_ID, -200):
+        assert get_latest_n_messages(target, chat_id) == get_latest_n_messages(source, chat_id)
+        assert get_new_message_count(target, chat_id) == 0
+
+
+def test_export_the_archive_as_it_is_now(redis_client, tmp_path):
+    # Given: An archived chat, where one message was edited and one forgotten since
+    messages = [make_message(message_id) for message_id in range(4)]
+    SegmentWriter(tmp_path, use_zstd=False).append(CHAT_ID, [json.dumps(asdict(message)).encode('utf-8')
+                                                             for message in messages])
+    for message in messages:
+        store_message(redis_client, CHAT_ID, message)
+    edit_message(redis_client, CHAT_ID, make_message(1, "edited"))
+    forget_message(redis_client, CHAT_ID, 2)
+
+    # When: We export the archive
+    output = io.StringIO()
+    exported = export_archived_chats(redis_client, SegmentReader(tmp_path), output)
+
+    # Then: The chat is exported oldest first, with the edit, and without the forgotten message
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert exported == 3
+    assert [(record['chat_id'], record['message_id'], record['content']) for record in records] == [
+        (CHAT_ID, 0, "message 0"), (CHAT_ID, 1, "edited"), (CHAT_ID, 3, "message 3")
+    ]
+
+
+def test_imported_history_goes_before_the_stored_messages(redis_client):
+    # Given: A chat the bot already stored messages for, with a cached summary
+    for message_id in (10, 11):
+        store_message(redis_client, CHAT_ID, make_message(message_id))
+    cache_summary(redis_client, CHAT_ID, "paragraph", 100, CachedSummary(11, "old summary"))
+
+    # When: We import its older history, newest first as it's exported, and then import it again
+    history = [(CHAT_ID, make_message(message_id, "concert tickets")) for message_id in range(11, -1, -1)]
+    assert import_messages(redis_client, history, batch_size=4) == 10
+    assert import_messages(redis_client, history) == 0
+
+    # Then: The history is older than the stored messages, and searchable
+    assert [msg.message_id for msg in get_latest_n_messages(redis_client, CHAT_ID)] == list(range(11, -1, -1))
+    assert len(search_messages(redis_client, CHAT_ID, "concert", limit=20)) == 10
+
+    # And: The cached summary no longer covers the window
+    assert get_cached_summary(redis_client, CHAT_ID, "paragraph", 100) is None
+
+
+def test_import_keeps_the_latest_messages(redis_client):
+    # Given: Two chats with a longer history than Redis keeps, exported interleaved
+    history = [(chat_id, make_message(message_id, "concert tickets"))
+               for message_id in range(MAX_MESSAGE_STORAGE + 19, -1, -1) for chat_id in (CHAT_ID, -200)]
+
+    # When: We import them in batches
+    stored = import_messages(redis_client, history, batch_size=50)
+
+    # Then: Each window only holds the latest messages, and says so
+    assert stored == 2 * MAX_MESSAGE_STORAGE
+    for chat_id in (CHAT_ID, -200):
+        messages = get_latest_n_messages(redis_client, chat_id, MAX_MESSAGE_STORAGE + 20)
+        assert (len(messages), messages[0].message_id, messages[-1].message_id) == (
+            MAX_MESSAGE_STORAGE, MAX_MESSAGE_STORAGE + 19, 20)
+
+    # And: The older messages are still searchable
+    assert len(search_messages(redis_client, CHAT_ID, "concert", limit=MAX_MESSAGE_STORAGE + 20)) == (
+        MAX_MESSAGE_STORAGE + 20)
+
+
+def test_read_telegram_desktop_export():
+    # Given: A Telegram Desktop export of a supergroup
+    export = json.loads("""{
+        "name": "Weekend plans", "type": "private_supergroup", "id": 1234567890,
+        "messages": [
+            {"id": 1, "type": "service", "date": "2024-05-14T12:00:00", "actor": "Alice", "action": "create_group"},
+            {"id": 2, "type": "message", "date": "2024-05-14T12:01:00", "date_unixtime": "1715688060",
+             "from": "Alice", "from_id": "user111", "text": "Dinner on Friday?"},
+            {"id": 3, "type": "message", "date": "2024-05-14T12:02:00", "date_unixtime": "1715688120",
+             "from": "Bob", "from_id": "user222",
+             "text": ["Yes, at ", {"type": "bold", "text": "8pm"}]},
+            {"id": 4, "type": "message", "date": "2024-05-14T12:03:00", "from": "Bob", "from_id": "user222",
+             "text": "", "photo": "photos/photo_1.jpg"}
+        ]
+    }""")
+
+    # When: We read it
+    chat_id, messages = read_telegram_desktop_export(export)
+
+    # Then: We get the Bot API chat id, and the text messages with their formatting removed
+    assert chat_id == -1001234567890
+    assert messages == [
+        Message(2, "Dinner on Friday?", 111, "Alice", "2024-05-14T12:01:00+00:00"),
+        Message(3, "Yes, at 8pm", 222, "Bob", "2024-05-14T12:02:00+00:00"),
+    ]
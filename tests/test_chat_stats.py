@@ -0,0 +1,124 @@
+from datetime import datetime
+
+from fakeredis import FakeRedis
+from starlette.testclient import TestClient
+
+import server
+from chat_stats import (record_activity, evict_quiet_posters, get_chat_stats, format_chat_stats,
+                        SECONDS_PER_HOUR, SECONDS_PER_DAY)
+from message_storage import Message, store_message
+
+NOW = 1_700_000_000.0
+
+
+def test_stored_messages_are_counted(redis_client):
+    # Given: 3 messages from 2 users
+    chat_id = -100
+    for message_id, (owner_id, owner_name) in enumerate([(1, "Ana"), (2, "Ben"), (1, "Ana")]):
+        store_message(redis_client, chat_id, Message(message_id=message_id, content="hello", owner_id=owner_id,
+                                                     owner_name=owner_name, created_at=datetime.now().isoformat()))
+
+    # When: We read the chat's stats
+    stats = get_chat_stats(redis_client, chat_id)
+
+    # Then: They were counted in the current hour
+    assert stats.messages == 3
+    assert stats.messages_per_hour[-1] == 3
+    assert stats.active_users_today == 2
+    assert stats.top_posters == [("Ana", 2), ("Ben", 1)]
+
+
+def test_messages_are_bucketed_by_hour(redis_client):
+    # Given: Messages over the last 3 hours, and one from yesterday
+    chat_id = -100
+    for hours_ago, messages in [(0, 2), (1, 0), (2, 5), (30, 1)]:
+        _record(redis_client, chat_id, owner_id=1, messages=messages, now=NOW - hours_ago * SECONDS_PER_HOUR)
+
+    # When: We read the last 3 hours
+    stats = get_chat_stats(redis_client, chat_id, hours=3, now=NOW)
+
+    # Then: Each hour has its own count, oldest first
+    assert stats.messages_per_hour == [5, 0, 2]
+    assert stats.busiest_hour == 5
+
+
+def test_active_users_are_counted_per_day_and_week(redis_client):
+    # Given: 3 users posted yesterday, and 2 of them and a new one today
+    chat_id = -100
+    for owner_id in (1, 2, 3):
+        _record(redis_client, chat_id, owner_id, now=NOW - SECONDS_PER_DAY)
+    for owner_id in (2, 3, 4):
+        _record(redis_client, chat_id, owner_id, now=NOW)
+
+    # When: We read the stats
+    stats = get_chat_stats(redis_client, chat_id, now=NOW)
+
+    # Then: Each user is only counted once
+    assert stats.active_users_today == 3
+    assert stats.active_users_this_week == 4
+
+
+def test_quiet_posters_are_evicted(redis_client):
+    # Given: 5 posters, the busiest posted 5 messages
+    chat_id = -100
+    for owner_id in range(1, 6):
+        _record(redis_client, chat_id, owner_id, messages=owner_id, now=NOW)
+
+    # When: Only 2 posters are kept
+    evicted = evict_quiet_posters(redis_client, chat_id, keep=2)
+
+    # Then: The busiest ones are still counted
+    assert evicted == 3
+    assert get_chat_stats(redis_client, chat_id, top_n=10, now=NOW).top_posters == [("User 5", 5), ("User 4", 4)]
+
+
+def test_chat_without_activity(redis_client):
+    # Expect: All zeros
+    stats = get_chat_stats(redis_client, -999, now=NOW)
+    assert stats.messages == 0
+    assert stats.active_users_this_week == 0
+    assert stats.top_posters == []
+    assert "Messages in the last 24 hours: 0" in format_chat_stats(stats)
+
+
+def test_stats_endpoint_needs_the_admin_token(mocker, monkeypatch):
+    # Given: A chat with activity, and an admin token
+    redis_client = FakeRedis()
+    mocker.patch('server.get_redis_client', return_value=redis_client)
+    _record(redis_client, -100, owner_id=1, messages=3)
+    _record(redis_client, -200, owner_id=2, messages=1)
+    store_message(redis_client, -100, Message(message_id=1, content="hi", owner_id=1, owner_name="User 1",
+                                              created_at=datetime.now().isoformat()))
+    store_message(redis_client, -200, Message(message_id=1, content="hi", owner_id=2, owner_name="User 2",
+                                              created_at=datetime.now().isoformat()))
+    monkeypatch.setenv('ADMIN_API_TOKEN', 'secret')
+    client = TestClient(server.web_app)
+
+    # Expect: It is refused without the token
+    assert client.get("/admin/stats/-100").status_code == 401
+    assert client.get("/admin/stats", headers={'Authorization': 'Bearer wrong'}).status_code == 401
+
+    # And: With it, we get the chat's stats
+    response = client.get("/admin/stats/-100", headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+    assert response.json()['messages'] == 4
+
+    # And: Every chat, busiest first
+    response = client.get("/admin/stats?limit=1", headers={'Authorization': 'Bearer secret'})
+    assert [chat['chat_id'] for chat in response.json()['chats']] == [-100]
+
+
+def test_stats_endpoint_is_disabled_without_a_token(monkeypatch):
+    # Given: No admin token is configured
+    monkeypatch.delenv('ADMIN_API_TOKEN', raising=False)
+
+    # Expect: Nobody can read the stats
+    response = TestClient(server.web_app).get("/admin/stats", headers={'Authorization': 'Bearer '})
+    assert response.status_code == 401
+
+
+def _record(redis_client, chat_id: int, owner_id: int, messages: int = 1, now: float = None):
+    pipeline = redis_client.pipeline(transaction=False)
+    for _ in range(messages):
+        record_activity(pipeline, chat_id, owner_id, f"User {owner_id}", now)
+    pipeline.execute()
@@ -0,0 +1,125 @@
+import asyncio
+import threading
+import time
+import tracemalloc
+
+import pytest
+from starlette.testclient import TestClient
+
+import debug_tools
+import server
+from debug_tools import LoopLagMonitor, sample_stacks, format_collapsed_stacks, get_memory_report
+
+
+def _block_the_loop(seconds: float):
+    time.sleep(seconds)
+
+
+@pytest.mark.asyncio
+async def test_loop_lag_monitor_logs_the_blocking_call():
+    # Given: A monitor watching the loop
+    monitor = LoopLagMonitor(threshold_seconds=0.05)
+    task = asyncio.create_task(monitor.run())
+    await asyncio.sleep(0.05)
+
+    # When: A sync call blocks the loop
+    _block_the_loop(0.3)
+    await asyncio.sleep(0.05)
+
+    # Then: The stall was caught while it was going on, with the blocking call in the stack
+    assert monitor.report.stalls == 1
+    assert monitor.report.max_lag_ms >= 50
+    assert "_block_the_loop" in monitor.report.last_stall_stack
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_loop_lag_monitor_ignores_a_responsive_loop():
+    # Given: A monitor watching a loop that never blocks
+    monitor = LoopLagMonitor(threshold_seconds=0.1)
+    task = asyncio.create_task(monitor.run())
+
+    # When: The loop keeps running
+    await asyncio.sleep(0.3)
+
+    # Then: Nothing was reported
+    assert monitor.report.stalls == 0
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+def _busy_wait(stop: threading.Event):
+    while not stop.is_set():
+        pass
+
+
+def test_profile_has_the_busy_thread():
+    # Given: A thread burning CPU
+    stop = threading.Event()
+    busy_thread = threading.Thread(target=_busy_wait, args=(stop,), name="busy")
+    busy_thread.start()
+
+    # When: We profile
+    try:
+        samples = sample_stacks(0.1, interval_seconds=0.005)
+    finally:
+        stop.set()
+        busy_thread.join()
+
+    # Then: Its stack was sampled, root first, in the collapsed format
+    busy_stacks = [line.rsplit(' ', 1) for line in format_collapsed_stacks(samples).splitlines()
+                   if line.startswith("busy;")]
+    assert busy_stacks and all(";_busy_wait (test_debug_tools.py:" in stack for stack, _ in busy_stacks)
+    assert sum(int(count) for _, count in busy_stacks) > 1
+
+
+def test_memory_report_has_the_growth_since_the_previous_one(mocker):
+    # Given: Allocations aren't traced yet
+    was_tracing = tracemalloc.is_tracing()
+    tracemalloc.stop()
+    mocker.patch.object(debug_tools, '_previous_memory_snapshot', None)
+
+    try:
+        # When: We get the first report
+        first = get_memory_report()
+
+        # Then: It started tracing
+        assert first['tracing'] == 'started'
+
+        # When: Something allocates, and we get the next reports
+        get_memory_report()
+        allocated = [bytearray(1024) for _ in range(1000)]
+        report = get_memory_report(top_n=50)
+
+        # Then: The allocation is among the growth
+        assert report['traced_bytes'] > 0
+        assert any("test_debug_tools.py" in stat['location'] and stat['size_diff_bytes'] >= 1024 * 1000
+                   for stat in report['growth'])
+        assert allocated
+    finally:
+        tracemalloc.stop()
+        if was_tracing:
+            tracemalloc.start()
+
+
+def test_debug_endpoints_need_the_admin_token(monkeypatch):
+    # Given: An admin token
+    monkeypatch.setenv('ADMIN_API_TOKEN', 'secret')
+    client = TestClient(server.web_app)
+
+    # Expect: The endpoints are refused without it
+    for path in ("/debug/loop", "/debug/profile", "/debug/memory"):
+        assert client.get(path).status_code == 401
+
+    # And: With it, a profile is returned as a file
+    response = client.get("/debug/profile?seconds=0.05", headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+    assert response.headers['Content-Disposition'] == 'attachment; filename="profile.folded"'
+    assert response.text
+
+    # And: Profiles longer than the limit are refused
+    response = client.get("/debug/profile?seconds=3600", headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 400
@@ -0,0 +1,198 @@
+import asyncio
+from datetime import datetime, time, timedelta
+from unittest.mock import AsyncMock
+from zoneinfo import ZoneInfo
+
+import pytest
+from fakeredis import FakeRedis
+
+from digest_scheduler import DigestConfig, DigestScheduler
+from message_storage import Message, store_message
+from redis_keys import digest_state_key
+
+WHITELISTED_CHAT_ID = -4257039919  # Test group
+TIMEZONE = ZoneInfo("America/Jamaica")
+
+
+def test_slots_are_spread_over_the_window(stub_redis_client):
+    # Given: A 1-hour window starting at 9:00
+    scheduler = DigestScheduler(stub_redis_client, AsyncMock(), _config())
+    day = datetime(2024, 5, 14, 12, tzinfo=TIMEZONE)
+    window_start = datetime(2024, 5, 14, 9, tzinfo=TIMEZONE)
+
+    # When: We get the slots of many chats
+    slots = {scheduler.slot_for(chat_id, day) for chat_id in range(-1, -101, -1)}
+
+    # Then: They are all inside the window, and not all at the same time
+    assert all(window_start <= slot < window_start + timedelta(hours=1) for slot in slots)
+    assert len(slots) > 50
+
+    # And: A chat always gets the same slot
+    assert scheduler.slot_for(-1, day) == scheduler.slot_for(-1, day)
+
+
+@pytest.mark.asyncio
+async def test_digest_is_posted_after_the_chat_slot(stub_redis_client, stub_summary):
+    # Given: A chat with new messages
+    _store_test_messages(stub_redis_client, WHITELISTED_CHAT_ID, range(5))
+    bot = AsyncMock()
+    scheduler = DigestScheduler(stub_redis_client, bot, _config())
+    slot = scheduler.slot_for(WHITELISTED_CHAT_ID, datetime(2024, 5, 14, tzinfo=TIMEZONE))
+
+    # When: The scheduler runs before the slot
+    assert await scheduler.run_once(slot - timedelta(seconds=1)) == []
+
+    # And: When it runs after the slot
+    for task in await scheduler.run_once(slot):
+        await task
+
+    # Then: The digest is posted once
+    bot.send_message.assert_awaited_once()
+    assert bot.send_message.call_args.kwargs['chat_id'] == WHITELISTED_CHAT_ID
+
+    # And: Is not posted again the same day
+    assert await scheduler.run_once(slot + timedelta(minutes=5)) == []
+
+
+@pytest.mark.asyncio
+async def test_digest_is_posted_after_enough_new_messages(stub_redis_client, stub_summary):
+    # Given: The message count trigger is set to 10, and the chat had a digest after 5 messages
+    _store_test_messages(stub_redis_client, WHITELISTED_CHAT_ID, range(5))
+    bot = AsyncMock()
+    scheduler = DigestScheduler(stub_redis_client, bot, _config(message_threshold=10))
+    before_slot = datetime(2024, 5, 14, 8, tzinfo=TIMEZONE)
+    stub_redis_client.hset(digest_state_key(WHITELISTED_CHAT_ID),
+                           mapping={'last_message_id': 4, 'last_scheduled_date': ''})
+
+    # When: 9 new messages arrive
+    _store_test_messages(stub_redis_client, WHITELISTED_CHAT_ID, range(5, 14))
+
+    # Then: No digest is due
+    assert await scheduler.run_once(before_slot) == []
+
+    # When: The 10th new message arrives
+    _store_test_messages(stub_redis_client, WHITELISTED_CHAT_ID, range(14, 15))
+    for task in await scheduler.run_once(before_slot):
+        await task
+
+    # Then: The digest is posted
+    bot.send_message.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_inactive_chat_skips_its_slot(stub_redis_client, stub_summary):
+    # Given: A chat with no messages since its last digest
+    _store_test_messages(stub_redis_client, WHITELISTED_CHAT_ID, range(3))
+    stub_redis_client.hset(digest_state_key(WHITELISTED_CHAT_ID),
+                           mapping={'last_message_id': 2, 'last_scheduled_date': ''})
+    bot = AsyncMock()
+    scheduler = DigestScheduler(stub_redis_client, bot, _config())
+    after_window = datetime(2024, 5, 14, 11, tzinfo=TIMEZONE)
+
+    # When: The scheduler runs
+    tasks = await scheduler.run_once(after_window)
+
+    # Then: Nothing is posted
+    assert tasks == []
+    bot.send_message.assert_not_called()
+
+    # And: The slot is marked as used for the day
+    assert stub_redis_client.hget(digest_state_key(WHITELISTED_CHAT_ID), 'last_scheduled_date') == b'2024-05-14'
+
+
+@pytest.mark.asyncio
+async def test_chats_are_read_in_batches_off_the_event_loop(stub_redis_client, stub_summary, mocker):
+    # Given: Three chats with new messages, read one chat per pipeline
+    chat_ids = [-1, -2, -3]
+    for chat_id in chat_ids:
+        _store_test_messages(stub_redis_client, chat_id, range(3))
+    mocker.patch('digest_scheduler.is_whitelisted', return_value=True)
+    mocker.patch('digest_scheduler.DIGEST_READ_BATCH_SIZE', 1)
+    to_thread = mocker.spy(asyncio, 'to_thread')
+    bot = AsyncMock()
+    scheduler = DigestScheduler(stub_redis_client, bot, _config())
+    after_window = datetime(2024, 5, 14, 11, tzinfo=TIMEZONE)
+
+    # When: The scheduler runs after every chat's slot
+    for task in await scheduler.run_once(after_window):
+        await task
+
+    # Then: The chats were read on a worker thread
+    to_thread.assert_called_once()
+
+    # And: Every chat got its digest
+    assert sorted(call.kwargs['chat_id'] for call in bot.send_message.call_args_list) == sorted(chat_ids)
+
+
+@pytest.mark.asyncio
+async def test_digest_is_not_posted_after_losing_the_leadership(stub_redis_client, stub_summary, mocker):
+    # Given: A chat due a digest, on an instance whose lease was taken over while it was summarizing
+    _store_test_messages(stub_redis_client, WHITELISTED_CHAT_ID, range(5))
+    mocker.patch('digest_scheduler.holds_leadership', return_value=False)
+    bot = AsyncMock()
+    scheduler = DigestScheduler(stub_redis_client, bot, _config())
+    slot = scheduler.slot_for(WHITELISTED_CHAT_ID, datetime(2024, 5, 14, tzinfo=TIMEZONE))
+
+    # When: The scheduler runs after the slot
+    for task in await scheduler.run_once(slot):
+        await task
+
+    # Then: The new leader posts the digest, not this instance
+    bot.send_message.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_digests_in_flight_are_held_and_stop_with_the_scheduler(stub_redis_client, stub_summary):
+    # Given: A chat due a digest, whose summary takes a while
+    _store_test_messages(stub_redis_client, WHITELISTED_CHAT_ID, range(5))
+    async def slow_summary(*args, **kwargs):
+        await asyncio.sleep(60)
+
+    stub_summary.side_effect = slow_summary
+    scheduler = DigestScheduler(stub_redis_client, AsyncMock(), _config())
+    slot = scheduler.slot_for(WHITELISTED_CHAT_ID, datetime(2024, 5, 14, tzinfo=TIMEZONE))
+
+    # When: The scheduler starts the digest, and is then stopped
+    run_task = asyncio.create_task(scheduler.run())
+    started = await scheduler.run_once(slot)
+    await asyncio.sleep(0)
+    run_task.cancel()
+    await asyncio.gather(run_task, return_exceptions=True)
+    await asyncio.gather(*started, return_exceptions=True)
+
+    # Then: The scheduler held the digest until it stopped, and cancelled it
+    assert len(started) == 1
+    assert started[0].cancelled()
+    assert not scheduler._tasks
+
+
+def _config(message_threshold: int = 0) -> DigestConfig:
+    return DigestConfig(
+        enabled=True,
+        local_time=time(hour=9),
+        timezone=TIMEZONE,
+        window=timedelta(hours=1),
+        message_threshold=message_threshold
+    )
+
+
+def _store_test_messages(redis_client: FakeRedis, chat_id: int, message_ids: range):
+    for message_id in message_ids:
+        message = Message(
+            message_id=message_id,
+            content=f"Test message chat: {chat_id}, id: {message_id}",
+            owner_id=901,
+            owner_name='Unit Tester',
+            created_at=datetime.now().isoformat()
+        )
+        store_message(redis_client, chat_id, message)
+
+
+@pytest.fixture
+def stub_redis_client():
+    return FakeRedis()
+
+
+@pytest.fixture
+def stub_summary(mocker):
+    return mocker.patch('digest_scheduler.summarize_chat', return_value="- A digest")
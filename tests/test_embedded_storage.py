@@ -0,0 +1,139 @@
+import time
+
+import pytest
+from redis.exceptions import ResponseError
+
+from embedded_storage import EmbeddedRedis
+from message_storage import store_message, get_latest_n_messages, get_new_message_count
+from tests.conftest import make_message
+
+
+def test_writes_survive_a_crash(tmp_path):
+    # Given: Messages stored, and the process dies without a snapshot
+    store = EmbeddedRedis(tmp_path)
+    for message_id in range(3):
+        store_message(store, -100, make_message(message_id))
+    store.hset("hash", mapping={"a": 1})
+    store.zadd("zset", {"a": 2.5})
+
+    # When: The storage is opened again
+    reopened = EmbeddedRedis(tmp_path)
+
+    # Then: The writes are replayed from the log
+    assert [msg.message_id for msg in get_latest_n_messages(reopened, -100)] == [2, 1, 0]
+    assert get_new_message_count(reopened, -100) == 3
+    assert reopened.hgetall("hash") == {b"a": b"1"}
+    assert reopened.zrange("zset", 0, -1, withscores=True) == [(b"a", 2.5)]
+
+
+def test_snapshots_compact_the_log(tmp_path):
+    # Given: A snapshot, and writes after it
+    store = EmbeddedRedis(tmp_path)
+    store.rpush("list", "a", "b")
+    store.snapshot()
+    store.rpush("list", "c")
+    store.close()
+
+    # When: The storage is opened again
+    reopened = EmbeddedRedis(tmp_path)
+
+    # Then: Only the latest log generation is kept, and nothing is lost or applied twice
+    assert reopened.lrange("list", 0, -1) == [b"a", b"b", b"c"]
+    assert len(list(tmp_path.glob("appendonly.*.aof"))) == 1
+
+
+def test_a_crash_during_a_snapshot_is_recovered(tmp_path):
+    # Given: A crash after a new log generation started, but before its snapshot was written
+    store = EmbeddedRedis(tmp_path)
+    store.rpush("list", "a")
+    snapshot = (tmp_path / "snapshot.json").read_bytes()
+    store.snapshot()
+    store.rpush("list", "b")
+    (tmp_path / "snapshot.json").write_bytes(snapshot)
+    (tmp_path / "appendonly.1.aof").write_text('["rpush", "list", ["a"]]\n')
+
+    # When: The storage is opened again, twice
+    EmbeddedRedis(tmp_path)
+    reopened = EmbeddedRedis(tmp_path)
+
+    # Then: Both logs were replayed once
+    assert reopened.lrange("list", 0, -1) == [b"a", b"b"]
+
+
+def test_a_torn_log_line_ends_the_replay(tmp_path):
+    # Given: The process died half way through writing a line
+    store = EmbeddedRedis(tmp_path)
+    store.set("a", 1)
+    log = next(tmp_path.glob("appendonly.*.aof"))
+    with open(log, "a") as log_file:
+        log_file.write('["set", "b", "2"')
+
+    # When: The storage is opened again
+    reopened = EmbeddedRedis(tmp_path)
+
+    # Then: The writes before the torn line are kept
+    assert reopened.get("a") == b"1"
+    assert reopened.get("b") is None
+
+
+def test_keys_expire(tmp_path):
+    # Expect: Expired keys to be gone, also after a restart
+    store = EmbeddedRedis(tmp_path)
+    store.set("short", 1, px=1)
+    store.set("long", 1, ex=60)
+    time.sleep(0.01)
+
+    assert store.get("short") is None
+    assert 0 < store.ttl("long") <= 60
+    assert EmbeddedRedis(tmp_path).exists("short", "long") == 1
+
+
+def test_set_if_not_exists(tmp_path):
+    # Expect: NX to only set missing keys
+    store = EmbeddedRedis(tmp_path)
+    assert store.set("key", "a", nx=True)
+    assert store.set("key", "b", nx=True) is None
+    assert store.get("key") == b"a"
+
+
+def test_wrong_type(tmp_path):
+    # Expect: The same error as Redis
+    store = EmbeddedRedis(tmp_path)
+    store.set("key", "value")
+    with pytest.raises(ResponseError):
+        store.lpush("key", "value")
+
+
+def test_hyperloglog_estimates_distinct_values(tmp_path):
+    # Given: Two overlapping HyperLogLogs, with repeated values
+    store = EmbeddedRedis(tmp_path)
+    assert store.pfadd("first", *range(10_000))
+    assert not store.pfadd("first", 1, 2, 3)
+    store.pfadd("second", *range(5_000, 20_000))
+
+    # Expect: The counts are within a few percent, and survive a restart
+    assert abs(store.pfcount("first") - 10_000) < 500
+    reopened = EmbeddedRedis(tmp_path)
+    assert abs(reopened.pfcount("first", "second") - 20_000) < 1_000
+    assert reopened.pfcount("missing") == 0
+
+    # And: A regular string isn't a HyperLogLog
+    store.set("key", "value")
+    with pytest.raises(ResponseError):
+        store.pfcount("key")
+
+
+def test_pubsub(tmp_path):
+    # Given: A subscription
+    store = EmbeddedRedis(tmp_path)
+    pubsub = store.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe("channel")
+
+    # When: A message is published
+    receivers = store.publish("channel", "hello")
+
+    # Then: It is received
+    assert receivers == 1
+    assert pubsub.get_message(timeout=1)['data'] == b"hello"
+    pubsub.close()
+    assert store.publish("channel", "hello") == 0
@@ -0,0 +1,112 @@
+import json
+
+import pytest
+from fakeredis import FakeRedis
+
+import message_storage
+from key_migration import migrate_legacy_keys
+from message_storage import Message, store_message, get_latest_n_messages, get_new_message_count, get_all_chat_ids
+from redis_keys import digest_state_key, search_ids_key
+
+CHAT_ID = -100
+
+
+def test_migrates_legacy_messages():
+    # Given: A chat stored under its bare chat id, newest first
+    redis_client = FakeRedis()
+    for message_id in range(5):
+        redis_client.lpush(str(CHAT_ID), _serialized_message(message_id))
+
+    # When: We migrate
+    report = migrate_legacy_keys(redis_client)
+
+    # Then: The messages are under the new key, in the same order, and the bare key is gone
+    assert (report.chats, report.messages) == (1, 5)
+    assert [msg.message_id for msg in get_latest_n_messages(redis_client, CHAT_ID)] == [4, 3, 2, 1, 0]
+    assert not redis_client.exists(str(CHAT_ID))
+    assert get_all_chat_ids(redis_client) == {CHAT_ID}
+
+
+@pytest.mark.parametrize("search_enabled", [True, False])
+def test_migrated_messages_are_indexed_only_when_search_is_enabled(search_enabled, mocker):
+    # Given: A legacy chat
+    mocker.patch.object(message_storage, '_search_enabled', search_enabled)
+    redis_client = FakeRedis()
+    redis_client.lpush(str(CHAT_ID), _serialized_message(1))
+
+    # When: We migrate
+    migrate_legacy_keys(redis_client)
+
+    # Then: The message is in the search index only if search is enabled
+    assert redis_client.exists(search_ids_key(CHAT_ID)) == search_enabled
+
+
+def test_merges_messages_stored_since_the_upgrade():
+    # Given: A legacy chat that received new messages after the upgrade
+    redis_client = FakeRedis()
+    for message_id in range(3):
+        redis_client.lpush(str(CHAT_ID), _serialized_message(message_id))
+    for message_id in (3, 4):
+        store_message(redis_client, CHAT_ID, Message(**json.loads(_serialized_message(message_id))))
+
+    # When: We migrate
+    migrate_legacy_keys(redis_client)
+
+    # Then: The legacy messages are older than the new ones
+    assert [msg.message_id for msg in get_latest_n_messages(redis_client, CHAT_ID)] == [4, 3, 2, 1, 0]
+
+
+def test_rerunning_an_interrupted_migration_does_not_duplicate_messages():
+    # Given: A migration copied the messages, but was interrupted before deleting the bare key
+    redis_client = FakeRedis()
+    for message_id in range(3):
+        redis_client.lpush(str(CHAT_ID), _serialized_message(message_id))
+    migrate_legacy_keys(redis_client)
+    for message_id in range(3):
+        redis_client.lpush(str(CHAT_ID), _serialized_message(message_id))
+
+    # When: We migrate again
+    report = migrate_legacy_keys(redis_client)
+
+    # Then: Nothing was copied twice
+    assert report.messages == 0
+    assert [msg.message_id for msg in get_latest_n_messages(redis_client, CHAT_ID)] == [2, 1, 0]
+
+
+def test_migrates_counters_and_checkpoints():
+    # Given: A legacy chat with a pending count, a digest checkpoint and a cached summary
+    redis_client = FakeRedis()
+    redis_client.lpush(str(CHAT_ID), _serialized_message(1))
+    redis_client.set(f"summary:pending:{CHAT_ID}", 7)
+    redis_client.hset(f"digest:state:{CHAT_ID}", mapping={'last_message_id': 1, 'last_scheduled_date': '2024-05-14'})
+    redis_client.set(f"summary:{CHAT_ID}:paragraph:100", "{}")
+
+    # When: We migrate
+    report = migrate_legacy_keys(redis_client)
+
+    # Then: The counter and the checkpoint moved, and the cache was dropped
+    assert get_new_message_count(redis_client, CHAT_ID) == 7
+    assert redis_client.hgetall(digest_state_key(CHAT_ID)) == {b'last_message_id': b'1',
+                                                             b'last_scheduled_date': b'2024-05-14'}
+    assert report.deleted_caches == 1
+    assert redis_client.keys("summary:*") == []
+    assert redis_client.keys("digest:*") == []
+
+
+@pytest.mark.parametrize("key", ["12345", "-100"])
+def test_skips_bare_keys_that_are_not_chats(key):
+    # Given: A bare numeric key that isn't a message list
+    redis_client = FakeRedis()
+    redis_client.set(key, "not a chat")
+
+    # When: We migrate
+    report = migrate_legacy_keys(redis_client)
+
+    # Then: It is left alone
+    assert report.chats == 0
+    assert redis_client.get(key) == b"not a chat"
+
+
+def _serialized_message(message_id: int) -> str:
+    return json.dumps({'message_id': message_id, 'content': f"message {message_id}", 'owner_id': 1,
+                       'owner_name': 'Alice', 'created_at': '2024-05-14T12:00:00'})
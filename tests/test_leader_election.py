@@ -0,0 +1,199 @@
+import asyncio
+from unittest.mock import Mock
+
+import pytest
+from fakeredis import FakeRedis
+from redis.cluster import RedisCluster
+
+import leader_election
+from leader_election import LeaderLease, LeaderElection, holds_leadership
+from redis_keys import leader_lease_key
+
+
+def test_only_one_instance_holds_the_lease(redis_client):
+    # Given: Two instances
+    first = LeaderLease(redis_client, ttl_seconds=10, instance_id="first")
+    second = LeaderLease(redis_client, ttl_seconds=10, instance_id="second")
+
+    # When: Both try to take the lease
+    first_token = first.try_acquire()
+    second_token = second.try_acquire()
+
+    # Then: Only the first one gets it
+    assert first_token == 1
+    assert second_token is None
+    assert first.renew()
+    assert not second.renew()
+
+
+def test_released_lease_is_taken_with_a_higher_fencing_token(redis_client):
+    # Given: A leader
+    first = LeaderLease(redis_client, ttl_seconds=10, instance_id="first")
+    second = LeaderLease(redis_client, ttl_seconds=10, instance_id="second")
+    first_token = first.try_acquire()
+
+    # When: It releases the lease
+    first.release()
+
+    # Then: The standby takes it, with a higher token
+    second_token = second.try_acquire()
+    assert second_token > first_token
+
+    # And: The old token isn't current anymore
+    assert not second.is_current(first_token)
+    assert second.is_current(second_token)
+
+
+def test_lost_lease_cant_be_renewed_or_released(redis_client):
+    # Given: A leader whose lease expired and was taken by another instance
+    first = LeaderLease(redis_client, ttl_seconds=10, instance_id="first")
+    second = LeaderLease(redis_client, ttl_seconds=10, instance_id="second")
+    first.try_acquire()
+    redis_client.delete(leader_lease_key("bot"))
+    second.try_acquire()
+
+    # When: The old leader tries to release the lease
+    first.release()
+
+    # Then: The new leader still holds it
+    assert second.renew()
+    assert not first.renew()
+    assert first.fencing_token is None
+
+
+def test_renewed_lease_is_extended(redis_client):
+    # Given: A leader with a short lease
+    lease = LeaderLease(redis_client, ttl_seconds=1, instance_id="first")
+    lease.try_acquire()
+    redis_client.pexpire(leader_lease_key("bot"), 100)
+
+    # When: It renews the lease
+    assert lease.renew()
+
+    # Then: The lease lasts for its full TTL again
+    assert redis_client.ttl(leader_lease_key("bot")) == 1
+
+
+def test_lease_on_a_cluster_without_transactions():
+    # Given: Two instances on a Redis Cluster, which has no WATCH
+    redis_client = FakeRedis()
+    cluster = _cluster(redis_client)
+    first = LeaderLease(cluster, ttl_seconds=10, instance_id="first")
+    second = LeaderLease(cluster, ttl_seconds=10, instance_id="second")
+
+    # When: Both try to take the lease, and the leader hands it over
+    first_token = first.try_acquire()
+    assert second.try_acquire() is None
+    assert first.renew() and not second.renew()
+    first.release()
+    second_token = second.try_acquire()
+
+    # Then: The lease goes from one to the other, with a higher token, without a transaction
+    assert second_token > first_token
+    assert not first.renew()
+    assert second.is_current(second_token)
+    assert 0 < redis_client.pttl(leader_lease_key("bot")) <= 10_000
+    cluster.transaction.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_standby_takes_over_when_the_leader_steps_down():
+    # Given: Two instances taking part in the election
+    redis_client = FakeRedis()
+    leading = []
+
+    def start(name: str) -> tuple[LeaderElection, asyncio.Task]:
+        election = LeaderElection(LeaderLease(redis_client, ttl_seconds=1, instance_id=name), 0.01)
+
+        async def lead(fencing_token: int):
+            leading.append((name, fencing_token))
+            await asyncio.Event().wait()
+
+        return election, asyncio.create_task(election.run(lead))
+
+    first, first_task = start("first")
+    await asyncio.sleep(0.05)
+    second, second_task = start("second")
+    await asyncio.sleep(0.05)
+
+    # Then: Only the first one leads
+    assert first.is_leader and not second.is_leader
+    assert leading == [("first", 1)]
+
+    # When: The leader is shut down
+    first_task.cancel()
+    await asyncio.gather(first_task, return_exceptions=True)
+    await asyncio.sleep(0.05)
+
+    # Then: The standby takes over right away, with the next token
+    assert second.is_leader
+    assert leading == [("first", 1), ("second", 2)]
+
+    second_task.cancel()
+    await asyncio.gather(second_task, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_leader_steps_down_when_the_lease_is_lost():
+    # Given: A leader
+    redis_client = FakeRedis()
+    election = LeaderElection(LeaderLease(redis_client, ttl_seconds=1, instance_id="first"), 0.01)
+    stopped = asyncio.Event()
+
+    async def lead(fencing_token: int):
+        try:
+            await asyncio.Event().wait()
+        finally:
+            stopped.set()
+
+    task = asyncio.create_task(election.run(lead))
+    await asyncio.sleep(0.05)
+    assert election.is_leader
+
+    # When: Another instance takes the lease
+    redis_client.set(leader_lease_key("bot"), b"9:intruder")
+    await asyncio.sleep(0.05)
+
+    # Then: The jobs are stopped
+    assert stopped.is_set()
+    assert not election.is_leader
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+def test_holds_leadership_checks_the_fencing_token(mocker):
+    # Given: A leader
+    redis_client = FakeRedis()
+    election = LeaderElection(LeaderLease(redis_client, ttl_seconds=10, instance_id="first"), 1)
+    election.lease.try_acquire()
+    mocker.patch.object(leader_election, '_leader_election', election)
+    assert holds_leadership()
+
+    # When: Its lease is taken over while it was paused
+    redis_client.set(leader_lease_key("bot"), b"2:second")
+
+    # Then: It doesn't lead anymore
+    assert not holds_leadership()
+
+
+def test_holds_leadership_without_an_election(mocker):
+    # Expect: A single instance always leads
+    mocker.patch.object(leader_election, '_leader_election', None)
+    assert holds_leadership()
+
+
+def _cluster(redis_client: FakeRedis) -> Mock:
+    # FakeRedis has no Lua, so the scripts run in Python, with the same compare-and-set
+    def register_script(source: str):
+        def run(keys, args):
+            if redis_client.get(keys[0]) != args[0]:
+                return 0
+            return redis_client.pexpire(keys[0], args[1]) if "pexpire" in source else redis_client.delete(keys[0])
+        return run
+
+    cluster = Mock(spec=RedisCluster)
+    cluster.register_script.side_effect = register_script
+    for command in ("exists", "incr", "set", "get"):
+        setattr(cluster, command, getattr(redis_client, command))
+    return cluster
@@ -0,0 +1,107 @@
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+import pytest
+
+import llm_backends
+from llm_backends import (
+    BackendSelection,
+    ExtractiveBackend,
+    OpenAIBackend,
+    SummaryStyle,
+    configure_backends,
+    register_backend,
+    select_backends,
+    summarize_with_backends
+)
+from openai_utils import ModelRouter, ModelTier
+from tests.conftest import make_message
+
+
+def test_extractive_backend_keeps_informative_messages_in_order():
+    # Given: A chat about a trip, with some noise
+    contents = [
+        "lol", "trip to the beach on saturday", "ok", "who is driving to the beach trip",
+        "😂", "beach trip leaves at noon saturday", "yeah"
+    ]
+    messages = [make_message(index, content) for index, content in enumerate(contents)]
+
+    # When: We summarize them as bullet points
+    summary = ExtractiveBackend(min_sentences=3).summarize(messages, SummaryStyle.BULLET_POINTS)
+
+    # Then: The messages about the trip are kept, oldest first
+    assert summary.text.splitlines() == [
+        "- Alice: trip to the beach on saturday",
+        "- Alice: who is driving to the beach trip",
+        "- Alice: beach trip leaves at noon saturday",
+    ]
+    assert summary.backend == "extractive"
+
+
+def test_select_backends_for_chat_override():
+    # Given: A chat that is served by the extractive backend
+    configure_backends(BackendSelection(primary="openai", fallback=None, chat_overrides={-100: "extractive"}))
+
+    # Expect: Only that chat to use it
+    assert [backend.name for backend in select_backends(-100, 50)] == ["extractive"]
+    assert [backend.name for backend in select_backends(-200, 50)] == ["openai"]
+
+
+def test_select_backends_for_small_windows():
+    # Given: Windows of up to 10 messages are served locally
+    configure_backends(BackendSelection(primary="openai", fallback="extractive", local_max_messages=10))
+
+    # Expect: The fallback backend for small windows only
+    assert [backend.name for backend in select_backends(-100, 10)] == ["extractive"]
+    assert [backend.name for backend in select_backends(-100, 11)] == ["openai", "extractive"]
+
+
+def test_summarize_with_backends_falls_back_on_failure():
+    # Given: The primary backend is failing
+    configure_backends(BackendSelection(primary="failing", fallback="extractive"))
+    failing_backend = Mock()
+    failing_backend.name = "failing"
+    failing_backend.summarize.side_effect = TimeoutError
+    register_backend(failing_backend)
+
+    # When: We summarize
+    summary = summarize_with_backends(-100, [make_message(1, "dinner plans for friday night")], SummaryStyle.PARAGRAPH)
+
+    # Then: The fallback backend wrote the summary
+    assert summary.backend == "extractive"
+    assert summary.text == "Alice said: dinner plans for friday night."
+
+
+def test_openai_backend_shortens_the_window_while_degraded(mocker):
+    # Given: A router whose completions are breaching the latency SLO
+    router = ModelRouter(
+        tiers=[ModelTier("fast", "gpt-fast", max_tokens=300, timeout_seconds=20, max_prompt_tokens=50)],
+        latency_slo_seconds=10,
+        max_in_flight=8,
+    )
+    router._latencies.extend([12.0] * 20)
+    client = Mock()
+    client.chat.completions.create.return_value = SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content="A summary"))],
+        usage=None
+    )
+    mocker.patch("llm_backends.get_ai_client", return_value=client)
+    messages = [make_message(index, f"message number {index} about the weekend") for index in range(10)]
+
+    # When: We summarize
+    summary = OpenAIBackend("gpt-fast", router=router).summarize(messages, SummaryStyle.PARAGRAPH)
+
+    # Then: Only the latest messages are sent, with the tier's limits
+    assert summary.text == "A summary"
+    kwargs = client.chat.completions.create.call_args.kwargs
+    user_content = kwargs['messages'][1]['content']
+    assert "message number 9 " in user_content
+    assert "message number 0 " not in user_content
+    assert (kwargs['model'], kwargs['max_tokens'], kwargs['timeout']) == ("gpt-fast", 300, 20)
+
+
+@pytest.fixture(autouse=True)
+def reset_backends():
+    yield
+    llm_backends._backends.clear()
+    llm_backends._selection = BackendSelection()
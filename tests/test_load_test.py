@@ -0,0 +1,56 @@
+from collections import Counter
+
+import pytest
+from fakeredis import FakeRedis
+
+import telegram_bot
+from load_test import LoadTestConfig, LoadTestReport, run_load_test
+
+
+@pytest.mark.asyncio
+async def test_run_load_test_reports_every_update():
+    # Given: A small burst of traffic with fast stubs
+    config = LoadTestConfig(
+        chats=5,
+        messages_per_second=200,
+        duration_seconds=0.5,
+        command_ratio=0.1,
+        bot_latency_ms=1,
+        openai_latency_ms=1
+    )
+    original_is_whitelisted = telegram_bot.is_whitelisted
+
+    # When: We replay it
+    report = await run_load_test(config, FakeRedis())
+
+    # Then: Every update was handled and measured
+    handled = sum(len(samples) for samples in report.handler_latencies_ms.values())
+    assert report.updates_sent == 100
+    assert handled == report.updates_sent
+
+    # And: The storage traffic was counted
+    assert report.redis_ops['LPUSH'] == len(report.handler_latencies_ms['listen_for_messages_handler'])
+
+    # And: The module level patches were undone
+    assert telegram_bot.is_whitelisted is original_is_whitelisted
+
+
+def test_report_format_includes_latency_percentiles():
+    # Given: A report for one handler
+    report = LoadTestReport(
+        updates_sent=10,
+        elapsed_seconds=1.0,
+        handler_latencies_ms={'gist_handler': [float(ms) for ms in range(1, 11)], 'help_handler': []},
+        loop_lag_ms=[1.0, 2.0],
+        redis_ops=Counter({'LPUSH': 3}),
+        bot_api_calls=Counter({'sendMessage': 1}),
+        openai_calls=1
+    )
+
+    # When: We format it
+    formatted = report.format()
+
+    # Then: It contains the handler stats and skips handlers without samples
+    assert 'gist_handler' in formatted
+    assert 'help_handler' not in formatted
+    assert 'Redis ops: 3' in formatted
@@ -0,0 +1,143 @@
+import json
+
+import pytest
+from fakeredis import FakeRedis
+
+import message_storage
+from message_archive import ArchiveConfig, MessageArchiver, SegmentReader, SegmentWriter
+from message_storage import Message, store_message, store_history, get_latest_n_messages, MAX_MESSAGE_STORAGE
+from redis_keys import archive_queue_key
+
+CHAT_ID = -100
+
+
+def test_archived_messages_are_read_back(tmp_path):
+    # Given: Messages from two days written to the archive
+    writer = SegmentWriter(tmp_path, use_zstd=False)
+    writer.append(CHAT_ID, [_serialized_message(1, "2024-05-14T23:59:00"), _serialized_message(2, "2024-05-15T08:00:00")])
+    writer.append(CHAT_ID, [_serialized_message(3, "2024-05-15T09:00:00")])
+
+    # When: We read the archive
+    reader = SegmentReader(tmp_path)
+
+    # Then: Each day has its own segment, and the messages come back oldest first
+    assert reader.chat_ids() == [CHAT_ID]
+    assert reader.days(CHAT_ID) == ["2024-05-14", "2024-05-15"]
+    assert [message.message_id for message in reader.read_messages(CHAT_ID)] == [1, 2, 3]
+    assert [message.message_id for message in reader.read_messages(CHAT_ID, start_day="2024-05-15")] == [2, 3]
+    assert [message.message_id for message in reader.read_messages(CHAT_ID, end_day="2024-05-14")] == [1]
+
+
+def test_messages_are_partitioned_by_utc_day(tmp_path):
+    # Expect: A message sent late in a UTC+ timezone to be archived under its UTC day
+    SegmentWriter(tmp_path, use_zstd=False).append(CHAT_ID, [_serialized_message(1, "2024-05-15T01:00:00+02:00")])
+
+    assert SegmentReader(tmp_path).days(CHAT_ID) == ["2024-05-14"]
+
+
+def test_a_torn_frame_ends_the_segment(tmp_path):
+    # Given: A crash tore the last frame of a segment
+    writer = SegmentWriter(tmp_path, use_zstd=False)
+    writer.append(CHAT_ID, [_serialized_message(1)])
+    writer.append(CHAT_ID, [_serialized_message(2)])
+    segment = tmp_path / str(CHAT_ID) / "2024-05-14.seg"
+    segment.write_bytes(segment.read_bytes()[:-3])
+
+    # When: We read the archive
+    messages = list(SegmentReader(tmp_path).read_messages(CHAT_ID))
+
+    # Then: The frames before it are read
+    assert [message.message_id for message in messages] == [1]
+
+
+@pytest.mark.parametrize("use_zstd", [False, True])
+def test_codecs(tmp_path, use_zstd):
+    if use_zstd:
+        pytest.importorskip("zstandard")
+
+    # Expect: The messages to survive compression
+    SegmentWriter(tmp_path, use_zstd=use_zstd).append(CHAT_ID, [_serialized_message(1, content="héllo 👋")])
+
+    assert [message.content for message in SegmentReader(tmp_path).read_messages(CHAT_ID)] == ["héllo 👋"]
+
+
+def test_archiver_drains_the_queue(tmp_path, mocker):
+    # Given: Archiving is enabled, and the chat has more messages than Redis keeps
+    mocker.patch.object(message_storage, '_archive_enabled', True)
+    redis_client = FakeRedis()
+    for message_id in range(MAX_MESSAGE_STORAGE + 50):
+        store_message(redis_client, CHAT_ID, Message(**json.loads(_serialized_message(message_id))))
+    archiver = MessageArchiver(redis_client, SegmentWriter(tmp_path, use_zstd=False),
+                               ArchiveConfig(enabled=True, directory=tmp_path, batch_size=100))
+
+    # When: The archiver runs
+    archived = archiver.run_once()
+
+    # Then: Every message is archived, including the ones trimmed from Redis, and the queue is empty
+    assert archived == MAX_MESSAGE_STORAGE + 50
+    assert len(get_latest_n_messages(redis_client, CHAT_ID, MAX_MESSAGE_STORAGE + 50)) == MAX_MESSAGE_STORAGE
+    archived_ids = [message.message_id for message in SegmentReader(tmp_path).read_messages(CHAT_ID)]
+    assert archived_ids == list(range(MAX_MESSAGE_STORAGE + 50))
+    assert redis_client.llen(archive_queue_key(CHAT_ID)) == 0
+
+
+def test_archiver_keeps_the_batch_if_the_write_fails(tmp_path, mocker):
+    # Given: The disk is failing
+    mocker.patch.object(message_storage, '_archive_enabled', True)
+    redis_client = FakeRedis()
+    store_message(redis_client, CHAT_ID, Message(**json.loads(_serialized_message(1))))
+    writer = SegmentWriter(tmp_path, use_zstd=False)
+    mocker.patch.object(writer, 'append', side_effect=OSError("disk full"))
+    archiver = MessageArchiver(redis_client, writer, ArchiveConfig(enabled=True, directory=tmp_path))
+
+    # When: The archiver runs
+    with pytest.raises(OSError):
+        archiver.run_once()
+
+    # Then: The message is still queued for the next run
+    assert redis_client.llen(archive_queue_key(CHAT_ID)) == 1
+
+
+def test_history_queued_while_a_batch_is_written_is_archived_once(redis_client, tmp_path, mocker):
+    # Given: A queued message, and history imported while the archiver writes it
+    mocker.patch.object(message_storage, '_archive_enabled', True)
+    store_message(redis_client, CHAT_ID, Message(**json.loads(_serialized_message(10))))
+    writer = SegmentWriter(tmp_path, use_zstd=False)
+    append = writer.append
+
+    def append_during_an_import(chat_id, batch):
+        if not redis_client.llen(archive_queue_key(CHAT_ID)):
+            store_history(redis_client, CHAT_ID, [Message(**json.loads(_serialized_message(message_id)))
+                                                  for message_id in (2, 1)])
+        return append(chat_id, batch)
+
+    mocker.patch.object(writer, 'append', side_effect=append_during_an_import)
+    archiver = MessageArchiver(redis_client, writer, ArchiveConfig(enabled=True, directory=tmp_path))
+
+    # When: The archiver runs
+    archived = archiver.run_once()
+
+    # Then: Every message is archived once, and read back oldest first
+    assert archived == 3
+    assert [message.message_id for message in SegmentReader(tmp_path).read_messages(CHAT_ID)] == [1, 2, 10]
+    assert redis_client.llen(archive_queue_key(CHAT_ID)) == 0
+
+
+def test_the_queue_is_bounded_while_nothing_archives(mocker):
+    # Given: Archiving is enabled, but no archiver drains the queue
+    mocker.patch.object(message_storage, '_archive_enabled', True)
+    mocker.patch.object(message_storage, '_archive_max_queued', 5)
+    redis_client = FakeRedis()
+
+    # When: More messages arrive than the queue holds
+    for message_id in range(8):
+        store_message(redis_client, CHAT_ID, Message(**json.loads(_serialized_message(message_id))))
+
+    # Then: Only the latest ones are kept for the archiver
+    queued = [json.loads(message)['message_id'] for message in redis_client.lrange(archive_queue_key(CHAT_ID), 0, -1)]
+    assert queued == [3, 4, 5, 6, 7]
+
+
+def _serialized_message(message_id: int, created_at: str = "2024-05-14T12:00:00", content: str = "") -> bytes:
+    return json.dumps({'message_id': message_id, 'content': content or f"message {message_id}", 'owner_id': 1,
+                       'owner_name': 'Alice', 'created_at': created_at}).encode('utf-8')
@@ -0,0 +1,127 @@
+import time
+
+import pytest
+
+from message_filter import prune_messages
+from tests.conftest import make_message
+
+
+@pytest.mark.parametrize("content", ["lol", "LOOOL", "hahahaha", "😂😂", "ok", "k", "??", "Lmaooo!!"])
+def test_low_information_messages_are_dropped(content):
+    # Given: A filler message between two real ones
+    messages = [
+        make_message(1, owner_name="Alice", content="Are we still on for dinner?"),
+        make_message(2, owner_name="Bob", content=content),
+        make_message(3, owner_name="Charlie", content="Yes, 8pm at the usual place")
+    ]
+
+    # When: We prune them
+    pruned, stats = prune_messages(messages)
+
+    # Then: Only the filler is dropped
+    assert [msg.message_id for msg in pruned] == [1, 3]
+    assert stats.dropped_low_information == 1
+
+
+def test_near_identical_messages_are_dropped():
+    # Given: Alice shares the same link twice with different tracking parameters, and Bob repeats his question
+    messages = [
+        make_message(1, owner_name="Alice", content="https://example.com/article?utm_source=whatsapp"),
+        make_message(2, owner_name="Bob", content="Did anyone read it?"),
+        make_message(3, owner_name="Alice", content="https://example.com/article?utm_source=telegram"),
+        make_message(4, owner_name="Bob", content="did anyone read it??")
+    ]
+
+    # When: We prune them
+    pruned, stats = prune_messages(messages)
+
+    # Then: Only the first of each is kept
+    assert [msg.message_id for msg in pruned] == [1, 2]
+    assert stats.dropped_duplicates == 2
+
+
+def test_links_with_different_parameters_are_kept():
+    # Given: Links to different videos, one of them shared twice
+    messages = [
+        make_message(1, owner_name="Alice", content="https://youtube.com/watch?v=a&si=abc"),
+        make_message(2, owner_name="Bob", content="https://youtube.com/watch?v=b"),
+        make_message(3, owner_name="Alice", content="https://youtube.com/watch?v=a&si=xyz"),
+        make_message(4, owner_name="Alice", content="https://example.com/item?id=1"),
+        make_message(5, owner_name="Bob", content="https://example.com/item?id=2&utm_source=telegram")
+    ]
+
+    # When: We prune them
+    pruned, stats = prune_messages(messages)
+
+    # Then: Only the repeated video is dropped
+    assert [msg.message_id for msg in pruned] == [1, 2, 4, 5]
+    assert stats.dropped_duplicates == 1
+
+
+def test_the_same_message_from_different_senders_is_kept():
+    # Given: Two senders send the same message, and the same short answer is given to two questions
+    messages = [
+        make_message(1, owner_name="Alice", content="Who's coming on Saturday?"),
+        make_message(2, owner_name="Bob", content="I'm in"),
+        make_message(3, owner_name="Charlie", content="I'm in"),
+        make_message(4, owner_name="Alice", content="Can you bring drinks Bob?"),
+        make_message(5, owner_name="Bob", content="yes"),
+        make_message(6, owner_name="Alice", content="And the speaker?"),
+        make_message(7, owner_name="Bob", content="Yes")
+    ]
+
+    # When: We prune them
+    pruned, stats = prune_messages(messages)
+
+    # Then: Nothing is dropped
+    assert [msg.message_id for msg in pruned] == [1, 2, 3, 4, 5, 6, 7]
+    assert stats.dropped_duplicates == stats.dropped_low_information == 0
+
+
+def test_consecutive_messages_from_the_same_sender_are_collapsed():
+    # Given: Alice sends 3 messages in a row
+    messages = [
+        make_message(1, owner_name="Alice", content="Guess what"),
+        make_message(2, owner_name="Alice", content="I got the job!"),
+        make_message(3, owner_name="Alice", content="Starting Monday"),
+        make_message(4, owner_name="Bob", content="Congrats, that's great news")
+    ]
+
+    # When: We prune them
+    pruned, stats = prune_messages(messages)
+
+    # Then: They become one message
+    assert [msg.content for msg in pruned] == [
+        "Guess what. I got the job! Starting Monday",
+        "Congrats, that's great news"
+    ]
+    assert stats.collapsed == 2
+    assert stats.tokens_saved > 0
+
+
+def test_nothing_worth_keeping_keeps_everything():
+    # Given: Only filler
+    messages = [make_message(1, owner_name="Alice", content="lol"), make_message(2, owner_name="Bob", content="😂")]
+
+    # When: We prune them
+    pruned, _ = prune_messages(messages)
+
+    # Then: They are kept as they are
+    assert pruned == messages
+
+
+def test_prune_is_fast_enough_for_every_request():
+    # Given: A full window of messages
+    messages = [
+        make_message(index, owner_name=f"User {index % 7}",
+                     content=f"message number {index} about the weekend trip https://x.com/{index}")
+        for index in range(200)
+    ]
+
+    # When: We prune them
+    started = time.perf_counter()
+    prune_messages(messages)
+    elapsed = time.perf_counter() - started
+
+    # Then: It takes a few milliseconds at most
+    assert elapsed < 0.05
@@ -4,16 +4,29 @@ from unittest.mock import Mock
 import pytest
 from fakeredis import FakeRedis
 
+
+import message_storage
 from message_storage import (
     Message,
     store_message,
     chat_exists,
     get_latest_n_messages,
-    configure_message_storage, MAX_MESSAGE_STORAGE, get_all_chat_ids
+    configure_message_storage, MAX_MESSAGE_STORAGE, get_all_chat_ids,
+    get_nth_latest_message,
+    edit_message,
+    forget_message,
+    iter_chat_messages,
+    search_messages,
+    get_thread_messages
 )
+from redis.crc import key_slot
+
+from redis_keys import summary_cache_key, chat_messages_key, pending_messages_key, digest_state_key
+from tests.conftest import make_message
+from window_cache import WindowCache
 
 
-def test_store_message(stub_redis_client):
+def test_store_message(redis_client):
     # Given: There are no messages for the chat
     chat_id = -100
 
@@ -27,28 +40,28 @@ def test_store_message(stub_redis_client):
     )
 
     # When: We store a message
-    result = store_message(stub_redis_client, chat_id, message)
+    result = store_message(redis_client, chat_id, message)
 
     # Then: The chat should have 1 message
     assert result == 1
 
 
-def test_store_message_does_not_bleed_into_other_chat(stub_redis_client):
+def test_store_message_does_not_bleed_into_other_chat(redis_client):
     # Given: There is 1 message in Chat A
     chat_a_id = -100
     message_a_1_id = 150
     message_a_1_content = f"Test message chat: {chat_a_id}, id: {message_a_1_id}"
-    message_a_1, _ = _create_test_message(stub_redis_client, chat_a_id, message_a_1_id, content=message_a_1_content)
+    message_a_1, _ = _create_test_message(redis_client, chat_a_id, message_a_1_id, content=message_a_1_content)
 
     # And: There are 2 messages in Chat B
     chat_b_id = -200
     message_b_1_id = 250
     message_b_1_content = f"Test message chat: {chat_b_id}, id: {message_b_1_id}"
-    message_b_1, _ = _create_test_message(stub_redis_client, chat_b_id, message_b_1_id, content=message_b_1_content)
+    message_b_1, _ = _create_test_message(redis_client, chat_b_id, message_b_1_id, content=message_b_1_content)
 
     message_b_2_id = 251
     message_b_2_content = f"Test message chat: {chat_b_id}, id: {message_b_2_id}"
-    message_b_2, _ = _create_test_message(stub_redis_client, chat_b_id, message_b_2_id, content=message_b_2_content)
+    message_b_2, _ = _create_test_message(redis_client, chat_b_id, message_b_2_id, content=message_b_2_content)
 
     # When: We store another message in Chat B
     message_b_3_id = message_b_2_id + 1
@@ -59,7 +72,7 @@ def test_store_message_does_not_bleed_into_other_chat(stub_redis_client):
         owner_name='Unit Tester',
         created_at=datetime.now().isoformat()
     )
-    result = store_message(stub_redis_client, chat_b_id, last_message)
+    result = store_message(redis_client, chat_b_id, last_message)
 
     # Then: Chat B should have 3 messages
     assert result == 3
@@ -67,11 +80,11 @@ def test_store_message_does_not_bleed_into_other_chat(stub_redis_client):
     # of messages for the chat. Hence, Chat B should have 3.
 
 
-def test_store_message_only_keeps_latest_messages(stub_redis_client):
+def test_store_message_only_keeps_latest_messages(redis_client):
     # Given: There are maximum messages for the chat
     chat_id = -100
     messages_and_count: list[tuple[Message, int]] = [
-        _create_test_message(stub_redis_client, chat_id, msg_id, content=f"Test message chat: {chat_id}, id: {msg_id}")
+        _create_test_message(redis_client, chat_id, msg_id, content=f"Test message chat: {chat_id}, id: {msg_id}")
         for msg_id in range(MAX_MESSAGE_STORAGE + 1)
     ]
 
@@ -84,47 +97,47 @@ def test_store_message_only_keeps_latest_messages(stub_redis_client):
         owner_name='Unit Tester',
         created_at=datetime.now().isoformat()
     )
-    result = store_message(stub_redis_client, chat_id, next_message)
+    result = store_message(redis_client, chat_id, next_message)
 
     # Then: The chat should have maximum messages
     assert result == MAX_MESSAGE_STORAGE
 
 
-def test_chat_exists(stub_redis_client):
+def test_chat_exists(redis_client):
     # Given: We have a message for a chat
     chat_id = -100
     message_id = 150
     content = f"Test message chat: {chat_id}, id: {message_id}"
-    message, _ = _create_test_message(stub_redis_client, chat_id, message_id, content=content)
+    message, _ = _create_test_message(redis_client, chat_id, message_id, content=content)
 
     # When: We check if the chat exists
-    exists = chat_exists(stub_redis_client, chat_id)
+    exists = chat_exists(redis_client, chat_id)
 
     # Then: It should be true
     assert exists
 
 
-def test_chat_does_not_exist(stub_redis_client):
+def test_chat_does_not_exist(redis_client):
     # Given: The chat doesn't exist
     non_existent_chat_id = -999
 
     # When: We check if the chat exists
-    exists = chat_exists(stub_redis_client, non_existent_chat_id)
+    exists = chat_exists(redis_client, non_existent_chat_id)
 
     # Then: It should be False
     assert not exists
 
 
-def test_get_latest_n_messages(stub_redis_client):
+def test_get_latest_n_messages(redis_client):
     # Given: We have 10 messages
     chat_id = -100
     created_messages_and_count: list[tuple[Message, int]] = [
-        _create_test_message(stub_redis_client, chat_id, msg_id, content=f"Test message chat: {chat_id}, id: {msg_id}")
+        _create_test_message(redis_client, chat_id, msg_id, content=f"Test message chat: {chat_id}, id: {msg_id}")
         for msg_id in range(10)
     ]
 
     # When: We get 5 messages
-    latest_messages = get_latest_n_messages(stub_redis_client, chat_id, 5)
+    latest_messages = get_latest_n_messages(redis_client, chat_id, 5)
 
     # Then: It should be the latest 5
     # Last created message will be the 1st index
@@ -132,37 +145,37 @@ def test_get_latest_n_messages(stub_redis_client):
     assert latest_messages[0].content == created_messages_and_count[-1][0].content
 
 
-def test_get_latest_n_messages_for_non_existent_chat(stub_redis_client):
+def test_get_latest_n_messages_for_non_existent_chat(redis_client):
     # Given: The chat doesn't exist
     non_existent_chat_id = -999
 
     # When: We get 5 messages
-    latest_messages = get_latest_n_messages(stub_redis_client, non_existent_chat_id, 5)
+    latest_messages = get_latest_n_messages(redis_client, non_existent_chat_id, 5)
 
     # Then: It should be 0
     assert len(latest_messages) == 0
 
 
 @pytest.mark.parametrize("num_of_msgs", [0, -1])
-def test_get_latest_n_messages_when_n_is_invalid(stub_redis_client, num_of_msgs):
+def test_get_latest_n_messages_when_n_is_invalid(redis_client, num_of_msgs):
     # Given: We have 10 messages
     chat_id = -100
     for msg_id in range(10):
-        _create_test_message(stub_redis_client, chat_id, msg_id, content=f"Test message chat: {chat_id}, id: {msg_id}")
+        _create_test_message(redis_client, chat_id, msg_id, content=f"Test message chat: {chat_id}, id: {msg_id}")
 
     # When: We get an invalid number of messages
-    latest_messages = get_latest_n_messages(stub_redis_client, chat_id, num_of_msgs)
+    latest_messages = get_latest_n_messages(redis_client, chat_id, num_of_msgs)
 
     # Then: It should be an empty list
     assert len(latest_messages) == 0
 
 
-def test_get_all_chat_ids(stub_redis_client):
+def test_get_all_chat_ids(redis_client):
     # Given: We have messages in multiple chats
     number_of_messages_to_create = range(1, 5)
     for index in number_of_messages_to_create:
         _create_test_message(
-            stub_redis_client,
+            redis_client,
             chat_id=index * -1,  # Group chats are negative numbers
             message_id=100 + index,
             owner_id=200 + index,
@@ -170,13 +183,174 @@ def test_get_all_chat_ids(stub_redis_client):
         )
 
     # When: We get all the chats ids
-    chat_ids = get_all_chat_ids(stub_redis_client)
+    chat_ids = get_all_chat_ids(redis_client)
 
     # Then: It should return the correct amount
     assert len(chat_ids) == len(number_of_messages_to_create)
     assert chat_ids == {num * -1 for num in number_of_messages_to_create}
 
 
+def test_get_all_chat_ids_skips_other_keys(redis_client):
+    # Given: There is a chat, with other keys in its hash slot
+    _create_test_message(redis_client, chat_id=-100, message_id=1)
+    redis_client.set(summary_cache_key(-100, "paragraph", 100), "{}")
+
+    # When: We get all the chats ids
+    chat_ids = get_all_chat_ids(redis_client)
+
+    # Then: Only the chat is returned
+    assert chat_ids == {-100}
+
+
+def test_get_nth_latest_message(redis_client):
+    # Given: We have 10 messages
+    chat_id = -100
+    for msg_id in range(10):
+        _create_test_message(redis_client, chat_id, msg_id, content=f"Test message chat: {chat_id}, id: {msg_id}")
+
+    # Expect: To count back from the latest message
+    assert get_nth_latest_message(redis_client, chat_id).message_id == 9
+    assert get_nth_latest_message(redis_client, chat_id, 3).message_id == 6
+    assert get_nth_latest_message(redis_client, chat_id, 10) is None
+
+
+def test_edited_message_replaces_the_stored_one(redis_client):
+    # Given: We have 5 messages
+    chat_id = -100
+    for msg_id in range(5):
+        _create_test_message(redis_client, chat_id, msg_id, content=f"Original message {msg_id}")
+
+    # When: One of them is edited
+    edited = Message(message_id=2, content="Edited message", owner_id=901, owner_name='Unit Tester',
+                     created_at=datetime.now().isoformat())
+    assert edit_message(redis_client, chat_id, edited)
+
+    # Then: The latest messages have the edited content, in the same place
+    contents = [message.content for message in get_latest_n_messages(redis_client, chat_id, 5)]
+    assert contents == ["Original message 4", "Original message 3", "Edited message",
+                        "Original message 1", "Original message 0"]
+
+    # And: So does the export
+    assert [message.content for message in iter_chat_messages(redis_client, chat_id)] == contents
+
+    # And: The search finds the new content, not the old one
+    assert [message.message_id for message in search_messages(redis_client, chat_id, "edited")] == [2]
+    assert [message.message_id for message in search_messages(redis_client, chat_id, "original")] == [4, 3, 1, 0]
+
+
+def test_forgotten_message_is_left_out(redis_client):
+    # Given: We have 5 messages
+    chat_id = -100
+    for msg_id in range(5):
+        _create_test_message(redis_client, chat_id, msg_id, content=f"Secret message {msg_id}")
+
+    # When: One of them is forgotten
+    assert forget_message(redis_client, chat_id, 3)
+
+    # Then: It isn't returned anymore
+    assert [message.message_id for message in get_latest_n_messages(redis_client, chat_id, 5)] == [4, 2, 1, 0]
+    assert [message.message_id for message in iter_chat_messages(redis_client, chat_id)] == [4, 2, 1, 0]
+    assert 3 not in [message.message_id for message in search_messages(redis_client, chat_id, "secret")]
+
+
+def test_revising_an_unknown_message(redis_client):
+    # Given: We have messages 10 to 14
+    chat_id = -100
+    for msg_id in range(10, 15):
+        _create_test_message(redis_client, chat_id, msg_id)
+
+    # Expect: Messages that aren't stored can't be revised
+    assert not forget_message(redis_client, chat_id, 20)
+    assert not forget_message(redis_client, -999, 1)
+
+
+def test_edits_invalidate_the_cached_window(redis_client, mocker):
+    # Given: A chat whose window is cached
+    cache = WindowCache(max_bytes=1024 * 1024, ttl_seconds=60, max_messages=MAX_MESSAGE_STORAGE)
+    mocker.patch('message_storage.get_window_cache', return_value=cache)
+    chat_id = -100
+    for msg_id in range(3):
+        _create_test_message(redis_client, chat_id, msg_id)
+    get_latest_n_messages(redis_client, chat_id, 3)
+
+    # When: A message is edited
+    edited = Message(message_id=1, content="Edited", owner_id=901, owner_name='Unit Tester',
+                     created_at=datetime.now().isoformat())
+    edit_message(redis_client, chat_id, edited)
+
+    # Then: The next read has the edit
+    assert get_latest_n_messages(redis_client, chat_id, 3)[1].content == "Edited"
+
+
+def test_store_message_evicts_once_the_indexes_are_full(redis_client, mocker):
+    # Given: Small caps, with the search index, the reply threads and the stats all on
+    mocker.patch.object(message_storage, '_search_enabled', True)
+    mocker.patch('message_storage.is_stats_enabled', return_value=True)
+    mocker.patch.multiple(message_storage, SEARCH_MAX_MESSAGES=2, SEARCH_EVICTION_BATCH=1, THREAD_MAX_REPLIES=2,
+                          THREAD_EVICTION_BATCH=1, STATS_MAX_POSTERS=2, STATS_EVICTION_BATCH=1)
+    evictions = [mocker.patch(f'message_storage.{name}')
+                 for name in ('evict_oldest', 'evict_oldest_replies', 'evict_quiet_posters')]
+
+    # When: A chain of replies, each by a new poster, fills them past their caps
+    for message_id in range(1, 6):
+        store_message(redis_client, -100, make_message(message_id, owner_id=message_id,
+                                                       reply_to_message_id=message_id - 1 or None))
+
+    # Then: Each of them is evicted
+    for evict in evictions:
+        evict.assert_called_with(redis_client, -100)
+
+
+def test_get_thread_messages(redis_client):
+    # Given: A thread that started before the latest messages, with other messages in between
+    chat_id = -100
+    _store_reply(redis_client, chat_id, 0, None)
+    _store_reply(redis_client, chat_id, 1, 0)
+    for msg_id in range(2, MAX_MESSAGE_STORAGE + 2):
+        _store_reply(redis_client, chat_id, msg_id, None)
+    _store_reply(redis_client, chat_id, MAX_MESSAGE_STORAGE + 2, 1)
+    _store_reply(redis_client, chat_id, MAX_MESSAGE_STORAGE + 3, 0)
+
+    # When: We get the thread of the latest reply
+    thread = get_thread_messages(redis_client, chat_id, MAX_MESSAGE_STORAGE + 3)
+
+    # Then: It has every message of the thread, oldest first, including the trimmed ones
+    assert [message.message_id for message in thread] == [0, 1, MAX_MESSAGE_STORAGE + 2, MAX_MESSAGE_STORAGE + 3]
+
+    # And: A message outside of any thread is on its own
+    assert [message.message_id for message in get_thread_messages(redis_client, chat_id, 5)] == [5]
+
+
+def test_chat_keys_share_a_cluster_slot():
+    # Given: The keys of a chat
+    chat_id = -4257039919
+    keys = [chat_messages_key(chat_id), pending_messages_key(chat_id), digest_state_key(chat_id),
+            summary_cache_key(chat_id, "paragraph", 100)]
+
+    # Expect: They are all on the same slot, and other chats are spread elsewhere
+    assert len({key_slot(key.encode()) for key in keys}) == 1
+    assert len({key_slot(chat_messages_key(other_chat_id).encode()) for other_chat_id in range(-100, 0)}) > 50
+
+
+def test_configure_message_storage_for_a_cluster(mocker):
+    # Given: We are configured to use a cluster
+    mocker.patch(
+        'os.getenv', side_effect=lambda x, default=None: {'REDIS_HOST': 'cluster.local',
+                                                          'REDIS_PORT': '6379',
+                                                          'REDIS_USE_TLS': 'True',
+                                                          'REDIS_TIMEOUT': '5',
+                                                          'REDIS_CLUSTER': 'True'}.get(x, default)
+    )
+    mock_redis = mocker.patch('message_storage.Redis')
+    mock_cluster = mocker.patch('message_storage.RedisCluster')
+    mock_cluster.return_value.ping.return_value = True
+
+    # Expect: A cluster client to be used
+    assert configure_message_storage()
+    mock_cluster.assert_called_once_with(host='cluster.local', port=6379, ssl=True, socket_timeout=5)
+    mock_redis.assert_not_called()
+
+
 def test_configure_message_storage_success(mocker):
     # Given: We have valid configs
     mocker.patch(
@@ -246,13 +420,9 @@ def test_convert_update_to_owner(first_name, last_name, expected):
     assert message_owner == expected
 
 
-@pytest.fixture
-def stub_redis_client(request):
-    redis_client = FakeRedis()
-    return redis_client
 
 
-def _create_test_message(stub_redis_client: FakeRedis,
+def _create_test_message(redis_client: FakeRedis,
                          chat_id: int,
                          message_id: int,
                          owner_id: int = 901,
@@ -261,7 +431,7 @@ def _create_test_message(stub_redis_client: FakeRedis,
     """
     Creates a test message.
 
-    @param stub_redis_client:
+    @param redis_client:
     @param chat_id:
     @param message_id:
     @param owner_id:
@@ -277,7 +447,14 @@ def _create_test_message(stub_redis_client: FakeRedis,
         created_at=datetime.now().isoformat()
     )
 
-    result = store_message(stub_redis_client, chat_id, message)
+    result = store_message(redis_client, chat_id, message)
     assert result != 0, "Message was not created during test setup"
 
     return message, result
+
+
+def _store_reply(redis_client: FakeRedis, chat_id: int, message_id: int, reply_to_message_id):
+    message = Message(message_id=message_id, content=f"Message {message_id}", owner_id=901,
+                      owner_name='Unit Tester', created_at=datetime.now().isoformat(),
+                      reply_to_message_id=reply_to_message_id)
+    store_message(redis_client, chat_id, message)
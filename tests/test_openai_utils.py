@@ -0,0 +1,142 @@
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+from message_storage import Message
+from openai_utils import (format_message_for_openai, summarize_messages_as_bullet_points, ModelRouter, ModelTier,
+                          parse_model_tiers, configure_model_router, get_model_router, configure_openai_caller,
+                          get_openai_caller)
+
+
+def test_format_message_for_openai():
+    # Given: We have messages
+    messages = [
+        Message(message_id=1, content="Hello", owner_id=1, owner_name="Alice", created_at="2023-05-14T12:00:00Z"),
+        Message(message_id=2, content="Hi", owner_id=2, owner_name="Bob", created_at="2023-05-14T12:01:00Z"),
+        Message(message_id=3, content="Bye?", owner_id=3, owner_name="Charlie", created_at="2023-05-14T12:02:00Z")
+    ]
+
+    # When: We format the messages
+    result = format_message_for_openai(messages)
+
+    # Then: They're formatted correctly
+    expected_result = "Alice: Hello;Bob: Hi;Charlie: Bye?"
+    assert result == expected_result, f"Expected '{expected_result}', but got '{result}'"
+
+
+def test_summarize_messages_reports_the_usage():
+    # Given: The model answers with its token usage
+    client = Mock()
+    client.chat.completions.create.return_value = SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content="- A point"))],
+        usage=SimpleNamespace(prompt_tokens=120, completion_tokens=8)
+    )
+
+    # When: We summarize messages
+    result = summarize_messages_as_bullet_points(client, "Alice: Hello;Bob: Hi", model="gpt-test")
+
+    # Then: The content and the usage are returned
+    assert result.content == "- A point"
+    assert (result.model, result.prompt_tokens, result.completion_tokens) == ("gpt-test", 120, 8)
+    assert client.chat.completions.create.call_args.kwargs['model'] == "gpt-test"
+
+
+def test_router_picks_the_smallest_tier_that_fits_the_prompt():
+    # Given: A router with a fast and a standard tier
+    router = _router()
+
+    # When: We route a small and a large prompt
+    small = router.route(prompt_tokens=500)
+    large = router.route(prompt_tokens=5_000)
+
+    # Then: Each goes to the tier that fits it
+    assert (small.tier.name, small.window_scale, small.degraded) == ("fast", 1.0, False)
+    assert (large.tier.name, large.window_scale, large.degraded) == ("standard", 1.0, False)
+
+
+def test_router_degrades_when_the_latency_slo_is_breached():
+    # Given: Completions have been slower than the SLO
+    router = _router()
+    router._latencies.extend([12.0] * 20)
+
+    # When: We route a large prompt
+    decision = router.route(prompt_tokens=5_000)
+
+    # Then: It goes to the fast tier, with a window shortened to fit it
+    assert decision.degraded
+    assert decision.tier.name == "fast"
+    assert decision.window_scale == 0.2
+
+
+def test_router_degrades_when_too_many_completions_are_in_flight():
+    # Given: The router is at its in-flight limit
+    router = _router(max_in_flight=1)
+
+    with router.track():
+        # When: We route a prompt
+        decision = router.route(prompt_tokens=500)
+
+    # Then: It is degraded, and the in-flight count is released afterwards
+    assert decision.degraded
+    assert decision.tier.name == "fast"
+    assert router.in_flight == 0
+    assert len(router._latencies) == 1
+
+
+def test_parse_model_tiers():
+    # Given: Tiers in the env variable format
+    tiers = "fast=gpt-4o-mini:300:20:2000, standard=gpt-4o:700:45.5:16000"
+
+    # When: We parse them
+    result = parse_model_tiers(tiers)
+
+    # Then: They're parsed in order
+    assert result == [
+        ModelTier("fast", "gpt-4o-mini", 300, 20.0, 2_000),
+        ModelTier("standard", "gpt-4o", 700, 45.5, 16_000),
+    ]
+
+
+def test_summarize_messages_passes_the_tier_limits():
+    # Given: The model answers without usage
+    client = Mock()
+    client.chat.completions.create.return_value = SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content="- A point"))],
+        usage=None
+    )
+
+    # When: We summarize with limits
+    summarize_messages_as_bullet_points(client, "Alice: Hello", model="gpt-test", max_tokens=300, timeout=20)
+
+    # Then: The limits are sent with the request
+    kwargs = client.chat.completions.create.call_args.kwargs
+    assert (kwargs['max_tokens'], kwargs['timeout']) == (300, 20)
+
+
+def test_router_and_caller_are_configured_from_the_env(monkeypatch):
+    # Given: The env is read after the module was imported, e.g. from a .env file
+    monkeypatch.setenv('OPENAI_MODEL_TIERS', "only=gpt-test:100:5:500")
+
+    # When: The router and the caller are configured
+    router = configure_model_router()
+    previous_caller = get_openai_caller()
+    caller = configure_openai_caller()
+
+    # Then: They use the env as it is now, and replace the previous ones
+    assert get_model_router() is router
+    assert [tier.model for tier in router.tiers] == ["gpt-test"]
+    assert get_openai_caller() is caller is not previous_caller
+
+    monkeypatch.delenv('OPENAI_MODEL_TIERS')
+    configure_model_router()
+    configure_openai_caller()
+
+
+def _router(max_in_flight: int = 8) -> ModelRouter:
+    return ModelRouter(
+        tiers=[
+            ModelTier("fast", "gpt-fast", max_tokens=300, timeout_seconds=20, max_prompt_tokens=1_000),
+            ModelTier("standard", "gpt-standard", max_tokens=700, timeout_seconds=45, max_prompt_tokens=16_000),
+        ],
+        latency_slo_seconds=10,
+        max_in_flight=max_in_flight,
+    )
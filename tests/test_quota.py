@@ -0,0 +1,111 @@
+import pytest
+
+import quota
+from quota import (QuotaConfig, configure_quota, acquire_summary_quota, record_token_usage, get_token_usage,
+                   get_usage_report, USER_SCOPE, CHAT_SCOPE)
+
+NOW = 1_715_688_000  # 2024-05-14 12:00:00 UTC
+
+
+def test_requests_are_limited_per_user(redis_client):
+    # Given: A user may request 2 summaries per hour
+    configure_quota(QuotaConfig(enabled=True, user_requests_per_window=2, chat_requests_per_window=10))
+
+    # When: They request a 3rd one
+    decisions = [acquire_summary_quota(redis_client, -100, 1, now=NOW + offset) for offset in (0, 10, 20)]
+
+    # Then: It is denied until the 1st one leaves the window
+    assert [decision.allowed for decision in decisions] == [True, True, False]
+    assert decisions[2].retry_after_seconds == 3600 - 20 + 1
+
+    # And: Other users in the chat are not limited
+    assert acquire_summary_quota(redis_client, -100, 2, now=NOW + 20).allowed
+
+
+def test_window_slides(redis_client):
+    # Given: A user used up their requests
+    configure_quota(QuotaConfig(enabled=True, user_requests_per_window=1, chat_requests_per_window=10))
+    assert acquire_summary_quota(redis_client, -100, 1, now=NOW).allowed
+    assert not acquire_summary_quota(redis_client, -100, 1, now=NOW + 1).allowed
+
+    # When: The window has passed
+    decision = acquire_summary_quota(redis_client, -100, 1, now=NOW + 3601)
+
+    # Then: They may request again
+    assert decision.allowed
+
+
+def test_denied_chat_requests_do_not_count_against_the_user(redis_client):
+    # Given: The chat used up its requests
+    configure_quota(QuotaConfig(enabled=True, user_requests_per_window=1, chat_requests_per_window=1))
+    assert acquire_summary_quota(redis_client, -100, 1, now=NOW).allowed
+
+    # When: Another user requests a summary in that chat
+    decision = acquire_summary_quota(redis_client, -100, 2, now=NOW + 1)
+
+    # Then: It is denied because of the chat, and the user still has their request
+    assert not decision.allowed
+    assert "chat" in decision.reason
+    assert acquire_summary_quota(redis_client, -200, 2, now=NOW + 2).allowed
+
+
+def test_daily_token_budget(redis_client):
+    # Given: A user may spend 1000 tokens per day, and spent 1200
+    configure_quota(QuotaConfig(enabled=True, user_daily_tokens=1000))
+    record_token_usage(redis_client, -100, 1, prompt_tokens=1100, completion_tokens=100, now=NOW)
+
+    # When: They request a summary
+    decision = acquire_summary_quota(redis_client, -100, 1, now=NOW)
+
+    # Then: It is denied until tomorrow
+    assert not decision.allowed
+    assert decision.retry_after_seconds == 12 * 60 * 60 + 1
+
+
+def test_ledger_tracks_users_chats_and_totals(redis_client):
+    # Given: Summaries were requested by a user and in the background
+    configure_quota(QuotaConfig())
+    record_token_usage(redis_client, -100, 1, prompt_tokens=1000, completion_tokens=100, now=NOW)
+    record_token_usage(redis_client, -100, None, prompt_tokens=500, completion_tokens=50, now=NOW)
+
+    # When: We read the ledger
+    user_usage = get_token_usage(redis_client, USER_SCOPE, 1, day="20240514")
+    chat_usage = get_token_usage(redis_client, CHAT_SCOPE, -100, day="20240514")
+
+    # Then: The user is charged for their summary, the chat for both
+    assert (user_usage.prompt_tokens, user_usage.completion_tokens) == (1000, 100)
+    assert (chat_usage.prompt_tokens, chat_usage.completion_tokens) == (1500, 150)
+
+
+def test_usage_report(redis_client, mocker):
+    # Given: Tokens were spent today
+    configure_quota(QuotaConfig(prompt_cost_per_1k=0.001, completion_cost_per_1k=0.002))
+    mocker.patch('quota.time.time', return_value=NOW)
+    record_token_usage(redis_client, -100, 1, prompt_tokens=1000, completion_tokens=500)
+
+    # When: We get the report
+    report = get_usage_report(redis_client)
+
+    # Then: It shows the totals, the cost and the top consumers
+    assert "Tokens: 1500 (1000 prompt, 500 completion)" in report
+    assert "Estimated cost: $0.0020" in report
+    assert "Top chats: -100 (1500)" in report
+    assert "Top users: 1 (1500)" in report
+
+
+def test_quotas_are_not_enforced_when_disabled(redis_client):
+    # Given: Quotas are disabled
+    configure_quota(QuotaConfig(enabled=False, user_requests_per_window=0))
+
+    # When: A user requests a summary
+    decision = acquire_summary_quota(redis_client, -100, 1, now=NOW)
+
+    # Then: It is allowed, and nothing is stored
+    assert decision.allowed
+    assert redis_client.dbsize() == 0
+
+
+@pytest.fixture(autouse=True)
+def reset_quota():
+    yield
+    quota._config = QuotaConfig()
@@ -0,0 +1,50 @@
+
+from redis_keys import thread_replies_key
+from reply_threads import index_reply, get_thread_ids, evict_oldest
+
+
+def test_thread_is_found_from_any_of_its_messages(redis_client):
+    # Given: Two threads in the same chat
+    chat_id = -100
+    _index_replies(redis_client, chat_id, {2: 1, 3: 1, 4: 3, 6: 5, 7: 4})
+
+    # Expect: Every message of a thread leads to the whole thread, oldest first
+    for message_id in (1, 3, 7):
+        assert get_thread_ids(redis_client, chat_id, message_id, limit=10) == [1, 2, 3, 4, 7]
+    assert get_thread_ids(redis_client, chat_id, 6, limit=10) == [5, 6]
+
+
+def test_thread_keeps_its_latest_messages(redis_client):
+    # Given: A long thread
+    chat_id = -100
+    _index_replies(redis_client, chat_id, {message_id: message_id - 1 for message_id in range(2, 11)})
+
+    # Expect: Only the latest messages are returned
+    assert get_thread_ids(redis_client, chat_id, 1, limit=3) == [8, 9, 10]
+
+
+def test_message_outside_of_a_thread(redis_client):
+    # Expect: A message nobody replied to is on its own
+    assert get_thread_ids(redis_client, -100, 42, limit=10) == [42]
+
+
+def test_oldest_replies_are_evicted(redis_client):
+    # Given: A chat with 5 replies to the same message
+    chat_id = -100
+    _index_replies(redis_client, chat_id, {message_id: 1 for message_id in range(2, 7)})
+
+    # When: Only 2 replies are kept
+    evicted = evict_oldest(redis_client, chat_id, keep=2)
+
+    # Then: The oldest ones are no longer part of the thread
+    assert evicted == 3
+    assert redis_client.zcard(thread_replies_key(chat_id)) == 2
+    assert get_thread_ids(redis_client, chat_id, 1, limit=10) == [1, 5, 6]
+    assert get_thread_ids(redis_client, chat_id, 2, limit=10) == [2]
+
+
+def _index_replies(redis_client, chat_id: int, parents: dict[int, int]):
+    pipeline = redis_client.pipeline(transaction=False)
+    for message_id, parent_id in parents.items():
+        index_reply(pipeline, chat_id, message_id, parent_id)
+    pipeline.execute()
@@ -0,0 +1,183 @@
+import threading
+import time
+from typing import Optional
+
+import httpx
+import pytest
+from openai import OpenAI, BadRequestError
+
+from openai_utils import summarize_messages_as_paragraph, RETRYABLE_OPENAI_ERRORS
+from resilience import (CircuitBreaker, CircuitState, CircuitOpenError, DeadlineExceededError, RetryPolicy,
+                        ResilientCaller)
+
+
+class FakeOpenAIServer:
+    """Answers chat completions in-process, with injected latency and errors"""
+
+    def __init__(self):
+        self.faults: list[tuple[float, int]] = []  # (latency, status code) of the next requests
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        with self._lock:
+            self.requests += 1
+            latency, status_code = self.faults.pop(0) if self.faults else (0, 200)
+
+        time.sleep(latency)
+        if status_code != 200:
+            return httpx.Response(status_code, json={"error": {"message": "injected", "type": "server_error"}})
+
+        return httpx.Response(200, json={
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": 0,
+            "model": "gpt-fake",
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "A summary"}}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12},
+        })
+
+    def client(self) -> OpenAI:
+        return OpenAI(api_key="fake-key", base_url="http://fake-openai/v1", max_retries=0,
+                      http_client=httpx.Client(transport=httpx.MockTransport(self.handle)))
+
+
+def test_retries_errors_from_the_server():
+    # Given: The server fails twice, then recovers
+    server = FakeOpenAIServer()
+    server.faults = [(0, 500), (0, 503)]
+    caller = _caller(max_attempts=3)
+
+    # When: We summarize through the caller
+    result = caller.call(lambda timeout: summarize_messages_as_paragraph(server.client(), "Alice: Hi", timeout=timeout))
+
+    # Then: The third attempt succeeds and the circuit stays closed
+    assert result.content == "A summary"
+    assert server.requests == 3
+    assert caller.breaker.state is CircuitState.CLOSED
+
+
+def test_does_not_retry_bad_requests():
+    # Given: The server rejects the request
+    server = FakeOpenAIServer()
+    server.faults = [(0, 400)]
+    caller = _caller(max_attempts=3)
+
+    # When: We summarize through the caller
+    with pytest.raises(BadRequestError):
+        caller.call(lambda timeout: summarize_messages_as_paragraph(server.client(), "Alice: Hi", timeout=timeout))
+
+    # Then: It was attempted once, and the provider is still considered healthy
+    assert server.requests == 1
+    assert caller.breaker.state is CircuitState.CLOSED
+
+
+def test_hedges_slow_attempts():
+    # Given: The first request hangs, and attempts slower than 50ms are hedged
+    server = FakeOpenAIServer()
+    server.faults = [(1, 200)]
+    caller = _caller(hedge_after=0.05)
+
+    # When: We summarize through the caller
+    started = time.monotonic()
+    result = caller.call(lambda timeout: summarize_messages_as_paragraph(server.client(), "Alice: Hi", timeout=timeout))
+
+    # Then: The duplicate answered first
+    assert result.content == "A summary"
+    assert server.requests == 2
+    assert time.monotonic() - started < 0.5
+
+
+def test_gives_up_at_the_deadline():
+    # Given: The server hangs for longer than the deadline
+    server = FakeOpenAIServer()
+    server.faults = [(0.5, 200)]
+    caller = _caller(deadline_seconds=0.1)
+
+    # When: We summarize through the caller
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceededError):
+        caller.call(lambda timeout: summarize_messages_as_paragraph(server.client(), "Alice: Hi", timeout=timeout))
+
+    # Then: It didn't wait for the server
+    assert time.monotonic() - started < 0.4
+
+
+def test_circuit_opens_and_fails_fast():
+    # Given: The server keeps failing
+    server = FakeOpenAIServer()
+    server.faults = [(0, 500)] * 3
+    caller = _caller(max_attempts=3, failure_threshold=3)
+
+    with pytest.raises(RETRYABLE_OPENAI_ERRORS):
+        caller.call(lambda timeout: summarize_messages_as_paragraph(server.client(), "Alice: Hi", timeout=timeout))
+
+    # When: We summarize again
+    with pytest.raises(CircuitOpenError):
+        caller.call(lambda timeout: summarize_messages_as_paragraph(server.client(), "Alice: Hi", timeout=timeout))
+
+    # Then: The open circuit didn't call the server
+    assert caller.breaker.state is CircuitState.OPEN
+    assert server.requests == 3
+
+
+def test_circuit_opens_when_the_server_hangs():
+    # Given: The server hangs for longer than the deadline, every time
+    server = FakeOpenAIServer()
+    server.faults = [(0.3, 200)] * 3
+    caller = _caller(deadline_seconds=0.05, failure_threshold=3)
+
+    # When: The calls run out of time
+    for _ in range(3):
+        with pytest.raises(DeadlineExceededError):
+            caller.call(lambda timeout: summarize_messages_as_paragraph(server.client(), "Alice: Hi", timeout=timeout))
+
+    # Then: The circuit opened, and the next call fails fast
+    assert caller.breaker.state is CircuitState.OPEN
+    with pytest.raises(CircuitOpenError):
+        caller.call(lambda timeout: summarize_messages_as_paragraph(server.client(), "Alice: Hi", timeout=timeout))
+    assert server.requests == 3
+
+
+def test_circuit_closes_after_a_successful_trial_call():
+    # Given: An open circuit whose reset timeout has passed
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout_seconds=0.05)
+    breaker.record_failure()
+    assert not breaker.allow()
+    time.sleep(0.06)
+
+    # When: A single trial call goes through and succeeds
+    assert breaker.state is CircuitState.HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+
+    # Then: The circuit is closed
+    assert breaker.state is CircuitState.CLOSED
+    assert breaker.allow()
+
+
+def test_backoff_is_jittered_and_bounded():
+    # Given: A retry policy
+    policy = RetryPolicy(base_delay_seconds=0.5, max_delay_seconds=2)
+
+    # When: We compute the delays of many retries
+    delays = [policy.backoff(attempt) for attempt in range(1, 10) for _ in range(20)]
+
+    # Then: They're random, and never above the cap
+    assert len(set(delays)) > 1
+    assert all(0 <= delay <= 2 for delay in delays)
+
+
+def _caller(max_attempts: int = 3,
+            deadline_seconds: float = 5,
+            hedge_after: Optional[float] = None,
+            failure_threshold: int = 5) -> ResilientCaller:
+    return ResilientCaller(
+        breaker=CircuitBreaker("test", failure_threshold=failure_threshold, reset_timeout_seconds=30),
+        retry_policy=RetryPolicy(max_attempts=max_attempts, base_delay_seconds=0.01,
+                                 retryable=RETRYABLE_OPENAI_ERRORS),
+        deadline_seconds=deadline_seconds,
+        hedge_after=lambda: hedge_after,
+    )
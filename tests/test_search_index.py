@@ -0,0 +1,97 @@
+from fakeredis import FakeRedis
+
+from message_storage import store_message, search_messages
+from search_index import tokenize, evict_oldest, index_size, remove_document, search
+from tests.conftest import make_message
+
+CHAT_ID = -100
+
+
+def test_tokenize():
+    # Expect: Words to be normalized, without stop words or possessives
+    assert tokenize("The CONCERT tickets are Bob's!") == ["concert", "tickets", "bob"]
+
+
+def test_finds_messages_with_every_term(redis_client):
+    # Given: A chat about dinner and a concert
+    _store(redis_client, 1, "Dinner at the new ramen place on Friday?")
+    _store(redis_client, 2, "I got the concert tickets")
+    _store(redis_client, 3, "Friday dinner works for me")
+
+    # When: We search for two terms
+    messages = search_messages(redis_client, CHAT_ID, "friday dinner")
+
+    # Then: Only the messages with both are found
+    assert {message.message_id for message in messages} == {1, 3}
+    assert search_messages(redis_client, CHAT_ID, "friday tickets") == []
+
+
+def test_rare_terms_rank_higher(redis_client):
+    # Given: "pizza" is in many messages, "anchovies" in one
+    for message_id in range(1, 6):
+        _store(redis_client, message_id, f"pizza again number {message_id}")
+    _store(redis_client, 6, "pizza with anchovies")
+    _store(redis_client, 7, "anchovies are gross")
+
+    # When: We search for either
+    messages = search_messages(redis_client, CHAT_ID, "anchovies", limit=2)
+
+    # Then: The messages with the rare term are found
+    assert {message.message_id for message in messages} == {6, 7}
+
+
+def test_ties_go_to_the_newest_message(redis_client):
+    # Given: Identical messages
+    for message_id in (5, 50, 500):
+        _store(redis_client, message_id, "see you at the beach")
+
+    # When: We search
+    messages = search_messages(redis_client, CHAT_ID, "beach")
+
+    # Then: The newest is first
+    assert [message.message_id for message in messages] == [500, 50, 5]
+
+
+def test_search_outlives_the_message_list(redis_client):
+    # Given: More messages than the latest-messages list keeps
+    _store(redis_client, 1, "the wifi password is hunter2")
+    for message_id in range(2, 300):
+        _store(redis_client, message_id, f"filler message {message_id}")
+
+    # When: We search for the first message
+    messages = search_messages(redis_client, CHAT_ID, "wifi password")
+
+    # Then: It is still found
+    assert [message.message_id for message in messages] == [1]
+
+
+def test_evict_oldest_removes_postings(redis_client):
+    # Given: An index with 10 messages
+    for message_id in range(10):
+        _store(redis_client, message_id, f"holiday plans {message_id}")
+
+    # When: We only keep the latest 3
+    evicted = evict_oldest(redis_client, CHAT_ID, keep=3)
+
+    # Then: The older ones can't be found, and their keys are cleaned up
+    assert evicted == 7
+    assert index_size(redis_client, CHAT_ID) == 3
+    assert [message.message_id for message in search_messages(redis_client, CHAT_ID, "holiday")] == [9, 8, 7]
+    assert not redis_client.exists("{chat:-100}:search:term:0")
+
+
+def test_remove_document(redis_client):
+    # Given: An indexed message
+    _store(redis_client, 1, "secret plans")
+
+    # When: It is removed
+    remove_document(redis_client, CHAT_ID, 1)
+
+    # Then: It is no longer found
+    assert search(redis_client, CHAT_ID, "secret", limit=5) == []
+
+
+
+
+def _store(redis_client: FakeRedis, message_id: int, content: str):
+    store_message(redis_client, CHAT_ID, make_message(message_id, content))
@@ -0,0 +1,104 @@
+import pytest
+from fakeredis import FakeRedis
+from starlette.testclient import TestClient
+
+import server
+import startup
+from startup import (StartupTimer, StartupError, connect_message_storage_async, warm_redis_pool, warm_up_async)
+
+
+@pytest.fixture
+def no_sleep(mocker):
+    return mocker.patch('startup.asyncio.sleep')
+
+
+@pytest.mark.asyncio
+async def test_connect_retries_until_the_storage_answers(mocker, no_sleep):
+    # Given: The storage is unavailable for the first 2 attempts
+    configure = mocker.patch('startup.configure_message_storage', side_effect=[False, False, True])
+
+    # When: The bot connects
+    await connect_message_storage_async(max_attempts=5, max_delay_seconds=1)
+
+    # Then: It backed off between the attempts
+    assert configure.call_count == 3
+    assert no_sleep.call_count == 2
+    assert all(0 <= call.args[0] <= 1 for call in no_sleep.call_args_list)
+
+
+@pytest.mark.asyncio
+async def test_connect_gives_up_after_the_last_attempt(mocker, no_sleep):
+    # Given: The storage never answers
+    configure = mocker.patch('startup.configure_message_storage', return_value=False)
+
+    # Expect: The bot gives up
+    with pytest.raises(StartupError):
+        await connect_message_storage_async(max_attempts=3, max_delay_seconds=1)
+    assert configure.call_count == 3
+    assert no_sleep.call_count == 2
+
+
+def test_warm_redis_pool_opens_connections():
+    # Given: A client without any connections
+    redis_client = FakeRedis()
+
+    # When: The pool is warmed
+    opened = warm_redis_pool(redis_client, 3)
+
+    # Then: The connections are back in the pool, ready to be used
+    assert opened == 3
+    assert len(redis_client.connection_pool._available_connections) == 3
+
+
+@pytest.mark.asyncio
+async def test_failed_warmups_dont_stop_the_startup(mocker):
+    # Given: OpenAI is unreachable
+    mocker.patch('startup.warm_openai', side_effect=ConnectionError("unreachable"))
+    warm_white_list = mocker.patch('startup.warm_white_list')
+
+    # When: The bot warms up
+    await warm_up_async(FakeRedis())
+
+    # Then: The other warmups still ran
+    warm_white_list.assert_called_once()
+
+
+def test_startup_report_times_the_phases():
+    # Given: A bot that started 2 seconds ago
+    timer = StartupTimer(started_at=0)
+    with timer.phase("storage"):
+        pass
+
+    # When: It is ready
+    timer.mark_ready()
+
+    # Then: The report has the phase and the time to ready
+    report = timer.report()
+    assert set(report['phases']) == {"storage"}
+    assert report['ready_after_seconds'] > 0
+    assert report['first_update_after_seconds'] is None
+
+
+def test_only_the_first_update_is_recorded():
+    # Given: A started bot
+    timer = StartupTimer()
+
+    # Expect: Only the first update is recorded
+    assert timer.mark_first_update()
+    first_update_after = timer.report()['first_update_after_seconds']
+    assert not timer.mark_first_update()
+    assert timer.report()['first_update_after_seconds'] == first_update_after
+
+
+def test_ready_endpoint_turns_green_once_ready(mocker):
+    # Given: A bot that is still starting
+    timer = StartupTimer()
+    mocker.patch.object(startup, '_startup_timer', timer)
+    client = TestClient(server.web_app)
+
+    # Expect: It isn't ready until it says so
+    assert client.get("/ready").status_code == 503
+    timer.mark_ready()
+    response = client.get("/ready")
+    assert response.status_code == 200
+    assert response.json()['ready']
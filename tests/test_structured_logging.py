@@ -0,0 +1,138 @@
+import json
+import logging
+
+import pytest
+
+import structured_logging
+from structured_logging import JsonFormatter, log_event, _RateLimiter
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    monkeypatch.setattr(structured_logging, '_sample_rates', {})
+    monkeypatch.setattr(structured_logging, '_rate_limiters', {})
+    monkeypatch.setattr(structured_logging, '_redact_content', True)
+
+    handler = RecordingHandler()
+    test_logger = logging.getLogger('test_structured_logging')
+    test_logger.addHandler(handler)
+    test_logger.setLevel(logging.DEBUG)
+    test_logger.propagate = False
+    yield handler
+    test_logger.removeHandler(handler)
+
+
+@pytest.fixture
+def test_logger(handler):
+    return logging.getLogger('test_structured_logging')
+
+
+def test_disabled_events_evaluate_nothing(test_logger, handler):
+    # Given: The logger only writes INFO and above
+    test_logger.setLevel(logging.INFO)
+    calls = []
+
+    # When: A DEBUG event with a lazy field is logged
+    log_event(test_logger, logging.DEBUG, "messages_read", messages=lambda: calls.append(1))
+
+    # Then: Nothing is written and the field was never evaluated
+    assert handler.records == []
+    assert calls == []
+
+
+def test_lazy_fields_are_evaluated_when_written(test_logger, handler):
+    # When: An event with a lazy field is logged
+    log_event(test_logger, logging.INFO, "message_stored", chat_id=-100, stored=lambda: 42)
+
+    # Then: The field holds the value
+    assert handler.records[0].msg.fields == {'chat_id': -100, 'stored': 42}
+    assert handler.records[0].getMessage() == "message_stored chat_id=-100 stored=42"
+
+
+def test_message_content_is_redacted(test_logger, handler):
+    # When: Events with message content are logged
+    log_event(test_logger, logging.INFO, "message_stored", content="my secret plans")
+    log_event(test_logger, logging.INFO, "messages_read", messages=["a", "b"])
+
+    # Then: Only the size of the content is written
+    assert handler.records[0].msg.fields['content'] == "<15 chars redacted>"
+    assert handler.records[1].msg.fields['messages'] == "<2 redacted>"
+
+
+def test_content_is_kept_when_redaction_is_off(test_logger, handler, monkeypatch):
+    # Given: Redaction is turned off
+    monkeypatch.setattr(structured_logging, '_redact_content', False)
+
+    # When: An event with message content is logged
+    log_event(test_logger, logging.INFO, "message_stored", content="hi")
+
+    # Then: The content is written
+    assert handler.records[0].msg.fields['content'] == "hi"
+
+
+def test_sampled_out_events_are_dropped(test_logger, handler, monkeypatch):
+    # Given: The health checks are never sampled
+    monkeypatch.setattr(structured_logging, '_sample_rates', {'health_check': 0.0})
+
+    # When: Health checks and another event are logged
+    for _ in range(10):
+        log_event(test_logger, logging.INFO, "health_check")
+    log_event(test_logger, logging.INFO, "message_stored")
+
+    # Then: Only the other event is written
+    assert [record.msg.name for record in handler.records] == ["message_stored"]
+
+
+def test_rate_limited_events_report_the_suppressed_count(test_logger, handler, monkeypatch):
+    # Given: At most 2 events a second
+    limiter = _RateLimiter(2)
+    monkeypatch.setattr(structured_logging, '_rate_limiters', {'message_received': limiter})
+
+    # When: A burst of 5 events is logged
+    for _ in range(5):
+        log_event(test_logger, logging.INFO, "message_received")
+
+    # Then: Only the first 2 are written
+    assert len(handler.records) == 2
+
+    # When: The bucket refills
+    limiter._tokens = 2
+    log_event(test_logger, logging.INFO, "message_received")
+
+    # Then: The next event says how many were suppressed
+    assert handler.records[-1].msg.fields == {'suppressed': 3}
+
+
+def test_json_formatter_writes_the_event_fields(test_logger, handler):
+    # Given: A logged event
+    log_event(test_logger, logging.WARNING, "message_stored", chat_id=-100, stored=3)
+
+    # When: It is formatted as JSON
+    entry = json.loads(JsonFormatter().format(handler.records[0]))
+
+    # Then: The fields are top-level keys
+    assert entry['event'] == "message_stored"
+    assert entry['level'] == "WARNING"
+    assert entry['logger'] == "test_structured_logging"
+    assert entry['chat_id'] == -100
+    assert entry['stored'] == 3
+
+
+def test_json_formatter_writes_plain_messages(test_logger, handler):
+    # Given: A regular log message
+    test_logger.info("Started the webserver on port %d", 8000)
+
+    # When: It is formatted as JSON
+    entry = json.loads(JsonFormatter().format(handler.records[0]))
+
+    # Then: The message is formatted
+    assert entry['message'] == "Started the webserver on port 8000"
@@ -0,0 +1,329 @@
+import json
+from dataclasses import asdict
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Optional
+
+import pytest
+from fakeredis import FakeRedis
+
+import llm_backends
+from message_archive import SegmentWriter
+from message_storage import Message, store_message, get_new_message_count
+import quota
+from quota import QuotaConfig, QuotaExceededError, configure_quota, get_token_usage, USER_SCOPE, CHAT_SCOPE
+from summary_cache import invalidate_cached_summaries
+from summary_pipeline import (SummaryStyle, summarize_chat, summarize_matching_messages, summarize_topics,
+                              summarize_thread, summarize_days, STALE_SUMMARY_NOTICE)
+
+
+@pytest.mark.asyncio
+async def test_summarize_chat_without_messages(stub_redis_client, stub_ai_client):
+    # Given: The chat doesn't exist
+    non_existent_chat_id = -999
+
+    # When: We summarize it
+    summary = await summarize_chat(non_existent_chat_id, 50, SummaryStyle.PARAGRAPH)
+
+    # Then: There is nothing to summarize, and the model was not called
+    assert summary is None
+    stub_ai_client.chat.completions.create.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_summarize_chat_sends_messages_in_chronological_order(stub_redis_client, stub_ai_client):
+    # Given: The chat has 3 messages
+    chat_id = -100
+    for message_id, content in enumerate(["first", "second", "third"]):
+        _store_test_message(stub_redis_client, chat_id, message_id, content)
+
+    # When: We summarize the latest 2
+    summary = await summarize_chat(chat_id, 2, SummaryStyle.PARAGRAPH)
+
+    # Then: The model got them oldest first
+    prompt = stub_ai_client.chat.completions.create.call_args.kwargs['messages'][1]['content']
+    assert prompt == "Tester 1: second;Tester 2: third"
+    assert summary == "- Point one\n- Point two"
+
+
+@pytest.mark.asyncio
+async def test_summarize_chat_as_bullet_points(stub_redis_client, stub_ai_client):
+    # Given: The chat has a message
+    chat_id = -100
+    _store_test_message(stub_redis_client, chat_id, 1, "hello")
+
+    # When: We summarize it as bullet points
+    summary = await summarize_chat(chat_id, 50, SummaryStyle.BULLET_POINTS)
+
+    # Then: The points are spaced out
+    assert summary == "- Point one\n\n- Point two"
+
+
+@pytest.mark.asyncio
+async def test_summarize_chat_is_cached_until_a_new_message(stub_redis_client, stub_ai_client):
+    # Given: The chat was summarized
+    chat_id = -100
+    _store_test_message(stub_redis_client, chat_id, 1, "hello")
+    first_summary = await summarize_chat(chat_id, 50, SummaryStyle.PARAGRAPH)
+
+    # When: It is summarized again
+    second_summary = await summarize_chat(chat_id, 50, SummaryStyle.PARAGRAPH)
+
+    # Then: The cached summary is served
+    assert second_summary == first_summary
+    assert stub_ai_client.chat.completions.create.call_count == 1
+
+    # When: A new message arrives
+    _store_test_message(stub_redis_client, chat_id, 2, "world")
+    await summarize_chat(chat_id, 50, SummaryStyle.PARAGRAPH)
+
+    # Then: The chat is summarized again
+    assert stub_ai_client.chat.completions.create.call_count == 2
+
+    # And: No messages are left to summarize
+    assert get_new_message_count(stub_redis_client, chat_id) == 0
+
+
+@pytest.mark.asyncio
+async def test_summarize_chat_is_not_cached_across_an_edit(mocker, stub_redis_client, stub_ai_client):
+    # Given: A message is edited while its chat is being summarized
+    chat_id = -100
+    _store_test_message(stub_redis_client, chat_id, 1, "the dinner is at 8")
+    summarize_with_backends = llm_backends.summarize_with_backends
+
+    def summarize_during_an_edit(*args):
+        invalidate_cached_summaries(stub_redis_client, chat_id)
+        return summarize_with_backends(*args)
+
+    mocker.patch('summary_pipeline.summarize_with_backends', side_effect=summarize_during_an_edit)
+    await summarize_chat(chat_id, 50, SummaryStyle.PARAGRAPH)
+
+    # When: The chat is summarized again
+    mocker.patch('summary_pipeline.summarize_with_backends', side_effect=summarize_with_backends)
+    await summarize_chat(chat_id, 50, SummaryStyle.PARAGRAPH)
+
+    # Then: The summary written before the edit isn't served
+    assert stub_ai_client.chat.completions.create.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_summarize_chat_serves_the_stale_summary_while_the_backend_is_unavailable(mocker, stub_redis_client,
+                                                                                        stub_ai_client):
+    # Given: The chat was summarized, then got a new message
+    chat_id = -100
+    _store_test_message(stub_redis_client, chat_id, 1, "hello")
+    first_summary = await summarize_chat(chat_id, 50, SummaryStyle.PARAGRAPH)
+    _store_test_message(stub_redis_client, chat_id, 2, "world")
+
+    # When: It is summarized while the backend's circuit is open
+    mocker.patch('summary_pipeline.is_primary_backend_available', return_value=False)
+    summary = await summarize_chat(chat_id, 50, SummaryStyle.PARAGRAPH)
+
+    # Then: The last summary is served, with a notice
+    assert summary == STALE_SUMMARY_NOTICE + first_summary
+    assert stub_ai_client.chat.completions.create.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_summarize_chat_records_the_token_usage(stub_redis_client, stub_ai_client):
+    # Given: The model reports its token usage
+    chat_id = -100
+    _store_test_message(stub_redis_client, chat_id, 1, "hello")
+    stub_ai_client.chat.completions.create.return_value.usage = SimpleNamespace(prompt_tokens=40,
+                                                                               completion_tokens=10)
+
+    # When: A user requests a summary
+    await summarize_chat(chat_id, 50, SummaryStyle.PARAGRAPH, user_id=7)
+
+    # Then: The tokens are added to the user's and the chat's usage
+    assert get_token_usage(stub_redis_client, USER_SCOPE, 7).total_tokens == 50
+    assert get_token_usage(stub_redis_client, CHAT_SCOPE, chat_id).total_tokens == 50
+
+
+@pytest.mark.asyncio
+async def test_summarize_chat_only_counts_model_calls_against_the_quota(stub_redis_client, stub_ai_client,
+                                                                         one_summary_quota):
+    # Given: A user may request one summary, and asks for a chat without messages
+    chat_id = -100
+    assert await summarize_chat(chat_id, 50, SummaryStyle.PARAGRAPH, user_id=7) is None
+
+    # When: They request the summary of a chat with a message, and then request it again
+    _store_test_message(stub_redis_client, chat_id, 1, "hello")
+    first_summary = await summarize_chat(chat_id, 50, SummaryStyle.PARAGRAPH, user_id=7)
+    cached_summary = await summarize_chat(chat_id, 50, SummaryStyle.PARAGRAPH, user_id=7)
+
+    # Then: Neither the empty chat nor the cache hit counted against their quota
+    assert cached_summary == first_summary
+
+    # When: A new message arrives, and they request another summary
+    _store_test_message(stub_redis_client, chat_id, 2, "world")
+
+    # Then: They are over quota, and the model is not called
+    with pytest.raises(QuotaExceededError):
+        await summarize_chat(chat_id, 50, SummaryStyle.PARAGRAPH, user_id=7)
+    assert stub_ai_client.chat.completions.create.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_summarize_matching_messages(stub_redis_client, stub_ai_client):
+    # Given: A chat where only some messages are about the trip
+    chat_id = -100
+    _store_test_message(stub_redis_client, chat_id, 1, "the trip is in june")
+    _store_test_message(stub_redis_client, chat_id, 2, "what's for lunch")
+    _store_test_message(stub_redis_client, chat_id, 3, "I booked the trip flights")
+
+    # When: We summarize the messages about the trip
+    await summarize_matching_messages(chat_id, "trip", SummaryStyle.PARAGRAPH)
+
+    # Then: Only those are sent, in chronological order
+    user_content = stub_ai_client.chat.completions.create.call_args.kwargs['messages'][1]['content']
+    assert user_content == "Tester 1: the trip is in june;Tester 3: I booked the trip flights"
+
+
+@pytest.mark.asyncio
+async def test_summarize_thread_only_sends_the_thread(stub_redis_client, stub_ai_client):
+    # Given: A chat where a thread is interleaved with other messages
+    chat_id = -100
+    _store_test_message(stub_redis_client, chat_id, 1, "who is driving on friday?")
+    _store_test_message(stub_redis_client, chat_id, 2, "what's for lunch")
+    _store_test_message(stub_redis_client, chat_id, 3, "I can drive", reply_to_message_id=1)
+    _store_test_message(stub_redis_client, chat_id, 4, "pizza")
+    _store_test_message(stub_redis_client, chat_id, 5, "great, I will bring snacks", reply_to_message_id=3)
+
+    # When: We summarize the thread of the first message
+    await summarize_thread(chat_id, 1, 50, SummaryStyle.PARAGRAPH)
+
+    # Then: Only the thread is sent, in chronological order
+    user_content = stub_ai_client.chat.completions.create.call_args.kwargs['messages'][1]['content']
+    assert user_content == "Tester 1: who is driving on friday?;Tester 3: I can drive;Tester 5: great, I will bring snacks"
+
+
+@pytest.mark.asyncio
+async def test_summarize_thread_of_a_message_without_replies(stub_redis_client, stub_ai_client):
+    # Given: A message nobody replied to
+    chat_id = -100
+    _store_test_message(stub_redis_client, chat_id, 1, "hello")
+    _store_test_message(stub_redis_client, chat_id, 2, "anyone here?")
+
+    # When: We summarize its thread
+    await summarize_thread(chat_id, 2, 50, SummaryStyle.PARAGRAPH)
+
+    # Then: We get a regular summary of the chat
+    user_content = stub_ai_client.chat.completions.create.call_args.kwargs['messages'][1]['content']
+    assert user_content == "Tester 1: hello;Tester 2: anyone here?"
+
+
+@pytest.mark.asyncio
+async def test_summarize_topics_focuses_on_one_topic(stub_redis_client, stub_ai_client):
+    # Given: A chat talking about two things at once
+    pytest.importorskip("numpy")
+    chat_id = -100
+    contents = ["dinner friday at the ramen place", "the concert tickets are on sale", "ramen for dinner",
+                "I bought concert tickets", "dinner friday works", "concert tickets for june"]
+    for message_id, content in enumerate(contents, start=1):
+        _store_test_message(stub_redis_client, chat_id, message_id, content)
+
+    # When: We summarize the topic about the concert
+    summary = await summarize_topics(chat_id, 50, SummaryStyle.PARAGRAPH, focus="concert")
+
+    # Then: Only its messages are sent, in chronological order
+    user_content = stub_ai_client.chat.completions.create.call_args.kwargs['messages'][1]['content']
+    assert user_content == ("Tester 2: the concert tickets are on sale;Tester 4: I bought concert tickets;"
+                            "Tester 6: concert tickets for june")
+    assert summary.startswith("Topic: ")
+
+
+@pytest.mark.asyncio
+async def test_summarize_topics_without_numpy(mocker, stub_redis_client, stub_ai_client):
+    # Given: Topic clustering isn't installed
+    mocker.patch('summary_pipeline.topic_clustering.is_available', return_value=False)
+    _store_test_message(stub_redis_client, -100, 1, "hello")
+
+    # When: We summarize by topic
+    summary = await summarize_topics(-100, 50, SummaryStyle.PARAGRAPH)
+
+    # Then: We get a regular summary
+    assert summary == "- Point one\n- Point two"
+
+
+@pytest.mark.asyncio
+async def test_summarize_days_reads_the_archive(monkeypatch, mocker, tmp_path, stub_redis_client, stub_ai_client):
+    # Given: An archived chat with more messages in the last days than a window, and one not archived yet
+    monkeypatch.setenv('ARCHIVE_ENABLED', 'True')
+    monkeypatch.setenv('ARCHIVE_DIR', str(tmp_path))
+    mocker.patch('summary_pipeline.MAX_MESSAGE_STORAGE', 2)
+    chat_id = -100
+    now = datetime.now(timezone.utc)
+    archived = [_test_message(1, "planning the trip a month ago", now - timedelta(days=30)),
+                _test_message(2, "the flights are booked", now - timedelta(days=2)),
+                _test_message(3, "the hotel is booked", now - timedelta(days=1))]
+    SegmentWriter(tmp_path, use_zstd=False).append(chat_id, [json.dumps(asdict(message)).encode('utf-8')
+                                                             for message in archived])
+    for message in archived:
+        store_message(stub_redis_client, chat_id, message)
+    _store_test_message(stub_redis_client, chat_id, 4, "who is driving to the airport?")
+
+    # When: We summarize the last 7 days
+    summary = await summarize_days(chat_id, 7, SummaryStyle.PARAGRAPH)
+
+    # Then: Each window of those days is summarized, and then their summaries
+    sent = [call.kwargs['messages'][1]['content'] for call in stub_ai_client.chat.completions.create.call_args_list]
+    assert sorted(sent[:2]) == ["Tester 2: the flights are booked;Tester 3: the hotel is booked",
+                                "Tester 4: who is driving to the airport?"]
+    assert sent[2].startswith("Summary of part 1: ")
+    assert summary == "- Point one\n- Point two"
+
+
+@pytest.mark.asyncio
+async def test_summarize_days_without_the_archive(monkeypatch, stub_redis_client, stub_ai_client):
+    # Given: Archiving is disabled
+    monkeypatch.setenv('ARCHIVE_ENABLED', 'False')
+    _store_test_message(stub_redis_client, -100, 1, "hello")
+
+    # When: We summarize the last days
+    summary = await summarize_days(-100, 7, SummaryStyle.PARAGRAPH)
+
+    # Then: We get a regular summary of the latest messages
+    assert summary == "- Point one\n- Point two"
+
+
+@pytest.fixture
+def stub_redis_client(mocker):
+    redis_client = FakeRedis()
+    mocker.patch('summary_pipeline.get_redis_client', return_value=redis_client)
+    return redis_client
+
+
+@pytest.fixture
+def one_summary_quota():
+    configure_quota(QuotaConfig(enabled=True, user_requests_per_window=1))
+    yield
+    quota._config = QuotaConfig()
+
+
+@pytest.fixture
+def stub_ai_client(mocker):
+    ai_client = mocker.Mock()
+    ai_client.chat.completions.create.return_value = SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content="- Point one\n- Point two"))],
+        usage=None
+    )
+    mocker.patch('llm_backends.get_ai_client', return_value=ai_client)
+    return ai_client
+
+
+def _store_test_message(redis_client: FakeRedis, chat_id: int, message_id: int, content: str,
+                        reply_to_message_id: Optional[int] = None):
+    store_message(redis_client, chat_id, _test_message(message_id, content, reply_to_message_id=reply_to_message_id))
+
+
+def _test_message(message_id: int, content: str, created_at: Optional[datetime] = None,
+                  reply_to_message_id: Optional[int] = None) -> Message:
+    return Message(
+        message_id=message_id,
+        content=content,
+        owner_id=message_id,
+        owner_name=f'Tester {message_id}',
+        created_at=(created_at or datetime.now()).isoformat(),
+        reply_to_message_id=reply_to_message_id
+    )
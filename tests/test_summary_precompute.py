@@ -0,0 +1,105 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from fakeredis import FakeRedis
+
+from message_storage import Message, store_message, get_new_message_count
+from summary_pipeline import SummaryStyle
+from summary_precompute import PrecomputeConfig, SummaryPrecomputer
+
+CHAT_ID = -100
+
+
+@pytest.mark.asyncio
+async def test_precompute_after_the_chat_goes_idle(stub_redis_client, stub_summarize_chat):
+    # Given: A chat that crossed the threshold
+    precomputer = SummaryPrecomputer(_config(message_threshold=3, idle_seconds=0.05))
+    for message_id in range(3):
+        _store_test_message(stub_redis_client, message_id)
+        precomputer.notify_message_stored(CHAT_ID)
+
+    # When: The chat is still active
+    await asyncio.sleep(0.02)
+
+    # Then: Nothing is computed yet
+    stub_summarize_chat.assert_not_called()
+
+    # When: The chat goes idle
+    await asyncio.sleep(0.1)
+
+    # Then: The summary is computed in the background
+    stub_summarize_chat.assert_awaited_once_with(CHAT_ID, 100, SummaryStyle.BULLET_POINTS, background=True)
+
+
+@pytest.mark.asyncio
+async def test_precompute_skips_chats_below_the_threshold(stub_redis_client, stub_summarize_chat):
+    # Given: A chat with fewer new messages than the threshold
+    precomputer = SummaryPrecomputer(_config(message_threshold=3))
+    _store_test_message(stub_redis_client, 1)
+
+    # Expect: Nothing to compute
+    assert not await precomputer.precompute(CHAT_ID)
+    stub_summarize_chat.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_precompute_yields_to_on_demand_summaries(stub_redis_client, stub_summarize_chat, mocker):
+    # Given: A user is waiting on a summary
+    mocker.patch('summary_precompute.on_demand_summaries_in_flight', return_value=1)
+    precomputer = SummaryPrecomputer(_config(message_threshold=1))
+    _store_test_message(stub_redis_client, 1)
+
+    # Expect: The speculative summary to wait
+    assert not await precomputer.precompute(CHAT_ID)
+    stub_summarize_chat.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_precompute_respects_the_budget(stub_redis_client, stub_summarize_chat):
+    # Given: A budget of 2 model calls
+    precomputer = SummaryPrecomputer(_config(message_threshold=1, max_model_calls_per_hour=2))
+    _store_test_message(stub_redis_client, 1)
+
+    # When: We precompute 3 times
+    results = [await precomputer.precompute(CHAT_ID) for _ in range(3)]
+
+    # Then: The third one is over budget
+    assert results == [True, True, False]
+    assert stub_summarize_chat.await_count == 2
+
+
+def test_store_message_counts_new_messages(stub_redis_client):
+    # When: We store 2 messages
+    _store_test_message(stub_redis_client, 1)
+    _store_test_message(stub_redis_client, 2)
+
+    # Then: They're counted as new
+    assert get_new_message_count(stub_redis_client, CHAT_ID) == 2
+
+
+def _config(**overrides) -> PrecomputeConfig:
+    return PrecomputeConfig(enabled=True, **overrides)
+
+
+def _store_test_message(redis_client: FakeRedis, message_id: int):
+    message = Message(
+        message_id=message_id,
+        content=f"Test message chat: {CHAT_ID}, id: {message_id}",
+        owner_id=901,
+        owner_name='Unit Tester',
+        created_at=datetime.now().isoformat()
+    )
+    store_message(redis_client, CHAT_ID, message)
+
+
+@pytest.fixture
+def stub_redis_client(mocker):
+    redis_client = FakeRedis()
+    mocker.patch('summary_precompute.get_redis_client', return_value=redis_client)
+    return redis_client
+
+
+@pytest.fixture
+def stub_summarize_chat(mocker):
+    return mocker.patch('summary_precompute.summarize_chat', return_value="- A summary")
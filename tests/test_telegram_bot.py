@@ -1,36 +1,29 @@
+import asyncio
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock, Mock
+
 import pytest
+from fakeredis import FakeRedis
+from redis.cluster import RedisCluster, ClusterNode
 from telegram.ext import CommandHandler, MessageHandler
 
-from message_storage import Message
+from message_storage import store_message, get_latest_n_messages
+from summary_cache import CachedSummary, cache_summary, get_cached_summary
+from tests.conftest import make_message
 from telegram_bot import (
-    format_message_for_openai, get_handlers, summary_handler, gist_handler, help_handler,
+    get_handlers, summary_handler, gist_handler, help_handler,
     listen_for_messages_handler, whisper_gist_handler, start_handler, get_admin_handlers,
     replay_messages_handler,
-    status_handler, broadcast_handler, whisper_handler
+    status_handler, broadcast_handler, whisper_handler, find_handler, find_gist_handler, export_handler,
+    forget_handler, edited_message_handler, stats_handler, _get_redis_status,
+    _determine_days_from_message_context
 )
 
 
-@pytest.mark.asyncio
-async def test_format_message_for_openai():
-    # Given: We have messages
-    messages = [
-        Message(message_id=1, content="Hello", owner_id=1, owner_name="Alice", created_at="2023-05-14T12:00:00Z"),
-        Message(message_id=2, content="Hi", owner_id=2, owner_name="Bob", created_at="2023-05-14T12:01:00Z"),
-        Message(message_id=3, content="Bye?", owner_id=3, owner_name="Charlie", created_at="2023-05-14T12:02:00Z")
-    ]
-
-    # When: We format the messages
-    result = await format_message_for_openai(messages)
-
-    # Then: They're formatted correctly
-    expected_result = "Alice: Hello;Bob: Hi;Charlie: Bye?"
-    assert result == expected_result, f"Expected '{expected_result}', but got '{result}'"
-
-
 def test_get_handlers():
     handlers = get_handlers()
 
-    assert len(handlers) == 7, "Expected 7 handlers"
+    assert len(handlers) == 11, "Expected 11 handlers"
 
     # Test CommandHandlers
     assert isinstance(handlers[0], CommandHandler)
@@ -57,15 +50,30 @@ def test_get_handlers():
     assert handlers[5].commands == frozenset({'whisper'})
     assert handlers[5].callback == whisper_handler
 
-    # Test MessageHandler
-    assert isinstance(handlers[6], MessageHandler)
-    assert handlers[6].callback == listen_for_messages_handler
+    assert isinstance(handlers[6], CommandHandler)
+    assert handlers[6].commands == frozenset({'find'})
+    assert handlers[6].callback == find_handler
+
+    assert isinstance(handlers[7], CommandHandler)
+    assert handlers[7].commands == frozenset({'findgist'})
+    assert handlers[7].callback == find_gist_handler
+
+    assert isinstance(handlers[8], CommandHandler)
+    assert handlers[8].commands == frozenset({'forget'})
+    assert handlers[8].callback == forget_handler
+
+    # Test MessageHandlers
+    assert isinstance(handlers[9], MessageHandler)
+    assert handlers[9].callback == listen_for_messages_handler
+
+    assert isinstance(handlers[10], MessageHandler)
+    assert handlers[10].callback == edited_message_handler
 
 
 def test_get_admin_handlers():
     handlers = get_admin_handlers()
 
-    assert len(handlers) == 3, "Expected 3 handlers"
+    assert len(handlers) == 5, "Expected 5 handlers"
 
     # Test CommandHandlers
     assert isinstance(handlers[0], CommandHandler)
@@ -79,3 +87,118 @@ def test_get_admin_handlers():
     assert isinstance(handlers[2], CommandHandler)
     assert handlers[2].commands == frozenset({'alert'})
     assert handlers[2].callback == broadcast_handler
+
+    assert isinstance(handlers[3], CommandHandler)
+    assert handlers[3].commands == frozenset({'export'})
+    assert handlers[3].callback == export_handler
+
+    assert isinstance(handlers[4], CommandHandler)
+    assert handlers[4].commands == frozenset({'stats'})
+    assert handlers[4].callback == stats_handler
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("handler", [status_handler, replay_messages_handler])
+async def test_admin_commands_refuse_other_users(mocker, handler):
+    # Given: A user who isn't an admin
+    get_usage_report = mocker.patch('telegram_bot.get_usage_report')
+    get_redis_client = mocker.patch('telegram_bot.get_redis_client')
+    update = Mock()
+    update.effective_user.id = 12345
+    update.effective_chat.id = -100
+    context = Mock()
+    context.bot.send_message = AsyncMock()
+
+    # When: They use an admin command
+    await handler(update, context)
+
+    # Then: They are refused, and nothing is read
+    assert context.bot.send_message.call_args_list[0].kwargs['text'] == "You are not allowed to access this command"
+    get_usage_report.assert_not_called()
+    get_redis_client.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_summary_is_sent_when_the_typing_indicator_fails(mocker):
+    # Given: A whitelisted chat, where the typing indicator can't be shown
+    mocker.patch('telegram_bot.is_whitelisted', return_value=True)
+    async def summarize_chat(*args, **kwargs):
+        await asyncio.sleep(0)
+        return "- A gist"
+
+    mocker.patch('telegram_bot.summarize_chat', side_effect=summarize_chat)
+    update = Mock()
+    update.effective_chat.id = -100
+    update.message.reply_to_message = None
+    context = Mock(args=[])
+    context.bot.send_message = AsyncMock()
+    context.bot.send_chat_action = AsyncMock(side_effect=RuntimeError("Timed out"))
+
+    # When: A user requests a gist
+    await gist_handler(update, context)
+
+    # Then: The indicator was attempted, and the gist is still sent
+    context.bot.send_chat_action.assert_awaited_once()
+    context.bot.send_message.assert_awaited_once_with(chat_id=-100, text="- A gist")
+
+
+@pytest.mark.asyncio
+async def test_edits_keep_the_reply_and_invalidate_the_summaries(mocker):
+    # Given: A stored reply, and a cached summary that quotes it
+    redis_client = FakeRedis()
+    mocker.patch('telegram_bot.get_redis_client', return_value=redis_client)
+    mocker.patch('telegram_bot.is_whitelisted', return_value=True)
+    store_message(redis_client, -100, make_message(1))
+    store_message(redis_client, -100, make_message(2, "see you at 8", reply_to_message_id=1))
+    cache_summary(redis_client, -100, "paragraph", 100, CachedSummary(2, "They meet at 8"))
+    scan_iter = mocker.spy(redis_client, 'scan_iter')
+
+    # When: The reply is edited
+    update = Mock(message=None)
+    update.effective_chat.id = -100
+    edited_message = update.edited_message
+    edited_message.id = 2
+    edited_message.text = "see you at 9"
+    edited_message.date = datetime(2024, 5, 14, 12, 5, tzinfo=timezone.utc)
+    edited_message.from_user.id = 7
+    edited_message.from_user.first_name = "Alice"
+    edited_message.from_user.last_name = None
+    edited_message.reply_to_message.message_id = 1
+    edited_message.reply_to_message.forum_topic_created = None
+    await edited_message_handler(update, Mock())
+
+    # Then: The edit is still a reply, and the summary is invalidated without scanning the keyspace
+    edited = get_latest_n_messages(redis_client, -100)[0]
+    assert (edited.content, edited.reply_to_message_id) == ("see you at 9", 1)
+    assert get_cached_summary(redis_client, -100, "paragraph", 100) is None
+    scan_iter.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_redis_status_of_a_cluster():
+    # Given: A cluster client, which has no single connection
+    cluster = Mock(spec=RedisCluster)
+    cluster.ping.return_value = True
+    cluster.get_nodes.return_value = [ClusterNode("10.0.0.1", 6379, server_type="primary"),
+                                      ClusterNode("10.0.0.2", 6379, server_type="replica")]
+    cluster.info.return_value = {'redis_version': '7.2.4'}
+
+    # When: We get its status
+    status = await _get_redis_status(cluster)
+
+    # Then: The nodes are listed
+    assert "10.0.0.1:6379 (primary), 10.0.0.2:6379 (replica)" in status
+    assert "7.2.4" in status
+
+
+@pytest.mark.parametrize("args, days", [
+    (["7", "days"], 7),
+    (["7", "DAYS"], 7),
+    (["7"], None),
+    (["days"], None),
+    (["200", "topic"], None),
+    ([], None),
+])
+def test_days_argument(args, days):
+    # Expect: Only a number followed by "days" to summarize whole days
+    assert _determine_days_from_message_context(Mock(args=args)) == days
@@ -0,0 +1,78 @@
+import pytest
+
+from message_storage import Message
+
+pytest.importorskip("numpy")
+
+from topic_clustering import cluster_messages, find_topic  # noqa: E402
+
+CHAT = [
+    "dinner friday at the ramen place",
+    "ramen sounds great for dinner",
+    "what time is dinner friday",
+    "ok",
+    "did anyone see the football game",
+    "that football match was wild",
+    "the referee ruined the game",
+    "concert tickets went on sale",
+    "I bought concert tickets for june",
+    "are the tickets refundable",
+    "ramen again lol dinner",
+    "football highlights tonight",
+]
+
+
+def test_groups_messages_by_topic():
+    # Given: A chat talking about dinner, football and a concert at the same time
+    messages = _messages(CHAT)
+
+    # When: We cluster the messages
+    topics = cluster_messages(messages)
+
+    # Then: Each conversation is its own topic, and the messages stay in order
+    topic_ids = {frozenset(message.message_id for message in topic.messages) for topic in topics}
+    assert topic_ids == {frozenset({0, 1, 2, 10}), frozenset({3, 4, 5, 6, 11}), frozenset({7, 8, 9})}
+    for topic in topics:
+        assert [message.message_id for message in topic.messages] == sorted(m.message_id for m in topic.messages)
+
+
+def test_clustering_is_deterministic():
+    # Expect: The same messages to give the same topics
+    assert [t.label for t in cluster_messages(_messages(CHAT))] == [t.label for t in cluster_messages(_messages(CHAT))]
+
+
+def test_few_messages_are_one_topic():
+    # Given: Too few messages to split
+    messages = _messages(["dinner friday", "the concert tickets"])
+
+    # When: We cluster the messages
+    topics = cluster_messages(messages)
+
+    # Then: They are a single topic
+    assert len(topics) == 1
+    assert len(topics[0].messages) == 2
+
+
+def test_messages_without_terms():
+    # Expect: Messages without any terms to still be one topic
+    topics = cluster_messages(_messages(["👍", "?", "k"]))
+
+    assert [len(topic.messages) for topic in topics] == [3]
+    assert topics[0].label == "other"
+
+
+def test_find_topic():
+    # Given: The topics of the chat
+    topics = cluster_messages(_messages(CHAT))
+
+    # When: We look for the concert
+    topic = find_topic(topics, "Concert")
+
+    # Then: We get the concert's messages, and nothing for a topic that wasn't discussed
+    assert {message.message_id for message in topic.messages} == {7, 8, 9}
+    assert find_topic(topics, "weather") is None
+
+
+def _messages(texts: list[str]) -> list[Message]:
+    return [Message(message_id=index, content=text, owner_id=index % 3, owner_name=f"Tester {index % 3}",
+                    created_at="2024-05-14T12:00:00") for index, text in enumerate(texts)]
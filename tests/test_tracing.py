@@ -0,0 +1,115 @@
+import json
+
+import pytest
+
+from tracing import (
+    FileSpanExporter,
+    get_current_span,
+    get_tracer,
+    start_span,
+    trace_update,
+    STATUS_ERROR
+)
+
+
+class InMemorySpanExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+    def shutdown(self):
+        pass
+
+
+@pytest.fixture
+def exporter():
+    exporter = InMemorySpanExporter()
+    get_tracer().configure(1.0, exporter)
+    yield exporter
+    get_tracer().configure(0.0, None)
+
+
+def test_child_spans_share_the_trace(exporter):
+    # Given: A traced operation with a nested storage call
+    with start_span("telegram.update", {"chat.id": -100}) as root:
+        with start_span("redis.get_latest_n_messages", {"messages.requested": 50}) as child:
+            child.set_attribute("messages.returned", 10)
+
+    # When: The spans are exported
+    get_tracer().shutdown()
+
+    # Then: The child belongs to the root's trace
+    assert [span.name for span in exporter.spans] == ["redis.get_latest_n_messages", "telegram.update"]
+    assert child.trace_id == root.trace_id
+    assert child.parent_span_id == root.span_id
+    assert child.attributes == {"messages.requested": 50, "messages.returned": 10}
+
+
+def test_failed_span_records_the_error(exporter):
+    # When: The traced operation raises
+    with pytest.raises(TimeoutError):
+        with start_span("openai.chat.completions"):
+            raise TimeoutError("too slow")
+    get_tracer().shutdown()
+
+    # Then: The span is marked as failed
+    assert exporter.spans[0].status_code == STATUS_ERROR
+    assert exporter.spans[0].attributes["exception.type"] == "TimeoutError"
+
+
+def test_unsampled_traces_are_not_recorded():
+    # Given: Tracing is disabled
+    get_tracer().configure(0.0, None)
+
+    # When: We trace an operation
+    with start_span("telegram.update") as root:
+        with start_span("redis.chat_exists") as child:
+            pass
+
+    # Then: Nothing is recorded
+    assert not root.is_recording
+    assert not child.is_recording
+    assert not get_current_span().is_recording
+
+
+@pytest.mark.asyncio
+async def test_trace_update_starts_the_root_span(exporter, mocker):
+    # Given: A traced handler
+    @trace_update
+    async def gist_handler(update, context):
+        with start_span("redis.chat_exists"):
+            return "done"
+
+    update = mocker.Mock(update_id=7)
+    update.effective_chat.id = -100
+
+    # When: It handles an update
+    result = await gist_handler(update, None)
+    get_tracer().shutdown()
+
+    # Then: The handler ran inside the update's span
+    assert result == "done"
+    assert gist_handler.__name__ == "gist_handler"
+    root = exporter.spans[-1]
+    assert root.name == "telegram.update"
+    assert root.attributes == {"handler": "gist_handler", "update.id": 7, "chat.id": -100}
+
+
+def test_file_exporter_writes_otlp_json(tmp_path):
+    # Given: A file exporter
+    trace_file = tmp_path / "traces.jsonl"
+    get_tracer().configure(1.0, FileSpanExporter(str(trace_file)))
+
+    # When: We trace an operation
+    with start_span("telegram.update", {"chat.id": -100, "sampled": True}):
+        pass
+    get_tracer().configure(0.0, None)
+
+    # Then: The file contains an OTLP payload
+    payload = json.loads(trace_file.read_text().splitlines()[0])
+    span = payload["resourceSpans"][0]["scopeSpans"][0]["spans"][0]
+    assert span["name"] == "telegram.update"
+    assert {"key": "chat.id", "value": {"intValue": "-100"}} in span["attributes"]
+    assert {"key": "sampled", "value": {"boolValue": True}} in span["attributes"]
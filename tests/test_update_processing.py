@@ -0,0 +1,103 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+from telegram import Chat, Message, Update
+
+from update_processing import ChatOrderedUpdateProcessor
+
+
+@pytest.mark.asyncio
+async def test_updates_of_a_chat_are_handled_in_order():
+    # Given: A chat whose first update is slower than the next ones
+    processor = ChatOrderedUpdateProcessor(max_concurrent_updates=8, max_queued_updates=100)
+    handled = []
+
+    async def handle(update_id: int, delay: float):
+        await asyncio.sleep(delay)
+        handled.append(update_id)
+
+    # When: Its updates are processed concurrently
+    await asyncio.gather(*(
+        processor.process_update(_update(update_id, chat_id=-100), handle(update_id, 0.03 if update_id == 1 else 0))
+        for update_id in range(1, 6)
+    ))
+
+    # Then: They are handled in the order they arrived
+    assert handled == [1, 2, 3, 4, 5]
+    assert processor.active_chats == 0
+
+
+@pytest.mark.asyncio
+async def test_a_slow_chat_doesnt_hold_up_the_others():
+    # Given: A slow update in one chat
+    processor = ChatOrderedUpdateProcessor(max_concurrent_updates=8, max_queued_updates=100)
+    handled = []
+    slow_update_started = asyncio.Event()
+    release_slow_update = asyncio.Event()
+
+    async def slow_summary():
+        slow_update_started.set()
+        await release_slow_update.wait()
+        handled.append("summary")
+
+    async def message(chat_id: int):
+        handled.append(chat_id)
+
+    slow_task = asyncio.create_task(processor.process_update(_update(1, chat_id=-100), slow_summary()))
+    await slow_update_started.wait()
+
+    # When: The other chats get messages meanwhile
+    await asyncio.gather(*(processor.process_update(_update(chat_id, chat_id=chat_id), message(chat_id))
+                           for chat_id in (-200, -300)))
+
+    # Then: They are handled without waiting for the slow one
+    assert handled == [-200, -300]
+
+    release_slow_update.set()
+    await slow_task
+    assert handled == [-200, -300, "summary"]
+
+
+@pytest.mark.asyncio
+async def test_concurrency_is_bounded():
+    # Given: At most 2 updates at once
+    processor = ChatOrderedUpdateProcessor(max_concurrent_updates=2, max_queued_updates=100)
+    running = 0
+    most_running = 0
+
+    async def handle():
+        nonlocal running, most_running
+        running += 1
+        most_running = max(most_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    # When: 10 chats get an update at the same time
+    await asyncio.gather(*(processor.process_update(_update(chat_id, chat_id=-chat_id), handle())
+                           for chat_id in range(1, 11)))
+
+    # Then: No more than 2 were handled at once
+    assert most_running == 2
+
+
+@pytest.mark.asyncio
+async def test_updates_without_a_chat_are_handled():
+    # Given: An update that doesn't belong to a chat
+    processor = ChatOrderedUpdateProcessor(max_concurrent_updates=2, max_queued_updates=100)
+    handled = []
+
+    async def handle():
+        handled.append("inline query")
+
+    # When: It is processed
+    await processor.process_update(Update(update_id=1), handle())
+
+    # Then: It is handled
+    assert handled == ["inline query"]
+
+
+def _update(update_id: int, chat_id: int) -> Update:
+    message = Message(message_id=update_id, date=datetime.now(timezone.utc),
+                      chat=Chat(id=chat_id, type=Chat.GROUP), text="Hi")
+    return Update(update_id=update_id, message=message)
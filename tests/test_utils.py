@@ -1,6 +1,6 @@
 import pytest
 
-from utils import str_to_bool
+from utils import str_to_bool, percentile
 
 
 @pytest.mark.parametrize("test_input,expected", [
@@ -50,3 +50,21 @@ def test_str_to_bool_invalid_values(test_input):
 def test_str_to_bool_non_string_input(test_input):
     with pytest.raises(AttributeError):
         str_to_bool(test_input)
+
+
+@pytest.mark.parametrize("pct,expected", [
+    (50, 5),
+    (99, 10),
+    (100, 10),
+    (0, 1)
+])
+def test_percentile(pct, expected):
+    # Given: We have samples out of order
+    samples = [7, 3, 10, 1, 5, 9, 2, 8, 4, 6]
+
+    # Expect: The nearest-rank percentile
+    assert percentile(samples, pct) == expected
+
+
+def test_percentile_no_samples():
+    assert percentile([], 99) == 0.0
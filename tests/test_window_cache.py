@@ -0,0 +1,127 @@
+import pytest
+from fakeredis import FakeRedis
+
+import window_cache
+from message_storage import store_message, get_latest_n_messages, MAX_MESSAGE_STORAGE
+from window_cache import WindowCache, configure_window_cache, handle_invalidation, invalidation_channel
+from tests.conftest import make_message
+
+CHAT_ID = -100
+
+
+def test_hot_chats_are_read_without_redis(cache, mocker):
+    # Given: A chat whose window was read once
+    redis_client = FakeRedis()
+    for message_id in range(5):
+        store_message(redis_client, CHAT_ID, make_message(message_id))
+    first_read = get_latest_n_messages(redis_client, CHAT_ID, 50)
+
+    # When: It is read again
+    lrange = mocker.spy(redis_client, 'lrange')
+    second_read = get_latest_n_messages(redis_client, CHAT_ID, 50)
+
+    # Then: The window comes from memory
+    assert second_read == first_read
+    lrange.assert_not_called()
+    assert cache.stats().hits == 1
+
+
+def test_stored_messages_update_the_cached_window(cache, mocker):
+    # Given: A cached window
+    redis_client = FakeRedis()
+    store_message(redis_client, CHAT_ID, make_message(1))
+    get_latest_n_messages(redis_client, CHAT_ID, 50)
+
+    # When: A message is stored
+    store_message(redis_client, CHAT_ID, make_message(2))
+
+    # Then: It is in the cached window, without reading Redis
+    lrange = mocker.spy(redis_client, 'lrange')
+    assert [msg.message_id for msg in get_latest_n_messages(redis_client, CHAT_ID, 50)] == [2, 1]
+    lrange.assert_not_called()
+
+
+def test_larger_windows_than_the_cached_one_are_read_from_redis(cache):
+    # Given: The cached window has the latest 2 of 5 messages
+    redis_client = FakeRedis()
+    for message_id in range(5):
+        store_message(redis_client, CHAT_ID, make_message(message_id))
+    get_latest_n_messages(redis_client, CHAT_ID, 2)
+
+    # Expect: A larger window to be read from Redis, and a smaller one from memory
+    assert [msg.message_id for msg in get_latest_n_messages(redis_client, CHAT_ID, 4)] == [4, 3, 2, 1]
+    assert [msg.message_id for msg in get_latest_n_messages(redis_client, CHAT_ID, 3)] == [4, 3, 2]
+    assert cache.stats().hits == 1
+
+
+def test_writes_from_other_replicas_invalidate_the_window(cache):
+    # Given: A cached window, and a subscription to the invalidations
+    redis_client = FakeRedis()
+    store_message(redis_client, CHAT_ID, make_message(1))
+    get_latest_n_messages(redis_client, CHAT_ID, 50)
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(invalidation_channel())
+    pubsub.get_message()
+
+    # When: Another replica stores a message, and publishes it
+    other_replica = WindowCache(max_bytes=1024 * 1024, ttl_seconds=60, max_messages=MAX_MESSAGE_STORAGE)
+    redis_client.lpush(f"{{chat:{CHAT_ID}}}:messages", '{"message_id": 2, "content": "hi", "owner_id": 1, '
+                                                          '"owner_name": "Bob", "created_at": "2024-05-14"}')
+    handle_invalidation(cache, f"{other_replica.instance_id}:{CHAT_ID}".encode())
+
+    # Then: The next read sees it
+    assert [msg.message_id for msg in get_latest_n_messages(redis_client, CHAT_ID, 50)] == [2, 1]
+
+    # And: The replica's own writes are published, but don't invalidate its own window
+    store_message(redis_client, CHAT_ID, make_message(3))
+    published = pubsub.get_message(timeout=1)
+    handle_invalidation(cache, published['data'])
+    assert cache.stats().invalidations == 1
+
+
+def test_a_window_read_before_a_write_is_not_cached(cache):
+    # Given: A window is read from Redis, then another replica writes before it is cached
+    redis_client = FakeRedis()
+    store_message(redis_client, CHAT_ID, make_message(1))
+    version = cache.version(CHAT_ID)
+    stale_window = [make_message(1)]
+    cache.invalidate(CHAT_ID)
+
+    # When: The stale window is cached
+    cache.put(CHAT_ID, stale_window, True, version)
+
+    # Then: It isn't served
+    assert cache.get(CHAT_ID, 50) is None
+
+
+def test_memory_budget_evicts_the_least_recently_used_chats():
+    # Given: A budget of about two windows
+    cache = WindowCache(max_bytes=2 * 5 * 420, ttl_seconds=60, max_messages=MAX_MESSAGE_STORAGE)
+    for chat_id in (1, 2):
+        cache.put(chat_id, [make_message(message_id) for message_id in range(5)], True, cache.version(chat_id))
+    cache.get(1, 5)
+
+    # When: A third chat is cached
+    cache.put(3, [make_message(message_id) for message_id in range(5)], True, cache.version(3))
+
+    # Then: The least recently used chat is evicted
+    assert cache.get(2, 5) is None
+    assert cache.get(1, 5) is not None
+    assert cache.stats().size_bytes <= 2 * 5 * 420
+
+
+def test_windows_expire(mocker):
+    # Expect: A window not to be served after its TTL
+    cache = WindowCache(max_bytes=1024 * 1024, ttl_seconds=60, max_messages=MAX_MESSAGE_STORAGE)
+    monotonic = mocker.patch('window_cache.time.monotonic', return_value=1000)
+    cache.put(CHAT_ID, [make_message(1)], True, cache.version(CHAT_ID))
+    assert cache.get(CHAT_ID, 1) is not None
+
+    monotonic.return_value = 1061
+    assert cache.get(CHAT_ID, 1) is None
+
+
+@pytest.fixture
+def cache(mocker):
+    mocker.patch.object(window_cache, '_window_cache', None)
+    return configure_window_cache(MAX_MESSAGE_STORAGE, max_bytes=1024 * 1024, ttl_seconds=60)